@@ -35,11 +35,12 @@
 ###############################################################################
 from __future__ import division
 
-import copy
-from itertools import imap, chain
+from itertools import imap
 import math
+import numpy
 import operator
 import scipy
+from scipy import sparse
 import tempfile
 
 from vistrails.core.data_structures.bijectivedict import Bidict
@@ -54,17 +55,6 @@ from .pipeline_utils import pipeline_bbox, pipeline_centroid
 ##############################################################################
 # EigenBase
 
-def mzeros(*args, **kwargs):
-    az = scipy.zeros(*args, dtype=float, **kwargs)
-    return scipy.matrix(az)
-
-def mones(*args, **kwargs):
-    az = scipy.ones(*args, dtype=float, **kwargs)
-    return scipy.matrix(az)
-
-#mzeros = lambda *args, **kwargs: scipy.matrix(scipy.zeros(*args, **kwargs))
-# mones = lambda *args, **kwargs: scipy.matrix(scipy.ones(*args, **kwargs))
- 
 class EigenBase(object):
 
     ##########################################################################
@@ -80,29 +70,112 @@ class EigenBase(object):
         self.init_edge_similarity()
 
     def init_vertex_similarity(self):
-        num_verts_p1 = len(self._p1.graph.vertices)
-        num_verts_p2 = len(self._p2.graph.vertices)
-        m_i = mzeros((num_verts_p1, num_verts_p2))
-        m_o = mzeros((num_verts_p1, num_verts_p2))
         def get_vertex_map(g):
             return Bidict([(v, k) for (k, v)
                            in enumerate(g.iter_vertices())])
         # vertex_maps: vertex_id to matrix index
         self._g1_vertex_map = get_vertex_map(self._p1.graph)
         self._g2_vertex_map = get_vertex_map(self._p2.graph)
-        for i in xrange(num_verts_p1):
-            for j in xrange(num_verts_p2):
-                v1_id = self._g1_vertex_map.inverse[i]
-                v2_id = self._g2_vertex_map.inverse[j]
-                (in_s8y, out_s8y) = self.compare_modules(v1_id, v2_id)
-                m_i[i,j] = in_s8y
-                m_o[i,j] = out_s8y
-        # print m_i
-        # print m_o
+        modules1 = [self._p1.modules[self._g1_vertex_map.inverse[i]]
+                    for i in xrange(len(self._g1_vertex_map))]
+        modules2 = [self._p2.modules[self._g2_vertex_map.inverse[j]]
+                    for j in xrange(len(self._g2_vertex_map))]
+        ports1 = [self.get_ports(m) for m in modules1]
+        ports2 = [self.get_ports(m) for m in modules2]
+
+        # same name -> 1.0, different names -> 0.99
+        names = {}
+        names1 = numpy.array([names.setdefault(m.name, len(names))
+                              for m in modules1], dtype=int)
+        names2 = numpy.array([names.setdefault(m.name, len(names))
+                              for m in modules2], dtype=int)
+        name_factor = numpy.where(names1[:, None] == names2[None, :],
+                                  1.0, 0.99)
+
+        m_i = self.port_similarity([p[0] for p in ports1],
+                                   [p[0] for p in ports2], False)
+        m_o = self.port_similarity([p[1] for p in ports1],
+                                   [p[1] for p in ports2], True)
+        m_i = scipy.matrix(m_i * name_factor)
+        m_o = scipy.matrix(m_o * name_factor)
         self._input_vertex_s8y = m_i
         self._output_vertex_s8y = m_o
         self._vertex_s8y = (m_i + m_o) / 2.0
 
+    @staticmethod
+    def port_similarity(ports1, ports2, weight_exact):
+        """port_similarity(ports1, ports2: list, weight_exact: bool) -> array
+        Computes compare_modules() for all pairs of modules at once, for
+        either input or output ports. ports1 and ports2 list the
+        {port name: [descriptor names]} dicts of the modules.
+
+        """
+        n1, n2 = len(ports1), len(ports2)
+        # encode ports as (name, descriptors) and descriptors as integers
+        port_codes = {}
+        desc_codes = {}
+        exact2 = []
+        hist2 = []
+        for j, ports in enumerate(ports2):
+            for name, descs in ports.iteritems():
+                exact2.append((port_codes.setdefault((name, tuple(descs)),
+                                                     len(port_codes)), j))
+                for desc in descs:
+                    hist2.append((desc_codes.setdefault(desc,
+                                                        len(desc_codes)), j))
+        rows = []        # module of each port of pipeline 1
+        weights = []     # score of an exact match
+        exact1 = []
+        counts1 = []
+        totals = numpy.zeros(n1)
+        for i, ports in enumerate(ports1):
+            for name, descs in ports.iteritems():
+                r = len(rows)
+                rows.append(i)
+                total_descs = max(len(descs), 1)
+                totals[i] += total_descs
+                weights.append(total_descs if weight_exact else 1.0)
+                code = port_codes.get((name, tuple(descs)))
+                if code is not None:
+                    exact1.append((r, code))
+                for desc in descs:
+                    code = desc_codes.get(desc)
+                    if code is not None:
+                        counts1.append((r, code))
+        nb_rows = len(rows)
+        result = numpy.empty((n1, n2))
+        result.fill(0.2)
+        if not nb_rows:
+            return result
+
+        def incidence(pairs, shape):
+            if not pairs:
+                return sparse.csr_matrix(shape)
+            pairs = numpy.array(pairs, dtype=int)
+            return sparse.coo_matrix(
+                    (numpy.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                    shape=shape).tocsr()
+        nb_ports, nb_descs = len(port_codes), len(desc_codes)
+        # has_port[c, j]: module j of pipeline 2 has port c
+        has_port = incidence(exact2, (nb_ports, n2))
+        # has_desc[d, j]: module j of pipeline 2 has a port of type d
+        has_desc = incidence(hist2, (nb_descs, n2))
+        has_desc.data[:] = 1.0
+        exact = incidence(exact1, (nb_rows, nb_ports)) * has_port
+        exact = exact.toarray() > 0
+        # number of descriptors of each port found in module j
+        found = (incidence(counts1, (nb_rows, nb_descs)) *
+                 has_desc).toarray()
+        scores = numpy.where(exact, numpy.array(weights)[:, None], found)
+        # sum the scores of the ports of each module
+        rows = numpy.array(rows, dtype=int)
+        per_module = sparse.coo_matrix(
+                (numpy.ones(nb_rows), (rows, numpy.arange(nb_rows))),
+                shape=(n1, nb_rows)).tocsr() * scores
+        has_ports = totals > 0
+        result[has_ports] = per_module[has_ports] / totals[has_ports, None]
+        return result
+
     def init_edge_similarity(self):
         def get_edge_map(g):
             itor = enumerate(imap(lambda x: x[2],
@@ -113,16 +186,32 @@ class EigenBase(object):
         self._g1_edge_map = get_edge_map(self._p1.graph)
         self._g2_edge_map = get_edge_map(self._p2.graph)
 
-        m_e = mzeros((len(self._g1_edge_map),
-                      len(self._g2_edge_map)))
-
-        for i in xrange(len(self._g1_edge_map)):
-            for j in xrange(len(self._g2_edge_map)):
-                c1_id = self._g1_edge_map.inverse[i]
-                c2_id = self._g2_edge_map.inverse[j]
-                s8y = self.compare_connections(c1_id, c2_id)
-                m_e[i, j] = s8y
-        self._edge_s8y = m_e
+        def encode(pipeline, edge_map, vertex_map, port_names):
+            sources, destinations, source_ports, dest_ports = [], [], [], []
+            for k in xrange(len(edge_map)):
+                c = pipeline.connections[edge_map.inverse[k]]
+                sources.append(vertex_map[c.sourceId])
+                destinations.append(vertex_map[c.destinationId])
+                source_ports.append(port_names.setdefault(
+                        c.source.name, len(port_names)))
+                dest_ports.append(port_names.setdefault(
+                        c.destination.name, len(port_names)))
+            return [numpy.array(a, dtype=int)
+                    for a in (sources, destinations, source_ports,
+                              dest_ports)]
+        port_names = {}
+        s1, d1, sp1, dp1 = encode(self._p1, self._g1_edge_map,
+                                  self._g1_vertex_map, port_names)
+        s2, d2, sp2, dp2 = encode(self._p2, self._g2_edge_map,
+                                  self._g2_vertex_map, port_names)
+
+        # see compare_connections()
+        out_s8y = numpy.asarray(self._output_vertex_s8y)
+        in_s8y = numpy.asarray(self._input_vertex_s8y)
+        m_e = (out_s8y[numpy.ix_(s1, s2)] + in_s8y[numpy.ix_(d1, d2)]) / 2.0
+        m_e *= ((sp1[:, None] == sp2[None, :]) &
+                (dp1[:, None] == dp2[None, :]))
+        self._edge_s8y = scipy.matrix(m_e)
 
     ##########################################################################
     # Atomic comparisons for modules and connections
@@ -323,59 +412,65 @@ class EigenPipelineSimilarity2(EigenBase):
         self.init_operator(alpha=alpha)
 
     def init_operator(self, alpha):
-        def edges(pip, v_id):
-            def from_fn(x): return (x[1], x[2])
-            def to_fn(x): return (x[0], x[2])
-            return chain(imap(from_fn,   pip.graph.iter_edges_from(v_id)),
-                         imap(to_fn,     pip.graph.iter_edges_to(v_id)))
         num_verts_p1 = len(self._p1.graph.vertices)
         num_verts_p2 = len(self._p2.graph.vertices)
         n = num_verts_p1 * num_verts_p2
-        def ix(a,b): return num_verts_p2 * a + b
-        # h is the raw substochastic matrix
-        from scipy import sparse
-        h = sparse.lil_matrix((n, n))
+
+        def incidences(pip, vertex_map, edge_map):
+            # every edge, seen from both of its endpoints
+            vertices, neighbors, edges = [], [], []
+            for (v_from, v_to, edge_id) in pip.graph.iter_all_edges():
+                v_from = vertex_map[v_from]
+                v_to = vertex_map[v_to]
+                edge_id = edge_map[edge_id]
+                vertices.extend((v_from, v_to))
+                neighbors.extend((v_to, v_from))
+                edges.extend((edge_id, edge_id))
+            return [numpy.array(a, dtype=int)
+                    for a in (vertices, neighbors, edges)]
+        v1, nb1, e1 = incidences(self._p1, self._g1_vertex_map,
+                                 self._g1_edge_map)
+        v2, nb2, e2 = incidences(self._p2, self._g2_vertex_map,
+                                 self._g2_edge_map)
+        # h is the raw substochastic matrix: the pair of modules (i, j)
+        # goes to the pair of their neighbors through each pair of edges,
+        # weighted by the similarity of the edges
+        # (i, j) has index i * num_verts_p2 + j
+        rows = (v1[:, None] * num_verts_p2 + v2[None, :]).ravel()
+        cols = (nb1[:, None] * num_verts_p2 + nb2[None, :]).ravel()
+        values = numpy.asarray(self._edge_s8y)[numpy.ix_(e1, e2)].ravel()
+        nonzero = values != 0.0
+        rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+        sums = numpy.bincount(rows, weights=values, minlength=n)
+        h = sparse.coo_matrix((values / sums[rows], (rows, cols)),
+                              shape=(n, n)).tocsr()
         # a is the dangling node vector
-        a = mzeros(n)
-        for i in xrange(num_verts_p1):
-            v1_id = self._g1_vertex_map.inverse[i]
-            for j in xrange(num_verts_p2):
-                ix_ij = ix(i,j)
-                v2_id = self._g2_vertex_map.inverse[j]
-                running_sum = 0.0
-                for (_, p1_edge) in edges(self._p1, v1_id):
-                    for (_, p2_edge) in edges(self._p2, v2_id):
-                        e1_id = self._g1_edge_map[p1_edge]
-                        e2_id = self._g2_edge_map[p2_edge]
-                        running_sum += self._edge_s8y[e1_id, e2_id]
-                if running_sum == 0.0:
-                    a[0, ix_ij] = 1.0
-                    continue
-                for (p1_v, p1_edge_id) in edges(self._p1, v1_id):
-                    for (p2_v, p2_edge_id) in edges(self._p2, v2_id):
-                        e1_id = self._g1_edge_map[p1_edge_id]
-                        e2_id = self._g2_edge_map[p2_edge_id]
-                        p1_v_id = self._g1_vertex_map[p1_v]
-                        p2_v_id = self._g2_vertex_map[p2_v]
-                        value = self._edge_s8y[e1_id, e2_id] / running_sum
-                        h[ix_ij, ix(p1_v_id, p2_v_id)] = value
+        a = (sums == 0.0).astype(float)
 
         self._alpha = alpha
         self._n = n
         self._h = h
+        # pi * h is computed as h^T * pi
+        self._ht = h.transpose().tocsr()
         self._a = a
-        self._e = mones(n) / n
+        self._e = numpy.ones(n) / n
 
     def step(self, pi_k):
-        r = pi_k * self._h * self._alpha
-        t = pi_k * self._alpha * self._a.transpose()
-        r += self._v * (t[0,0] + 1.0 - self._alpha)
+        r = self._ht.dot(pi_k) * self._alpha
+        t = self._alpha * pi_k.dot(self._a)
+        r += self._v * (t + 1.0 - self._alpha)
         return r
 
-    def solve_v(self, s8y):
-        fl = s8y.flatten()
+    def solve_v(self, s8y, tolerance=1e-7, min_steps=10, max_steps=10000):
+        """solve_v(s8y: matrix, tolerance: float, min_steps: int,
+                   max_steps: int) -> matrix
+        Power iteration, stops when the squared norm of the change is below
+        tolerance (after min_steps) or after max_steps.
+
+        """
+        fl = numpy.asarray(s8y).ravel()
         self._v = fl / fl.sum()
-        v = copy.copy(self._e)
+        v = self._e.copy()
         step = 0
         def write_current_matrix():
             f = open('%s/%s_%03d.v' % (tempfile.gettempdir(),
@@ -391,11 +486,10 @@ class EigenPipelineSimilarity2(EigenBase):
             if self._debug:
                 write_current_matrix()
             new = self.step(v)
-            r = (v-new)
-            r = scipy.multiply(r,r)
-            s = r.sum()
-            if s < 0.0000001 and step >= 10:
-                return v
+            r = v - new
+            s = r.dot(r)
+            if (s < tolerance and step >= min_steps) or step >= max_steps:
+                return scipy.matrix(v)
             step += 1
             v = new
 
@@ -476,4 +570,66 @@ class EigenPipelineSimilarity2(EigenBase):
         return inputmap, outputmap, combinedmap
 
 
-    
+##############################################################################
+
+import unittest
+
+
+class TestEigen(unittest.TestCase):
+    @staticmethod
+    def make_pipeline(modules, connections):
+        from vistrails.core.modules.basic_modules import identifier as \
+            basic_pkg
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        controller = VistrailController(Vistrail(), auto_save=False)
+        controller.change_selected_version(0)
+        ids = [controller.add_module(basic_pkg, name).id for name in modules]
+        for (src, src_port, dst, dst_port) in connections:
+            controller.add_connection(ids[src], src_port, ids[dst], dst_port)
+        return controller.current_pipeline
+
+    def make_similarity(self):
+        p1 = self.make_pipeline(
+                ['String', 'String', 'ConcatenateString', 'Integer'],
+                [(0, 'value', 2, 'str1'), (1, 'value', 2, 'str2')])
+        p2 = self.make_pipeline(
+                ['String', 'ConcatenateString', 'List', 'Float', 'String'],
+                [(0, 'value', 1, 'str2'), (4, 'value', 1, 'str1'),
+                 (1, 'value', 2, 'head'), (3, 'value', 2, 'tail')])
+        return EigenPipelineSimilarity2(p1, p2, alpha=0.15)
+
+    def test_vertex_similarity(self):
+        e = self.make_similarity()
+        for (i, v1_id) in e._g1_vertex_map.inverse.iteritems():
+            for (j, v2_id) in e._g2_vertex_map.inverse.iteritems():
+                (in_s8y, out_s8y) = e.compare_modules(v1_id, v2_id)
+                self.assertAlmostEqual(e._input_vertex_s8y[i, j], in_s8y)
+                self.assertAlmostEqual(e._output_vertex_s8y[i, j], out_s8y)
+
+    def test_edge_similarity(self):
+        e = self.make_similarity()
+        for (i, c1_id) in e._g1_edge_map.inverse.iteritems():
+            for (j, c2_id) in e._g2_edge_map.inverse.iteritems():
+                self.assertAlmostEqual(e._edge_s8y[i, j],
+                                       e.compare_connections(c1_id, c2_id))
+
+    def test_solve(self):
+        e = self.make_similarity()
+        n = len(e._p1.modules) * len(e._p2.modules)
+        self.assertEqual(e._h.shape, (n, n))
+        # rows of h are stochastic, except for the dangling pairs
+        sums = numpy.asarray(e._h.sum(1)).ravel()
+        for (s, dangling) in zip(sums, e._a):
+            self.assertAlmostEqual(s, 0.0 if dangling else 1.0)
+        (inputmap, outputmap, combinedmap) = e.solve()
+        for m in (inputmap, outputmap, combinedmap):
+            self.assertEqual(set(m.iterkeys()), set(e._p1.modules))
+            self.assertTrue(set(m.itervalues()) <= set(e._p2.modules))
+        # the concatenations match
+        c1 = [m.id for m in e._p1.modules.itervalues()
+              if m.name == 'ConcatenateString'][0]
+        c2 = [m.id for m in e._p2.modules.itervalues()
+              if m.name == 'ConcatenateString'][0]
+        self.assertEqual(combinedmap[c1], c2)
@@ -0,0 +1,295 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""On-disk, size-bounded store for module outputs, keyed by the
+subpipeline signatures computed by the Hasher.
+
+It is used by the CachedInterpreter as a second-level cache: results that
+were evicted from memory, or computed by a previous process, can be
+restored without running the upstream subpipeline again.
+"""
+
+from __future__ import division
+
+import cPickle as pickle
+import os
+import tempfile
+import time
+
+from vistrails.core import debug
+
+##############################################################################
+
+class DiskCacheEntry(object):
+    def __init__(self, signature, abs_name, time, size):
+        self.signature = signature
+        self.abs_name = abs_name
+        self.time = time
+        self.size = size
+
+
+class DiskResultCache(object):
+    """Stores pickled output dictionaries in a directory, evicting the least
+    recently used entries once `max_size` bytes are exceeded.
+
+    Entries are written to a temporary file then renamed, so a crashed
+    process never leaves a truncated entry behind; temporary files older
+    than `TMP_EXPIRY` seconds are removed when the cache is opened.
+    """
+
+    SUFFIX = '.vtcache'
+    TMP_PREFIX = 'tmp_'
+    TMP_EXPIRY = 3600
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.elements = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stores = 0
+        self.total_size = 0
+        self.init_cache()
+
+    def init_cache(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        now = time.time()
+        for fname in os.listdir(self.directory):
+            abs_name = os.path.join(self.directory, fname)
+            if fname.startswith(self.TMP_PREFIX):
+                # left behind by a process that died while writing; recent
+                # ones might still be written by another process
+                try:
+                    if os.stat(abs_name).st_mtime < now - self.TMP_EXPIRY:
+                        os.unlink(abs_name)
+                except OSError:
+                    pass
+                continue
+            if not fname.endswith(self.SUFFIX):
+                continue
+            statinfo = os.stat(abs_name)
+            signature = fname[:-len(self.SUFFIX)]
+            self.elements[signature] = DiskCacheEntry(signature, abs_name,
+                                                      statinfo.st_mtime,
+                                                      statinfo.st_size)
+            self.total_size += statinfo.st_size
+
+    def size(self):
+        return self.total_size
+
+    def stats(self):
+        """stats() -> dict
+        Returns the counters of this cache, for reporting.
+
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'stores': self.stores,
+                'entries': len(self.elements),
+                'size': self.size()}
+
+    def __contains__(self, signature):
+        return signature in self.elements
+
+    def get(self, signature):
+        """get(signature: str) -> dict or None
+        Returns the outputs stored for this signature, or None.
+
+        """
+        entry = self.elements.get(signature)
+        if entry is None:
+            self.misses += 1
+            return None
+        try:
+            with open(entry.abs_name, 'rb') as fp:
+                outputs = pickle.load(fp)
+        except Exception, e:
+            debug.warning("Could not read cached result %s" % entry.abs_name,
+                          e)
+            self.remove(signature)
+            self.misses += 1
+            return None
+        entry.time = time.time()
+        try:
+            os.utime(entry.abs_name, (entry.time, entry.time))
+        except OSError:
+            pass
+        self.hits += 1
+        return outputs
+
+    def put(self, signature, outputs):
+        """put(signature: str, outputs: dict) -> bool
+        Stores the outputs for this signature. Returns False if they couldn't
+        be pickled or don't fit in the cache.
+
+        """
+        try:
+            data = pickle.dumps(outputs, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+        size = len(data)
+        if size > self.max_size:
+            return False
+        if signature in self.elements:
+            self.remove(signature)
+        self.remove_lru(self.size() + size - self.max_size)
+
+        abs_name = os.path.join(self.directory, signature + self.SUFFIX)
+        fd, tmp_name = tempfile.mkstemp(prefix=self.TMP_PREFIX,
+                                        dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            if os.path.exists(abs_name):
+                # os.rename() doesn't replace on Windows
+                os.unlink(abs_name)
+            os.rename(tmp_name, abs_name)
+        except (IOError, OSError), e:
+            debug.warning("Could not write cached result %s" % abs_name, e)
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            return False
+        self.elements[signature] = DiskCacheEntry(signature, abs_name,
+                                                  time.time(), size)
+        self.total_size += size
+        self.stores += 1
+        return True
+
+    def remove_lru(self, nbytes):
+        """remove_lru(nbytes: int) -> None
+        Removes least recently used entries until nbytes have been freed.
+
+        """
+        if nbytes <= 0:
+            return
+        elements = sorted(self.elements.itervalues(), key=lambda e: e.time)
+        for entry in elements:
+            if nbytes <= 0:
+                break
+            nbytes -= entry.size
+            self.remove(entry.signature)
+            self.evictions += 1
+
+    def remove(self, signature):
+        entry = self.elements.pop(signature, None)
+        if entry is not None:
+            self.total_size -= entry.size
+            try:
+                os.unlink(entry.abs_name)
+            except OSError, e:
+                debug.warning("Could not remove file %s" % entry.abs_name, e)
+
+    def clear(self):
+        for signature in self.elements.keys():
+            self.remove(signature)
+
+##############################################################################
+# Unit tests
+
+import shutil
+import unittest
+
+
+class TestDiskResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_resultcache_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        cache = DiskResultCache(self.directory, 1024 * 1024)
+        self.assertIsNone(cache.get('aaaa'))
+        self.assertTrue(cache.put('aaaa', {'value': [1, 2, 3]}))
+        self.assertEqual(cache.get('aaaa'), {'value': [1, 2, 3]})
+        self.assertEqual((cache.hits, cache.misses, cache.stores), (1, 1, 1))
+
+        # A new instance sees the entries written by the previous one
+        cache = DiskResultCache(self.directory, 1024 * 1024)
+        self.assertIn('aaaa', cache)
+        self.assertEqual(cache.get('aaaa'), {'value': [1, 2, 3]})
+
+    def test_unpicklable(self):
+        cache = DiskResultCache(self.directory, 1024 * 1024)
+        self.assertFalse(cache.put('bbbb', {'value': lambda: None}))
+        self.assertNotIn('bbbb', cache)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_lru_eviction(self):
+        value = {'value': 'x' * 1000}
+        entry_size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        cache = DiskResultCache(self.directory, entry_size * 2)
+        self.assertTrue(cache.put('a', value))
+        cache.elements['a'].time -= 10
+        self.assertTrue(cache.put('b', value))
+        cache.elements['b'].time -= 5
+        # Touch 'a' so 'b' becomes the least recently used
+        cache.get('a')
+        self.assertTrue(cache.put('c', value))
+        self.assertEqual(sorted(cache.elements), ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.size(), cache.max_size)
+        self.assertFalse(cache.put('d', {'value': 'x' * 10000}))
+
+    def test_size(self):
+        cache = DiskResultCache(self.directory, 1024 * 1024)
+        cache.put('a', {'value': 'x' * 100})
+        cache.put('b', {'value': 'y' * 200})
+        cache.put('a', {'value': 'z' * 300})
+        on_disk = sum(os.path.getsize(os.path.join(self.directory, f))
+                      for f in os.listdir(self.directory))
+        self.assertEqual(cache.size(), on_disk)
+        self.assertEqual(DiskResultCache(self.directory, 1024 * 1024).size(),
+                         on_disk)
+        cache.remove('b')
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+
+    def test_stale_temporary_files(self):
+        stale = os.path.join(self.directory, DiskResultCache.TMP_PREFIX + 'a')
+        recent = os.path.join(self.directory, DiskResultCache.TMP_PREFIX + 'b')
+        for fname in (stale, recent):
+            with open(fname, 'wb') as fp:
+                fp.write('partial entry')
+        old = time.time() - DiskResultCache.TMP_EXPIRY - 10
+        os.utime(stale, (old, old))
+        cache = DiskResultCache(self.directory, 1024 * 1024)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(recent))
+        self.assertEqual(cache.size(), 0)
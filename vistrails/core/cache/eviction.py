@@ -0,0 +1,188 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Memory budget for the modules kept in the persistent pipeline of the
+cached interpreter."""
+
+from __future__ import division
+
+import sys
+
+try:
+    import numpy
+except ImportError: # pragma: no cover
+    numpy = None
+
+##############################################################################
+
+def estimate_size(value, max_depth=3):
+    """estimate_size(value: object, max_depth: int) -> int
+
+    Returns a rough estimate of the memory used by a value, in bytes.
+    Containers are followed up to max_depth levels.
+    """
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value.nbytes
+    try:
+        size = sys.getsizeof(value)
+    except TypeError:
+        size = 0
+    if max_depth > 0:
+        if isinstance(value, (list, tuple, set, frozenset)):
+            size += sum(estimate_size(v, max_depth - 1) for v in value)
+        elif isinstance(value, dict):
+            size += sum(estimate_size(k, max_depth - 1) +
+                        estimate_size(v, max_depth - 1)
+                        for k, v in value.iteritems())
+    return size
+
+
+class EvictionEntry(object):
+    def __init__(self, size, cost):
+        self.size = size
+        self.cost = cost
+        self.priority = 0.0
+        self.last_used = 0
+
+
+class CacheEvictionPolicy(object):
+    """Chooses which cached modules to drop to keep the estimated size of
+    their outputs under max_size bytes.
+
+    This is a GreedyDual-Size policy: an entry gets a priority of
+    L + cost / size when it is computed or reused, where L is the priority of
+    the last evicted entry, and the entry with the lowest priority is evicted
+    first; ties are broken by least recent use. Entries that were not used
+    recently, that are large or that are cheap to recompute go first.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = {}
+        self.inflation = 0.0
+        self.evictions = 0
+        self._clock = 0
+
+    def _touch(self, entry):
+        self._clock += 1
+        entry.last_used = self._clock
+        entry.priority = self.inflation + entry.cost / max(entry.size, 1)
+
+    def computed(self, key, size, cost):
+        """computed(key, size: int, cost: float) -> None
+        Records that an entry was computed, taking cost seconds, and now
+        uses size bytes.
+
+        """
+        entry = EvictionEntry(size, cost)
+        self._touch(entry)
+        self.entries[key] = entry
+
+    def hit(self, key):
+        """hit(key) -> bool
+        Records that an entry was reused. Returns False if it is unknown.
+
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        self._touch(entry)
+        return True
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries = {}
+        self.inflation = 0.0
+
+    def total_size(self):
+        return sum(entry.size for entry in self.entries.itervalues())
+
+    def over_budget(self):
+        return bool(self.entries) and self.total_size() > self.max_size
+
+    def choose_victim(self):
+        """choose_victim() -> key
+        Returns the entry that should be evicted next, and updates the
+        inflation value accordingly.
+
+        """
+        key, entry = min(self.entries.iteritems(),
+                         key=lambda (k, e): (e.priority, e.last_used))
+        self.inflation = entry.priority
+        return key
+
+##############################################################################
+# Unit tests
+
+import unittest
+
+
+class TestCacheEvictionPolicy(unittest.TestCase):
+    def test_estimate_size(self):
+        small = estimate_size([1, 2])
+        large = estimate_size(['x' * 10000, 2])
+        self.assertGreater(large - small, 10000)
+        if numpy is not None:
+            self.assertEqual(estimate_size(numpy.zeros(100, dtype='f8')),
+                             800)
+
+    def test_lru(self):
+        policy = CacheEvictionPolicy(100)
+        policy.computed('a', 50, 1.0)
+        policy.computed('b', 50, 1.0)
+        policy.hit('a')
+        self.assertFalse(policy.over_budget())
+        policy.computed('c', 50, 1.0)
+        self.assertTrue(policy.over_budget())
+        # Same costs, so the least recently used goes first
+        self.assertEqual(policy.choose_victim(), 'b')
+        policy.remove('b')
+        self.assertFalse(policy.over_budget())
+        # 'a' and 'c' now have the same priority; using 'a' keeps it
+        policy.hit('a')
+        self.assertEqual(policy.choose_victim(), 'c')
+
+    def test_weighted(self):
+        policy = CacheEvictionPolicy(100)
+        policy.computed('cheap', 50, 0.1)
+        policy.computed('expensive', 50, 10.0)
+        policy.computed('huge', 5000, 5.0)
+        self.assertEqual(policy.choose_victim(), 'huge')
+        policy.remove('huge')
+        policy.hit('cheap')
+        self.assertEqual(policy.choose_victim(), 'cheap')
@@ -0,0 +1,363 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Content hashing of files on disk, shared by the packages that identify
+data by its digest (persistence, persistent_archive).
+
+Digests are recorded in an index keyed on the file's path and stat
+fingerprint (size, mtime, inode), so that unchanged files are not read
+again; files that need hashing are read in large blocks by a pool of
+threads, hashlib releasing the GIL while it digests.
+"""
+
+from __future__ import division
+
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import sqlite3
+import threading
+import time
+
+from vistrails.core import debug
+
+##############################################################################
+
+def _sha1_prefix(size):
+    return ''
+
+def _git_blob_prefix(size):
+    # Same as dulwich.objects.object_header(Blob.type_num, size)
+    return 'blob %d\0' % size
+
+def _file_archive_prefix(size):
+    # Same as file_archive.hash_file()
+    return 'file\n'
+
+# Hashing methods: the digest is the SHA1 of this prefix then the contents
+HASH_METHODS = {
+    'sha1': _sha1_prefix,
+    'git-blob': _git_blob_prefix,
+    'file_archive': _file_archive_prefix,
+}
+
+def stat_fingerprint(st):
+    """Returns a string identifying a version of a file from its stat.
+    """
+    return '%d:%r:%d' % (st.st_size, st.st_mtime, st.st_ino)
+
+def hash_file_contents(filename, method='sha1', chunk_size=1 << 20):
+    """Hashes a single file, reading it in blocks of `chunk_size` bytes.
+    """
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        hasher.update(HASH_METHODS[method](os.fstat(fp.fileno()).st_size))
+        while True:
+            block = fp.read(chunk_size)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class FileHashIndex(object):
+    """Persistent map (path, method) -> (fingerprint, digest).
+
+    If `filename` is None or the database cannot be opened, the index is
+    only kept in memory.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.conn = None
+        self.entries = {}
+        self.lock = threading.Lock()
+        if filename is not None:
+            try:
+                self.conn = sqlite3.connect(filename,
+                                            check_same_thread=False)
+                self.conn.execute(
+                        "CREATE TABLE IF NOT EXISTS hashes("
+                        "path TEXT, method TEXT, fingerprint TEXT, "
+                        "digest TEXT, PRIMARY KEY (path, method))")
+                self.conn.commit()
+            except sqlite3.Error, e:
+                debug.warning("Couldn't open file hash index %s" % filename,
+                              e)
+                self.conn = None
+
+    def get(self, path, method, fingerprint):
+        """Returns the recorded digest, or None if the file changed.
+        """
+        with self.lock:
+            entry = self.entries.get((path, method))
+            if entry is None and self.conn is not None:
+                entry = self.conn.execute(
+                        "SELECT fingerprint, digest FROM hashes "
+                        "WHERE path=? AND method=?",
+                        (path, method)).fetchone()
+                if entry is not None:
+                    entry = tuple(str(e) for e in entry)
+                    self.entries[(path, method)] = entry
+        if entry is not None and entry[0] == fingerprint:
+            return entry[1]
+        return None
+
+    def put_many(self, records):
+        """Records a list of (path, method, fingerprint, digest).
+        """
+        if not records:
+            return
+        with self.lock:
+            for path, method, fingerprint, digest in records:
+                self.entries[(path, method)] = (fingerprint, digest)
+            if self.conn is not None:
+                try:
+                    self.conn.executemany(
+                            "INSERT OR REPLACE INTO hashes VALUES "
+                            "(?, ?, ?, ?)",
+                            records)
+                    self.conn.commit()
+                except sqlite3.Error, e:
+                    debug.warning("Couldn't update file hash index", e)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM hashes")
+                self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class FileHasher(object):
+    """Hashes batches of files, using the index to skip unchanged ones.
+    """
+
+    # Files modified more recently than this are not recorded in the index,
+    # as another write in the same mtime tick would go unnoticed
+    RACY_DELAY = 2.0
+
+    def __init__(self, index=None, threads=None, chunk_size=1 << 20):
+        if index is None:
+            index = FileHashIndex()
+        self.index = index
+        if threads is None:
+            try:
+                threads = min(multiprocessing.cpu_count(), 8)
+            except NotImplementedError:
+                threads = 1
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.hashed = 0
+
+    def hash_files(self, filenames, method='sha1'):
+        """Returns a dict mapping each of `filenames` to its digest.
+        """
+        if method not in HASH_METHODS:
+            raise ValueError("Unknown hashing method %r" % method)
+        results = {}
+        todo = []
+        for filename in filenames:
+            if filename in results:
+                continue
+            path = os.path.abspath(filename)
+            st = os.stat(path)
+            fingerprint = stat_fingerprint(st)
+            digest = self.index.get(path, method, fingerprint)
+            if digest is not None:
+                results[filename] = digest
+            else:
+                results[filename] = None
+                todo.append((filename, path, fingerprint, st.st_mtime))
+
+        if not todo:
+            return results
+
+        def work(item):
+            return hash_file_contents(item[1], method, self.chunk_size)
+        if self.threads > 1 and len(todo) > 1:
+            pool = ThreadPool(min(self.threads, len(todo)))
+            try:
+                digests = pool.map(work, todo)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            digests = map(work, todo)
+        self.hashed += len(todo)
+
+        now = time.time()
+        records = []
+        for (filename, path, fingerprint, mtime), digest in zip(todo,
+                                                                 digests):
+            results[filename] = digest
+            if now - mtime >= self.RACY_DELAY:
+                records.append((path, method, fingerprint, digest))
+        self.index.put_many(records)
+        return results
+
+    def hash_file(self, filename, method='sha1'):
+        return self.hash_files([filename], method)[filename]
+
+    def get_digest(self, key, method, fingerprint, mtime, compute):
+        """Memoizes an arbitrary digest in the index.
+
+        `compute` is only called if no digest was recorded under `key` for
+        this `fingerprint`. `mtime` is the most recent modification time of
+        the files the fingerprint was built from; as in hash_files(), the
+        digest is not recorded if that is too recent.
+        """
+        key = os.path.abspath(key)
+        digest = self.index.get(key, method, fingerprint)
+        if digest is None:
+            digest = compute()
+            if time.time() - mtime >= self.RACY_DELAY:
+                self.index.put_many([(key, method, fingerprint, digest)])
+        return digest
+
+
+_file_hasher = None
+_file_hasher_lock = threading.Lock()
+
+def get_file_hasher():
+    """Returns the shared FileHasher, indexed in the .vistrails directory.
+    """
+    global _file_hasher
+    with _file_hasher_lock:
+        if _file_hasher is None:
+            filename = None
+            try:
+                from vistrails.core.system import current_dot_vistrails
+                dot_vistrails = current_dot_vistrails()
+                if dot_vistrails and os.path.isdir(dot_vistrails):
+                    filename = os.path.join(dot_vistrails, 'file_hashes.db')
+            except Exception:
+                pass
+            _file_hasher = FileHasher(FileHashIndex(filename))
+        return _file_hasher
+
+##############################################################################
+
+import unittest
+
+class TestFileHasher(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix='vt_filehash_')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def make_file(self, name, contents, age=60):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as fp:
+            fp.write(contents)
+        mtime = time.time() - age
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_methods(self):
+        filename = self.make_file('a', 'hello')
+        hasher = FileHasher()
+        self.assertEqual(hasher.hash_file(filename),
+                         hashlib.sha1('hello').hexdigest())
+        self.assertEqual(hasher.hash_file(filename, 'git-blob'),
+                         hashlib.sha1('blob 5\0hello').hexdigest())
+        self.assertEqual(hasher.hash_file(filename, 'file_archive'),
+                         hashlib.sha1('file\nhello').hexdigest())
+        with self.assertRaises(ValueError):
+            hasher.hash_file(filename, 'md5')
+
+    def test_parallel(self):
+        filenames = [self.make_file('f%d' % i, 'contents %d' % i * 1000)
+                     for i in xrange(20)]
+        hasher = FileHasher(threads=4, chunk_size=100)
+        digests = hasher.hash_files(filenames)
+        self.assertEqual(len(digests), 20)
+        for i, filename in enumerate(filenames):
+            self.assertEqual(digests[filename],
+                             hashlib.sha1('contents %d' % i * 1000)
+                             .hexdigest())
+
+    def test_index(self):
+        db = os.path.join(self.directory, 'index.db')
+        filename = self.make_file('a', 'first')
+        hasher = FileHasher(FileHashIndex(db))
+        digest = hasher.hash_file(filename)
+        hasher.hash_file(filename)
+        self.assertEqual(hasher.hashed, 1)
+        hasher.index.close()
+
+        # Persisted across instances
+        hasher = FileHasher(FileHashIndex(db))
+        self.assertEqual(hasher.hash_file(filename), digest)
+        self.assertEqual(hasher.hashed, 0)
+
+        # Changed file is hashed again
+        self.make_file('a', 'second', age=30)
+        self.assertEqual(hasher.hash_file(filename),
+                         hashlib.sha1('second').hexdigest())
+        self.assertEqual(hasher.hashed, 1)
+        hasher.index.close()
+
+    def test_racy(self):
+        filename = self.make_file('a', 'new', age=0)
+        hasher = FileHasher()
+        hasher.hash_file(filename)
+        hasher.hash_file(filename)
+        self.assertEqual(hasher.hashed, 2)
+
+    def test_racy_digest(self):
+        hasher = FileHasher()
+        computed = []
+        def compute():
+            computed.append(1)
+            return 'digest'
+        now = time.time()
+        hasher.get_digest('key', 'test', 'fp', now, compute)
+        hasher.get_digest('key', 'test', 'fp', now, compute)
+        self.assertEqual(len(computed), 2)
+        hasher.get_digest('key', 'test', 'fp', now - 60, compute)
+        hasher.get_digest('key', 'test', 'fp', now - 60, compute)
+        self.assertEqual(len(computed), 3)
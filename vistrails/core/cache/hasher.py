@@ -37,7 +37,8 @@
 from __future__ import division
 
 import unittest
-from vistrails.core.cache.utils import hash_list
+import weakref
+from vistrails.core.cache.utils import hash_list, hash_sorted
 
 try:
     import hashlib
@@ -48,7 +49,57 @@ except ImportError:
 
 ##############################################################################
 
+def _cache_signature(obj, sig, children=(), parts=()):
+    """Caches sig on obj if obj and its children support it, making obj the
+    owner of its children (whose signatures went into sig) and of its parts
+    (which went into sig otherwise) so that changing them drops sig.
+
+    Returns whether sig was cached.
+
+    """
+    if not hasattr(obj, '_cached_signature'):
+        return False
+    for child in children:
+        if getattr(child, '_cached_signature', None) is None:
+            # not cacheable, or hashed through a custom hasher
+            return False
+    for part in parts:
+        if not hasattr(part, '_signature_owner'):
+            return False
+    owner = weakref.ref(obj)
+    for child in children:
+        child._signature_owner = owner
+    for part in parts:
+        part._signature_owner = owner
+    obj._cached_signature = sig
+    return True
+
+def _cached_signature(obj):
+    return getattr(obj, '_cached_signature', None)
+
 class Hasher(object):
+    """Computes the signatures used by the cache.
+
+    The signatures of parameters, functions, control parameters, port specs
+    and modules are cached on the objects. Their setters, and the methods
+    adding or removing children, call clear_signature(), which drops the
+    cached signature of the object and of the objects containing it. Objects
+    hashed through a custom constant hasher, and their containers, are
+    never cached, since these hashers can depend on more than the object
+    (e.g. the modification time of a file).
+
+    """
+
+    @staticmethod
+    def clear_signature(obj):
+        """clear_signature(obj) -> None
+        Drops the signature cached on obj and on the objects containing it.
+
+        """
+        while obj is not None:
+            obj._cached_signature = None
+            owner = obj._signature_owner
+            obj = owner() if owner is not None else None
 
     @staticmethod
     def parameter_signature(p, constant_hasher_map={}):
@@ -56,7 +107,8 @@ class Hasher(object):
         custom_hasher = constant_hasher_map.get(k, None)
         if custom_hasher:
             return custom_hasher(p)
-        else:
+        sig = _cached_signature(p)
+        if sig is None:
             hasher = sha_hash()
             u = hasher.update
             u(p.type)
@@ -65,26 +117,44 @@ class Hasher(object):
             u(p.strValue)
             u(p.name)
             u(p.evaluatedStrValue)
-            return hasher.digest()
+            sig = hasher.digest()
+            _cache_signature(p, sig)
+        return sig
 
     @staticmethod
     def function_signature(function, constant_hasher_map={}):
+        sig = _cached_signature(function)
+        if sig is not None:
+            return sig
+        params = function.params
+        param_sigs = []
+        custom = False
+        for p in params:
+            if constant_hasher_map.get((p.identifier, p.type, p.namespace)):
+                custom = True
+            param_sigs.append(Hasher.parameter_signature(p,
+                                                         constant_hasher_map))
         hasher = sha_hash()
         u = hasher.update
         u(function.name)
         u(function.returnType)
-        u(hash_list(function.params,
-                    Hasher.parameter_signature,
-                    constant_hasher_map))
-        return hasher.digest()
+        u(hash_sorted(param_sigs))
+        sig = hasher.digest()
+        if not custom:
+            _cache_signature(function, sig, params)
+        return sig
 
     @staticmethod
     def control_param_signature(control_param, constant_hasher_map={}):
-        hasher = sha_hash()
-        u = hasher.update
-        u(control_param.name)
-        u(control_param.value)
-        return hasher.digest()
+        sig = _cached_signature(control_param)
+        if sig is None:
+            hasher = sha_hash()
+            u = hasher.update
+            u(control_param.name)
+            u(control_param.value)
+            sig = hasher.digest()
+            _cache_signature(control_param, sig)
+        return sig
 
     @staticmethod
     def connection_signature(c):
@@ -96,13 +166,18 @@ class Hasher(object):
 
     @staticmethod
     def port_spec_signature(ps, constant_hasher_map={}):
-        hasher = sha_hash()
-        u = hasher.update
-        u(ps.type)
-        u(ps.name)
-        u(ps.sigstring)
-        u('%d' % ps.depth)
-        return hasher.digest()
+        sig = _cached_signature(ps)
+        if sig is None:
+            hasher = sha_hash()
+            u = hasher.update
+            u(ps.type)
+            u(ps.name)
+            u(ps.sigstring)
+            u('%d' % ps.depth)
+            sig = hasher.digest()
+            # the items make up the sigstring
+            _cache_signature(ps, sig, parts=ps.port_spec_items)
+        return sig
 
     @staticmethod
     def connection_subpipeline_signature(c, source_sig, dest_sig):
@@ -119,20 +194,31 @@ class Hasher(object):
 
     @staticmethod
     def module_signature(obj, constant_hasher_map={}):
+        descriptor = obj.module_descriptor
+        sig = _cached_signature(obj)
+        if sig is not None and obj._signature_descriptor is descriptor:
+            return sig
         hasher = sha_hash()
         u = hasher.update
-        u(obj.module_descriptor.name)
-        u(obj.module_descriptor.package)
-        u(obj.module_descriptor.namespace or '')
-        u(obj.module_descriptor.package_version or '')
-        u(obj.module_descriptor.version or '')
-        u(hash_list(obj.functions, Hasher.function_signature,
+        u(descriptor.name)
+        u(descriptor.package)
+        u(descriptor.namespace or '')
+        u(descriptor.package_version or '')
+        u(descriptor.version or '')
+        functions = obj.functions
+        control_parameters = obj.control_parameters
+        port_specs = obj.port_spec_list
+        u(hash_list(functions, Hasher.function_signature,
                     constant_hasher_map))
-        u(hash_list(obj.control_parameters, Hasher.control_param_signature,
+        u(hash_list(control_parameters, Hasher.control_param_signature,
                     constant_hasher_map))
-        u(hash_list(obj.port_spec_list, Hasher.port_spec_signature,
+        u(hash_list(port_specs, Hasher.port_spec_signature,
                     constant_hasher_map))
-        return hasher.digest()
+        sig = hasher.digest()
+        if _cache_signature(obj, sig,
+                            functions + control_parameters + port_specs):
+            obj._signature_descriptor = descriptor
+        return sig
 
     @staticmethod
     def subpipeline_signature(module_sig, upstream_sigs):
@@ -191,3 +277,91 @@ class TestCacheHash(unittest.TestCase):
         api.add_connection(ps.id, 'b', so.id, 'value')
         # will fail if outputportspec is not hashed and cache is reused
         self.assertEqual(c.execute_current_workflow()[0][0].errors, {})
+
+    def make_module(self):
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.module_function import ModuleFunction
+        from vistrails.core.vistrail.module_param import ModuleParam
+        param = ModuleParam(type='String', val='a')
+        function = ModuleFunction(name='value', parameters=[param])
+        module = Module(id=0, name='String',
+                        package=get_vistrails_basic_pkg_id(),
+                        functions=[function])
+        return module, function, param
+
+    def test_param_change(self):
+        module, function, param = self.make_module()
+        sig = Hasher.module_signature(module)
+        param.strValue = 'b'
+        self.assertNotEqual(Hasher.module_signature(module), sig)
+        param.strValue = 'a'
+        self.assertEqual(Hasher.module_signature(module), sig)
+        param.type = 'Integer'
+        self.assertNotEqual(Hasher.module_signature(module), sig)
+
+    def test_function_change(self):
+        from vistrails.core.vistrail.module_function import ModuleFunction
+        module, function, param = self.make_module()
+        sig = Hasher.module_signature(module)
+        module.delete_function_by_real_id(function.real_id)
+        self.assertNotEqual(Hasher.module_signature(module), sig)
+        module.add_function(function)
+        self.assertEqual(Hasher.module_signature(module), sig)
+        module.add_function(ModuleFunction(id=1, name='other'))
+        self.assertNotEqual(Hasher.module_signature(module), sig)
+
+    def test_port_spec_change(self):
+        from vistrails.core.vistrail.port_spec import PortSpec
+        module, function, param = self.make_module()
+        sig = Hasher.module_signature(module)
+        spec = PortSpec(id=0, name='a', type='output',
+                        sigstring='org.vistrails.vistrails.basic:Integer')
+        module.add_port_spec(spec)
+        sig2 = Hasher.module_signature(module)
+        self.assertNotEqual(sig2, sig)
+        spec.port_spec_items[0].module = 'Float'
+        self.assertNotEqual(Hasher.module_signature(module), sig2)
+        module.delete_port_spec(spec)
+        self.assertEqual(Hasher.module_signature(module), sig)
+
+    def test_unchanged_not_rehashed(self):
+        global sha_hash
+        module, function, param = self.make_module()
+        sig = Hasher.module_signature(module)
+        old_sha_hash = sha_hash
+        def fail():
+            self.fail("unchanged module was rehashed")
+        sha_hash = fail
+        try:
+            self.assertEqual(Hasher.module_signature(module), sig)
+        finally:
+            sha_hash = old_sha_hash
+
+    def test_custom_hasher_not_cached(self):
+        module, function, param = self.make_module()
+        sigs = iter(['1', '2'])
+        chm = {param.spec_tuple: lambda p: next(sigs)}
+        self.assertNotEqual(Hasher.module_signature(module, chm),
+                            Hasher.module_signature(module, chm))
+
+    def test_pipeline_change(self):
+        """Changes made through actions drop the cached signatures"""
+        from vistrails.core.modules.module_registry import get_module_registry
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+        controller = VistrailController(Vistrail())
+        module = controller.add_module(get_vistrails_basic_pkg_id(), 'String')
+        registry = get_module_registry()
+        def signature():
+            pipeline = controller.current_pipeline
+            return registry.module_signature(pipeline,
+                                             pipeline.modules[module.id])
+        sig = signature()
+        controller.update_function(module, 'value', ['a'])
+        sig_a = signature()
+        self.assertNotEqual(sig_a, sig)
+        controller.update_function(controller.current_pipeline.modules[
+                                       module.id], 'value', ['b'])
+        self.assertNotEqual(signature(), sig_a)
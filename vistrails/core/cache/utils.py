@@ -47,8 +47,11 @@ except ImportError:
 ##############################################################################
 
 def hash_list(lst, hasher_f, constant_hasher_map={}):
+    return hash_sorted([hasher_f(el, constant_hasher_map) for el in lst])
+
+def hash_sorted(sigs):
+    """Hashes a sequence of signatures, ignoring their order."""
     hasher = sha_hash()
-    hash_l = [hasher_f(el, constant_hasher_map) for el in lst]
-    hash_l.sort()
-    for hel in hash_l: hasher.update(hel)
+    for sig in sorted(sigs):
+        hasher.update(sig)
     return hasher.digest()
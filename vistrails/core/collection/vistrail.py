@@ -38,6 +38,7 @@ from __future__ import division
 import copy
 import locale
 import sys
+import unittest
 
 from vistrails.core.thumbnails import ThumbnailCache
 from vistrails.core import debug
@@ -347,16 +348,20 @@ class VistrailEntity(Entity):
                 #             self.add_parameter_exploration_entity(pe)
                 
             # read persisted log entries
-            log = None
+            added = []
             try:
-                log = vistrail.get_persisted_log()
+                for wf_exec in vistrail.iter_persisted_workflow_execs():
+                    added.append((wf_exec.parent_version,
+                                  self.add_wf_exec_entity(wf_exec, False)))
             except Exception, e:
                 debug.unexpected_exception(e)
                 debug.critical("Failed to read log", debug.format_exc())
-                
-            if log is not None:
-                for wf_exec in log.workflow_execs:
-                    self.add_wf_exec_entity(wf_exec, False)
+                # remove the entities of the executions read before the error
+                for version_id, (entity, wf_entity) in reversed(added):
+                    entity.parent.children.remove(entity)
+                    if wf_entity is not None:
+                        self.children.remove(wf_entity)
+                        del self.wf_entity_map[version_id]
 
             # read unpersisted log entries
             if vistrail.log is not None:
@@ -528,3 +533,33 @@ class VistrailEntity(Entity):
         for child in self.get_children():
             if child.match(search):
                 return True
+
+
+class TestVistrailEntity(unittest.TestCase):
+    def test_log_read_error(self):
+        """ entities of a log that fails to read are not kept """
+        import os
+        from vistrails.core.db.io import load_vistrail
+        from vistrails.core.db.locator import FileLocator
+
+        locator = FileLocator(os.path.join(
+                vistrails.core.system.vistrails_root_directory(),
+                'tests/resources/spx_loop.vt'))
+        vistrail = load_vistrail(locator)[0]
+        entity = VistrailEntity(vistrail)
+        wf_execs = sum(len(wf_entity.children)
+                       for wf_entity in entity.wf_entity_map.itervalues())
+        self.assertEqual(wf_execs, 109)
+
+        def iter_failing(iter_wf_execs=vistrail.iter_persisted_workflow_execs):
+            for i, wf_exec in enumerate(iter_wf_execs()):
+                if i == 50:
+                    raise ValueError("corrupted log")
+                yield wf_exec
+        vistrail.iter_persisted_workflow_execs = iter_failing
+        entity = VistrailEntity(vistrail)
+        self.assertEqual(sum(len(wf_entity.children)
+                             for wf_entity in entity.wf_entity_map.itervalues()),
+                         0)
+        self.assertEqual(len(entity.wf_entity_map),
+                         len(vistrail.get_tagMap()))
@@ -65,7 +65,9 @@ _simple_documentation = """
 autoConnect: Automatically connect dragged in modules
 autoSave: Automatically save backup vistrails every two minutes
 batch: Run in batch mode instead of interactive mode
+batchProcesses: Number of processes used to run workflows in batch mode
 cache: Cache previous results so they may be used in future computations
+cacheMemoryLimit: Memory available to cached results (MB, 0 for no limit)
 customVersionColors: Allow setting custom colors for versions
 dataDir: Default data directory
 db: The name for the database to load the vistrail from
@@ -78,6 +80,7 @@ enablePackagesSilently: Automatically enable packages when needed
 errorLog: Write errors to a log file
 NoExecute: Do not execute specified workflows
 executionLog: Track execution provenance when running workflows
+executionThreads: Number of threads used to run independent modules
 fileDir: Default vistrail directory
 fixedCustomVersionColorSaturation: Don't vary custom color with age
 fixedSpreadsheetCells: Draw spreadsheet cells at a fixed size
@@ -85,6 +88,7 @@ graphsAsPdf: Generate graphs in PDF format instead of images
 handlerDontAsk: Do not ask about extension handling at startup
 hideUpgrades: Don't show upgrade nodes in the version tree
 host: The hostname for the database to load the vistrail from
+indexExecutionLogs: Store an index of the execution log in .vt files
 installBundles: Install missing Python dependencies
 installBundlesWithPip: Use pip to install missing Python dependencies
 isInServerMode: Indicates whether VisTrails is being run as a server
@@ -111,12 +115,18 @@ enableUsage: Enable sending anonymous usage statistics
 disableUsage: Disable sending anonymous usage statistics
 repositoryHTTPURL: Remote package repository URL
 repositoryLocalPath: Local package repository directory
+resultCache.cacheDir: Persistent result cache directory
+resultCache.cacheSize: Persistent result cache size (MB)
+resultCache.enabled: Store module results on disk to reuse them across sessions
 rootDirectory: Directory that contains the VisTrails source code
 rpcConfig: Config file for server connection options
 rpcInstances: Number of other instances that vistrails should start
 rpcLogFile: Log file for XML RPC server
 rpcPort: Port where this xml rpc server will work
 rpcServer: Hostname or ip address where this xml rpc server will work
+saveCompactVistrails: Store actions in .vt files so they can be read on demand
+saveIncrementally: Only append changes to .vt files when saving
+saveVersionSnapshots: Store version snapshots in .vt files to speed up loading
 shell.fontFace: Console Font
 shell.fontSize: Console Font Size
 showConnectionErrors: Show error when input value doesn't match type during execution
@@ -165,10 +175,24 @@ batch: Boolean
 
     Run vistrails in batch mode instead of interactive mode.
 
+batchProcesses: Integer
+
+    The number of worker processes used to run the workflows given on the
+    command-line concurrently. 0 or 1 runs them one after the other, a
+    negative value uses one process per CPU. This is only used when running
+    without the GUI.
+
 cache: Boolean
 
     Cache previous results so they may be used in future computations.
 
+cacheMemoryLimit: Integer
+
+    The estimated amount of memory (in MB) that the results of cached
+    modules may use. Past this limit, the results that were used least
+    recently, are the largest or the cheapest to recompute are discarded.
+    0 means no limit.
+
 customVersionColors: Boolean
 
     Allow setting custom colors for versions, and display these colors in the
@@ -222,6 +246,12 @@ executionLog: Boolean
 
     Track execution provenance when running workflows.
 
+executionThreads: Integer
+
+    The number of threads used to run modules that don't depend on each
+    other concurrently. 0 or 1 runs modules one after the other. This is
+    only used when running without the GUI.
+
 fileDir: Path
 
     The location that VisTrails uses as a default directory for
@@ -252,6 +282,13 @@ host: URL
 
     The hostname for the database to load the vistrail from.
 
+indexExecutionLogs: Boolean
+
+    Whether to store an index of the execution log in .vt files, so
+    that tools looking for executions by version or module only read
+    the matching executions. Older versions of VisTrails cannot open
+    files that contain this index.
+
 installBundles: Boolean
 
     Automatically try to install missing Python dependencies.
@@ -395,6 +432,24 @@ repositoryLocalPath: Path
 
     Path used to locate packages available to be installed.
 
+resultCache: ConfigurationObject
+
+    Settings for the persistent, on-disk cache of module results.
+
+resultCache.cacheDir: Path
+
+    The directory where cached module results are stored.
+
+resultCache.cacheSize: Integer
+
+    The maximum size (in MB) of the result cache. The least recently used
+    results are removed when it is exceeded.
+
+resultCache.enabled: Boolean
+
+    Whether to store the results of cacheable modules on disk so they can be
+    reused by later sessions instead of being recomputed.
+
 reviewMode: Boolean
 
     *Deprecated* Used to interactively export a pipeline.
@@ -427,6 +482,28 @@ runningJobsList: String
 
     Storage for recent vistrails; users should not edit.
 
+saveCompactVistrails: Boolean
+
+    Whether to store the actions in .vt files in a compact format,
+    where the version tree is indexed separately from the operations
+    so that these are only read when needed. This makes large
+    vistrails much faster to open. Older versions of VisTrails cannot
+    open these files.
+
+saveIncrementally: Boolean
+
+    Whether saving a .vt file should only append what changed since it
+    was last saved to a journal inside the file, instead of writing it
+    entirely. The file is rewritten when the journal grows too large.
+    Older versions of VisTrails cannot open files that contain a
+    journal.
+
+saveVersionSnapshots: Boolean
+
+    Whether to store snapshots of the version tree in .vt files so
+    that workflows can be materialized faster after loading. Older
+    versions of VisTrails cannot open files that contain snapshots.
+
 shell: ConfigurationObject
 
     Settings for the appearance of the VisTrails console.
@@ -698,7 +775,18 @@ base_config = {
     [ConfigField('autoSave', True, bool, ConfigType.ON_OFF),
      ConfigField('dbDefault', False, bool, ConfigType.ON_OFF),
      ConfigField('cache', True, bool, ConfigType.ON_OFF),
+     ConfigField('cacheMemoryLimit', 0, int),
+     ConfigFieldParent('resultCache',
+        [ConfigField('enabled', False, bool, ConfigType.ON_OFF),
+         ConfigField('cacheDir', "resultcache", ConfigPath),
+         ConfigField('cacheSize', 1024, int)]),
      ConfigField('stopOnError', True, bool, ConfigType.ON_OFF),
+     ConfigField('executionThreads', 0, int),
+     ConfigField('batchProcesses', 0, int),
+     ConfigField('saveVersionSnapshots', False, bool, ConfigType.ON_OFF),
+     ConfigField('saveCompactVistrails', False, bool, ConfigType.ON_OFF),
+     ConfigField('saveIncrementally', False, bool, ConfigType.ON_OFF),
+     ConfigField('indexExecutionLogs', False, bool, ConfigType.ON_OFF),
      ConfigField('executionLog', True, bool, ConfigType.ON_OFF),
      ConfigField('errorLog', True, bool, ConfigType.ON_OFF),
      ConfigField('defaultFileType', system.vistrails_default_file_type(), str,
@@ -35,20 +35,26 @@
 ###############################################################################
 """ Module used when running  vistrails uninteractively """
 from __future__ import absolute_import, division
+from itertools import izip
+import multiprocessing
 import os.path
+import time
 import unittest
 
 from vistrails.core.application import is_running_gui
 from vistrails.core.configuration import get_vistrails_configuration
 import vistrails.core.interpreter.default
 import vistrails.core.db.io
-from vistrails.core.db.io import load_vistrail
+from vistrails.core.db.io import load_vistrail, serialize, unserialize
 from vistrails.core.db.locator import XMLFileLocator, ZIPFileLocator
 from vistrails.core import debug
 import vistrails.core.interpreter.cached
-from vistrails.core.vistrail.job import Workflow as JobWorkflow
+from vistrails.core.log.workflow_exec import WorkflowExec
+from vistrails.core.param_explore import ParameterExplorationRunner, \
+    write_exploration_results
+from vistrails.core.vistrail.job import JobMonitor, Workflow as JobWorkflow
 import vistrails.core.vistrail.pipeline
-from vistrails.core.utils import VistrailsInternalError
+from vistrails.core.utils import InstanceObject, VistrailsInternalError
 from vistrails.core.vistrail.controller import VistrailController
 import vistrails.core.packagemanager
 import vistrails.core.system
@@ -58,24 +64,32 @@ import vistrails.db
 
 ################################################################################
 
-def run_and_get_results(w_list, parameters='',
-                        update_vistrail=True, extra_info=None,
-                        reason='Console Mode Execution'):
-    """run_and_get_results(w_list: list of (locator, version), parameters: str,
-                           output_dir:str, update_vistrail: boolean,
-                           extra_info:dict)
-    Run all workflows in w_list, and returns an interpreter result object.
-    version can be a tag name or a version id.
-    
+def _prepare_batch(w_list, parameters, update_vistrail, extra_info):
+    """_prepare_batch(w_list: list of (locator, version), parameters: str,
+                      update_vistrail: bool, extra_info: dict) -> list
+    Loads each vistrail in w_list once and selects the versions to run.
+
+    Returns a list of (locator, workflow, controller, version,
+    upgraded_version, aliases, params) tuples, in the order of w_list.
+    Upgrades are performed here so that the versions can then be executed in
+    any order, or in other processes.
+
     """
     elements = parameters.split("$&$")
     aliases = {}
     params = []
-    result = []
+    controllers = {}
+    entries = []
     for locator, workflow in w_list:
-        (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
-        controller = VistrailController(v, locator, abstractions, thumbnails,
-                                        mashups, auto_save=update_vistrail)
+        try:
+            controller = controllers[locator]
+        except KeyError:
+            (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
+            controller = VistrailController(v, locator, abstractions,
+                                            thumbnails, mashups,
+                                            auto_save=update_vistrail)
+            controllers[locator] = controller
+        v = controller.vistrail
         if isinstance(workflow, basestring):
             version = v.get_version_number(workflow)
         elif isinstance(workflow, (int, long)):
@@ -97,64 +111,238 @@ def run_and_get_results(w_list, parameters='',
                     aliases[key] = value
                 elif 'mashup_id' in extra_info:
                     # new-style mashups can have aliases not existing in pipeline
-                    for mashuptrail in mashups:
+                    for mashuptrail in controller._mashups:
                         if mashuptrail.vtVersion == version:
                             mashup = mashuptrail.getMashup(extra_info['mashup_id'])
                             c = mashup.getAliasByName(key).component
                             params.append((c.vttype, c.vtid, value))
 
-        if not update_vistrail:
-            conf = get_vistrails_configuration()
-            if conf.has('thumbs'):
-                conf.thumbs.autoSave = False
-        
-        jobMonitor = controller.jobMonitor
-        current_workflow = jobMonitor.currentWorkflow()
-        if not current_workflow:
-            for job in jobMonitor.workflows.itervalues():
+        # apply pending upgrades now, the upgraded version is the one that
+        # will get executed
+        controller.flush_delayed_actions()
+        entries.append((locator, workflow, controller, version,
+                        controller.current_version,
+                        dict(aliases), list(params)))
+    return entries
+
+def _execute_batch_entry(entry, extra_info, reason):
+    """_execute_batch_entry(entry: tuple, extra_info: dict, reason: str)
+                            -> (result, JobWorkflow)
+    Runs one of the entries returned by _prepare_batch().
+
+    """
+    (locator, workflow, controller, version, upgraded_version,
+     aliases, params) = entry
+    v = controller.vistrail
+    if controller.current_version != upgraded_version:
+        controller.change_selected_version(upgraded_version)
+
+    jobMonitor = controller.jobMonitor
+    current_workflow = jobMonitor.currentWorkflow()
+    if not current_workflow:
+        for job in jobMonitor.workflows.itervalues():
+            try:
+                job_version = int(job.version)
+            except ValueError:
                 try:
-                    job_version = int(job.version)
-                except ValueError:
-                    try:
-                        job_version =  v.get_version_number(job.version)
-                    except KeyError:
-                        # this is a PE or mashup
-                        continue
-                if version == job_version:
-                    current_workflow = job
-                    jobMonitor.startWorkflow(job)
-            if not current_workflow:
-                current_workflow = JobWorkflow(version)
-                jobMonitor.startWorkflow(current_workflow)
+                    job_version =  v.get_version_number(job.version)
+                except KeyError:
+                    # this is a PE or mashup
+                    continue
+            if version == job_version:
+                current_workflow = job
+                jobMonitor.startWorkflow(job)
+        if not current_workflow:
+            current_workflow = JobWorkflow(version)
+            jobMonitor.startWorkflow(current_workflow)
+
+    start = time.time()
+    try:
+        (results, _) = \
+        controller.execute_current_workflow(custom_aliases=aliases,
+                                            custom_params=params,
+                                            extra_info=extra_info,
+                                            reason=reason)
+    finally:
+        jobMonitor.finishWorkflow()
+    run = results[0]
+    run.wall_time = time.time() - start
+    new_version = controller.current_version
+    run.workflow_info = (locator.name, new_version)
+    run.pipeline = controller.current_pipeline
+    run.job = None
+    if current_workflow.jobs:
+        if current_workflow.completed():
+            run.job = "COMPLETED"
+        else:
+            run.job = "RUNNING: %s" % current_workflow.id
+            for job in current_workflow.jobs.itervalues():
+                if not job.finished:
+                    run.job += "\n  %s %s %s" % (job.start, job.name, job.description())
+    return run, current_workflow
+
+# The entries are inherited by the worker processes when they are forked
+_batch_entries = None
+
+class BatchExecutionError(Exception):
+    """Raised in place of an error that happened in a worker process.
+
+    The original exception can't always be unpickled in the main process,
+    which leaves multiprocessing waiting for the result forever.
+    """
+
+def _execute_batch_worker(args):
+    """Executes an entry in a worker process.
+
+    Returns a picklable summary of the result: the module instances are not
+    sent back, the errors are converted to strings, and the execution log and
+    job information are serialized.
+
+    """
+    i, extra_info, reason = args
+    locator, workflow, controller = _batch_entries[i][:3]
+    nb_execs = len(controller.log.workflow_execs)
+    try:
+        run, job_workflow = _execute_batch_entry(_batch_entries[i],
+                                                 extra_info, reason)
+    except Exception:
+        raise BatchExecutionError("Version '%s' of %s failed:\n%s" % (
+                                  workflow, locator.name, debug.format_exc()))
+    version = run.workflow_info[1]
+    thumbnail = None
+    if controller.vistrail.has_thumbnail(version):
+        thumbnail = controller.vistrail.get_thumbnail(version)
+    return InstanceObject(
+            objects=dict((m_id, None) for m_id in run.objects),
+            errors=dict((m_id, debug.format_exception(e)
+                               if isinstance(e, Exception) else str(e))
+                        for m_id, e in run.errors.iteritems()),
+            executed=dict(run.executed),
+            suspended=dict((m_id, str(e))
+                           for m_id, e in run.suspended.iteritems()),
+            parameter_changes=run.parameter_changes,
+            workflow_info=run.workflow_info,
+            wall_time=run.wall_time,
+            job=run.job,
+            job_monitor=controller.jobMonitor.serialize(),
+            job_workflow_id=job_workflow.id,
+            thumbnail=thumbnail,
+            workflow_execs=[serialize(wf_exec) for wf_exec in
+                            controller.log.workflow_execs[nb_execs:]])
+
+def _merge_batch_result(entry, result):
+    """Merges the summary sent back by a worker into the entry's controller.
+    """
+    controller = entry[2]
+    version = result.workflow_info[1]
+    if controller.current_version != version:
+        controller.change_selected_version(version)
+    result.pipeline = controller.current_pipeline
+
+    # like execute_workflow_list(), record the parameters set during the
+    # execution as new versions, the executed version stays the same
+    if result.parameter_changes:
+        controller.add_parameter_changes_from_execution(
+                result.pipeline, version, result.parameter_changes)
+
+    # executions get new ids in this log
+    log = controller.log
+    for xml in result.workflow_execs:
+        wf_exec = unserialize(xml, WorkflowExec)
+        log.add_workflow_exec(wf_exec.do_copy(True, log.id_scope, {}))
+    del result.workflow_execs
+
+    job_workflow = JobMonitor(result.job_monitor).getWorkflow(
+            result.job_workflow_id)
+    if job_workflow is not None and job_workflow.jobs:
+        controller.jobMonitor.addWorkflow(job_workflow)
+    del result.job_monitor
+    del result.job_workflow_id
+
+    if (result.thumbnail is not None and
+            (not controller.vistrail.has_thumbnail(version) or
+             controller.vistrail.get_thumbnail(version) != result.thumbnail)):
+        controller.vistrail.set_thumbnail(version, result.thumbnail)
+    del result.thumbnail
+
+def get_batch_processes():
+    """get_batch_processes() -> int
+    Returns the number of processes used to run workflows in batch mode.
+
+    """
+    conf = get_vistrails_configuration()
+    if not conf.check('batchProcesses'):
+        return 1
+    if conf.batchProcesses < 0:
+        return multiprocessing.cpu_count()
+    return conf.batchProcesses
+
+def run_and_get_results(w_list, parameters='',
+                        update_vistrail=True, extra_info=None,
+                        reason='Console Mode Execution', processes=None):
+    """run_and_get_results(w_list: list of (locator, version), parameters: str,
+                           output_dir:str, update_vistrail: boolean,
+                           extra_info:dict, processes: int)
+    Run all workflows in w_list, and returns an interpreter result object.
+    version can be a tag name or a version id.
+
+    Each vistrail is only loaded once. If processes is more than 1
+    (it defaults to the 'batchProcesses' configuration setting), the
+    workflows are executed concurrently in that many worker processes. In
+    that case, the results hold the ids of the executed modules but not
+    their instances, and the errors are strings. Results are returned in
+    the order of w_list and have a 'wall_time' attribute.
+    
+    """
+    global _batch_entries
 
+    entries = _prepare_batch(w_list, parameters, update_vistrail, extra_info)
+
+    if not update_vistrail:
+        conf = get_vistrails_configuration()
+        if conf.has('thumbs'):
+            conf.thumbs.autoSave = False
+
+    if processes is None:
+        processes = get_batch_processes()
+    processes = min(processes, len(entries))
+    if processes > 1 and (is_running_gui() or not hasattr(os, 'fork')):
+        processes = 1
+
+    result = []
+    if processes <= 1:
+        for entry in entries:
+            run, _ = _execute_batch_entry(entry, extra_info, reason)
+            result.append(run)
+    else:
+        _batch_entries = entries
+        pool = multiprocessing.Pool(processes)
         try:
-            (results, _) = \
-            controller.execute_current_workflow(custom_aliases=aliases,
-                                                custom_params=params,
-                                                extra_info=extra_info,
-                                                reason=reason)
+            result = pool.map(_execute_batch_worker,
+                              [(i, extra_info, reason)
+                               for i in xrange(len(entries))],
+                              chunksize=1)
         finally:
-            jobMonitor.finishWorkflow()
-        new_version = controller.current_version
+            _batch_entries = None
+            pool.terminate()
+            pool.join()
+        for entry, run in izip(entries, result):
+            _merge_batch_result(entry, run)
+
+    written = set()
+    for entry, run in izip(entries, result):
+        locator, workflow, controller, version = entry[:4]
+        new_version = run.workflow_info[1]
         if new_version != version:
             debug.log("Version '%s' (%s) was upgraded. The actual "
                       "version executed was %s" % (
                       workflow, version, new_version))
-        run = results[0]
-        run.workflow_info = (locator.name, new_version)
-        run.pipeline = controller.current_pipeline
-
-        if update_vistrail:
+        debug.log("Version '%s' of %s executed in %.3fs" % (
+                  workflow, locator.name, run.wall_time))
+        if update_vistrail and id(controller) not in written:
+            written.add(id(controller))
             controller.write_vistrail(locator)
-        result.append(run)
-        if current_workflow.jobs:
-            if current_workflow.completed():
-                run.job = "COMPLETED"
-            else:
-                run.job = "RUNNING: %s" % current_workflow.id
-                for job in current_workflow.jobs.itervalues():
-                    if not job.finished:
-                        run.job += "\n  %s %s %s" % (job.start, job.name, job.description())
+        if run.job is not None:
             print run.job
     return result
 
@@ -272,12 +460,18 @@ def run(w_list, parameters='', update_vistrail=True,
     return all_errors
 
 def run_parameter_exploration(locator, pe_id, extra_info = {},
-                              reason="Console Mode Parameter Exploration Execution"):
+                              reason="Console Mode Parameter Exploration Execution",
+                              output=None):
     """run_parameter_exploration(w_list: (locator, version),
                                  pe_id: str/int,
-                                 reason: str) -> (pe_id, [error msg])
+                                 reason: str, output: str) -> (pe_id, [error msg])
     Run parameter exploration in w, and returns an interpreter result object.
     version can be a tag name or a version id.
+
+    Without the GUI, the points are generated and executed one at a time,
+    in 'batchProcesses' processes, and the result of each point is written
+    to 'output' (a filename or file object, JSON, one line per point) if it
+    is set.
     
     """
     if is_running_gui():
@@ -298,20 +492,80 @@ def run_parameter_exploration(locator, pe_id, extra_info = {},
         except Exception, e:
             return (locator, pe_id,
                     debug.format_exception(e), debug.format_exc())
+    else:
+        try:
+            (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
+            controller = VistrailController(v, locator, abstractions,
+                                            thumbnails, mashups)
+            try:
+                pe_id = int(pe_id)
+                pe = controller.vistrail.get_paramexp(pe_id)
+            except ValueError:
+                pe = controller.vistrail.get_named_paramexp(pe_id)
+            controller.change_selected_version(pe.action_id)
+            errors = _run_parameter_exploration(controller, pe, extra_info,
+                                                reason, output)
+        except Exception, e:
+            return (locator, pe_id,
+                    debug.format_exception(e), debug.format_exc())
+        if errors:
+            point, module_id, error = errors[0]
+            return (locator, pe_id,
+                    "%d error(s), first at point %s, module %s: %s" % (
+                    len(errors), point, module_id, error), '')
+
+def _run_parameter_exploration(controller, pe, extra_info, reason, output):
+    """Runs a parameter exploration without the GUI.
+
+    Returns the list of (point, module_id, error) for the failed modules.
+    """
+    actions, pre_actions, vistrail_vars = \
+            pe.collectParameterActions(controller.current_pipeline)
+    kwargs = {'locator': controller.locator,
+              'current_version': controller.current_version,
+              'reason': reason,
+              'extra_info': extra_info}
+    if controller.get_vistrail_variables():
+        # remove vars used in pe
+        vars = dict([(v.uuid, v) for v in controller.get_vistrail_variables()
+                     if v.uuid not in vistrail_vars])
+        kwargs['vistrail_variables'] = lambda x: vars.get(x, None)
+    log = controller.log if controller.logging_on() else None
+    runner = ParameterExplorationRunner(controller.current_pipeline,
+                                        actions, pre_actions,
+                                        processes=get_batch_processes(),
+                                        log=log, **kwargs)
+    if output is None:
+        with open(os.devnull, 'w') as output:
+            return write_exploration_results(runner.run(), output)
+    elif isinstance(output, basestring):
+        with open(output, 'w') as output:
+            return write_exploration_results(runner.run(), output)
+    else:
+        return write_exploration_results(runner.run(), output)
 
 def run_parameter_explorations(w_list, extra_info = {},
-                       reason="Console Mode Parameter Exploration Execution"):
+                       reason="Console Mode Parameter Exploration Execution",
+                       output=None):
     """run(w_list: list of (locator, pe_id), reason: str) -> boolean
     For each workflow in w_list, run parameter exploration pe_id
     version can be a tag name or a version id.
     Returns list of errors (empty list if there are no errors)
     """
     all_errors = []
-    for locator, pe_id in w_list:
-        result = run_parameter_exploration(locator, pe_id, reason=reason,
-                                           extra_info=extra_info)
-        if result:
-            all_errors.append(result)
+    opened = isinstance(output, basestring)
+    if opened:
+        output = open(output, 'w')
+    try:
+        for locator, pe_id in w_list:
+            result = run_parameter_exploration(locator, pe_id, reason=reason,
+                                               extra_info=extra_info,
+                                               output=output)
+            if result:
+                all_errors.append(result)
+    finally:
+        if opened:
+            output.close()
     return all_errors
 
 def cleanup():
@@ -405,6 +659,136 @@ class TestConsoleMode(unittest.TestCase):
                                      update_vistrail=False)[0]
         self.assertEquals(len(result.executed), 1)
 
+    def test_batch_loads_once(self):
+        import vistrails.core.console_mode as console_mode
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                 '/tests/resources/pythonsource.xml')
+        loaded = []
+        orig_load_vistrail = console_mode.load_vistrail
+        def counting_load_vistrail(locator):
+            loaded.append(locator.name)
+            return orig_load_vistrail(locator)
+        console_mode.load_vistrail = counting_load_vistrail
+        try:
+            results = run_and_get_results([(locator, "test_simple_success"),
+                                           (locator, "testPortsAndFail"),
+                                           (locator, "test_simple_success")],
+                                          update_vistrail=False)
+        finally:
+            console_mode.load_vistrail = orig_load_vistrail
+        self.assertEqual(loaded, [locator.name])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0].workflow_info, results[2].workflow_info)
+        self.assertNotEqual(results[0].workflow_info,
+                            results[1].workflow_info)
+        for result in results:
+            self.assertEqual(result.errors, {})
+            self.assertGreaterEqual(result.wall_time, 0.0)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "needs fork()")
+    def test_batch_processes(self):
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                 '/tests/resources/pythonsource.xml')
+        w_list = [(locator, "test_simple_success"),
+                  (locator, "testPortsAndFail"),
+                  (locator, "test_simple_success")]
+        serial = run_and_get_results(w_list, update_vistrail=False,
+                                     processes=1)
+        parallel = run_and_get_results(w_list, update_vistrail=False,
+                                       processes=2)
+        self.assertEqual([r.workflow_info for r in parallel],
+                         [r.workflow_info for r in serial])
+        for p_result, s_result in izip(parallel, serial):
+            self.assertEqual(set(p_result.executed), set(s_result.executed))
+            self.assertEqual(set(p_result.objects), set(s_result.objects))
+            self.assertEqual(p_result.errors, {})
+            self.assertIsNotNone(p_result.pipeline)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "needs fork()")
+    def test_batch_processes_parameter_changes(self):
+        import vistrails.core.console_mode as console_mode
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                 '/tests/resources/test_change_vistrail.xml')
+        w_list = [(locator, "v1"), (locator, "v2")]
+        loaded = []
+        orig_load_vistrail = console_mode.load_vistrail
+        def keeping_load_vistrail(locator):
+            res = orig_load_vistrail(locator)
+            loaded.append(res[0])
+            return res
+        console_mode.load_vistrail = keeping_load_vistrail
+        try:
+            serial = run_and_get_results(w_list, update_vistrail=False,
+                                         processes=1)
+            parallel = run_and_get_results(w_list, update_vistrail=False,
+                                           processes=2)
+        finally:
+            console_mode.load_vistrail = orig_load_vistrail
+        self.assertEqual([r.workflow_info for r in parallel],
+                         [r.workflow_info for r in serial])
+        # the parameters changed during execution are new versions
+        s_vistrail, p_vistrail = loaded
+        self.assertEqual(len(p_vistrail.actionMap), len(s_vistrail.actionMap))
+        for p_result, s_result in izip(parallel, serial):
+            self.assertTrue(s_result.parameter_changes)
+            self.assertEqual(p_result.parameter_changes,
+                             s_result.parameter_changes)
+            version = s_result.workflow_info[1]
+            children = lambda v: sorted(a.id for a in v.actionMap.itervalues()
+                                        if a.parent == version)
+            self.assertEqual(children(p_vistrail), children(s_vistrail))
+            self.assertTrue(children(s_vistrail))
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "needs fork()")
+    def test_batch_processes_error(self):
+        import vistrails.core.console_mode as console_mode
+        from vistrails.core.utils import InvalidPipeline
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                 '/tests/resources/pythonsource.xml')
+        orig_execute = console_mode._execute_batch_entry
+        def failing_execute(entry, extra_info, reason):
+            if entry[1] == "testPortsAndFail":
+                # can't be unpickled
+                raise InvalidPipeline([])
+            return orig_execute(entry, extra_info, reason)
+        console_mode._execute_batch_entry = failing_execute
+        try:
+            with self.assertRaises(BatchExecutionError) as cm:
+                run_and_get_results([(locator, "test_simple_success"),
+                                     (locator, "testPortsAndFail")],
+                                    update_vistrail=False, processes=2)
+        finally:
+            console_mode._execute_batch_entry = orig_execute
+        self.assertIn("testPortsAndFail", str(cm.exception))
+        self.assertIn("InvalidPipeline", str(cm.exception))
+
+    def test_merge_batch_result(self):
+        from vistrails.core.vistrail.job import Workflow as JobWorkflow
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                 '/tests/resources/pythonsource.xml')
+        entry = _prepare_batch([(locator, "test_simple_success")],
+                               '', False, None)[0]
+        controller = entry[2]
+        version = entry[4]
+        wf_exec = WorkflowExec(id=1, ts_start=None, ts_end=None)
+        monitor = JobMonitor()
+        job_workflow = JobWorkflow(version)
+        job_workflow.jobs['job'] = None
+        monitor.workflows[job_workflow.id] = job_workflow
+        result = InstanceObject(workflow_info=(locator.name, version),
+                                workflow_execs=[serialize(wf_exec)] * 2,
+                                job_monitor=monitor.serialize(),
+                                job_workflow_id=job_workflow.id,
+                                thumbnail=None,
+                                parameter_changes=[])
+        nb_execs = len(controller.log.workflow_execs)
+        _merge_batch_result(entry, result)
+        execs = controller.log.workflow_execs[nb_execs:]
+        self.assertEqual(len(execs), 2)
+        self.assertNotEqual(execs[0].id, execs[1].id)
+        self.assertIs(result.pipeline, controller.current_pipeline)
+        self.assertFalse(hasattr(result, 'workflow_execs'))
+
     def test_dynamic_module_error(self):
         locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() + 
                                  '/tests/resources/dynamic_module_error.xml')
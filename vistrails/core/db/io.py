@@ -37,6 +37,7 @@ from __future__ import division
 
 from vistrails.core.vistrail.action import Action
 from vistrails.core.log.log import Log
+from vistrails.core.log.workflow_exec import WorkflowExec
 from vistrails.core.vistrail.operation import AddOp, ChangeOp, DeleteOp
 from vistrails.db.services.io import SaveBundle
 import vistrails.db.services.io
@@ -114,6 +115,12 @@ def open_log(fname, was_appended=False):
     return log
 
 
+def iter_log(fname, was_appended=False):
+    for workflow_exec in vistrails.db.services.io.iter_log_from_xml(
+            fname, was_appended):
+        WorkflowExec.convert(workflow_exec)
+        yield workflow_exec
+
 def merge_logs(new_log, log_fname):
     log = vistrails.db.services.io.merge_logs(new_log, log_fname)
     Log.convert(log)
@@ -43,14 +43,19 @@ import cPickle as pickle
 
 import time
 
+from vistrails.core.cache.disk import DiskResultCache
+from vistrails.core.cache.eviction import CacheEvictionPolicy, estimate_size
 from vistrails.core.common import InstanceObject, VistrailsInternalError
+from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core import debug
 import vistrails.core.interpreter.base
 from vistrails.core.interpreter.base import AbortExecution
+from vistrails.core.interpreter.scheduler import ParallelScheduler, \
+    SynchronizedLogging
 from vistrails.core.log.controller import DummyLogController
 from vistrails.core.modules.basic_modules import identifier as basic_pkg, \
-                                                 Generator
+                                                 Generator, PathObject
 from vistrails.core.modules.module_registry import get_module_registry
 from vistrails.core.modules.vistrails_module import ModuleBreakpoint, \
     ModuleConnector, ModuleError, ModuleErrors, ModuleHadError, \
@@ -91,6 +96,8 @@ class ViewUpdatingLogController(object):
         self.executed = {}
         self.suspended = {}
         self.cached = {}
+        self.compute_start = {}
+        self.compute_times = {}
 
     def signalSuccess(self, obj):
         self.executed[obj.id] = True
@@ -107,6 +114,7 @@ class ViewUpdatingLogController(object):
     def begin_compute(self, obj):
         i = self.remap_id(obj.id)
         self.view.set_module_computing(i)
+        self.compute_start.setdefault(obj.id, time.time())
 
         reg = get_module_registry()
         module_name = reg.get_descriptor(obj.__class__).name
@@ -157,6 +165,9 @@ class ViewUpdatingLogController(object):
                     self.end_update(child.module, child, was_suspended=True)
         elif error is None:
             self.view.set_module_success(i)
+            if obj.id in self.compute_start:
+                self.compute_times[obj.id] = (time.time() -
+                                              self.compute_start[obj.id])
         else:
             self.view.set_module_error(i, error.msg, error.errorTrace)
 
@@ -215,6 +226,70 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         self._objects = {}
         self.filePool = self._file_pool
         self._streams = []
+        self._result_cache = self.create_result_cache()
+        self._eviction_policy = self.create_eviction_policy()
+        self._scheduling = False
+
+    @staticmethod
+    def get_execution_threads():
+        """get_execution_threads() -> int
+
+        Returns the number of threads used to run independent modules
+        concurrently. Returns 1 when running the GUI, which can't be updated
+        from other threads.
+        """
+        conf = get_vistrails_configuration()
+        if not conf.check('executionThreads'):
+            return 1
+        from vistrails.core.application import get_vistrails_application
+        app = get_vistrails_application()
+        if app is not None and app.is_running_gui():
+            return 1
+        return conf.executionThreads
+
+    @staticmethod
+    def create_eviction_policy():
+        """create_eviction_policy() -> CacheEvictionPolicy
+
+        Creates the policy bounding the memory used by cached modules if a
+        limit is set in the configuration, else returns None.
+        """
+        conf = get_vistrails_configuration()
+        if not conf.check('cacheMemoryLimit'):
+            return None
+        return CacheEvictionPolicy(conf.cacheMemoryLimit * 1024 * 1024)
+
+    @staticmethod
+    def create_result_cache():
+        """create_result_cache() -> DiskResultCache
+
+        Creates the on-disk result cache if it is enabled in the
+        configuration, else returns None.
+        """
+        conf = get_vistrails_configuration()
+        if not (conf.has_deep_value('resultCache.enabled') and
+                conf.get_deep_value('resultCache.enabled')):
+            return None
+        directory = vistrails.core.system.get_vistrails_directory(
+                'resultCache.cacheDir')
+        if directory is None:
+            return None
+        max_size = conf.get_deep_value('resultCache.cacheSize') * 1024 * 1024
+        try:
+            return DiskResultCache(directory, max_size)
+        except OSError, e:
+            debug.warning("Could not open result cache %s" % directory, e)
+            return None
+
+    def get_result_cache_stats(self):
+        """get_result_cache_stats() -> dict
+
+        Returns the hit/miss/eviction counters of the on-disk result cache,
+        or None if it is disabled.
+        """
+        if self._result_cache is None:
+            return None
+        return self._result_cache.stats()
 
     def clear(self):
         self._file_pool.cleanup()
@@ -222,6 +297,8 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         for obj in self._objects.itervalues():
             obj.clear()
         self._objects = {}
+        if self._eviction_policy is not None:
+            self._eviction_policy.clear()
 
     def __del__(self):
         self.clear()
@@ -240,6 +317,46 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         for v in dependencies:
             self._persistent_pipeline.delete_module(v)
             del self._objects[v]
+            if self._eviction_policy is not None:
+                self._eviction_policy.remove(v)
+
+    def record_cache_usage(self, logging_obj):
+        """record_cache_usage(logging_obj: ViewUpdatingLogController) -> None
+
+        Updates the eviction policy with the modules that were computed or
+        reused during an execution.
+        """
+        policy = self._eviction_policy
+        if policy is None:
+            return
+        def output_size(obj):
+            return sum(estimate_size(value)
+                       for port_name, value in obj.outputPorts.iteritems()
+                       if port_name != 'self')
+        for i in logging_obj.executed:
+            if i in self._objects:
+                policy.computed(i, output_size(self._objects[i]),
+                                logging_obj.compute_times.get(i, 0.0))
+        for i in logging_obj.cached:
+            if i in self._objects and not policy.hit(i):
+                # Restored from the result cache: cost to reload is low
+                policy.computed(i, output_size(self._objects[i]), 0.0)
+
+    def enforce_memory_limit(self):
+        """enforce_memory_limit() -> None
+
+        Removes modules from the persistent pipeline, along with the modules
+        that depend on them, until the estimated size of the cached results
+        is under the limit.
+        """
+        policy = self._eviction_policy
+        if policy is None:
+            return
+        while policy.over_budget():
+            victim = policy.choose_victim()
+            self.clean_modules([victim])
+            policy.remove(victim)
+            policy.evictions += 1
 
     def clean_non_cacheable_modules(self):
         """clean_non_cacheable_modules() -> None
@@ -252,6 +369,77 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                                  if not mod.is_cacheable()]
         self.clean_modules(non_cacheable_modules)
 
+    def restore_cached_results(self, module_ids, connection_ids):
+        """restore_cached_results(module_ids: list of persistent module ids,
+                                  connection_ids: list of persistent
+                                  connection ids) -> set
+
+        Loads the outputs of newly-created modules from the on-disk result
+        cache. Returns the set of module ids that were restored; they are
+        up-to-date and their upstream doesn't need to be executed.
+        """
+        if self._result_cache is None:
+            return set()
+        restored = {}
+        for i in module_ids:
+            obj = self._objects[i]
+            if obj.signature is None or not obj.is_cacheable():
+                continue
+            outputs = self._result_cache.get(obj.signature)
+            if outputs is not None:
+                restored[i] = outputs
+        # Ports that were not set when the results were stored can't be
+        # provided, so these modules need to run
+        for i in connection_ids:
+            conn = self._persistent_pipeline.connections[i]
+            outputs = restored.get(conn.sourceId)
+            if (outputs is not None and conn.source.name != 'self' and
+                    conn.source.name not in outputs):
+                del restored[conn.sourceId]
+        for i, outputs in restored.iteritems():
+            obj = self._objects[i]
+            for port_name, value in outputs.iteritems():
+                obj.set_output(port_name, value)
+            obj.upToDate = True
+        return set(restored)
+
+    def store_cached_results(self, objs, execs):
+        """store_cached_results(objs: dict, execs: dict) -> None
+
+        Writes the outputs of the modules that were executed to the on-disk
+        result cache, if they are cacheable and don't depend on non-cacheable
+        modules.
+        """
+        if self._result_cache is None:
+            return
+        non_cacheable = [i for (i, mod) in self._objects.iteritems()
+                         if not mod.is_cacheable()]
+        if non_cacheable:
+            g = self._persistent_pipeline.graph
+            non_cacheable = set(g.vertices_topological_sort(non_cacheable))
+        for i, obj in objs.iteritems():
+            if (not execs.get(i) or obj.id not in self._objects or
+                    obj.id in non_cacheable or obj.signature is None):
+                continue
+            outputs = dict((port_name, value)
+                           for port_name, value in obj.outputPorts.iteritems()
+                           if port_name != 'self')
+            if any(self._is_temporary_file(value)
+                   for value in outputs.itervalues()):
+                continue
+            self._result_cache.put(obj.signature, outputs)
+
+    def _is_temporary_file(self, value):
+        """Whether value refers to a file in the file pool.
+
+        These files are deleted at the end of the session, so they can't be
+        stored in the result cache.
+        """
+        if isinstance(value, (list, tuple)):
+            return any(self._is_temporary_file(v) for v in value)
+        return (isinstance(value, PathObject) and
+                value.name.startswith(self._file_pool.directory))
+
     def _clear_package(self, identifier):
         """clear_package(identifier: str) -> None
 
@@ -419,10 +607,19 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                 if connector:
                     obj.set_input_port(f.name, connector, is_method=True)
 
+        # Restore results from the on-disk cache
+        restored = self.restore_cached_results(
+                [tmp_to_persistent_module_map[i] for i in module_added_set
+                 if i not in errors],
+                [conn_map[i] for i in conn_added_set])
+
         # Create the new connections
         for i in conn_added_set:
             persistent_id = conn_map[i]
             conn = self._persistent_pipeline.connections[persistent_id]
+            if conn.destinationId in restored:
+                # Restored modules won't be computed, don't pull upstream
+                continue
             src = self._objects[conn.sourceId]
             dst = self._objects[conn.destinationId]
             self.make_connection(conn, src, dst)
@@ -523,22 +720,24 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         self._streams.append(Generator.generators)
         Generator.generators = []
 
-        # Update new sinks
-        for obj in persistent_sinks:
+        def update_module(obj):
+            """Updates a module and reports errors. Returns True if the
+            execution should stop.
+            """
             abort = False
             try:
                 obj.update()
-                continue
+                return False
             except ModuleWasSuspended:
-                continue
+                return False
             except ModuleHadError:
                 pass
             except AbortExecution:
-                break
+                return True
             except ModuleSuspended, ms:
                 ms.module.logging.end_update(ms.module, ms,
                                              was_suspended=True)
-                continue
+                return False
             except ModuleErrors, mes:
                 for me in mes.module_errors:
                     me.module.logging.end_update(me.module, me)
@@ -552,9 +751,34 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                 mb.module.logging.end_update(mb.module)
                 logging_obj.signalError(mb.module, mb)
                 abort = True
-            if stop_on_error or abort:
+            return stop_on_error or abort
+
+        # Run independent modules concurrently, if enabled
+        scheduler = None
+        nb_threads = self.get_execution_threads()
+        if nb_threads > 1 and not self._scheduling:
+            scheduler = ParallelScheduler(nb_threads)
+            synchronized_logging = SynchronizedLogging(logging_obj)
+            for obj in tmp_id_to_module_map.itervalues():
+                obj.logging = synchronized_logging
+            self._scheduling = True
+            try:
+                scheduler.run(persistent_sinks,
+                              set(tmp_id_to_module_map.itervalues()),
+                              stop_on_error)
+            finally:
+                self._scheduling = False
+
+        # Update new sinks
+        for obj in persistent_sinks:
+            if update_module(obj):
                 break
 
+        # Report failures from the parallel run that were not reached
+        if scheduler is not None:
+            for obj in scheduler.deferred_modules():
+                update_module(obj)
+
         if Generator.generators:
             record_usage(generators=len(Generator.generators))
         # execute all generators until inputs are exhausted
@@ -593,6 +817,8 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
 
         Generator.generators = self._streams.pop()
 
+        self.record_cache_usage(logging_obj)
+
         if self.done_update_hook:
             self.done_update_hook(self._persistent_pipeline, self._objects)
                 
@@ -642,6 +868,8 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         view = fetch('view', None)
 
         self.clean_modules(to_delete)
+        self.store_cached_results(objs, execs)
+        self.enforce_memory_limit()
 
         if view is not None:
             for i in objs:
@@ -773,6 +1001,11 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
 
         logger.finish_workflow_execution(result.errors, suspended=result.suspended)
 
+        if self._result_cache is not None:
+            debug.debug("Result cache: %(hits)d hits, %(misses)d misses, "
+                        "%(evictions)d evictions, %(entries)d entries "
+                        "(%(size)d bytes)" % self._result_cache.stats())
+
         record_usage(time=time_end - time_start, modules=len(res[1]),
                      errors=len(res[2]), executed=len(res[3]),
                      suspended=len(res[4]))
@@ -958,6 +1191,129 @@ class TestCachedInterpreter(unittest.TestCase):
         finally:
             StandardOutput.compute = old_compute
 
+    def test_parallel(self):
+        """Test executing with the parallel scheduler."""
+        from vistrails.tests.utils import execute, intercept_result
+        from vistrails.core.modules.basic_modules import List
+
+        old_threads = CachedInterpreter.__dict__['get_execution_threads']
+        CachedInterpreter.get_execution_threads = staticmethod(lambda: 4)
+        try:
+            with intercept_result(List, 'value') as results:
+                self.assertFalse(execute([
+                        ('Integer', basic_pkg, [
+                            ('value', [('Integer', '3')]),
+                        ]),
+                        ('Integer', basic_pkg, [
+                            ('value', [('Integer', '4')]),
+                        ]),
+                        ('List', basic_pkg, []),
+                        ('Integer', basic_pkg, []),
+                    ],
+                    [
+                        (0, 'value', 2, 'head'),
+                        (1, 'value', 2, 'tail'),
+                        (0, 'value', 3, 'value'),
+                    ]))
+            self.assertEqual(results, [[3, 4]])
+        finally:
+            CachedInterpreter.get_execution_threads = old_threads
+
+    def test_memory_limit(self):
+        """Test that cached modules are evicted past the memory limit."""
+        from vistrails.core.modules.basic_modules import StandardOutput
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.db.io import load_vistrail
+
+        old_compute = StandardOutput.compute
+        StandardOutput.compute = lambda s: None
+        try:
+            locator = XMLFileLocator(
+                    vistrails.core.system.vistrails_root_directory() +
+                    '/tests/resources/dummy.xml')
+            (v, abstractions, thumbnails, mashups) = load_vistrail(locator)
+            controller = VistrailController(v, locator, abstractions,
+                                            thumbnails, mashups)
+            n = v.get_version_number('int chain')
+            controller.change_selected_version(n)
+            controller.flush_delayed_actions()
+            pipeline = controller.current_pipeline
+
+            interpreter = CachedInterpreter()
+            interpreter._eviction_policy = CacheEvictionPolicy(1024 * 1024)
+            result = interpreter.execute(pipeline, locator=v,
+                                         current_version=n)
+            self.assertEqual(result.errors, {})
+            self.assertEqual(len(interpreter._persistent_pipeline.modules), 3)
+            self.assertEqual(set(interpreter._eviction_policy.entries),
+                             set(interpreter._objects))
+
+            # Evicting the first Integer also removes its downstream
+            interpreter._eviction_policy.max_size = 1
+            interpreter.enforce_memory_limit()
+            self.assertEqual(len(interpreter._persistent_pipeline.modules), 0)
+            self.assertEqual(interpreter._objects, {})
+            self.assertEqual(interpreter._eviction_policy.entries, {})
+
+            result = interpreter.execute(pipeline, locator=v,
+                                         current_version=n)
+            self.assertEqual(result.errors, {})
+            self.assertTrue(all(result.executed.itervalues()))
+            interpreter.clear()
+        finally:
+            StandardOutput.compute = old_compute
+
+    def test_result_cache(self):
+        """Test that results are reused from disk by a new interpreter."""
+        import shutil
+        import tempfile
+        from vistrails.core.modules.basic_modules import StandardOutput
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.db.io import load_vistrail
+
+        old_compute = StandardOutput.compute
+        StandardOutput.compute = lambda s: None
+        directory = tempfile.mkdtemp(prefix='vt_resultcache_')
+        try:
+            locator = XMLFileLocator(
+                    vistrails.core.system.vistrails_root_directory() +
+                    '/tests/resources/dummy.xml')
+            (v, abstractions, thumbnails, mashups) = load_vistrail(locator)
+            controller = VistrailController(v, locator, abstractions,
+                                            thumbnails, mashups)
+            n = v.get_version_number('int chain')
+            controller.change_selected_version(n)
+            controller.flush_delayed_actions()
+            pipeline = controller.current_pipeline
+
+            interpreter = CachedInterpreter()
+            interpreter._result_cache = DiskResultCache(directory, 1024*1024)
+            result = interpreter.execute(pipeline, locator=v,
+                                         current_version=n)
+            self.assertEqual(result.errors, {})
+            self.assertEqual(interpreter.get_result_cache_stats()['stores'],
+                             2)
+            interpreter.clear()
+
+            # A new interpreter restores both Integer modules, so only the
+            # (non-cacheable) StandardOutput runs
+            interpreter = CachedInterpreter()
+            interpreter._result_cache = DiskResultCache(directory, 1024*1024)
+            result = interpreter.execute(pipeline, locator=v,
+                                         current_version=n)
+            self.assertEqual(result.errors, {})
+            executed = [i for i, e in result.executed.iteritems() if e]
+            self.assertEqual(
+                    [pipeline.modules[i].name for i in executed],
+                    ['StandardOutput'])
+            self.assertEqual(interpreter.get_result_cache_stats()['hits'], 2)
+            interpreter.clear()
+        finally:
+            StandardOutput.compute = old_compute
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,271 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Runs independent modules of a pipeline concurrently.
+
+The ParallelScheduler computes which modules are upstream of the sinks
+being executed, and updates each of them on a thread pool as soon as all
+of its upstream modules are done. Modules are updated through the regular
+Module.update(), so the interpreter then only needs to run its usual serial
+loop over the sinks to collect the results.
+
+Errors are not reported by the worker threads: the exception is stored and
+raised again the next time the module is updated, from the interpreter's
+thread. This way, ModuleSuspended and ModuleErrors are aggregated by the
+downstream modules exactly as in a serial execution.
+"""
+
+from __future__ import division
+
+from multiprocessing.pool import ThreadPool
+import Queue
+import sys
+import threading
+
+##############################################################################
+
+class SynchronizedLogging(object):
+    """Wraps a logging controller so that modules running in different
+    threads report to it one at a time.
+    """
+    def __init__(self, logging_obj, lock=None):
+        self._logging = logging_obj
+        if lock is None:
+            lock = threading.RLock()
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._logging, name)
+        if not callable(attr):
+            return attr
+        def synchronized(*args, **kwargs):
+            with self._lock:
+                result = attr(*args, **kwargs)
+            if name == 'begin_loop_execution':
+                # Loop objects report to the same log
+                result = SynchronizedLogging(result, self._lock)
+            return result
+        return synchronized
+
+
+class ParallelScheduler(object):
+    """Updates the modules upstream of some sinks using a pool of threads.
+
+    Only the modules in `modules` are scheduled; other objects (such as the
+    constants created for functions) are updated by the module using them.
+    Groups are not run on the pool, since they execute a pipeline of their
+    own; they and their downstream modules are left to the serial loop.
+    """
+
+    def __init__(self, nb_threads):
+        self.nb_threads = nb_threads
+        self._deferred = {}
+
+    @staticmethod
+    def _dependencies(sinks, modules):
+        upstream = {}
+        downstream = {}
+        to_visit = list(sinks)
+        while to_visit:
+            obj = to_visit.pop()
+            if obj in upstream:
+                continue
+            deps = set(connector.obj
+                       for connector_list in obj.inputPorts.itervalues()
+                       for connector in connector_list
+                       if connector.obj in modules)
+            upstream[obj] = deps
+            for dep in deps:
+                downstream.setdefault(dep, set()).add(obj)
+                to_visit.append(dep)
+        return upstream, downstream
+
+    @staticmethod
+    def _update(obj, results):
+        try:
+            obj.update()
+        except Exception:
+            results.put((obj, sys.exc_info()))
+        else:
+            results.put((obj, None))
+
+    def _defer(self, obj, exc_info):
+        """Stores the exception raised by a module so that it is raised again
+        by its next update() call.
+        """
+        state = obj.had_error, obj.was_suspended
+        obj.had_error = obj.was_suspended = False
+        def replay():
+            self._restore(obj)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._deferred[obj] = state
+        obj.update = replay
+
+    def _restore(self, obj):
+        obj.had_error, obj.was_suspended = self._deferred.pop(obj)
+        del obj.update
+
+    def deferred_modules(self):
+        """deferred_modules() -> list of modules
+
+        Returns the modules that failed in a worker thread and that weren't
+        updated since. Updating them raises the original exception.
+        """
+        return self._deferred.keys()
+
+    def run(self, sinks, modules, stop_on_error=True):
+        """run(sinks: list of modules, modules: set of modules,
+               stop_on_error: bool) -> None
+
+        Updates the sinks and the modules upstream of them. If stop_on_error
+        is set, no new module gets started after one fails.
+        """
+        from vistrails.core.modules.sub_module import Group
+
+        upstream, downstream = self._dependencies(sinks, modules)
+        nb_pending = dict((obj, len(deps))
+                          for obj, deps in upstream.iteritems())
+        ready = [obj for obj, deps in upstream.iteritems() if not deps]
+        results = Queue.Queue()
+        running = 0
+        failed = False
+        pool = ThreadPool(self.nb_threads)
+        try:
+            while ready or running:
+                while ready and not (failed and stop_on_error):
+                    obj = ready.pop()
+                    if isinstance(obj, Group):
+                        continue
+                    pool.apply_async(self._update, (obj, results))
+                    running += 1
+                if not running:
+                    break
+                obj, exc_info = results.get()
+                running -= 1
+                if exc_info is not None:
+                    self._defer(obj, exc_info)
+                    failed = True
+                    continue
+                for dep in downstream.get(obj, ()):
+                    nb_pending[dep] -= 1
+                    if nb_pending[dep] == 0:
+                        ready.append(dep)
+        finally:
+            pool.close()
+            pool.join()
+
+##############################################################################
+# Testing
+
+import time
+import unittest
+
+from vistrails.core.modules.vistrails_module import Module, ModuleConnector, \
+    ModuleError, ModuleSuspended
+
+
+class _Branch(Module):
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def __init__(self, fail=None):
+        Module.__init__(self)
+        self.fail = fail
+
+    def compute(self):
+        with self.lock:
+            _Branch.active += 1
+            _Branch.max_active = max(_Branch.max_active, _Branch.active)
+        try:
+            time.sleep(0.1)
+        finally:
+            with self.lock:
+                _Branch.active -= 1
+        if self.fail == 'error':
+            raise ModuleError(self, "branch failed")
+        elif self.fail == 'suspend':
+            raise ModuleSuspended(self, "branch suspended", handle=object())
+        self.set_output('value', 1)
+
+
+class _Join(Module):
+    def compute(self):
+        self.set_output('value', sum(c() for c in self.inputPorts['in']))
+
+
+class TestParallelScheduler(unittest.TestCase):
+    def make_pipeline(self, *fail):
+        from vistrails.core.vistrail.port_spec import PortSpec
+        spec = PortSpec(sigstring='org.vistrails.vistrails.basic:Integer')
+        branches = [_Branch(f) for f in fail]
+        join = _Join()
+        for branch in branches:
+            join.set_input_port('in', ModuleConnector(branch, 'value', spec))
+        _Branch.max_active = 0
+        return branches, join
+
+    def test_concurrent(self):
+        branches, join = self.make_pipeline(None, None, None, None)
+        ParallelScheduler(4).run([join], set(branches + [join]))
+        self.assertGreater(_Branch.max_active, 1)
+        self.assertTrue(join.computed)
+        self.assertEqual(join.get_output('value'), 4)
+
+    def test_error(self):
+        branches, join = self.make_pipeline(None, 'error', None)
+        scheduler = ParallelScheduler(4)
+        scheduler.run([join], set(branches + [join]), stop_on_error=False)
+        self.assertFalse(join.computed)
+        self.assertEqual(scheduler.deferred_modules(), [branches[1]])
+        # The error is raised from the interpreter's thread
+        with self.assertRaises(ModuleError) as cm:
+            join.update()
+        self.assertIs(cm.exception.module, branches[1])
+        self.assertEqual(scheduler.deferred_modules(), [])
+        self.assertTrue(branches[1].had_error)
+
+    def test_suspended(self):
+        branches, join = self.make_pipeline('suspend', None, 'suspend')
+        scheduler = ParallelScheduler(4)
+        scheduler.run([join], set(branches + [join]))
+        # Suspensions are aggregated by the downstream module, as in a
+        # serial execution
+        with self.assertRaises(ModuleSuspended) as cm:
+            join.update()
+        self.assertIs(cm.exception.module, join)
+        self.assertEqual(set(e.module for e in cm.exception.children),
+                         set([branches[0], branches[2]]))
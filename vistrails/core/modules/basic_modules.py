@@ -51,12 +51,14 @@ from vistrails.core import debug
 
 from abc import ABCMeta
 from ast import literal_eval
+from collections import OrderedDict
 from itertools import izip
 import mimetypes
 import os
 import pickle
 import re
 import shutil
+import threading
 import zipfile
 import urllib
 
@@ -1009,7 +1011,56 @@ class Unpickle(Module):
 
 ##############################################################################
 
+class CodeCache(object):
+    """Process-wide cache of compiled code objects, keyed by the hash of the
+    source.
+
+    This avoids compiling a script again each time it runs, for instance on
+    every iteration of a loop.
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, code_str):
+        if isinstance(code_str, unicode):
+            key = sha_hash(code_str.encode('utf-8')).digest()
+        else:
+            key = sha_hash(code_str).digest()
+        with self.lock:
+            code = self.entries.pop(key, None)
+            if code is not None:
+                self.hits += 1
+                self.entries[key] = code
+                return code
+        # Python 2.6 needs code to end with newline
+        code = compile(code_str + '\n', '<string>', 'exec')
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = code
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return code
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+_code_cache = CodeCache()
+
+def get_code_cache():
+    return _code_cache
+
 class CodeRunnerMixin(object):
+    """Runs a user-provided script as the module's computation.
+
+    If the module has a 'pure' input port set to True by a parameter, the
+    script is declared to only depend on its source and inputs: the module is
+    then cacheable by its signature, even if it is NotCacheable otherwise.
+    """
     def __init__(self):
         self.output_ports_order = []
         super(CodeRunnerMixin, self).__init__()
@@ -1020,6 +1071,25 @@ class CodeRunnerMixin(object):
         # output_ports are reversed for display purposes...
         self.output_ports_order.reverse()
 
+    def is_pure(self):
+        """Returns whether the script was declared pure.
+
+        Only parameters are considered, so that this is known before the
+        module (and its upstream) is executed.
+        """
+        for connector in self.inputPorts.get('pure', []):
+            if connector in self.is_method:
+                try:
+                    return bool(connector())
+                except Exception:
+                    return False
+        return False
+
+    def is_cacheable(self):
+        if self.is_pure():
+            return True
+        return super(CodeRunnerMixin, self).is_cacheable()
+
     def run_code(self, code_str,
                  use_input=False,
                  use_output=False):
@@ -1049,8 +1119,9 @@ class CodeRunnerMixin(object):
                         'self': self})
         if 'source' in locals_:
             del locals_['source']
-        # Python 2.6 needs code to end with newline
-        exec code_str + '\n' in locals_, locals_
+        if 'pure' in locals_:
+            del locals_['pure']
+        exec _code_cache.compile(code_str) in locals_, locals_
         if use_output:
             for k in self.output_ports_order:
                 if locals_.get(k) is not None:
@@ -1069,12 +1140,15 @@ class PythonSource(CodeRunnerMixin, NotCacheable, Module):
     fail(error_message).
 
     If you want a PythonSource execution to be cached, call
-    cache_this().
+    cache_this(), or set 'pure' to True if its results only depend on the
+    source and inputs; the latter allows it to be skipped entirely when its
+    results are already cached.
     """
     _settings = ModuleSettings(
         configure_widget=("vistrails.gui.modules.python_source_configure:"
                              "PythonSourceConfigurationWidget"))
-    _input_ports = [IPort('source', 'String', optional=True, default="")]
+    _input_ports = [IPort('source', 'String', optional=True, default=""),
+                    IPort('pure', 'Boolean', optional=True, default=False)]
     _output_pors = [OPort('self', 'Module')]
 
     def compute(self):
@@ -1194,17 +1268,21 @@ class Generator(object):
     """
     Used to keep track of list iteration, it will execute a module once for
     each input in the list/generator.
+
+    If `batched` is set, each step of the stream produces a whole chunk of
+    values (a list or NumPy array) instead of a single one.
     """
     _settings = ModuleSettings(abstract=True)
 
     generators = []
     def __init__(self, size=None, module=None, generator=None, port=None,
-                 accumulated=False):
+                 accumulated=False, batched=False):
         self.module = module
         self.generator = generator
         self.port = port
         self.size = size
         self.accumulated = accumulated
+        self.batched = batched
         if generator and module not in Generator.generators:
             # add to global list of generators
             # they will be topologically ordered
@@ -1217,16 +1295,26 @@ class Generator(object):
         if isinstance(value, Generator):
             value = value.all()
         return value
-    
+
+    def next_batch(self):
+        """ return the values of the current step as a sequence, or None at
+        the end of the stream
+
+        """
+        value = self.next()
+        if value is None or self.batched:
+            return value
+        return [value]
+
     def all(self):
         """ exhausts next() for Streams
         
         """
         items = []
-        item = self.next()
+        item = self.next_batch()
         while item is not None:
-            items.append(item)
-            item = self.next()
+            items.extend(item)
+            item = self.next_batch()
         return items
 
     @staticmethod
@@ -1658,6 +1746,57 @@ class TestPythonSource(unittest.TestCase):
                 ]))
         self.assertEqual(results[-1], "nb is 42")
 
+    def test_pure(self):
+        """Setting 'pure' with a parameter makes PythonSource cacheable"""
+        from vistrails.core.modules.vistrails_module import ModuleConnector
+        module = PythonSource()
+        self.assertFalse(module.is_cacheable())
+        # Only a parameter can declare it, not an upstream module
+        module.set_input_port('pure',
+                              ModuleConnector(create_constant(True), 'value'))
+        self.assertFalse(module.is_cacheable())
+
+        module = PythonSource()
+        module.set_input_port('pure',
+                              ModuleConnector(create_constant(False), 'value'),
+                              is_method=True)
+        self.assertFalse(module.is_cacheable())
+        module = PythonSource()
+        module.set_input_port('pure',
+                              ModuleConnector(create_constant(True), 'value'),
+                              is_method=True)
+        self.assertTrue(module.is_cacheable())
+
+    def test_code_cache(self):
+        """Scripts are compiled once"""
+        import urllib2
+        from vistrails.tests.utils import execute, intercept_result
+        source = 'r = "%d %s" % (i, "pure" in locals())'
+        cache = get_code_cache()
+        cache.clear()
+        misses = cache.misses
+        with intercept_result(PythonSource, 'r') as results:
+            self.assertFalse(execute([
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', urllib2.quote(source))]),
+                        ('i', [('Integer', '1')]),
+                        ('pure', [('Boolean', 'True')]),
+                    ]),
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', urllib2.quote(source))]),
+                        ('i', [('Integer', '2')]),
+                    ]),
+                ],
+                add_port_specs=[
+                    (0, 'input', 'i', 'org.vistrails.vistrails.basic:Integer'),
+                    (0, 'output', 'r', 'org.vistrails.vistrails.basic:String'),
+                    (1, 'input', 'i', 'org.vistrails.vistrails.basic:Integer'),
+                    (1, 'output', 'r', 'org.vistrails.vistrails.basic:String'),
+                ]))
+        # 'pure' is not visible from the script
+        self.assertEqual(sorted(results), ["1 False", "2 False"])
+        self.assertEqual(cache.misses, misses + 1)
+
 
 class TestNumericConversions(unittest.TestCase):
     def test_full(self):
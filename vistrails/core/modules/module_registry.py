@@ -524,6 +524,9 @@ class ModuleRegistry(DBRegistry):
     def set_defaults(self, other=None):
         self._root_descriptor = None
         self.signals = ModuleRegistrySignals()
+        # incremented whenever packages, descriptors or ports change, so that
+        # results derived from the registry can be checked for staleness
+        self.generation = 0
         self.setup_indices()
         if other is None:
             # _constant_hasher_map stores callables for custom parameter
@@ -625,6 +628,7 @@ class ModuleRegistry(DBRegistry):
         # self.descriptors[(desc.package, desc.name, desc.namespace)] = desc
         self.descriptors_by_id[desc.id] = desc
         package.add_descriptor(desc)
+        self.generation += 1
     def delete_descriptor(self, desc, package=None):
         if package is None:
             try:
@@ -636,8 +640,10 @@ class ModuleRegistry(DBRegistry):
         # del self.descriptors[(desc.package, desc.name, desc.namespace)]
         del self.descriptors_by_id[desc.id]
         package.delete_descriptor(desc)
+        self.generation += 1
     def add_package(self, package):
         DBRegistry.db_add_package(self, package)
+        self.generation += 1
         for key in chain(package.old_identifiers, [package.identifier]):
             if key in self.packages:
                 old_pkg = self.packages[key]
@@ -651,6 +657,7 @@ class ModuleRegistry(DBRegistry):
         # FIXME hard to incremental updates here so we'll just recreate
         # this can be slow
         self.setup_indices()
+        self.generation += 1
 
     def has_abs_upgrade(self, identifier, name, namespace='',
                         package_version='', module_version=''):
@@ -1491,6 +1498,7 @@ class ModuleRegistry(DBRegistry):
             raise InvalidPortSpec(descriptor, spec.name, spec.type, e)
 
         descriptor.add_port_spec(spec)
+        self.generation += 1
         if spec.type == 'input':
             self.signals.emit_new_input_port(descriptor.identifier,
                                              descriptor.name, spec.name, spec)
@@ -1732,11 +1740,13 @@ class ModuleRegistry(DBRegistry):
         """Remove an input port by name.
         """
         descriptor.delete_input_port(port_name)
+        self.generation += 1
 
     def delete_output_port(self, descriptor, port_name):
         """Removes an output port by name.
         """
         descriptor.delete_output_port(port_name)
+        self.generation += 1
 
     def source_ports_from_descriptor(self, descriptor, sorted=True):
         ports = [p[1] for p in self.module_ports('output', descriptor)]
@@ -40,12 +40,14 @@ from base64 import b16encode, b16decode
 import copy
 from itertools import izip, product, chain
 import json
+import multiprocessing
+import os
 import time
 import traceback
 import warnings
 
 from vistrails.core.data_structures.bijectivedict import Bidict
-from vistrails.core import debug
+from vistrails.core import debug, is_running_gui
 from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core.modules.config import ModuleSettings, IPort, OPort
 from vistrails.core.vistrail.module_control_param import ModuleControlParam
@@ -192,6 +194,10 @@ InvalidOutput = _InvalidOutput
 class DummyModuleLogging(object):
     def _dummy_method(self, *args, **kwargs): pass
 
+    def begin_loop_execution(self, *args, **kwargs):
+        # also stands for the loop logging, e.g. for nested loops in workers
+        return self
+
     def __getattr__(self, name):
         return self._dummy_method
 
@@ -676,6 +682,13 @@ class Module(object):
         elements, port_names = self.do_combine(combine_type, inputs, port_names)
         num_inputs = len(elements)
         loop = self.logging.begin_loop_execution(self, num_inputs)
+        if (self.get_loop_execution() == 'process' and not self.upToDate and
+                num_inputs > 1):
+            outputs = self.compute_all_processes(loop, port_names, elements)
+            for nameOutput in outputs:
+                self.set_output(nameOutput, outputs[nameOutput])
+            loop.end_loop_execution()
+            return
         ## Update everything for each value inside the list
         outputs = {}
         for i in xrange(num_inputs):
@@ -729,6 +742,76 @@ class Module(object):
             self.set_output(nameOutput, outputs[nameOutput])
         loop.end_loop_execution()
 
+    def get_loop_execution(self):
+        """Returns how iterations of implicit loops are run: 'serial', or
+        'process' to use a pool of worker processes.
+
+        Worker processes are forked, so 'process' falls back to 'serial' on
+        systems without fork(), when running the GUI, and inside a worker
+        (e.g. for nested loops), as pool workers cannot have children.
+        """
+        execution = self.control_params.get(
+                ModuleControlParam.LOOP_EXECUTION_KEY, 'serial')
+        if execution == 'process' and (
+                not hasattr(os, 'fork') or
+                multiprocessing.current_process().daemon or
+                is_running_gui()):
+            return 'serial'
+        return execution
+
+    def compute_all_processes(self, loop, port_names, elements):
+        """Runs the iterations of compute_all() in worker processes.
+
+        The iterations are split in chunks that are sent to a pool of forked
+        processes, so only the indices go through the pipes, and the outputs
+        come back in order. Logging for each iteration happens here, as the
+        results are received.
+
+        """
+        num_inputs = len(elements)
+        nb_workers = int(self.control_params.get(
+                ModuleControlParam.LOOP_WORKERS_KEY, 0) or
+                multiprocessing.cpu_count())
+        chunksize = max(1, num_inputs // (nb_workers * 4))
+        chunks = [range(i, min(i + chunksize, num_inputs))
+                  for i in xrange(0, num_inputs, chunksize)]
+
+        if self.list_depth == 1:
+            self.typeChecking(self, port_names, elements)
+
+        outputs = {}
+        # the module and its inputs are inherited by the forked workers
+        pool = multiprocessing.Pool(nb_workers,
+                                    initializer=_init_loop_worker,
+                                    initargs=(self, port_names, elements))
+        try:
+            results = pool.imap(_compute_loop_chunk, chunks)
+            for chunk, chunk_results in izip(chunks, results):
+                for i, (success, value, trace) in izip(chunk, chunk_results):
+                    module = copy.copy(self)
+                    module.list_depth = self.list_depth - 1
+                    loop.begin_iteration(module, i)
+                    module.logging.begin_update(module)
+                    module.logging.begin_compute(module)
+                    if not success:
+                        raise ModuleError(module, value, errorTrace=trace)
+                    for nameOutput, output in value.iteritems():
+                        outputs.setdefault(nameOutput, []).append(output)
+                    module.logging.end_update(module)
+                    module.logging.signalSuccess(module)
+                    loop.end_iteration(module)
+                    self.logging.update_progress(self, (i + 1) / num_inputs)
+        except ModuleError:
+            raise
+        except Exception, e:
+            raise ModuleError(self, "Error running loop in worker "
+                                    "processes: %s" %
+                                    debug.format_exception(e))
+        finally:
+            pool.terminate()
+            pool.join()
+        return outputs
+
     def build_stream(self):
         """Determines and builds correct generator type.
 
@@ -737,6 +820,9 @@ class Module(object):
         if True in [g.accumulated for g in self.streamed_ports.values()]:
             # the module can only compute once the streaming is finished
             self.compute_after_streaming()
+        elif isinstance(self, BatchStreaming):
+            # the module computes once for each batch of the stream
+            self.compute_batch_streaming()
         elif self.list_depth > 0:
             # iterate the module for each value in the stream
             self.compute_streaming()
@@ -767,22 +853,58 @@ class Module(object):
         ports = [port for port, depth, value in self.iterated_ports
                  if depth == self.list_depth]
         num_inputs = self.iterated_ports[0][2].size
+        iter_dict = dict([(port, value)
+                          for port, depth, value in self.iterated_ports])
         # the generator will read next from each iterated input port and
         # compute the module again
         module = copy.copy(self)
         module.list_depth = self.list_depth - 1
-        if num_inputs:
-            milestones = [i*num_inputs//10 for i in xrange(1, 11)]
+        reader = StreamReader(self, module, ports,
+                              [iter_dict[port] for port in ports])
+        output_names = self.outputPorts.keys()
         def generator(self):
             self.logging.begin_compute(module)
             i = 0
+            milestone = 0
             while 1:
-                iter_dict = dict([(port, (depth, value))
-                                  for port, depth, value in
-                                  self.iterated_ports])
+                columns = reader.read()
+                if reader.batched:
+                    outputs = dict((name, []) for name in output_names)
+                for elements in izip(*columns):
+                    module.had_error = False
+                    ## Type checking
+                    if i == 0:
+                        self.typeChecking(module, ports, [elements])
+
+                    module.upToDate = False
+                    module.computed = False
 
-                elements = [iter_dict[port][1].next() for port in ports]
-                if None in elements:
+                    reader.set_values(elements, i)
+
+                    try:
+                        module.compute()
+                    except ModuleSuspended, e:
+                        e.loop_iteration = i
+                        suspended.append(e)
+                        i += 1
+                        if reader.batched:
+                            # drop whatever this element had output
+                            for name in output_names:
+                                module.outputPorts.pop(name, None)
+                        continue
+                    except Exception, e:
+                        raise ModuleError(module, str(e))
+                    i += 1
+                    if reader.batched:
+                        for name in output_names:
+                            outputs[name].append(
+                                    module.outputPorts.get(name))
+                if reader.batched:
+                    for name in output_names:
+                        module.set_output(name, outputs[name])
+                milestone = self.stream_progress(module, i, num_inputs,
+                                                 milestone)
+                if reader.finished:
                     for name_output in module.outputPorts:
                         module.set_output(name_output, None)
                     if suspended:
@@ -794,30 +916,65 @@ class Module(object):
                                 children=suspended)
                     self.logging.update_progress(module, 1.0)
                     self.logging.end_update(module)
-                    yield None
-                if num_inputs:
-                    if i in milestones:
-                        self.logging.update_progress(module, float(i)/num_inputs)
-                else:
-                    self.logging.update_progress(module, 0.5)
-                module.had_error = False
-                ## Type checking
-                if i == 0:
-                    self.typeChecking(module, ports, [elements])
+                    while 1:
+                        yield None
+                yield True
 
-                module.upToDate = False
-                module.computed = False
+        _generator = generator(self)
+        # set streaming outputs
+        for name_output in self.outputPorts:
+            iterator = Generator(size=num_inputs,
+                                 module=module,
+                                 generator=_generator,
+                                 port=name_output,
+                                 batched=reader.batched)
+            self.set_output(name_output, iterator)
 
-                self.setInputValues(module, ports, elements, i)
+    def compute_batch_streaming(self):
+        """This method creates a generator object that computes the module
+        once for each batch of the streamed inputs.
 
-                try:
-                    module.compute()
-                except ModuleSuspended, e:
-                    e.loop_iteration = i
-                    suspended.append(e)
-                except Exception, e:
-                    raise ModuleError(module, str(e))
-                i += 1
+        The module gets each streamed port as a list of elements, and should
+        set each output to the list of the corresponding results; the outputs
+        are streamed as batches.
+
+        """
+        from vistrails.core.modules.basic_modules import Generator
+        ports = self.streamed_ports.keys()
+        num_inputs = self.streamed_ports[ports[0]].size
+        module = copy.copy(self)
+        module.list_depth = max(self.list_depth - 1, 0)
+        reader = StreamReader(self, module, ports,
+                              [self.streamed_ports[port] for port in ports])
+        output_names = self.outputPorts.keys()
+        def generator(self):
+            self.logging.begin_compute(module)
+            i = 0
+            milestone = 0
+            while 1:
+                columns = reader.read()
+                if columns:
+                    module.had_error = False
+                    module.upToDate = False
+                    module.computed = False
+                    reader.set_batch(columns, i)
+                    try:
+                        module.compute()
+                    except Exception, e:
+                        raise ModuleError(module, str(e))
+                    i += len(columns[0])
+                else:
+                    for name in output_names:
+                        module.set_output(name, [])
+                milestone = self.stream_progress(module, i, num_inputs,
+                                                 milestone)
+                if reader.finished:
+                    for name_output in module.outputPorts:
+                        module.set_output(name_output, None)
+                    self.logging.update_progress(module, 1.0)
+                    self.logging.end_update(module)
+                    while 1:
+                        yield None
                 yield True
 
         _generator = generator(self)
@@ -826,9 +983,25 @@ class Module(object):
             iterator = Generator(size=num_inputs,
                                  module=module,
                                  generator=_generator,
-                                 port=name_output)
+                                 port=name_output,
+                                 batched=True)
             self.set_output(name_output, iterator)
 
+    def stream_progress(self, module, i, num_inputs, milestone):
+        """Reports the progress of a stream after `i` elements.
+
+        Progress is only reported every tenth of the stream, so that it costs
+        the same whatever the size of the batches; returns the next milestone.
+        """
+        if num_inputs:
+            if i >= milestone:
+                self.logging.update_progress(module, float(i)/num_inputs)
+                milestone = i + max(num_inputs//10, 1)
+        elif milestone == 0:
+            self.logging.update_progress(module, 0.5)
+            milestone = 1
+        return milestone
+
     def compute_accumulate(self):
         """This method creates a generator object that converts all
         streaming inputs to list inputs for modules that do not explicitly
@@ -846,14 +1019,20 @@ class Module(object):
         module.had_error = False
         module.upToDate = False
         module.computed = False
+        reader = StreamReader(self, module, ports,
+                              [self.streamed_ports[port] for port in ports])
 
         inputs = dict([(port, []) for port in ports])
         def generator(self):
             self.logging.begin_update(module)
             i = 0
             while 1:
-                elements = [self.streamed_ports[port].next() for port in ports]
-                if None in elements:
+                columns = reader.read()
+                for port, values in zip(ports, columns):
+                    inputs[port].extend(values)
+                if columns:
+                    i += len(columns[0])
+                if reader.finished:
                     self.logging.begin_compute(module)
                     # assembled all inputs so do the actual computation
                     elements = [inputs[port] for port in ports]
@@ -872,13 +1051,11 @@ class Module(object):
                                         len(suspended), num_inputs),
                                 children=suspended)
                     self.logging.end_update(module)
-                    yield None
+                    while 1:
+                        yield None
 
-                for port, value in zip(ports, elements):
-                    inputs[port].append(value)
                 for name_output in module.outputPorts:
                     module.set_output(name_output, None)
-                i += 1
                 yield True
 
         _generator = generator(self)
@@ -909,6 +1086,12 @@ class Module(object):
         module.had_error = False
         module.upToDate = False
         module.computed = False
+        # streamed elements are set one at a time
+        module.list_depth = max(self.list_depth - 1, 0)
+        # batched streams produce several elements per step, which are
+        # taken one at a time
+        streams = [self.streamed_ports[port] for port in ports]
+        buffers = [[] for port in ports]
 
         def generator(self):
             self.logging.begin_update(module)
@@ -916,7 +1099,15 @@ class Module(object):
             for name_output in module.outputPorts:
                 module.set_output(name_output, None)
             while 1:
-                elements = [self.streamed_ports[port].next() for port in ports]
+                elements = []
+                for stream, buf in izip(streams, buffers):
+                    if stream.batched:
+                        values = stream.next()
+                        if values is not None:
+                            buf.extend(values)
+                        elements.append(buf.pop(0) if buf else None)
+                    else:
+                        elements.append(stream.next())
                 if None not in elements:
                     self.logging.begin_compute(module)
                     ## Type checking
@@ -1112,6 +1303,10 @@ class Module(object):
         from vistrails.core.modules.basic_modules import get_module
         if not module.input_specs:
             return
+        # typecheck only if all params should be type-checked
+        type_checked = dict((inputPort, False not in self.get_type_checks(
+                                 module.input_specs[inputPort]))
+                            for inputPort in inputPorts)
         for elementList in inputList:
             if len(elementList) != len(inputPorts):
                 raise ModuleError(self,
@@ -1121,8 +1316,7 @@ class Module(object):
                 if isinstance(element, Generator):
                     raise ModuleError(self, "Generator is not allowed here")
                 port_spec = module.input_specs[inputPort]
-                # typecheck only if all params should be type-checked
-                if False in self.get_type_checks(port_spec):
+                if not type_checked[inputPort]:
                     break
                 v_module = get_module(element, port_spec.signature)
                 if v_module is not None:
@@ -1456,41 +1650,50 @@ class Module(object):
         module.had_error = False
         module.upToDate = False
         module.computed = False
-
-        if num_inputs:
-            milestones = [i*num_inputs//10 for i in xrange(1, 11)]
+        reader = StreamReader(self, module, ports,
+                              [self.streamed_ports[port] for port in ports])
+        output_names = self.outputPorts.keys()
 
         def _Generator(self):
             self.logging.begin_compute(module)
             i = 0
+            milestone = 0
             # <initialize here>
             #intsum = 0
             userGenerator = UserGenerator(module)
             while 1:
-                elements = [self.streamed_ports[port].next() for port in ports]
-                if None in elements:
+                columns = reader.read()
+                if reader.batched:
+                    outputs = dict((name, []) for name in output_names)
+                for elements in izip(*columns):
+                    ## Type checking
+                    self.typeChecking(module, ports, [elements])
+                    reader.set_values(elements, i)
+
+                    userGenerator.next()
+                    # <compute here>
+                    #intsum += dict(zip(ports, elements))['integerStream']
+                    #print "Sum so far:", intsum
+
+                    # <set output here if any>
+                    #module.set_output(name_output, intsum)
+                    i += 1
+                    if reader.batched:
+                        for name in output_names:
+                            outputs[name].append(
+                                    module.outputPorts.get(name))
+                if reader.batched:
+                    for name in output_names:
+                        module.set_output(name, outputs[name])
+                milestone = self.stream_progress(self, i, num_inputs,
+                                                 milestone)
+                if reader.finished:
                     self.logging.update_progress(self, 1.0)
                     self.logging.end_update(module)
                     for name_output in module.outputPorts:
                         module.set_output(name_output, None)
-                    yield None
-                ## Type checking
-                self.typeChecking(module, ports, [elements])
-                self.setInputValues(module, ports, elements, i)
-
-                userGenerator.next()
-                # <compute here>
-                #intsum += dict(zip(ports, elements))['integerStream']
-                #print "Sum so far:", intsum
-
-                # <set output here if any>
-                #module.set_output(name_output, intsum)
-                if num_inputs:
-                    if i in milestones:
-                        self.logging.update_progress(self, float(i)/num_inputs)
-                else:
-                    self.logging.update_progress(self, 0.5)
-                i += 1
+                    while 1:
+                        yield None
                 yield True
 
         generator = _Generator(self)
@@ -1499,11 +1702,12 @@ class Module(object):
             iterator = Generator(size=num_inputs,
                                  module=module,
                                  generator=generator,
-                                 port=name_output)
+                                 port=name_output,
+                                 batched=reader.batched)
 
             self.set_output(name_output, iterator)
 
-    def set_streaming_output(self, port, generator, size=0):
+    def set_streaming_output(self, port, generator, size=0, batched=False):
         """This method is used to set a streaming output port.
 
         :param port: the name of the output port to be set
@@ -1511,14 +1715,16 @@ class Module(object):
         :param generator: An iterator object supporting .next()
         :param size: The number of values if known (default=0)
         :type size: int
+        :param batched: Whether the iterator yields batches of values (lists
+          or NumPy arrays) instead of single values (default=False)
+        :type batched: bool
         """
         from vistrails.core.modules.basic_modules import Generator
         module = copy.copy(self)
 
-        if size:
-            milestones = [i*size//10 for i in xrange(1, 11)]
         def _Generator():
             i = 0
+            milestone = 0
             while 1:
                 try:
                     value = generator.next()
@@ -1535,18 +1741,18 @@ class Module(object):
                     self.logging.update_progress(self, 1.0)
                     yield None
                 module.set_output(port, value)
-                if size:
-                    if i in milestones:
-                        self.logging.update_progress(self, float(i)/size)
+                if batched:
+                    i += len(value)
                 else:
-                    self.logging.update_progress(self, 0.5)
-                i += 1
+                    i += 1
+                milestone = self.stream_progress(self, i, size, milestone)
                 yield True
         _generator = _Generator()
         self.set_output(port, Generator(size=size,
                                         module=module,
                                         generator=_generator,
-                                        port=port))
+                                        port=port,
+                                        batched=batched))
 
     def job_monitor(self):
         """Returns the JobMonitor for the associated controller if it exists.
@@ -1622,6 +1828,51 @@ class Module(object):
     def updateUpstreamPort(self, *args, **kwargs):
         return self.update_upstream_port(*args, **kwargs)
 
+# Module being looped over by compute_all_processes(), set in each worker
+# process by its pool initializer
+_loop_module = None
+
+def _init_loop_worker(module, port_names, elements):
+    global _loop_module
+    _loop_module = (module, port_names, elements)
+
+def _compute_loop_chunk(indices):
+    """Runs some iterations of a loop, in a worker process.
+
+    Returns a list of (success, outputs or error message, error trace).
+    """
+    self, port_names, elements = _loop_module
+    results = []
+    for i in indices:
+        module = copy.copy(self)
+        module.list_depth = self.list_depth - 1
+        module.had_error = False
+        module.was_suspended = False
+        module.upToDate = False
+        module.computed = False
+        module.logging = _dummy_logging
+        self.setInputValues(module, port_names, elements[i], i)
+        try:
+            module.update()
+        except ModuleSuspended, e:
+            results.append((False,
+                            "Iteration %d suspended, which is not supported "
+                            "when running in worker processes: %s" % (
+                                    i, e.msg),
+                            None))
+        except ModuleError, e:
+            results.append((False, e.msg, e.errorTrace))
+        except Exception, e:
+            results.append((False, debug.format_exception(e),
+                            traceback.format_exc()))
+        else:
+            results.append((True,
+                            dict((name, value)
+                                 for name, value in module.outputPorts.iteritems()
+                                 if name != 'self'),
+                            None))
+    return results
+
 ################################################################################
 
 class NotCacheable(object):
@@ -1636,6 +1887,112 @@ class Streaming(object):
 
     """
 
+class BatchStreaming(Streaming):
+    """ A mixin indicating that compute() accepts batches of a stream
+
+    compute() is called once per batch, with each streamed input port set to
+    a list of elements, and should set each output port to the list of the
+    corresponding results.
+
+    """
+
+class StreamReader(object):
+    """Reads the streamed input ports of a module in lockstep.
+
+    Each call to read() advances every stream by one step. Batched streams
+    produce several values per step, so values are buffered until they are
+    available on all the ports.
+
+    It also sets the values on the copy of the module that is computed for
+    the stream, updating the same connectors for every element instead of
+    creating new ones.
+    """
+
+    def __init__(self, module, stream_module, ports, streams):
+        self.module = module
+        self.stream_module = stream_module
+        self.ports = ports
+        self.streams = streams
+        self.batched = any(stream.batched for stream in streams)
+        self.buffers = [[] for stream in streams]
+        self.finished = False
+        self.connectors = {}
+        self.port_hashes = {}
+        self.signature = None
+
+    def read(self):
+        """Advances the streams, returning a list of values for each port.
+
+        The lists are empty if no element is available yet; `finished` is
+        set once one of the streams is exhausted.
+        """
+        if self.finished:
+            return []
+        for stream, buf in izip(self.streams, self.buffers):
+            values = stream.next_batch()
+            if values is None:
+                self.finished = True
+            else:
+                buf.extend(values)
+        count = min(len(buf) for buf in self.buffers)
+        if not count:
+            return []
+        columns = []
+        for buf in self.buffers:
+            columns.append(buf[:count])
+            del buf[:count]
+        return columns
+
+    def _set_signature(self, port, iteration):
+        # The fake signature is
+        # XOR(signature(loop module), iteration, hash(inputPort))
+        if self.signature is None:
+            self.signature = b16decode(self.module.signature.upper())
+        port_hash = self.port_hashes.get(port)
+        if port_hash is None:
+            port_hash = sha1_hash()
+            port_hash.update(port)
+            port_hash = self.port_hashes[port] = port_hash.digest()
+        self.stream_module.signature = b16encode(xor(
+                self.signature,
+                long2bytes(iteration, 20),
+                port_hash))
+
+    def _new_connector(self, port, value, depth):
+        from vistrails.core.modules.basic_modules import create_constant
+        module = self.stream_module
+        if port in module.inputPorts:
+            del module.inputPorts[port]
+        spec = None
+        if port in self.module.input_specs:
+            spec = self.module.input_specs[port].__copy__()
+            spec.depth += depth
+        connector = ModuleConnector(create_constant(value), 'value', spec)
+        module.set_input_port(port, connector)
+        return connector
+
+    def set_values(self, elements, iteration):
+        """Sets one element of each stream as the module's inputs.
+        """
+        module = self.stream_module
+        for element, port in izip(elements, self.ports):
+            connector = self.connectors.get(port)
+            if (connector is not None and
+                    module.inputPorts.get(port) == [connector]):
+                connector.obj.setValue(element)
+            else:
+                self.connectors[port] = self._new_connector(
+                        port, element, module.list_depth)
+            self._set_signature(port, iteration)
+
+    def set_batch(self, columns, iteration):
+        """Sets a list of elements of each stream as the module's inputs.
+        """
+        for column, port in izip(columns, self.ports):
+            self._new_connector(port, column,
+                                self.stream_module.list_depth + 1)
+            self._set_signature(port, iteration)
+
 ################################################################################
 
 class Converter(Module):
@@ -1863,3 +2220,285 @@ class TestImplicitLooping(unittest.TestCase):
 
     def test_list_custom(self):
         self.run_vt("test-list-custom.vt")
+
+    def test_process_loop(self):
+        """Runs the iterations of a loop in worker processes.
+        """
+        import os
+        from vistrails.tests.utils import execute, intercept_result
+        if not hasattr(os, 'fork'):
+            self.skipTest("worker processes need fork()")
+
+        def run(control_params):
+            from vistrails.packages.pythonCalc.init import PythonCalc
+            with intercept_result(PythonCalc, 'value') as results:
+                self.assertFalse(execute([
+                        ('List', 'org.vistrails.vistrails.basic', [
+                            ('value', [('List', '[1, 2, 3, 4, 5, 6]')]),
+                        ]),
+                        ('PythonCalc', 'org.vistrails.vistrails.pythoncalc', [
+                            ('value2', [('Float', '3.0')]),
+                            ('op', [('String', '*')]),
+                        ]),
+                    ],
+                    [
+                        (0, 'value', 1, 'value1'),
+                    ],
+                    add_control_params=control_params))
+            # The last result is the one from the looping module
+            return results[-1]
+
+        serial = run([])
+        processes = run([
+                (1, ModuleControlParam.LOOP_EXECUTION_KEY, 'process'),
+                (1, ModuleControlParam.LOOP_WORKERS_KEY, '2')])
+        self.assertEqual(serial, [3.0, 6.0, 9.0, 12.0, 15.0, 18.0])
+        self.assertEqual(processes, serial)
+
+    def test_process_loop_error(self):
+        """Errors in worker processes are reported on the looped module.
+        """
+        import os
+        from vistrails.tests.utils import execute
+        if not hasattr(os, 'fork'):
+            self.skipTest("worker processes need fork()")
+
+        errors = execute([
+                ('List', 'org.vistrails.vistrails.basic', [
+                    ('value', [('List', '[1, 0, 2]')]),
+                ]),
+                ('PythonCalc', 'org.vistrails.vistrails.pythoncalc', [
+                    ('value1', [('Float', '1.0')]),
+                    ('op', [('String', '/')]),
+                ]),
+            ],
+            [
+                (0, 'value', 1, 'value2'),
+            ],
+            add_control_params=[
+                (1, ModuleControlParam.LOOP_EXECUTION_KEY, 'process')])
+        self.assertEqual(list(errors), [1])
+
+    def test_nested_process_loop(self):
+        """Loops nested in a worker process run serially in that worker.
+        """
+        import os
+        import urllib2
+        from vistrails.tests.utils import execute, intercept_result
+        if not hasattr(os, 'fork'):
+            self.skipTest("worker processes need fork()")
+
+        from vistrails.packages.pythonCalc.init import PythonCalc
+        # the PythonSource is looped and outputs lists, so PythonCalc loops
+        # over a list of lists
+        pair = urllib2.quote("o = [x, x * 10]")
+        with intercept_result(PythonCalc, 'value') as results:
+            self.assertFalse(execute([
+                    ('List', 'org.vistrails.vistrails.basic', [
+                        ('value', [('List', '[1.0, 2.0, 3.0]')]),
+                    ]),
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', pair)]),
+                    ]),
+                    ('PythonCalc', 'org.vistrails.vistrails.pythoncalc', [
+                        ('value2', [('Float', '2.0')]),
+                        ('op', [('String', '*')]),
+                    ]),
+                ],
+                [
+                    (0, 'value', 1, 'x'),
+                    (1, 'o', 2, 'value1'),
+                ],
+                add_port_specs=[
+                    (1, 'input', 'x',
+                     'org.vistrails.vistrails.basic:Float'),
+                    (1, 'output', 'o',
+                     'org.vistrails.vistrails.basic:List'),
+                ],
+                add_control_params=[
+                    (2, ModuleControlParam.LOOP_EXECUTION_KEY, 'process'),
+                    (2, ModuleControlParam.LOOP_WORKERS_KEY, '2')]))
+        self.assertEqual(results[-1],
+                         [[2.0, 20.0], [4.0, 40.0], [6.0, 60.0]])
+
+    def test_batched_stream(self):
+        """A stream of batches is consumed element by element downstream.
+        """
+        import urllib2
+        from vistrails.core.modules.basic_modules import PythonSource
+        from vistrails.tests.utils import execute, intercept_result
+
+        produce = urllib2.quote(
+                "self.set_streaming_output("
+                "'o', iter([[1.0, 2.0, 3.0], [4.0], [], [5.0, 6.0]]), 6, "
+                "batched=True)")
+        collect = urllib2.quote("total = values")
+        with intercept_result(PythonSource, 'total') as results:
+            self.assertFalse(execute([
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', produce)]),
+                    ]),
+                    ('PythonCalc', 'org.vistrails.vistrails.pythoncalc', [
+                        ('value2', [('Float', '10.0')]),
+                        ('op', [('String', '*')]),
+                    ]),
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', collect)]),
+                    ]),
+                ],
+                [
+                    (0, 'o', 1, 'value1'),
+                    (1, 'value', 2, 'values'),
+                ],
+                add_port_specs=[
+                    (0, 'output', 'o',
+                     'org.vistrails.vistrails.basic:List'),
+                    (2, 'input', 'values',
+                     'org.vistrails.vistrails.basic:List'),
+                    (2, 'output', 'total',
+                     'org.vistrails.vistrails.basic:List'),
+                ]))
+        self.assertEqual(results, [[10.0, 20.0, 30.0, 40.0, 50.0, 60.0]])
+
+    def test_batched_stream_after_accumulate(self):
+        """A batched stream is unpacked next to an accumulated input.
+        """
+        import urllib2
+        from vistrails.core.modules.basic_modules import PythonSource
+        from vistrails.tests.utils import execute, intercept_result
+
+        produce = urllib2.quote(
+                "self.set_streaming_output("
+                "'o', iter([[1.0, 2.0, 3.0], [4.0], [], [5.0, 6.0]]), 6, "
+                "batched=True)")
+        collect = urllib2.quote("total = values")
+        combine = urllib2.quote("r = (len(total), v)")
+        with intercept_result(PythonSource, 'r') as results:
+            self.assertFalse(execute([
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', produce)]),
+                    ]),
+                    ('PythonCalc', 'org.vistrails.vistrails.pythoncalc', [
+                        ('value2', [('Float', '10.0')]),
+                        ('op', [('String', '*')]),
+                    ]),
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', collect)]),
+                    ]),
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', combine)]),
+                    ]),
+                ],
+                [
+                    (0, 'o', 1, 'value1'),
+                    (1, 'value', 2, 'values'),
+                    (2, 'total', 3, 'total'),
+                    (1, 'value', 3, 'v'),
+                ],
+                add_port_specs=[
+                    (0, 'output', 'o',
+                     'org.vistrails.vistrails.basic:List'),
+                    (2, 'input', 'values',
+                     'org.vistrails.vistrails.basic:List'),
+                    (2, 'output', 'total',
+                     'org.vistrails.vistrails.basic:List'),
+                    (3, 'input', 'total',
+                     'org.vistrails.vistrails.basic:List'),
+                    (3, 'input', 'v',
+                     'org.vistrails.vistrails.basic:Float'),
+                    (3, 'output', 'r',
+                     'org.vistrails.vistrails.basic:List'),
+                ]))
+        # computed once the accumulation is done, with single elements
+        self.assertEqual(results, [(6, 50.0)])
+
+    def test_stream_reader(self):
+        """Batched and single-value streams are read in lockstep.
+        """
+        from vistrails.core.modules.basic_modules import Generator
+        producers = [Module(), Module()]
+        streams = [Generator(module=producers[0], port='value',
+                             batched=True),
+                   Generator(module=producers[1], port='value')]
+        reader = StreamReader(Module(), Module(), ['a', 'b'], streams)
+        self.assertTrue(reader.batched)
+        results = []
+        for batch, value in [([1, 2, 3], 'x'), ([4], 'y'), ([], 'z'),
+                             (None, 'w')]:
+            producers[0].set_output('value', batch)
+            producers[1].set_output('value', value)
+            results.append(reader.read())
+        self.assertEqual(results, [[[1], ['x']], [[2], ['y']], [[3], ['z']],
+                                   [[4], ['w']]])
+        self.assertTrue(reader.finished)
+        self.assertEqual(reader.read(), [])
+
+    def test_batched_stream_suspended(self):
+        """A suspended element leaves nothing in the batch it belongs to.
+        """
+        from vistrails.core.modules.basic_modules import Generator
+
+        class Halve(Module):
+            def compute(self):
+                value = self.get_input('value')
+                self.set_output('half', value / 2)
+                if value == 2.0:
+                    raise ModuleSuspended(self, "waiting", handle=self)
+                self.set_output('double', value * 2)
+
+        producer = Module()
+        halve = Halve()
+        halve.signature = '0' * 40
+        halve.set_output('half', None)
+        halve.set_output('double', None)
+        halve.list_depth = 1
+        halve.iterated_ports = [('value', 1,
+                                 Generator(size=3, module=producer,
+                                           port='values', batched=True))]
+        generators, Generator.generators = Generator.generators, []
+        try:
+            halve.compute_streaming()
+            streams = [halve.get_output('half'), halve.get_output('double')]
+            producer.set_output('values', [1.0, 2.0, 3.0])
+            Generator.generators[0].generator.next()
+            results = [stream.next_batch() for stream in streams]
+            producer.set_output('values', None)
+            with self.assertRaises(ModuleSuspended):
+                Generator.generators[0].generator.next()
+        finally:
+            Generator.generators = generators
+        self.assertEqual(results, [[0.5, 1.5], [2.0, 6.0]])
+
+    def test_batch_streaming(self):
+        """A BatchStreaming module is computed once per batch.
+        """
+        from vistrails.core.modules.basic_modules import Generator
+
+        class Scale(BatchStreaming, Module):
+            batches = []
+            def compute(self):
+                values = self.get_input('values')
+                Scale.batches.append(len(values))
+                self.set_output('scaled', [v * 2 for v in values])
+
+        producer = Module()
+        scale = Scale()
+        scale.signature = '0' * 40
+        scale.set_output('scaled', None)
+        scale.streamed_ports = {'values': Generator(size=5, module=producer,
+                                                    port='values',
+                                                    batched=True)}
+        generators, Generator.generators = Generator.generators, []
+        try:
+            scale.compute_batch_streaming()
+            stream = scale.get_output('scaled')
+            self.assertTrue(stream.batched)
+            results = []
+            for batch in ([1, 2, 3], [4, 5], None):
+                producer.set_output('values', batch)
+                Generator.generators[0].generator.next()
+                results.append(stream.next_batch())
+        finally:
+            Generator.generators = generators
+        self.assertEqual(Scale.batches, [3, 2])
+        self.assertEqual(results, [[2, 4, 6], [8, 10], None])
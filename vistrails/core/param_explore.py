@@ -42,6 +42,11 @@ from vistrails.core import debug
 from vistrails.core.vistrail.module_function import ModuleFunction
 from vistrails.core.vistrail.module_param import ModuleParam
 import copy
+import itertools
+import json
+import multiprocessing
+import os
+import time
 
 import unittest
 
@@ -175,7 +180,7 @@ class InterpolateDiscreteParam(object):
             p.type = convert[type(v).__name__]
             p.strValue = str(v)
             f.params.append(p)
-        m.functions.append(f)
+        m.add_function(f)
 
 class ActionBasedParameterExploration(object):
     """
@@ -209,38 +214,222 @@ class ActionBasedParameterExploration(object):
         """
         results = []
         resultActions = []
+        for pipeline, performedActions in self.iter_explore(pipeline,
+                                                            actions,
+                                                            pre_actions):
+            results.append(pipeline)
+            resultActions.append(performedActions)
+        return (results, resultActions)
+
+    def iter_explore(self, pipeline, actions, pre_actions=[]):
+        """ iter_explore(pipeline: Pipeline, actions: [action set],
+                         pre_actions: [action set]) -> iterator
+        Same as explore(), but generates the (pipeline, actions) tuples
+        one at a time, so that all the pipelines are not in memory at the
+        same time.
         
-        def exploreDimension(pipeline, performedActions, dim):
-            """ exploreDimension(pipeline: Pipeline, performedActions: [actions],
-                                 dim: int) -> None
-            Start applying actions to the pipeline at dimension
-            dim. 'pipeline' will not be modified in the function
-            
-            """
-            if dim<0:
-                results.append(pipeline)
-                resultActions.append(performedActions)
-                return
-            currentActions = actions[dim]
-            if len(currentActions)==0:
-                # Ignore empty dimension
-                exploreDimension(pipeline, performedActions, dim-1)
-                return
-            for actionSet in currentActions:
-                currentPipeline = copy.copy(pipeline)
-                currentPeformedActions = copy.copy(performedActions)
-                for action in actionSet:
-                    currentPipeline.perform_action(action)
-                    currentPeformedActions.append(action)
-                exploreDimension(currentPipeline, currentPeformedActions, dim-1)
-        
-        # perform pre_actions
-        currentPipeline = copy.copy(pipeline)
+        """
+        base = copy.copy(pipeline)
         for action in pre_actions:
+            base.perform_action(action)
+        for point in exploration_points(actions):
+            yield perform_point(base, actions, point, pre_actions)
+
+def exploration_points(actions):
+    """ exploration_points(actions: [action set]) -> iterator
+    Generates the points of the exploration, in the order used by
+    ActionBasedParameterExploration.explore(). Each point is a tuple with
+    the index of the action set to use in each dimension, or None for an
+    empty dimension.
+
+    """
+    steps = [xrange(len(a)) if a else [None] for a in actions]
+    # the first dimension varies the fastest
+    for point in itertools.product(*reversed(steps)):
+        yield point[::-1]
+
+def perform_point(pipeline, actions, point, pre_actions=[]):
+    """ perform_point(pipeline: Pipeline, actions: [action set],
+                      point: tuple, pre_actions: [action set])
+                      -> (Pipeline, [actions])
+    Returns a copy of the pipeline with the actions for this point applied,
+    and the list of actions leading to it. 'pipeline' should already have
+    pre_actions applied.
+
+    """
+    currentPipeline = copy.copy(pipeline)
+    performedActions = list(pre_actions)
+    for dim in xrange(len(actions)-1, -1, -1):
+        if point[dim] is None:
+            continue
+        for action in actions[dim][point[dim]]:
             currentPipeline.perform_action(action)
-        
-        exploreDimension(currentPipeline, pre_actions, len(actions)-1)
-        return (results, resultActions)
+            performedActions.append(action)
+    return currentPipeline, performedActions
+
+# The exploration is inherited by the worker processes when they are forked
+_running_exploration = None
+
+def _execute_point_worker(args):
+    index, point = args
+    return _running_exploration.execute_point(index, point, serialize_log=True)
+
+class ParameterExplorationRunner(object):
+    """
+    ParameterExplorationRunner executes a parameter exploration without
+    building all the pipelines first: each point is generated, executed and
+    reported in turn, so that very large explorations can run headless.
+
+    The points can be executed in several worker processes. The first point
+    is always executed in this process first; with the caching interpreter,
+    the modules that do not depend on the explored parameters are then in
+    the cache that the workers inherit, and are not computed again.
+    
+    """
+    def __init__(self, pipeline, actions, pre_actions=[], processes=1,
+                 log=None, **kwargs):
+        """ ParameterExplorationRunner(pipeline: Pipeline,
+                                       actions: [action set],
+                                       pre_actions: [action set],
+                                       processes: int, log: Log)
+        actions and pre_actions are the same as for
+        ActionBasedParameterExploration.explore(). Executions are recorded
+        to 'log' if it is set. The other keyword arguments are passed to
+        the interpreter.
+
+        """
+        self.base = copy.copy(pipeline)
+        for action in pre_actions:
+            self.base.perform_action(action)
+        self.actions = actions
+        self.pre_actions = pre_actions
+        self.processes = processes
+        self.log = log
+        self.kwargs = kwargs
+
+    def __len__(self):
+        count = 1
+        for a in self.actions:
+            count *= max(1, len(a))
+        return count
+
+    def points(self):
+        return exploration_points(self.actions)
+
+    def execute_point(self, index, point, serialize_log=False):
+        """ execute_point(index: int, point: tuple, serialize_log: bool)
+                          -> InstanceObject
+        Executes one point and returns a picklable summary of the result.
+        If serialize_log is True, the execution is recorded to a new log and
+        returned as XML in the 'workflow_execs' attribute.
+
+        """
+        from vistrails.core.db.io import serialize
+        from vistrails.core.interpreter.default import get_default_interpreter
+        from vistrails.core.log.controller import DummyLogController, \
+            LogController
+        from vistrails.core.log.log import Log
+        from vistrails.core.utils import InstanceObject
+
+        pipeline, performedActions = perform_point(self.base, self.actions,
+                                                   point, self.pre_actions)
+        if self.log is None:
+            log = None
+            logger = DummyLogController
+        elif serialize_log:
+            log = Log()
+            logger = LogController(log)
+        else:
+            log = self.log
+            logger = LogController(log)
+        kwargs = dict(self.kwargs)
+        kwargs['logger'] = logger
+        kwargs['actions'] = performedActions
+        kwargs['reason'] = '%s %s' % (kwargs.get('reason',
+                                                 'Parameter Exploration'),
+                                      '_'.join('%s' % p for p in point))
+
+        start = time.time()
+        result = get_default_interpreter().execute(pipeline, **kwargs)
+        wall_time = time.time() - start
+        workflow_execs = []
+        if serialize_log and log is not None:
+            workflow_execs = [serialize(wf_exec)
+                              for wf_exec in log.workflow_execs]
+        return InstanceObject(
+                index=index,
+                point=point,
+                errors=dict((m_id, debug.format_exception(e)
+                                   if isinstance(e, Exception) else str(e))
+                            for m_id, e in result.errors.iteritems()),
+                executed=dict(result.executed),
+                wall_time=wall_time,
+                workflow_execs=workflow_execs)
+
+    def _merge_log(self, result):
+        from vistrails.core.db.io import unserialize
+        from vistrails.core.log.workflow_exec import WorkflowExec
+
+        for xml in result.workflow_execs:
+            wf_exec = unserialize(xml, WorkflowExec)
+            self.log.add_workflow_exec(
+                    wf_exec.do_copy(True, self.log.id_scope, {}))
+        result.workflow_execs = []
+
+    def run(self):
+        """ run() -> iterator
+        Executes the exploration, generating the results of execute_point()
+        in the order of the points as they become available.
+
+        """
+        global _running_exploration
+
+        points = enumerate(self.points())
+        try:
+            index, point = next(points)
+        except StopIteration:
+            return
+        yield self.execute_point(index, point)
+
+        processes = min(self.processes, len(self) - 1)
+        if processes <= 1 or not hasattr(os, 'fork'):
+            for index, point in points:
+                yield self.execute_point(index, point)
+            return
+
+        _running_exploration = self
+        pool = multiprocessing.Pool(processes)
+        try:
+            for result in pool.imap(_execute_point_worker, points):
+                if self.log is not None:
+                    self._merge_log(result)
+                yield result
+        finally:
+            _running_exploration = None
+            pool.terminate()
+            pool.join()
+
+def write_exploration_results(results, output):
+    """ write_exploration_results(results: iterator, output: file) -> list
+    Writes each result from ParameterExplorationRunner.run() to 'output' as
+    a line of JSON, as they are generated. Returns the list of (point,
+    module_id, error) for the modules that failed.
+
+    """
+    errors = []
+    for result in results:
+        output.write(json.dumps({'index': result.index,
+                                 'point': result.point,
+                                 'errors': result.errors,
+                                 'executed': sorted(m_id
+                                     for m_id, done in result.executed.iteritems()
+                                     if done),
+                                 'wall_time': result.wall_time}))
+        output.write('\n')
+        output.flush()
+        for m_id, error in sorted(result.errors.iteritems()):
+            errors.append((result.point, m_id, error))
+    return errors
 
 def _pipelinePositions(sheetCount, rowCount, colCount,
                        pipelines):
@@ -283,5 +472,121 @@ class TestParameterExploration(unittest.TestCase):
                           (5, 5.0, 'two'),
                           (10, 10.0, 'three')])
 
+    def make_pipeline(self):
+        from vistrails.core.modules.basic_modules import identifier as \
+            basic_pkg, version as basic_version
+        from vistrails.core.vistrail.connection import Connection
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.pipeline import Pipeline
+        from vistrails.core.vistrail.port import Port
+
+        pipeline = Pipeline()
+        pipeline.add_module(Module(
+                id=0, name='String', package=basic_pkg,
+                version=basic_version,
+                functions=[ModuleFunction(
+                        id=0, name='value',
+                        parameters=[ModuleParam(id=0, pos=0, type='String',
+                                                val='a')])]))
+        pipeline.add_module(Module(
+                id=1, name='ConcatenateString', package=basic_pkg,
+                version=basic_version,
+                functions=[ModuleFunction(
+                        id=1, name='str2',
+                        parameters=[ModuleParam(id=1, pos=0, type='String',
+                                                val='x')])]))
+        pipeline.add_connection(Connection(
+                id=0,
+                ports=[Port(id=0, type='source', moduleId=0,
+                            name='value_as_string',
+                            signature='(%s:String)' % basic_pkg),
+                       Port(id=1, type='destination', moduleId=1,
+                            name='str1',
+                            signature='(%s:String)' % basic_pkg)]))
+        return pipeline
+
+    def make_actions(self, pipeline, values):
+        import vistrails.core.db.action
+
+        function = pipeline.modules[1].functions[0]
+        old_param = function.params[0]
+        actions = []
+        for i, value in enumerate(values):
+            new_param = ModuleParam(id=-1-i, pos=0, type='String', val=value)
+            actions.append((vistrails.core.db.action.create_action(
+                    [('change', old_param, new_param,
+                      function.vtType, function.real_id)]),))
+        return actions
+
+    def test_points_order(self):
+        class FakePipeline(object):
+            def __init__(self, performed=()):
+                self.performed = list(performed)
+            def __copy__(self):
+                return FakePipeline(self.performed)
+            def perform_action(self, action):
+                self.performed.append(action)
+
+        actions = [[('a1',), ('a2',)], [], [('b1',), ('b2',), ('b3',)]]
+        explorer = ActionBasedParameterExploration()
+        pipelines, performed = explorer.explore(FakePipeline(), actions,
+                                                ['pre'])
+        self.assertEqual([p.performed for p in pipelines], performed)
+        self.assertEqual(performed[:3], [['pre', 'b1', 'a1'],
+                                         ['pre', 'b1', 'a2'],
+                                         ['pre', 'b2', 'a1']])
+        self.assertEqual(len(performed), 6)
+        self.assertEqual(list(exploration_points(actions))[:3],
+                         [(0, None, 0), (1, None, 0), (0, None, 1)])
+        self.assertEqual([a for p, a in explorer.iter_explore(FakePipeline(),
+                                                              actions,
+                                                              ['pre'])],
+                         performed)
+
+    def run_exploration(self, processes, log=None):
+        import StringIO
+
+        pipeline = self.make_pipeline()
+        actions = [self.make_actions(pipeline, ['b', 'c', 'd', 'e'])]
+        runner = ParameterExplorationRunner(pipeline, actions,
+                                            processes=processes, log=log)
+        self.assertEqual(len(runner), 4)
+        output = StringIO.StringIO()
+        errors = write_exploration_results(runner.run(), output)
+        self.assertEqual(errors, [])
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_runner(self):
+        from vistrails.core.interpreter.cached import CachedInterpreter
+
+        CachedInterpreter.flush()
+        results = self.run_exploration(1)
+        self.assertEqual([r['index'] for r in results], range(4))
+        self.assertEqual([r['point'] for r in results],
+                         [[0], [1], [2], [3]])
+        # the upstream module is only computed once
+        self.assertEqual(results[0]['executed'], [0, 1])
+        for r in results[1:]:
+            self.assertEqual(r['executed'], [1])
+
+    @unittest.skipIf(not hasattr(os, 'fork'), "needs fork()")
+    def test_runner_processes(self):
+        from vistrails.core.interpreter.cached import CachedInterpreter
+        from vistrails.core.log.log import Log
+
+        CachedInterpreter.flush()
+        log = Log()
+        results = self.run_exploration(2, log)
+        self.assertEqual([r['point'] for r in results],
+                         [[0], [1], [2], [3]])
+        # the workers use the cache filled by the first point
+        self.assertEqual(results[0]['executed'], [0, 1])
+        for r in results[1:]:
+            self.assertEqual(r['executed'], [1])
+        # executions in the workers are merged back into the log
+        wf_execs = log.workflow_execs
+        self.assertEqual(len(wf_execs), 4)
+        self.assertEqual(len(set(wf_exec.id for wf_exec in wf_execs)), 4)
+
 if __name__ == '__main__':
     unittest.main()
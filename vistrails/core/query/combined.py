@@ -38,6 +38,7 @@ from __future__ import division
 
 from vistrails.core import reportusage
 
+from index import get_version_index
 from version import SearchCompiler
 from visual import VisualQuery
 
@@ -58,8 +59,25 @@ class CombinedSearch(VisualQuery):
             VisualQuery.run(self, controller, name)
         compiler = SearchCompiler(self.search_str, self.use_regex)
         self.search_stmt = compiler.searchStmt
+        # versions that can match, None if all of them need to be checked
+        self.index = get_version_index(controller.vistrail)
+        self.candidate_versions = self.search_stmt.candidates(self.index)
+        self.hide_upgrades = getattr(get_vistrails_configuration(),
+                                     'hideUpgrades', True)
+        if self.candidate_versions is not None and self.hide_upgrades:
+            self.outdated_versions = self.index.outdated_versions()
 
     def match(self, controller, action):
+        if self.candidate_versions is not None:
+            indexed = action.timestep
+            if self.hide_upgrades:
+                # unknown if the upgrade was not materialized yet
+                indexed = self.index.indexed_version(controller.vistrail,
+                                                     indexed,
+                                                     self.outdated_versions)
+            if (indexed is not None and
+                    indexed not in self.candidate_versions):
+                return False
         if self.queryPipeline is not None and \
                 len(self.queryPipeline.modules) > 0:
             if action.timestep in self.versionDict:
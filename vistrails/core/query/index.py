@@ -0,0 +1,405 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Inverted index over the versions of a vistrail.
+
+Searching the version tree for modules used to materialize the pipeline of
+every version. The index maps terms (module names, package identifiers,
+functions, parameter values, users) to the versions where they appear, so
+that searches only need to materialize the pipelines of the candidates.
+
+It is built by walking the version tree and replaying the operations of each
+action once, and is extended when actions get added to the vistrail. The
+index only lives in memory: it is not saved with the vistrail, and is built
+again the first time a vistrail is searched after being opened.
+"""
+
+from __future__ import division
+
+import datetime
+import time
+import unittest
+
+from vistrails.db.services.action_chain import get_action_chain_cache
+
+
+_module_types = ('module', 'group', 'abstraction')
+
+
+class _IndexState(object):
+    """Terms in the pipeline of a version, updated as actions are replayed.
+    """
+    def __init__(self):
+        # (what, id) -> (name, terms)
+        self.objects = {}
+        # term -> number of objects in the pipeline with this term
+        self.counts = {}
+
+    def _add(self, key, value, undo):
+        self.objects[key] = value
+        counts = self.counts
+        for term in value[1]:
+            counts[term] = counts.get(term, 0) + 1
+        undo.append((True, key, value))
+
+    def _remove(self, key, undo):
+        try:
+            value = self.objects.pop(key)
+        except KeyError:
+            return
+        counts = self.counts
+        for term in value[1]:
+            if counts[term] == 1:
+                del counts[term]
+            else:
+                counts[term] -= 1
+        undo.append((False, key, value))
+
+    def add_object(self, what, obj_id, data, parent_type, parent_id, undo):
+        if what in _module_types:
+            terms = [('module', data.db_name),
+                     ('descriptor', data.db_package, data.db_name,
+                      data.db_namespace or '', data.db_version or '',
+                      str(getattr(data, 'db_internal_version', '') or ''))]
+            if data.db_package:
+                terms.append(('package', data.db_package))
+            self._add((what, obj_id), (data.db_name, terms), undo)
+        elif what == 'function':
+            parent = self.objects.get((parent_type, parent_id))
+            if parent is None:
+                return
+            self._add((what, obj_id),
+                      (None, [('function', parent[0], data.db_name)]), undo)
+        elif what == 'parameter':
+            self._add((what, obj_id), (None, [('parameter', data.db_val)]),
+                      undo)
+
+    def apply(self, action):
+        """apply(action) -> list
+        Replays the operations of action, returns what is needed to undo
+        them.
+
+        """
+        undo = []
+        for op in action.db_operations:
+            if op.vtType == 'add':
+                self.add_object(op.db_what, op.db_objectId, op.db_data,
+                                op.db_parentObjType, op.db_parentObjId, undo)
+            elif op.vtType == 'delete':
+                self._remove((op.db_what, op.db_objectId), undo)
+            elif op.vtType == 'change':
+                self._remove((op.db_what, op.db_oldObjId), undo)
+                self.add_object(op.db_what, op.db_newObjId, op.db_data,
+                                op.db_parentObjType, op.db_parentObjId, undo)
+        return undo
+
+    def undo(self, undo):
+        ignored = []
+        for added, key, value in reversed(undo):
+            if added:
+                self._remove(key, ignored)
+            else:
+                self._add(key, value, ignored)
+
+
+class VersionIndex(object):
+    """Maps terms to the versions of a vistrail they appear in.
+
+    Terms are tuples: ('module', name), ('package', identifier),
+    ('descriptor', identifier, name, namespace, package_version,
+    module_version), ('function', module_name, function_name),
+    ('parameter', value) and ('user', user). The creation dates of the
+    versions are also kept. Call update() to index the actions added since
+    the last call.
+
+    This index is in-memory only; it does not persist between sessions.
+    """
+    def __init__(self):
+        self._postings = {}
+        self._dates = {}
+        self._actions = {}
+        self._action_list = []
+        self.revision = 0
+
+    def clear(self):
+        self._postings = {}
+        self._dates = {}
+        self._actions = {}
+        self._action_list = []
+        self.revision += 1
+
+    def __len__(self):
+        return len(self._actions)
+
+    def __contains__(self, version):
+        return version in self._actions
+
+    def outdated_versions(self):
+        """outdated_versions() -> set
+        Returns the versions with modules that are not in the registry as
+        they were stored, i.e. that get upgraded when they are loaded.
+        Modules from packages that are not loaded can't be upgraded and
+        are not considered.
+
+        """
+        from vistrails.core.modules.module_registry import \
+            get_module_registry
+        registry = get_module_registry()
+        result = set()
+        for term, versions in self._postings.iteritems():
+            if (term[0] == 'descriptor' and term[1] in registry.packages and
+                    not registry.has_descriptor_with_name(*term[1:])):
+                result.update(versions)
+        return result
+
+    def indexed_version(self, vistrail, version, outdated):
+        """indexed_version(vistrail, version: int, outdated: set) -> int
+        Returns the indexed version whose pipeline is the upgraded pipeline
+        of version, or None if that upgrade was not materialized yet.
+        outdated is the set returned by outdated_versions().
+
+        """
+        upgrade = vistrail.get_upgrade(version, False)
+        if upgrade in self._actions:
+            version = upgrade
+        if version in outdated:
+            return None
+        return version
+
+    def update(self, vistrail):
+        """update(vistrail) -> None
+        Indexes the versions that were added to vistrail since last time.
+
+        """
+        # compares the actions themselves, so that replacing one is seen
+        if vistrail.db_actions == self._action_list:
+            return
+        self._action_list = list(vistrail.db_actions)
+        actions = dict((action.db_id, action)
+                       for action in vistrail.db_actions)
+        for version, action in self._actions.iteritems():
+            if actions.get(version) is not action:
+                # something was removed or replaced, start over
+                self.clear()
+                break
+
+        children = {}
+        for version, action in actions.iteritems():
+            if version not in self._actions:
+                children.setdefault(action.db_prevId, []).append(action)
+        roots = [parent for parent in children
+                 if parent == 0 or parent in self._actions]
+        for parent in roots:
+            self._index_subtree(vistrail, parent, children)
+        self.revision += 1
+
+    def _state_at(self, vistrail, version):
+        state = _IndexState()
+        if version == 0:
+            return state
+        operations = get_action_chain_cache(vistrail).get_operations(vistrail,
+                                                                     version)
+        undo = []
+        for op in operations:
+            if op.vtType == 'add':
+                obj_id = op.db_objectId
+            else:
+                obj_id = op.db_newObjId
+            state.add_object(op.db_what, obj_id, op.db_data,
+                             op.db_parentObjType, op.db_parentObjId, undo)
+        return state
+
+    def _index_subtree(self, vistrail, root, children):
+        state = self._state_at(vistrail, root)
+        postings = self._postings
+        # walk the tree without recursion, undoing actions on the way up
+        stack = [(action, None) for action in children.get(root, [])]
+        while stack:
+            action, undo = stack.pop()
+            if undo is not None:
+                state.undo(undo)
+                continue
+            undo = state.apply(action)
+            stack.append((action, undo))
+            version = action.db_id
+            self._actions[version] = action
+            for term in state.counts:
+                try:
+                    postings[term].add(version)
+                except KeyError:
+                    postings[term] = set([version])
+            if action.db_user:
+                postings.setdefault(('user', action.db_user),
+                                    set()).add(version)
+            # same default as Action.date
+            date = action.db_date or datetime.datetime(1900, 1, 1)
+            self._dates[version] = time.mktime(date.timetuple())
+            stack.extend((child, None)
+                         for child in children.get(version, []))
+
+    def versions(self, term):
+        """versions(term: tuple) -> set
+        Returns the versions where term appears.
+
+        """
+        return self._postings.get(term, set())
+
+    def find(self, kind, predicate):
+        """find(kind: str, predicate: callable) -> set
+        Returns the versions containing a term of this kind for which
+        predicate returns True. The predicate gets the rest of the term,
+        e.g. the name for modules or (module_name, function_name) for
+        functions.
+
+        """
+        result = set()
+        for term, versions in self._postings.iteritems():
+            if term[0] == kind:
+                value = term[1] if len(term) == 2 else term[1:]
+                if predicate(value):
+                    result.update(versions)
+        return result
+
+    def versions_between(self, start=None, end=None):
+        """versions_between(start: float, end: float) -> set
+        Returns the versions created between these times (inclusive).
+
+        """
+        return set(version
+                   for version, date in self._dates.iteritems()
+                   if ((start is None or date >= start) and
+                       (end is None or date <= end)))
+
+
+def get_version_index(vistrail):
+    """get_version_index(vistrail) -> VersionIndex
+    Returns the up-to-date index of this vistrail, building it if needed.
+
+    """
+    try:
+        index = vistrail._version_index
+    except AttributeError:
+        index = vistrail._version_index = VersionIndex()
+    index.update(vistrail)
+    return index
+
+
+################################################################################
+
+class TestVersionIndex(unittest.TestCase):
+    def test_index(self):
+        from vistrails.core.db.locator import XMLFileLocator
+        import vistrails.core.system
+        vistrail = XMLFileLocator(
+                vistrails.core.system.vistrails_root_directory() +
+                '/tests/resources/dummy.xml').load()
+        index = get_version_index(vistrail)
+        self.assertEqual(len(index), len(vistrail.db_actions))
+
+        names = set()
+        for version in vistrail.actionMap:
+            if version == 0:
+                continue
+            pipeline = vistrail.getPipeline(version)
+            modules = set(m.name for m in pipeline.modules.itervalues())
+            names.update(modules)
+            for name in modules:
+                self.assertIn(version, index.versions(('module', name)))
+            for module in pipeline.modules.itervalues():
+                for function in module.functions:
+                    self.assertIn(version, index.versions(
+                            ('function', module.name, function.name)))
+                    for param in function.params:
+                        self.assertIn(version, index.versions(
+                                ('parameter', param.strValue)))
+            for name in names - modules:
+                self.assertNotIn(version, index.versions(('module', name)))
+        self.assertEqual(index.find('module', lambda n: False), set())
+
+    def test_incremental(self):
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.modules.module_registry import get_module_registry
+        from vistrails.core.vistrail.controller import VistrailController
+        import vistrails.core.system
+        locator = XMLFileLocator(
+                vistrails.core.system.vistrails_root_directory() +
+                '/tests/resources/dummy.xml')
+        controller = VistrailController(locator.load(), locator)
+        index = get_version_index(controller.vistrail)
+        versions = index.versions(('module', 'Float'))
+        nb = len(index)
+
+        controller.change_selected_version(0)
+        controller.add_module_from_descriptor(
+                get_module_registry().get_descriptor_by_name(
+                        vistrails.core.system.get_vistrails_basic_pkg_id(),
+                        'Float'))
+        version = controller.current_version
+        index = get_version_index(controller.vistrail)
+        self.assertEqual(len(index), nb + 1)
+        self.assertEqual(index.versions(('module', 'Float')),
+                         versions | set([version]))
+
+    def test_replaced(self):
+        from vistrails.core.db.action import create_action
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.modules.module_registry import get_module_registry
+        from vistrails.core.vistrail.controller import VistrailController
+        import vistrails.core.system
+        locator = XMLFileLocator(
+                vistrails.core.system.vistrails_root_directory() +
+                '/tests/resources/dummy.xml')
+        controller = VistrailController(locator.load(), locator)
+        vistrail = controller.vistrail
+        index = get_version_index(vistrail)
+        nb = len(index)
+
+        # replace a leaf version, the number of actions stays the same
+        parents = set(action.prevId for action in vistrail.actionMap.values())
+        leaf = max(version for version in vistrail.actionMap
+                   if version not in parents)
+        parent = vistrail.actionMap[leaf].prevId
+        vistrail.db_delete_action(vistrail.actionMap[leaf])
+        module = controller.create_module_from_descriptor(
+                get_module_registry().get_descriptor_by_name(
+                        vistrails.core.system.get_vistrails_basic_pkg_id(),
+                        'Integer'))
+        action = create_action([('add', module)])
+        vistrail.add_action(action, parent)
+        version = action.id
+        self.assertEqual(len(vistrail.db_actions), nb)
+        index = get_version_index(vistrail)
+        self.assertNotIn(leaf, index)
+        self.assertIn(version, index.versions(('module', 'Integer')))
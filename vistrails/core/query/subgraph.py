@@ -0,0 +1,368 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Subgraph matching of a query pipeline against pipelines.
+
+A match maps every module of the query to a distinct module of the target
+pipeline with the same name, accepted by a module comparison function, such
+that every connection of the query exists between the corresponding target
+modules, on the same ports.
+
+Target modules are first filtered by a signature (module name, and number of
+connections on each port), then the mappings are searched by backtracking,
+extending partial mappings along the connections of the query like VF2.
+"""
+
+from __future__ import division
+
+import unittest
+
+
+def _has_connections(signature, required):
+    """Checks that a module has at least the required number of connections
+    on each port.
+    """
+    for key, count in required:
+        if signature.get(key, 0) < count:
+            return False
+    return True
+
+
+class PipelineGraphIndex(object):
+    """Labels and connectivity of a pipeline, used for subgraph matching.
+
+    Build it once per pipeline and reuse it for every query.
+    """
+    def __init__(self, pipeline):
+        self.modules = pipeline.modules
+        # name -> [module ids]
+        self.by_name = {}
+        # module id -> {(source port, destination port): set(module ids)}
+        self.outputs = {}
+        self.inputs = {}
+        # module id -> {('out'|'in', port): number of connections}
+        self.signatures = {}
+        for module_id, module in pipeline.modules.iteritems():
+            self.by_name.setdefault(module.name, []).append(module_id)
+            self.outputs[module_id] = {}
+            self.inputs[module_id] = {}
+            self.signatures[module_id] = {}
+        for connection in pipeline.connections.itervalues():
+            source = connection.source.moduleId
+            destination = connection.destination.moduleId
+            if source not in self.modules or destination not in self.modules:
+                continue
+            ports = (connection.source.name, connection.destination.name)
+            self.outputs[source].setdefault(ports, set()).add(destination)
+            self.inputs[destination].setdefault(ports, set()).add(source)
+            signature = self.signatures[source]
+            key = ('out', ports[0])
+            signature[key] = signature.get(key, 0) + 1
+            signature = self.signatures[destination]
+            key = ('in', ports[1])
+            signature[key] = signature.get(key, 0) + 1
+
+    def edges(self, module_id):
+        """edges(module_id) -> list of (ports, other module id, outgoing)
+        """
+        result = []
+        for ports, others in self.outputs[module_id].iteritems():
+            result.extend((ports, other, True) for other in others)
+        for ports, others in self.inputs[module_id].iteritems():
+            result.extend((ports, other, False) for other in others)
+        return result
+
+    def has_edge(self, source, destination, ports):
+        return destination in self.outputs[source].get(ports, ())
+
+
+class SubgraphMatcher(object):
+    """Finds the occurrences of a query pipeline in target pipelines.
+
+    match_module(target_module, query_module) -> bool is called for modules
+    with the same name and compatible connections.
+    """
+    def __init__(self, query, match_module=None):
+        if not isinstance(query, PipelineGraphIndex):
+            query = PipelineGraphIndex(query)
+        self.query = query
+        self.match_module = match_module
+        self._edges = dict((module_id, query.edges(module_id))
+                           for module_id in query.modules)
+        self._orders = {}
+
+    def _order(self, first):
+        """Order in which query modules get mapped when starting from first.
+
+        Modules connected to the ones already mapped come first, the most
+        connected first, so that connections prune the search early.
+        """
+        try:
+            return self._orders[first]
+        except KeyError:
+            pass
+        edges = self._edges
+        order = [first]
+        placed = set(order)
+        while len(order) < len(edges):
+            frontier = set(other
+                           for module_id in order
+                           for ports, other, outgoing in edges[module_id]
+                           if other not in placed)
+            if not frontier:
+                # disconnected query, start a new component
+                frontier = set(edges) - placed
+            best = max(frontier,
+                       key=lambda m: (sum(1 for p, o, out in edges[m]
+                                          if o in placed),
+                                      len(edges[m]), -m))
+            order.append(best)
+            placed.add(best)
+        self._orders[first] = order
+        return order
+
+    def candidates(self, target):
+        """candidates(target: PipelineGraphIndex) -> dict
+        Returns the target modules each query module can be mapped to, or
+        None if one of them has none.
+
+        """
+        result = {}
+        query = self.query
+        for query_id, query_module in query.modules.iteritems():
+            query_signature = query.signatures[query_id].items()
+            matched = set()
+            for target_id in target.by_name.get(query_module.name, ()):
+                if not _has_connections(target.signatures[target_id],
+                                        query_signature):
+                    continue
+                if (self.match_module is not None and
+                        not self.match_module(target.modules[target_id],
+                                              query_module)):
+                    continue
+                matched.add(target_id)
+            if not matched:
+                return None
+            result[query_id] = matched
+        return result
+
+    def _feasible(self, query_id, target, candidates, mapping, used):
+        # candidates connected to the modules already mapped
+        possible = None
+        constraints = []
+        for ports, other, outgoing in self._edges[query_id]:
+            if other not in mapping:
+                continue
+            mapped = mapping[other]
+            constraints.append((ports, mapped, outgoing))
+            if possible is None:
+                if outgoing:
+                    neighbors = target.inputs[mapped].get(ports, ())
+                else:
+                    neighbors = target.outputs[mapped].get(ports, ())
+                possible = [t for t in neighbors
+                            if t in candidates[query_id]]
+        if possible is None:
+            possible = candidates[query_id]
+        for target_id in possible:
+            if target_id in used:
+                continue
+            for ports, mapped, outgoing in constraints:
+                if outgoing:
+                    if not target.has_edge(target_id, mapped, ports):
+                        break
+                elif not target.has_edge(mapped, target_id, ports):
+                    break
+            else:
+                yield target_id
+
+    def _extend(self, order, depth, target, candidates, mapping, used):
+        if depth == len(order):
+            return True
+        query_id = order[depth]
+        for target_id in self._feasible(query_id, target, candidates,
+                                        mapping, used):
+            mapping[query_id] = target_id
+            used.add(target_id)
+            if self._extend(order, depth + 1, target, candidates, mapping,
+                            used):
+                return True
+            del mapping[query_id]
+            used.discard(target_id)
+        return False
+
+    def find(self, target, query_id=None, target_id=None, candidates=None):
+        """find(target: PipelineGraphIndex, query_id, target_id) -> dict
+        Returns a mapping of the query modules to target modules, with
+        query_id mapped to target_id if given, or None if there is none.
+
+        """
+        if not self.query.modules:
+            return {}
+        if candidates is None:
+            candidates = self.candidates(target)
+            if candidates is None:
+                return None
+        if query_id is None:
+            query_id = min(self.query.modules,
+                           key=lambda m: (len(candidates[m]), m))
+            mapping, used = {}, set()
+        elif target_id not in candidates[query_id]:
+            return None
+        else:
+            mapping, used = {query_id: target_id}, set([target_id])
+        order = self._order(query_id)
+        if self._extend(order, len(mapping), target, candidates, mapping,
+                        used):
+            return mapping
+        return None
+
+    def matched_modules(self, target):
+        """matched_modules(target: PipelineGraphIndex) -> set
+        Returns the target modules that are part of an occurrence of the
+        query.
+
+        """
+        candidates = self.candidates(target)
+        if candidates is None:
+            return set()
+        covered = dict((query_id, set()) for query_id in candidates)
+        for query_id in sorted(candidates,
+                               key=lambda m: len(candidates[m])):
+            for target_id in candidates[query_id]:
+                if target_id in covered[query_id]:
+                    continue
+                mapping = self.find(target, query_id, target_id, candidates)
+                if mapping is None:
+                    continue
+                for q, t in mapping.iteritems():
+                    covered[q].add(t)
+            if not covered[query_id]:
+                # the query doesn't occur at all
+                return set()
+        result = set()
+        for targets in covered.itervalues():
+            result.update(targets)
+        return result
+
+
+################################################################################
+
+class TestSubgraphMatcher(unittest.TestCase):
+    @staticmethod
+    def make_pipeline(modules, connections):
+        """Creates a pipeline from {id: name} and a list of
+        (source id, source port, destination id, destination port).
+
+        """
+        from vistrails.core.modules.basic_modules import identifier as basic_pkg
+        from vistrails.core.vistrail.connection import Connection
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.pipeline import Pipeline
+        from vistrails.core.vistrail.port import Port
+        pipeline = Pipeline()
+        for module_id, name in modules.iteritems():
+            pipeline.add_module(Module(id=module_id, name=name,
+                                       package=basic_pkg))
+        for i, (source, source_port, dest, dest_port) in \
+                enumerate(connections):
+            ports = [Port(id=2 * i, type='source', moduleId=source,
+                          moduleName=modules[source], name=source_port),
+                     Port(id=2 * i + 1, type='destination', moduleId=dest,
+                          moduleName=modules[dest], name=dest_port)]
+            pipeline.add_connection(Connection(id=i, ports=ports))
+        return pipeline
+
+    def matched(self, query, target, match_module=None):
+        matcher = SubgraphMatcher(query, match_module)
+        return matcher.matched_modules(PipelineGraphIndex(target))
+
+    def test_chain(self):
+        query = self.make_pipeline({1: 'A', 2: 'B'}, [(1, 'out', 2, 'in')])
+        target = self.make_pipeline(
+                {1: 'A', 2: 'B', 3: 'A', 4: 'B', 5: 'C'},
+                [(1, 'out', 2, 'in'), (3, 'other', 4, 'in'),
+                 (2, 'out', 5, 'in')])
+        self.assertEqual(self.matched(query, target), set([1, 2]))
+
+    def test_injective(self):
+        # two A's connected to the same B are needed
+        query = self.make_pipeline({1: 'A', 2: 'A', 3: 'B'},
+                                   [(1, 'out', 3, 'in'),
+                                    (2, 'out', 3, 'in')])
+        target = self.make_pipeline({1: 'A', 2: 'B'}, [(1, 'out', 2, 'in')])
+        self.assertEqual(self.matched(query, target), set())
+        target = self.make_pipeline({1: 'A', 2: 'A', 3: 'B', 4: 'A'},
+                                    [(1, 'out', 3, 'in'),
+                                     (2, 'out', 3, 'in')])
+        self.assertEqual(self.matched(query, target), set([1, 2, 3]))
+
+    def test_diamond(self):
+        query = self.make_pipeline({1: 'A', 2: 'B', 3: 'C', 4: 'D'},
+                                   [(1, 'out', 2, 'in'), (1, 'out', 3, 'in'),
+                                    (2, 'out', 4, 'in1'),
+                                    (3, 'out', 4, 'in2')])
+        # C feeds another D than B does
+        target = self.make_pipeline(
+                {1: 'A', 2: 'B', 3: 'C', 4: 'D', 5: 'D'},
+                [(1, 'out', 2, 'in'), (1, 'out', 3, 'in'),
+                 (2, 'out', 4, 'in1'), (3, 'out', 5, 'in2')])
+        self.assertEqual(self.matched(query, target), set())
+        target = self.make_pipeline(
+                {1: 'A', 2: 'B', 3: 'C', 4: 'D', 5: 'D'},
+                [(1, 'out', 2, 'in'), (1, 'out', 3, 'in'),
+                 (2, 'out', 4, 'in1'), (3, 'out', 5, 'in2'),
+                 (3, 'out', 4, 'in2')])
+        self.assertEqual(self.matched(query, target), set([1, 2, 3, 4]))
+
+    def test_disconnected(self):
+        query = self.make_pipeline({1: 'A', 2: 'B'}, [])
+        target = self.make_pipeline({1: 'A', 2: 'A', 3: 'C'}, [])
+        self.assertEqual(self.matched(query, target), set())
+        target = self.make_pipeline({1: 'A', 2: 'A', 3: 'B'}, [])
+        self.assertEqual(self.matched(query, target), set([1, 2, 3]))
+
+    def test_match_module(self):
+        query = self.make_pipeline({1: 'A', 2: 'B'}, [(1, 'out', 2, 'in')])
+        target = self.make_pipeline({1: 'A', 2: 'B', 3: 'A'},
+                                    [(1, 'out', 2, 'in'),
+                                     (3, 'out', 2, 'in')])
+        self.assertEqual(
+                self.matched(query, target,
+                             lambda target, query: target.id != 1),
+                set([2, 3]))
+        matcher = SubgraphMatcher(query)
+        mapping = matcher.find(PipelineGraphIndex(target), 1, 3)
+        self.assertEqual(mapping, {1: 3, 2: 2})
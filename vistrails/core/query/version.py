@@ -43,6 +43,7 @@ import time
 import unittest
 
 from vistrails.core.query import extract_text
+from vistrails.core.query.index import get_version_index
 from vistrails.core.system import time_strptime
 
 ################################################################################
@@ -69,6 +70,14 @@ class SearchStmt(object):
     def run(self, controller, n):
         pass
 
+    def candidates(self, index):
+        """candidates(index: VersionIndex) -> set or None
+        Returns the versions that can match according to the index, or None
+        if the index can't tell.
+
+        """
+        return None
+
     def __call__(self):
         """Make SearchStmt behave just like a QueryObject."""
         return self
@@ -406,6 +415,8 @@ class BeforeSearchStmt(TimeSearchStmt):
             return False
         t = time.mktime(time_strptime(action.date, "%d %b %Y %H:%M:%S"))
         return t <= self.date
+    def candidates(self, index):
+        return index.versions_between(end=self.date)
 
 class AfterSearchStmt(TimeSearchStmt):
     def match(self, controller, action):
@@ -413,6 +424,8 @@ class AfterSearchStmt(TimeSearchStmt):
             return False
         t = time.mktime(time_strptime(action.date, "%d %b %Y %H:%M:%S"))
         return t >= self.date
+    def candidates(self, index):
+        return index.versions_between(start=self.date)
 
 class RegexEnabledSearchStmt(SearchStmt):
     def __init__(self, content, use_regex):
@@ -432,6 +445,8 @@ class UserSearchStmt(RegexEnabledSearchStmt):
         if not action.user:
             return False
         return self._content_matches(action.user)
+    def candidates(self, index):
+        return index.find('user', self._content_matches)
 
 class NotesSearchStmt(RegexEnabledSearchStmt):
     def match(self, controller, action):
@@ -450,11 +465,25 @@ class NameSearchStmt(RegexEnabledSearchStmt):
         return bool(m)
 
 class ModuleSearchStmt(RegexEnabledSearchStmt):
+    _candidates = (None, None, None)
+    _outdated = (None, None, None)
+
     def match(self, controller, action):
         version = action.timestep
         from vistrails.core.configuration import get_vistrails_configuration
         hide_upgrades = getattr(get_vistrails_configuration(),
                                 'hideUpgrades', True)
+        # only materialize the pipelines that contain a matching module
+        vistrail = controller.vistrail
+        index = get_version_index(vistrail)
+        if hide_upgrades:
+            # unknown if the upgrade was not materialized yet
+            indexed = index.indexed_version(vistrail, version,
+                                            self.outdated(index))
+        else:
+            indexed = version
+        if indexed is not None and indexed not in self.candidates(index):
+            return False
         if hide_upgrades:
             version = controller.create_upgrade(version, delay_update=True)
         p = controller.get_pipeline(version, do_validate=False)
@@ -464,6 +493,18 @@ class ModuleSearchStmt(RegexEnabledSearchStmt):
         return False
     def matchModule(self, v, m):
         return self._content_matches(m.name)
+    def candidates(self, index):
+        cached_index, revision, versions = self._candidates
+        if cached_index is not index or revision != index.revision:
+            versions = index.find('module', self._content_matches)
+            self._candidates = (index, index.revision, versions)
+        return versions
+    def outdated(self, index):
+        cached_index, revision, versions = self._outdated
+        if cached_index is not index or revision != index.revision:
+            versions = index.outdated_versions()
+            self._outdated = (index, index.revision, versions)
+        return versions
 
 class AndSearchStmt(SearchStmt):
     def __init__(self, lst):
@@ -478,6 +519,17 @@ class AndSearchStmt(SearchStmt):
             if validModuleStmt(s):
                 return s.matchModule(v, m)
         return True
+    def candidates(self, index):
+        result = None
+        for s in self.matchList:
+            versions = s.candidates(index)
+            if versions is None:
+                continue
+            elif result is None:
+                result = set(versions)
+            else:
+                result.intersection_update(versions)
+        return result
 
 class OrSearchStmt(SearchStmt):
     def __init__(self, lst):
@@ -492,6 +544,14 @@ class OrSearchStmt(SearchStmt):
             if validModuleStmt(s):
                 return s.matchModule(v, m)
         return True
+    def candidates(self, index):
+        result = set()
+        for s in self.matchList:
+            versions = s.candidates(index)
+            if versions is None:
+                return None
+            result.update(versions)
+        return result
 
 class NotSearchStmt(SearchStmt):
     def __init__(self, stmt):
@@ -737,5 +797,73 @@ class TestSearch(unittest.TestCase):
         SearchCompiler('before')
         SearchCompiler('after')
 
+    def test_module_search_index(self):
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.vistrail.controller import VistrailController
+        import vistrails.core.system
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                 '/tests/resources/dummy.xml')
+        controller = VistrailController(locator.load(), locator)
+        vistrail = controller.vistrail
+        expected = set(
+                version
+                for version in vistrail.actionMap
+                if version != 0 and
+                any(m.name == 'FileSink'
+                    for m in vistrail.getPipeline(version).modules.itervalues()))
+        self.assertTrue(expected)
+
+        materialized = []
+        create_upgrade = controller.create_upgrade
+        def counting_create_upgrade(version, *args, **kwargs):
+            materialized.append(version)
+            return create_upgrade(version, *args, **kwargs)
+        controller.create_upgrade = counting_create_upgrade
+
+        stmt = SearchCompiler('module:FileSink').searchStmt
+        matched = set(version
+                      for version, action in vistrail.actionMap.items()
+                      if version != 0 and stmt.match(controller, action))
+        self.assertEqual(matched, expected)
+        # pipelines are only materialized for the matching versions
+        self.assertEqual(set(materialized), expected)
+
+    def test_module_search_upgrade(self):
+        from vistrails.core.db.action import create_action
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.location import Location
+        from vistrails.core.vistrail.module import Module
+        import vistrails.core.system
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                 '/tests/resources/dummy.xml')
+        controller = VistrailController(locator.load(), locator)
+        # index the vistrail before adding the version
+        SearchCompiler('module:Directory', True).searchStmt.candidates(
+                get_version_index(controller.vistrail))
+
+        # this module gets renamed to Directory by its upgrade
+        module = Module(id=controller.id_scope.getNewId(Module.vtType),
+                        name='GetItemsFromDirectory',
+                        package=vistrails.core.system.get_vistrails_basic_pkg_id(),
+                        version='1.5',
+                        location=Location(id=controller.id_scope.getNewId(
+                                                  Location.vtType),
+                                          x=0.0, y=0.0))
+        action = create_action([('add', module)])
+        controller.vistrail.add_action(action, 0)
+        version = action.id
+
+        stmt = SearchCompiler('module:Directory', True).searchStmt
+        self.assertTrue(stmt.match(controller, action))
+        # once the upgrade exists, its indexed terms are used
+        upgrade = controller.vistrail.get_upgrade(version, False)
+        self.assertNotEqual(upgrade, version)
+        index = get_version_index(controller.vistrail)
+        self.assertIn(upgrade, index.versions(('module', 'Directory')))
+        self.assertEqual(index.indexed_version(controller.vistrail, version,
+                                               index.outdated_versions()),
+                         upgrade)
+
 if __name__ == '__main__':
     unittest.main()
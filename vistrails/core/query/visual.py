@@ -36,11 +36,14 @@
 from __future__ import division
 
 from vistrails.core import query
+from vistrails.core.query.index import get_version_index
+from vistrails.core.query.subgraph import PipelineGraphIndex, SubgraphMatcher
 from vistrails.core.modules.module_registry import get_module_registry
 from vistrails.core import reportusage
 from vistrails.core.utils import append_to_dict_of_lists
 import copy
 import re
+import unittest
 
 ################################################################################
 
@@ -50,88 +53,50 @@ class VisualQuery(query.Query):
         self.queryPipeline = copy.copy(pipeline)
         self.versions_to_check = versions_to_check
 
-    def heuristicDAGIsomorphism(self,
-                                target, template,
-                                target_ids, template_ids):
-        resultIds = set()
-        while 1:
-            templateNames = set((i, template.modules[i].name)
-                                for i in template_ids)
-            targetNames = {}
-            for i in target_ids:
-                append_to_dict_of_lists(targetNames, target.modules[i].name, i)
-
-            nextTargetIds = set()
-            nextTemplateIds = set()
-
-            for (i, templateName) in templateNames:
-                if templateName not in targetNames:
-                    return (False, resultIds)
+    def candidates(self, index):
+        """candidates(index: VersionIndex) -> set
+        Returns the versions that contain all the modules of the query.
+
+        """
+        result = None
+        for module in self.queryPipeline.modules.itervalues():
+            terms = [('module', module.name)]
+            terms.extend(('function', module.name, function.name)
+                         for function in module.functions)
+            for term in terms:
+                if result is None:
+                    result = set(index.versions(term))
                 else:
-                    templateModule = template.modules[i]
-                    matched = [tId
-                               for tId in targetNames[templateName]
-                               if self.matchQueryModule(target.modules[tId],
-                                                        templateModule)]
-                    resultIds.update(matched)
-                    for matchedTargetId in matched:
-                        nextTargetIds.update([moduleId for
-                                              (moduleId, edgeId) in
-                                              target.graph.edges_from(matchedTargetId)])
-                    nextTemplateIds.update([moduleId for
-                                            (moduleId, edgeId) in
-                                            template.graph.edges_from(i)])
-
-            if not len(nextTemplateIds):
-                return (True, resultIds)
-
-            target_ids = nextTargetIds
-            template_ids = nextTemplateIds
+                    result.intersection_update(index.versions(term))
+        return result if result is not None else set()
 
     def run(self, controller, name):
         reportusage.record_feature('visualquery', controller)
         result = []
         self.tupleLength = 2
+        from vistrails.core.configuration import get_vistrails_configuration
+        hide_upgrades = getattr(get_vistrails_configuration(),
+                                'hideUpgrades', True)
+        matcher = SubgraphMatcher(self.queryPipeline, self.matchQueryModule)
+        # only materialize the pipelines that contain all the query modules
+        index = get_version_index(controller.vistrail)
+        candidate_versions = self.candidates(index)
+        if hide_upgrades:
+            outdated = index.outdated_versions()
         for version in self.versions_to_check:
-            from vistrails.core.configuration import get_vistrails_configuration
-            hide_upgrades = getattr(get_vistrails_configuration(),
-                                    'hideUpgrades', True)
+            if hide_upgrades:
+                # unknown if the upgrade was not materialized yet
+                indexed = index.indexed_version(controller.vistrail, version,
+                                                outdated)
+            else:
+                indexed = version
+            if indexed is not None and indexed not in candidate_versions:
+                continue
             if hide_upgrades:
                 version = controller.create_upgrade(version, delay_update=True)
             p = controller.get_pipeline(version, do_validate=False)
 
-            matches = set()
-            queryModuleNameIndex = {}
-            for moduleId, module in p.modules.iteritems():
-                append_to_dict_of_lists(queryModuleNameIndex, module.name, moduleId)
-            for querySourceId in self.queryPipeline.graph.sources():
-                querySourceName = self.queryPipeline.modules[querySourceId].name
-                if not queryModuleNameIndex.has_key(querySourceName):
-                    # need to reset matches here!
-                    matches = set()
-                    continue
-                candidates = queryModuleNameIndex[querySourceName]
-                atLeastOneMatch = False
-                for candidateSourceId in candidates:
-                    querySource = self.queryPipeline.modules[querySourceId]
-                    candidateSource = p.modules[candidateSourceId]
-                    if not self.matchQueryModule(candidateSource,
-                                                 querySource):
-                        continue
-                    (match, targetIds) = self.heuristicDAGIsomorphism \
-                                             (template = self.queryPipeline, 
-                                              target = p,
-                                              template_ids = [querySourceId],
-                                              target_ids = [candidateSourceId])
-                    if match:
-                        atLeastOneMatch = True
-                        matches.update(targetIds)
-                        
-                # We always perform AND operation
-                if not atLeastOneMatch:
-                    matches = set()
-                    break
-                
+            matches = matcher.matched_modules(PipelineGraphIndex(p))
             for m in matches:
                 result.append((version, m))
 
@@ -153,14 +118,18 @@ class VisualQuery(query.Query):
         """
         if target.name != template.name:
             return False
-        if target.getNumFunctions()>template.getNumFunctions():
+        # Module.functions sorts the functions, only get them once
+        targetFunctions = target.functions
+        if not targetFunctions:
+            return True
+        templateFunctions = template.functions
+        if len(targetFunctions)>len(templateFunctions):
             return False
         candidateFunctions = {}
-        for fid in xrange(template.getNumFunctions()):
-            f = template.functions[fid]
+        for f in templateFunctions:
             append_to_dict_of_lists(candidateFunctions, f.name, f)
 
-        for f in target.functions:
+        for f in targetFunctions:
             if f.name not in candidateFunctions:
                 return False
             fNotMatch = True
@@ -249,3 +218,35 @@ class VisualQuery(query.Query):
         #             except:
         #                 print 'Invalid query "%s".' % template.strValue
         #                 return False
+
+################################################################################
+
+class TestVisualQuery(unittest.TestCase):
+    def test_run(self):
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.pipeline import Pipeline
+        import vistrails.core.system
+        locator = XMLFileLocator(vistrails.core.system.vistrails_root_directory() +
+                                 '/tests/resources/dummy.xml')
+        controller = VistrailController(locator.load(), locator)
+        vistrail = controller.vistrail
+        versions = set(vistrail.actionMap) - set([0])
+        expected = set(
+                version
+                for version in versions
+                if any(m.name == 'StandardOutput'
+                       for m in vistrail.getPipeline(version).modules.itervalues()))
+        self.assertTrue(expected)
+
+        query_pipeline = Pipeline()
+        module = [m for m in vistrail.getPipeline(max(expected)).modules.itervalues()
+                  if m.name == 'StandardOutput'][0]
+        module = copy.copy(module)
+        module.functions = []
+        query_pipeline.add_module(module)
+        result = VisualQuery(query_pipeline, versions).run(controller, '')
+        matched = set(vistrail.get_upgrade(version, False)
+                      for version in expected)
+        self.assertEqual(set(version for version, module_id in result),
+                         matched)
@@ -137,16 +137,26 @@ class Action(DBAction):
         _action.__class__ = Action
         for _annotation in _action.annotations:
             Annotation.convert(_annotation)
-        for _operation in _action.operations:
-            if _operation.vtType == 'add':
-                AddOp.convert(_operation)
-            elif _operation.vtType == 'change':
-                ChangeOp.convert(_operation)
-            elif _operation.vtType == 'delete':
-                DeleteOp.convert(_operation)
-            else:
-                raise TypeError("Unknown operation type '%s'" %
-                                _operation.vtType)
+        operations = _action.operations
+        if getattr(operations, 'loaded', True):
+            for _operation in operations:
+                Action.convert_operation(_operation)
+        else:
+            # operations read lazily from a compact bundle get converted
+            # when they are loaded
+            operations.converters.append(Action.convert_operation)
+
+    @staticmethod
+    def convert_operation(_operation):
+        if _operation.vtType == 'add':
+            AddOp.convert(_operation)
+        elif _operation.vtType == 'change':
+            ChangeOp.convert(_operation)
+        elif _operation.vtType == 'delete':
+            DeleteOp.convert(_operation)
+        else:
+            raise TypeError("Unknown operation type '%s'" %
+                            _operation.vtType)
             
     ##########################################################################
     # Operators
@@ -92,6 +92,7 @@ from vistrails.core.vistrail.vistrail import Vistrail
 from vistrails.core.theme import DefaultCoreTheme
 from vistrails.db import VistrailsDBException
 from vistrails.db.domain import IdScope, DBWorkflowExec
+from vistrails.db.services.compact import get_action_store
 from vistrails.db.services.io import create_temp_folder, remove_temp_folder
 from vistrails.db.services.io import SaveBundle, open_vt_log_from_db
 from vistrails.db.services.vistrail import getSharedRoot
@@ -208,6 +209,8 @@ class VistrailController(object):
 
     def flush_pipeline_cache(self):
         self._pipelines = {0: Pipeline()}
+        if self.vistrail is not None:
+            self.vistrail.clear_pipeline_cache()
 
     def logging_on(self):
         return get_vistrails_configuration().check('executionLog')
@@ -2289,7 +2292,14 @@ class VistrailController(object):
     
     def find_abstractions(self, vistrail, recurse=False):
         abstractions = {}
-        for action in vistrail.actions:
+        store = get_action_store(vistrail)
+        if store is not None:
+            # don't read the chunks of a compact vistrail that don't add
+            # abstractions
+            actions = store.get_abstraction_actions()
+        else:
+            actions = vistrail.actions
+        for action in actions:
             for operation in action.operations:
                 if operation.vtType == 'add' or \
                         operation.vtType == 'change':
@@ -2624,6 +2634,9 @@ class VistrailController(object):
                 kwargs['vistrail_variables'] = \
                     self.get_vistrail_variable_by_uuid
             result = interpreter.execute(pipeline, **kwargs)
+            # The jobs we were waiting on have finished, resume the workflow
+            while result.suspended and self.jobMonitor.waitForJobs():
+                result = interpreter.execute(pipeline, **kwargs)
             
             thumb_cache = ThumbnailCache.getInstance()
             
@@ -4250,6 +4263,8 @@ class VistrailController(object):
         # Fast check: if target is cached, copy it and we're done.
         elif version in self._pipelines:
             result = copy.copy(self._pipelines[version])
+        elif self.vistrail.is_pipeline_cached(version):
+            result = self.vistrail.getPipeline(version)
         else:
             # Find the closest upstream pipeline to the current one
             cv = self._current_full_graph.inverse_immutable().closest_vertex
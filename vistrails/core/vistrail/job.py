@@ -48,7 +48,11 @@ from uuid import uuid1
 
 import datetime
 import getpass
+import heapq
+import itertools
 import json
+import os
+import threading
 import time
 import unittest
 import weakref
@@ -342,6 +346,133 @@ class Job(object):
         return True
 
 
+class JobPoller(object):
+    """ Checks job handles from a single background thread.
+
+    Each handle is checked with an exponential backoff, starting every
+    'min_interval' seconds and slowing down up to the interval given to
+    watch(). Watching a handle returns an Event that is set once the job is
+    done.
+    """
+    min_interval = 0.25
+    backoff = 2.0
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+        self._thread = None
+        self._pid = None
+
+    def watch(self, handle, max_interval, callback=None):
+        """ watch(handle: JobHandle, max_interval: float,
+                  callback: callable) -> threading.Event
+
+            Starts checking the handle; callback is called from the polling
+            thread once it is done.
+        """
+        event = threading.Event()
+        interval = min(self.min_interval, max_interval)
+        with self._condition:
+            self._ensure_thread()
+            heapq.heappush(self._queue, (time.time() + interval,
+                                         next(self._counter),
+                                         handle, interval, max_interval,
+                                         event, callback))
+            self._condition.notify()
+        return event
+
+    def cancel(self, event):
+        """ cancel(event: threading.Event) -> None
+
+            Stops checking the handle that was returned this event.
+        """
+        with self._condition:
+            self._queue = [entry for entry in self._queue
+                           if entry[5] is not event]
+            heapq.heapify(self._queue)
+
+    def pending(self):
+        with self._condition:
+            return len(self._queue)
+
+    def _ensure_thread(self):
+        # the thread doesn't survive a fork, start a new one if needed
+        if (self._thread is None or self._pid != os.getpid() or
+                not self._thread.is_alive()):
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run,
+                                            name='JobPoller')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.time():
+                    if self._queue:
+                        self._condition.wait(self._queue[0][0] - time.time())
+                    else:
+                        self._condition.wait()
+                entry = heapq.heappop(self._queue)
+            (_, _, handle, interval, max_interval,
+             event, callback) = entry
+            try:
+                done = is_job_done(handle)
+            except Exception, e:
+                debug.warning("Error checking job status", e)
+                done = True
+            if not done:
+                interval = min(interval * self.backoff, max_interval)
+                with self._condition:
+                    heapq.heappush(self._queue, (time.time() + interval,
+                                                 next(self._counter),
+                                                 handle, interval,
+                                                 max_interval,
+                                                 event, callback))
+                continue
+            event.set()
+            if callback is not None:
+                try:
+                    callback(handle)
+                except Exception, e:
+                    debug.unexpected_exception(e)
+
+_job_poller = None
+
+def get_job_poller():
+    """ get_job_poller() -> JobPoller
+
+        Returns the poller shared by all the JobMonitors.
+    """
+    global _job_poller
+    if _job_poller is None:
+        _job_poller = JobPoller()
+    return _job_poller
+
+def is_job_done(handle):
+    """ is_job_done(handle: JobHandle) -> bool
+
+        A job is done when it reaches finished or failed state
+        val() is used by stable batchq branch
+    """
+    finished = handle.finished()
+    if hasattr(finished, 'val'):
+        finished = finished.val()
+    if finished:
+        return True
+
+    # FIXME : deprecate this, remove from RemoteQ
+    # finished should just return True here too
+    if hasattr(handle, 'failed'):
+        failed = handle.failed()
+        if hasattr(failed, 'val'):
+            failed = failed.val()
+        if failed:
+            return True
+    return False
+
+
 class JobMonitor(object):
     """ Keeps a list of running jobs and the current job for a vistrail.
 
@@ -354,6 +485,8 @@ class JobMonitor(object):
         self.workflows = {}
         self.jobs = {}
         self.callback = None
+        # events for the jobs we are waiting on, see waitForJobs()
+        self._waiting = []
         if json_string is not None:
             self.unserialize(json_string)
 
@@ -520,6 +653,12 @@ class JobMonitor(object):
                 self.callback().finishWorkflow(workflow)
         finally:
             self._current_workflow = None
+            # stop checking jobs that nobody waited on
+            if self._waiting:
+                poller = get_job_poller()
+                for event in self._waiting:
+                    poller.cancel(event)
+                self._waiting = []
 
     def addJob(self, id, params=None, name='', finished=False):
         """ addJob(id: str, params: dict, name: str, finished: bool) -> uuid
@@ -584,21 +723,48 @@ class JobMonitor(object):
         conf = get_vistrails_configuration()
         interval = conf.jobCheckInterval
         if interval and not conf.jobAutorun:
-            if handle:
-                # wait for module to complete
-                try:
-                    while not self.isDone(handle):
-                        time.sleep(interval)
-                        print ("Waiting for job: %s,"
-                               "press Ctrl+C to suspend") % job.name
-                except KeyboardInterrupt:
-                    raise ModuleSuspended(module, 'Interrupted by user, job'
-                                          ' is still running', handle=handle)
+            if handle and not self.isDone(handle):
+                # Don't block here, so that independent modules can submit
+                # their jobs too; the caller waits for all of them with
+                # waitForJobs() and executes the workflow again
+                self._waiting.append(get_job_poller().watch(handle,
+                                                            interval))
+                raise ModuleSuspended(module, 'Waiting for job',
+                                      handle=handle)
         else:
             if not handle or not self.isDone(handle):
                 raise ModuleSuspended(module, 'Job is running',
                                       handle=handle)
 
+    def waitForJobs(self):
+        """ waitForJobs() -> bool
+
+            Blocks until all the jobs that checkJob() started waiting on are
+            done. Returns True if the workflow should be executed again to
+            get their results, False if there were no such jobs or if the
+            user interrupted the wait.
+
+        """
+        waiting, self._waiting = self._waiting, []
+        if not waiting:
+            return False
+        print ("Waiting for %d job(s), "
+               "press Ctrl+C to suspend") % len(waiting)
+        try:
+            for event in waiting:
+                # wait with a timeout so that Ctrl+C is not ignored
+                while not event.wait(1.0):
+                    pass
+        except KeyboardInterrupt:
+            poller = get_job_poller()
+            for event in waiting:
+                poller.cancel(event)
+            return False
+        # the workflow will be executed again, as if it was started again
+        if self._current_workflow is not None:
+            self._current_workflow.reset()
+        return True
+
     def getJob(self, id):
         """ getJob(id: str) -> Job
 
@@ -629,23 +795,8 @@ class JobMonitor(object):
         """ isDone(self, monitor) -> bool
 
             A job is done when it reaches finished or failed state
-            val() is used by stable batchq branch
         """
-        finished = handle.finished()
-        if hasattr(finished, 'val'):
-            finished = finished.val()
-        if finished:
-            return True
-
-        # FIXME : deprecate this, remove from RemoteQ
-        # finished should just return True here too
-        if hasattr(handle, 'failed'):
-            failed = handle.failed()
-            if hasattr(failed, 'val'):
-                failed = failed.val()
-            if failed:
-                return True
-        return False
+        return is_job_done(handle)
 
 
 ###############################################################################
@@ -688,3 +839,91 @@ class TestJob(unittest.TestCase):
         self.assertIn(workflow2.id, jm.workflows)
         self.assertEqual(workflow1, jm.workflows[workflow1.id])
         self.assertEqual(workflow2, jm.workflows[workflow2.id])
+
+
+class FakeJobHandle(object):
+    """ A local job handle that is done after it has been checked 'checks'
+        times.
+    """
+    def __init__(self, checks):
+        self.checks = checks
+        self.times = []
+
+    def finished(self):
+        self.times.append(time.time())
+        return len(self.times) > self.checks
+
+
+class TestJobPoller(unittest.TestCase):
+    def setUp(self):
+        conf = get_vistrails_configuration()
+        self.conf = conf.jobCheckInterval, conf.jobAutorun
+        conf.jobCheckInterval = 1
+        conf.jobAutorun = False
+
+    def tearDown(self):
+        conf = get_vistrails_configuration()
+        conf.jobCheckInterval, conf.jobAutorun = self.conf
+
+    def test_backoff(self):
+        poller = JobPoller()
+        poller.min_interval = 0.01
+        handle = FakeJobHandle(3)
+        done = []
+        event = poller.watch(handle, 0.04, done.append)
+        self.assertTrue(event.wait(5.0))
+        self.assertEqual(done, [handle])
+        self.assertEqual(len(handle.times), 4)
+        delays = [b - a for a, b in zip(handle.times, handle.times[1:])]
+        self.assertGreaterEqual(delays[-1], 0.035)
+        self.assertEqual(poller.pending(), 0)
+
+    def test_concurrent_jobs(self):
+        from vistrails.core.modules.vistrails_module import Module
+        jm = JobMonitor()
+        jm.startWorkflow(Workflow(1))
+        try:
+            handles = [FakeJobHandle(1), FakeJobHandle(1)]
+            # both jobs get submitted without waiting for the first one
+            for i, handle in enumerate(handles):
+                with self.assertRaises(ModuleSuspended):
+                    jm.checkJob(Module(), 'job%d' % i, handle)
+                self.assertEqual(len(handle.times), 1)
+            self.assertTrue(jm.waitForJobs())
+            for handle in handles:
+                self.assertEqual(len(handle.times), 2)
+            self.assertFalse(jm.waitForJobs())
+        finally:
+            jm.finishWorkflow()
+
+    def test_resume_workflow(self):
+        from vistrails.core.modules.module_registry import get_module_registry
+        from vistrails.core.packagemanager import get_package_manager
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        pm = get_package_manager()
+        if not pm.has_package('org.vistrails.vistrails.myjobs'):
+            pm.late_enable_package('myjob',
+                                   {'myjob': 'vistrails.tests.resources.'})
+        try:
+            descriptor = get_module_registry().get_descriptor_by_name(
+                    'org.vistrails.vistrails.myjobs', 'SuspendNJob')
+            controller = VistrailController(Vistrail(), auto_save=False)
+            controller.change_selected_version(0)
+            controller.add_module_from_descriptor(descriptor)
+            module = controller.add_module_from_descriptor(descriptor)
+            controller.update_function(module, 'n', ['2'])
+            jm = controller.jobMonitor
+            jm.startWorkflow(Workflow(controller.current_version))
+            try:
+                result = controller.execute_current_workflow()[0][0]
+            finally:
+                jm.finishWorkflow()
+            self.assertEqual(result.errors, {})
+            self.assertEqual(result.suspended, {})
+            self.assertEqual(len(jm.jobs), 2)
+            for job in jm.jobs.itervalues():
+                self.assertTrue(job.finished)
+        finally:
+            pm.late_disable_package('myjob')
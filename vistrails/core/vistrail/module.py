@@ -43,6 +43,7 @@ from itertools import izip
 import weakref
 
 from vistrails.db.domain import DBModule
+from vistrails.core.cache.hasher import Hasher
 from vistrails.core.vistrail.annotation import Annotation
 from vistrails.core.vistrail.location import Location
 from vistrails.core.vistrail.module_control_param import ModuleControlParam
@@ -154,12 +155,17 @@ class Module(DBModule):
     VISTRAIL_VAR_ANNOTATION = '__vistrail_var__'
     INLINE_WIDGET_ANNOTATION = '__inline_widgets__'
 
+    # set by Hasher, dropped when functions, control parameters or port
+    # specs are added, changed or deleted
+    _cached_signature = None
+    _signature_owner = None
+    _signature_descriptor = None
+
     ##########################################################################
 
     id = DBModule.db_id
     cache = DBModule.db_cache
     annotations = DBModule.db_annotations
-    control_parameters = DBModule.db_controlParameters
     location = DBModule.db_location
     center = DBModule.db_location
     name = DBModule.db_name
@@ -167,9 +173,23 @@ class Module(DBModule):
     namespace = DBModule.db_namespace
     package = DBModule.db_package
     version = DBModule.db_version
-    port_spec_list = DBModule.db_portSpecs
     internal_version = ''
 
+    def _get_control_parameters(self):
+        return self.db_controlParameters
+    def _set_control_parameters(self, control_parameters):
+        self.db_controlParameters = control_parameters
+        Hasher.clear_signature(self)
+    control_parameters = property(_get_control_parameters,
+                                  _set_control_parameters)
+
+    def _get_port_spec_list(self):
+        return self.db_portSpecs
+    def _set_port_spec_list(self, port_specs):
+        self.db_portSpecs = port_specs
+        Hasher.clear_signature(self)
+    port_spec_list = property(_get_port_spec_list, _set_port_spec_list)
+
     # type check this (list, hash)
     def _get_functions(self):
         self.db_functions.sort(key=lambda x: x.db_pos)
@@ -177,7 +197,17 @@ class Module(DBModule):
     def _set_functions(self, functions):
         # want to convert functions to hash...?
         self.db_functions = functions
+        Hasher.clear_signature(self)
     functions = property(_get_functions, _set_functions)
+    def db_add_function(self, function):
+        DBModule.db_add_function(self, function)
+        Hasher.clear_signature(self)
+    def db_change_function(self, function):
+        DBModule.db_change_function(self, function)
+        Hasher.clear_signature(self)
+    def db_delete_function(self, function):
+        DBModule.db_delete_function(self, function)
+        Hasher.clear_signature(self)
     def add_function(self, function):
         self.db_add_function(function)
     def has_function_with_real_id(self, f_id):
@@ -199,6 +229,15 @@ class Module(DBModule):
         self.db_add_controlParameter(controlParameter)
     def delete_control_parameter(self, controlParameter):
         self.db_delete_controlParameter(controlParameter)
+    def db_add_controlParameter(self, controlParameter):
+        DBModule.db_add_controlParameter(self, controlParameter)
+        Hasher.clear_signature(self)
+    def db_change_controlParameter(self, controlParameter):
+        DBModule.db_change_controlParameter(self, controlParameter)
+        Hasher.clear_signature(self)
+    def db_delete_controlParameter(self, controlParameter):
+        DBModule.db_delete_controlParameter(self, controlParameter)
+        Hasher.clear_signature(self)
     def has_control_parameter_with_name(self, name):
         return self.db_has_controlParameter_with_name(name)
     def get_control_parameter_by_name(self, name):
@@ -226,6 +265,7 @@ class Module(DBModule):
             self._input_port_specs.append(spec)
         elif spec.type == 'output':
             self._output_port_specs.append(spec)
+        Hasher.clear_signature(self)
     # override DBModule.db_add_portSpec so that _*_port_specs are updated
     db_add_portSpec = add_port_spec
     def delete_port_spec(self, spec):
@@ -234,8 +274,12 @@ class Module(DBModule):
         elif spec.type == 'output':
             self._output_port_specs.remove(spec)
         DBModule.db_delete_portSpec(self, spec)
+        Hasher.clear_signature(self)
     # override DBModule.db_delete_portSpec so that _*_port_specs are updated
     db_delete_portSpec = delete_port_spec
+    def db_change_portSpec(self, spec):
+        DBModule.db_change_portSpec(self, spec)
+        Hasher.clear_signature(self)
 
     def _get_input_port_specs(self):
         return sorted(self._input_port_specs, 
@@ -36,6 +36,7 @@
 from __future__ import division
 
 from vistrails.db.domain import DBControlParameter
+from vistrails.core.cache.hasher import Hasher
 
 import unittest
 import copy
@@ -44,6 +45,8 @@ class ModuleControlParam(DBControlParameter):
 
     # Valid control parameters should be put here
     LOOP_KEY = 'loop_type' # How input lists are combined
+    LOOP_EXECUTION_KEY = 'loop_execution' # 'serial' or 'process'
+    LOOP_WORKERS_KEY = 'loop_workers' # Number of processes for 'process'
     WHILE_COND_KEY = 'while_cond' # Run module in a while loop
     WHILE_INPUT_KEY = 'while_input' # input port for forwarded value
     WHILE_OUTPUT_KEY = 'while_output' # output port for forwarded value
@@ -52,6 +55,10 @@ class ModuleControlParam(DBControlParameter):
     CACHE_KEY = 'cache' # Turn caching on/off for this module (not implemented)
     JOB_CACHE_KEY = 'job_cache' # Always persist output values to disk
 
+    # set by Hasher, dropped by the setters below
+    _cached_signature = None
+    _signature_owner = None
+
     ##########################################################################
     # Constructors and copy
 
@@ -76,8 +83,20 @@ class ModuleControlParam(DBControlParameter):
     # Properties
 
     id = DBControlParameter.db_id
-    name = DBControlParameter.db_name
-    value = DBControlParameter.db_value
+
+    def _get_name(self):
+        return self.db_name
+    def _set_name(self, name):
+        self.db_name = name
+        Hasher.clear_signature(self)
+    name = property(_get_name, _set_name)
+
+    def _get_value(self):
+        return self.db_value
+    def _set_value(self, value):
+        self.db_value = value
+        Hasher.clear_signature(self)
+    value = property(_get_value, _set_value)
 
     ##########################################################################
     # Operators
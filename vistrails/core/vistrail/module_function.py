@@ -40,6 +40,7 @@
 from __future__ import division
 
 from vistrails.db.domain import DBFunction
+from vistrails.core.cache.hasher import Hasher
 from vistrails.core.modules.utils import create_port_spec_string
 from vistrails.core.utils import enum, VistrailsInternalError, all, eprint
 from vistrails.core.vistrail.module_param import ModuleParam
@@ -59,6 +60,10 @@ class ModuleFunction(DBFunction):
     __fields__ = ['name', 'returnType', 'params']
     """ Stores a function from a vistrail module """
 
+    # set by Hasher, dropped when the name or the parameters change
+    _cached_signature = None
+    _signature_owner = None
+
     ##########################################################################
     # Constructors and copy
     
@@ -106,7 +111,13 @@ class ModuleFunction(DBFunction):
     id = DBFunction.db_pos
     pos = DBFunction.db_pos
     real_id = DBFunction.db_id
-    name = DBFunction.db_name   
+
+    def _get_name(self):
+        return self.db_name
+    def _set_name(self, name):
+        self.db_name = name
+        Hasher.clear_signature(self)
+    name = property(_get_name, _set_name)
 
     def _get_sigstring(self):
         return create_port_spec_string([p.spec_tuple for p in self.params])
@@ -117,6 +128,7 @@ class ModuleFunction(DBFunction):
         return self.db_parameters
     def _set_params(self, params):
         self.db_parameters = params
+        Hasher.clear_signature(self)
     # If you're mutating the params property, watch out for the sort
     # gotcha: every time you use the params on reading position,
     # they get resorted
@@ -131,6 +143,18 @@ class ModuleFunction(DBFunction):
         for p in params:
             self.db_add_parameter(p)
 
+    def db_add_parameter(self, parameter):
+        DBFunction.db_add_parameter(self, parameter)
+        Hasher.clear_signature(self)
+
+    def db_change_parameter(self, parameter):
+        DBFunction.db_change_parameter(self, parameter)
+        Hasher.clear_signature(self)
+
+    def db_delete_parameter(self, parameter):
+        DBFunction.db_delete_parameter(self, parameter)
+        Hasher.clear_signature(self)
+
     ##########################################################################
 
     def getNumParams(self):
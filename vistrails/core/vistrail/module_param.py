@@ -40,6 +40,7 @@
 from __future__ import division
 
 from vistrails.db.domain import DBParameter
+from vistrails.core.cache.hasher import Hasher
 from vistrails.core.modules.utils import parse_port_spec_item_string, \
     create_port_spec_item_string
 from vistrails.core.utils import enum
@@ -55,6 +56,10 @@ from vistrails.core.system import get_vistrails_basic_pkg_id
 class ModuleParam(DBParameter):
     """ Stores a parameter setting for a vistrail function """
 
+    # set by Hasher, dropped by the setters below
+    _cached_signature = None
+    _signature_owner = None
+
     ##########################################################################
     # Constructor
 
@@ -141,11 +146,37 @@ class ModuleParam(DBParameter):
     id = DBParameter.db_pos
     pos = DBParameter.db_pos
     real_id = DBParameter.db_id
-    name = DBParameter.db_name
-    typeStr = DBParameter.db_type
-    strValue = DBParameter.db_val
     alias = DBParameter.db_alias
 
+    def _get_name(self):
+        return self.db_name
+    def _set_name(self, name):
+        self.db_name = name
+        Hasher.clear_signature(self)
+    name = property(_get_name, _set_name)
+
+    def _get_typeStr(self):
+        return self.db_type
+    def _set_typeStr(self, typeStr):
+        self.db_type = typeStr
+        Hasher.clear_signature(self)
+    typeStr = property(_get_typeStr, _set_typeStr)
+
+    def _get_strValue(self):
+        return self.db_val
+    def _set_strValue(self, strValue):
+        self.db_val = strValue
+        Hasher.clear_signature(self)
+    strValue = property(_get_strValue, _set_strValue)
+
+    def _get_evaluatedStrValue(self):
+        return self._evaluatedStrValue
+    def _set_evaluatedStrValue(self, evaluatedStrValue):
+        self._evaluatedStrValue = evaluatedStrValue
+        Hasher.clear_signature(self)
+    evaluatedStrValue = property(_get_evaluatedStrValue,
+                                 _set_evaluatedStrValue)
+
     def parse_db_type(self):
         if self.db_type:
             (self._identifier, self._type, self._namespace) = \
@@ -163,6 +194,7 @@ class ModuleParam(DBParameter):
             self.db_type = create_port_spec_item_string(self._identifier,
                                                         self._type,
                                                         self._namespace)
+        Hasher.clear_signature(self)
 
     def _get_type(self):
         if not hasattr(self, '_type'):
@@ -38,7 +38,6 @@
 from __future__ import division
 
 from vistrails.core.cache.hasher import Hasher
-from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core.data_structures.graph import Graph, GraphContainsCycles
 from vistrails.core import debug
@@ -54,6 +53,7 @@ from vistrails.db.domain import DBWorkflow
 from vistrails.core.utils import InvalidPipeline
 
 import copy
+from itertools import chain
 
 import unittest
 from vistrails.core.vistrail.abstraction import Abstraction
@@ -110,6 +110,48 @@ class CycleInPipeline(Exception):
     def __str__(self):
         return "Pipeline contains a cycle"
 
+class _ValidationState(object):
+    """Results of the last validation of a pipeline, per module and
+    connection, along with the modules and connections changed since then.
+
+    These results only hold for the registry they were computed against.
+
+    """
+    def __init__(self, registry):
+        self.registry_key = (id(registry), registry.generation)
+        self.module_errors = {}
+        self.connection_errors = {}
+        self.cycle_errors = set()
+        self.modules = set()
+        self.connections = set()
+        # modules whose list depth needs updating, None for all of them
+        self.list_depth_modules = None
+
+    def __copy__(self):
+        cp = _ValidationState.__new__(_ValidationState)
+        cp.registry_key = self.registry_key
+        cp.module_errors = dict(self.module_errors)
+        cp.connection_errors = dict(self.connection_errors)
+        cp.cycle_errors = set(self.cycle_errors)
+        cp.modules = set(self.modules)
+        cp.connections = set(self.connections)
+        if self.list_depth_modules is None:
+            cp.list_depth_modules = None
+        else:
+            cp.list_depth_modules = set(self.list_depth_modules)
+        return cp
+
+    def is_current(self, registry):
+        return self.registry_key == (id(registry), registry.generation)
+
+    def errors(self):
+        errors = set(self.cycle_errors)
+        for module_errors in self.module_errors.itervalues():
+            errors.update(module_errors)
+        for connection_errors in self.connection_errors.itervalues():
+            errors.update(connection_errors)
+        return errors
+
 class Pipeline(DBWorkflow):
     """ A Pipeline is a set of modules and connections between them. """
     
@@ -134,6 +176,9 @@ class Pipeline(DBWorkflow):
             self._subpipeline_signatures = Bidict()
             self._module_signatures = Bidict()
             self._connection_signatures = Bidict()
+            self._signature_upstream = {}
+            self._validation = None
+            self._owners = None
         else:
             self.is_valid = other.is_valid
             self.aliases = Bidict([(k,copy.copy(v))
@@ -147,6 +192,9 @@ class Pipeline(DBWorkflow):
             self._module_signatures = \
                 Bidict([(k,copy.copy(v))
                         for (k,v) in other._module_signatures.iteritems()])
+            self._signature_upstream = dict(other._signature_upstream)
+            self._validation = copy.copy(other._validation)
+            self._owners = None
 
         self.graph = Graph()
         for module in self.module_list:
@@ -189,6 +237,8 @@ class Pipeline(DBWorkflow):
         cp = DBWorkflow.do_copy(self, new_ids, id_scope, id_remap)
         cp.__class__ = Pipeline
         cp.set_defaults(self)
+        if new_ids:
+            cp._validation = None
         return cp
 
     @staticmethod
@@ -264,6 +314,9 @@ class Pipeline(DBWorkflow):
         self._subpipeline_signatures = Bidict()
         self._module_signatures = Bidict()
         self._connection_signatures = Bidict()
+        self._signature_upstream = {}
+        self._validation = None
+        self._owners = None
 
     def get_tmp_id(self, type):
         """get_tmp_id(type: str) -> long
@@ -350,6 +403,22 @@ class Pipeline(DBWorkflow):
                     (op.vtType, op.what)
                 raise VistrailsInternalError(msg)
 
+        # Only the downstream cone of the modified modules needs to be
+        # rehashed, and only the modified objects revalidated
+        has_signatures = bool(self._module_signatures or
+                              self._subpipeline_signatures)
+        if has_signatures or self._validation is not None:
+            module_ids = self._operation_modules(op)
+            if has_signatures:
+                if module_ids is None:
+                    self._invalidate_signatures(self.modules.keys())
+                else:
+                    self._invalidate_signatures(module_ids)
+            if module_ids is None:
+                self._validation = None
+            else:
+                self._mark_modified(module_ids)
+
         if op.vtType == 'add':
             f(op.data, op.parentObjType, op.parentObjId)
         elif op.vtType == 'delete':
@@ -369,6 +438,7 @@ class Pipeline(DBWorkflow):
 #             m.abstraction = self.abstraction_map[m.abstraction_id]
         self.db_add_object(m)
         self.graph.add_vertex(m.id)
+        self._mark_modified([m.id])
 
     def change_module(self, old_id, m, *args):
         if not self.has_module_with_id(old_id):
@@ -376,6 +446,7 @@ class Pipeline(DBWorkflow):
         self.db_change_object(old_id, m)
         self.graph.delete_vertex(old_id)
         self.graph.add_vertex(m.id)
+        self._mark_modified([old_id, m.id])
 
     def delete_module(self, id, *args):
         """delete_module(id:int) -> None 
@@ -398,6 +469,7 @@ class Pipeline(DBWorkflow):
             del self._module_signatures[id]
         if id in self._subpipeline_signatures:
             del self._subpipeline_signatures[id]
+        self._mark_modified([id])
 
     def add_connection(self, c, *args):
         """add_connection(c: Connection) -> None 
@@ -408,10 +480,12 @@ class Pipeline(DBWorkflow):
             raise VistrailsInternalError("duplicate connection id " + str(c.id))
 #         self.connections[c.id] = copy.copy(c)
         self.db_add_object(c)
+        self._mark_modified(connection_ids=[c.id])
         if c.source is not None and c.destination is not None:
             assert(c.sourceId != c.destinationId)        
             self.graph.add_edge(c.sourceId, c.destinationId, c.id)
             self.ensure_connection_specs([c.id])
+            self._mark_modified([c.destinationId])
 
             source_name = c.source.name
             output_ports = self.modules[c.sourceId].connected_output_ports
@@ -434,6 +508,8 @@ class Pipeline(DBWorkflow):
             raise VistrailsInternalError("connection %s doesn't exist" % old_id)
 
         old_conn = self.connections[old_id]
+        self._mark_connection_modified(old_conn)
+        self._mark_modified(connection_ids=[c.id])
         if old_conn.source is not None and old_conn.destination is not None:
             self.graph.delete_edge(old_conn.sourceId, old_conn.destinationId,
                                    old_conn.id)
@@ -452,6 +528,7 @@ class Pipeline(DBWorkflow):
             assert(c.sourceId != c.destinationId)
             self.graph.add_edge(c.sourceId, c.destinationId, c.id)
             self.ensure_connection_specs([c.id])
+            self._mark_modified([c.destinationId])
             self.modules[c.sourceId].connected_output_ports.add(c.source.name)
             self.modules[c.destinationId].connected_input_ports.add(
                 c.destination.name)
@@ -465,6 +542,7 @@ class Pipeline(DBWorkflow):
         if not self.has_connection_with_id(id):
             raise VistrailsInternalError("id %s missing in connections" % id)
         conn = self.connections[id]
+        self._mark_connection_modified(conn)
         # self.connections.pop(id)
         self.db_delete_object(id, 'connection')
         if conn.source is not None and conn.destination is not None and \
@@ -484,6 +562,29 @@ class Pipeline(DBWorkflow):
         if id in self._connection_signatures:
             del self._connection_signatures[id]
         
+    def _mark_modified(self, module_ids=(), connection_ids=()):
+        """Records modules and connections to check again on the next
+        validate().
+
+        """
+        if self._validation is not None:
+            self._validation.modules.update(module_ids)
+            self._validation.connections.update(connection_ids)
+
+    def _mark_connection_modified(self, connection):
+        self._mark_modified(connection_ids=[connection.id])
+        if connection.destination is not None:
+            self._mark_modified([connection.destinationId])
+
+    def reset_validation(self):
+        """reset_validation() -> None
+        Forgets the results of the previous validations, so that the next
+        call to validate() checks the whole pipeline. This is needed after
+        modifying modules in place rather than through actions.
+
+        """
+        self._validation = None
+
     def add_parameter(self, param, parent_type, parent_id):
         self.db_add_object(param, parent_type, parent_id)
         if not self.has_alias(param.alias):
@@ -516,6 +617,7 @@ class Pipeline(DBWorkflow):
     def add_port(self, port, parent_type, parent_id):
         self.db_add_object(port, parent_type, parent_id)
         connection = self.connections[parent_id]
+        self._mark_connection_modified(connection)
         if connection.source is not None and \
                 connection.destination is not None:
             self.graph.add_edge(connection.sourceId, 
@@ -536,6 +638,7 @@ class Pipeline(DBWorkflow):
 
     def delete_port(self, port_id, port_type, parent_type, parent_id):
         conn = self.connections[parent_id]
+        self._mark_connection_modified(conn)
         if len(conn.ports) >= 2:
             self.graph.delete_edge(conn.sourceId, 
                                    conn.destinationId, 
@@ -559,7 +662,9 @@ class Pipeline(DBWorkflow):
             dest_list = \
                 self.graph.inverse_adjacency_list[connection.destinationId]
             dest_list.remove((connection.sourceId, connection.id))
+        self._mark_connection_modified(connection)
         self.db_change_object(old_port_id, port, parent_type, parent_id)
+        self._mark_connection_modified(connection)
         if len(connection.ports) >= 2:
             source_list = self.graph.adjacency_list[connection.sourceId]
             source_list.append((connection.destinationId, connection.id))
@@ -773,28 +878,59 @@ class Pipeline(DBWorkflow):
 
     # Subpipelines
 
-    def subpipeline_signature(self, module_id, visited_ids=None):
+    def subpipeline_signature(self, module_id):
         """subpipeline_signature(module_id): string
         Returns the signature for the subpipeline whose sink id is module_id."""
-        if visited_ids is None:
-            visited_ids = set([module_id])
-        elif module_id in visited_ids:
-            raise CycleInPipeline()
         try:
             return self._subpipeline_signatures[module_id]
         except KeyError:
-            upstream_sigs = [(self.subpipeline_signature(
-                                      m,
-                                      visited_ids | set([module_id])) +
+            self._compute_subpipeline_signatures([module_id])
+            return self._subpipeline_signatures[module_id]
+
+    def _compute_subpipeline_signatures(self, module_ids):
+        """Computes the missing subpipeline signatures for the given modules
+        and their upstream, in a single topological pass.
+
+        A module's signature is only ever cached if the signatures of all
+        its upstream modules are, so the walk stops at cached modules.
+
+        """
+        signatures = self._subpipeline_signatures
+        graph = self.graph
+        # number of upstream edges whose source still needs a signature
+        pending = {}
+        stack = [m for m in module_ids if m not in signatures]
+        while stack:
+            module_id = stack.pop()
+            if module_id in pending:
+                continue
+            count = 0
+            for (m, _) in graph.edges_to(module_id):
+                if m not in signatures:
+                    count += 1
+                    if m not in pending:
+                        stack.append(m)
+            pending[module_id] = count
+
+        ready = [m for (m, count) in pending.iteritems() if count == 0]
+        while ready:
+            module_id = ready.pop()
+            del pending[module_id]
+            upstream_sigs = [(signatures[m] +
                               Hasher.connection_signature(
                                       self.connections[edge_id]))
-                             for (m, edge_id) in
-                             self.graph.edges_to(module_id)]
+                             for (m, edge_id) in graph.edges_to(module_id)]
             module_sig = self.module_signature(module_id)
-            sig = Hasher.subpipeline_signature(module_sig,
-                                               upstream_sigs)
-            self._subpipeline_signatures[module_id] = sig
-            return sig
+            signatures[module_id] = Hasher.subpipeline_signature(
+                    module_sig, upstream_sigs)
+            for (m, _) in graph.edges_from(module_id):
+                if m in pending:
+                    pending[m] -= 1
+                    if pending[m] == 0:
+                        ready.append(m)
+        if pending:
+            # the modules left over are in or downstream of a cycle
+            raise CycleInPipeline()
 
     def subpipeline_id_from_signature(self, signature):
         """subpipeline_id_from_signature(sig): int
@@ -828,16 +964,165 @@ class Pipeline(DBWorkflow):
         return signature in self._connection_signatures.inverse
 
     def refresh_signatures(self):
-        self._connection_signatures = {}
-        self._subpipeline_signatures = {}
-        self._module_signatures = {}
+        """refresh_signatures(): recompute the signatures of this pipeline.
+
+        This is for pipelines modified without perform_operation(). The
+        modules whose signature or upstream connections changed since the
+        last time are found, and only the signatures that depend on them
+        are dropped and recomputed.
+
+        """
+        registry = get_module_registry()
+        module_sigs = self._module_signatures
+        old_upstream = self._signature_upstream
+        self._signature_upstream = {}
+
+        # modules that were removed
+        changed = set(m for m in module_sigs if m not in self.modules)
+        changed.update(m for m in self._subpipeline_signatures
+                       if m not in self.modules)
+        for module_id, module in self.modules.iteritems():
+            upstream = self._upstream_key(module_id)
+            self._signature_upstream[module_id] = upstream
+            if old_upstream.get(module_id) != upstream:
+                changed.add(module_id)
+            elif (module_id in module_sigs and
+                    module_sigs[module_id] !=
+                    registry.module_signature(self, module)):
+                changed.add(module_id)
+        self._invalidate_signatures(changed)
         self.compute_signatures()
 
+    def _upstream_key(self, module_id):
+        """Describes the connections going into a module, to detect changes
+        that affect its subpipeline signature.
+
+        """
+        connections = self.connections
+        return sorted((m, edge_id,
+                       connections[edge_id].source.name,
+                       connections[edge_id].destination.name)
+                      for (m, edge_id) in self.graph.edges_to(module_id))
+
+    def _invalidate_signatures(self, module_ids):
+        """Drops the signatures that depend on the given modules: their
+        module signatures, and the subpipeline signatures of their
+        downstream cone along with the connection signatures into it.
+
+        """
+        graph = self.graph
+        signatures = self._subpipeline_signatures
+        module_ids = set(module_ids)
+        if any(m in self._module_signatures for m in module_ids):
+            self._module_signatures = Bidict(
+                    (k, v)
+                    for k, v in self._module_signatures.iteritems()
+                    if k not in module_ids)
+        # Nothing downstream of a module without a signature has one
+        dirty = set(m for m in module_ids if m in signatures)
+        if not dirty:
+            return
+        # modules already removed from the graph have no downstream left
+        stack = [m for m in dirty if m in graph.vertices]
+        while stack:
+            for (m, _) in graph.edges_from(stack.pop()):
+                if m not in dirty and m in signatures:
+                    dirty.add(m)
+                    stack.append(m)
+        # Rebuild the mappings so that their inverses stay consistent
+        self._subpipeline_signatures = Bidict(
+                (k, v)
+                for k, v in signatures.iteritems()
+                if k not in dirty)
+        connections = self.connections
+        self._connection_signatures = Bidict(
+                (k, v)
+                for k, v in self._connection_signatures.iteritems()
+                if k in connections and
+                connections[k].destinationId not in dirty)
+
+    def _operation_modules(self, op):
+        """Returns the ids of the modules whose signatures an operation may
+        change, or None if they can't be determined.
+
+        """
+        what = op.db_what
+        parent_type = op.parentObjType
+        if what in ('module', 'abstraction', 'group'):
+            if op.vtType == 'add':
+                return [op.data.id]
+            elif op.vtType == 'delete':
+                return [op.objectId]
+            return [op.oldObjId]
+        elif what == 'connection':
+            module_ids = []
+            if op.vtType != 'add':
+                if op.vtType == 'delete':
+                    c = self.connections.get(op.objectId)
+                else:
+                    c = self.connections.get(op.oldObjId)
+                if c is not None and c.destination is not None:
+                    module_ids.append(c.destinationId)
+            if op.vtType != 'delete' and op.data.destination is not None:
+                module_ids.append(op.data.destinationId)
+            return module_ids
+        elif what in ('location', 'annotation'):
+            # these don't take part in the signatures
+            return []
+        elif parent_type in ('module', 'abstraction', 'group'):
+            if (what in ('function', 'portSpec') and
+                    self._owners is not None and op.vtType != 'delete'):
+                self._owners[(what, op.data.db_id)] = op.parentObjId
+            return [op.parentObjId]
+        elif parent_type == 'connection':
+            # changing a port moves or reroutes the connection
+            module_ids = []
+            c = self.connections.get(op.parentObjId)
+            if c is not None and c.destination is not None:
+                module_ids.append(c.destinationId)
+            if op.vtType != 'delete' and op.data.type == 'destination':
+                module_ids.append(op.data.moduleId)
+            return module_ids
+        elif parent_type in ('function', 'portSpec'):
+            module_id = self._owner_module(parent_type, op.parentObjId)
+            if module_id is None:
+                return None
+            return [module_id]
+        elif parent_type in (None, 'workflow'):
+            return []
+        return None
+
+    def _owner_module(self, what, obj_id):
+        """Returns the id of the module that has the function or port spec
+        with this id, or None if there is none.
+
+        The owners are indexed the first time, then kept up to date by
+        _operation_modules(); the index is rebuilt if it turns out stale.
+
+        """
+        for rebuild in (False, True):
+            if rebuild or self._owners is None:
+                self._owners = owners = {}
+                for module in self.modules.itervalues():
+                    for function in module.db_functions:
+                        owners[('function', function.db_id)] = module.id
+                    for spec in getattr(module, 'db_portSpecs', ()):
+                        owners[('portSpec', spec.db_id)] = module.id
+            module_id = self._owners.get((what, obj_id))
+            module = self.modules.get(module_id)
+            if module is not None:
+                if what == 'function':
+                    children = module.db_functions_id_index
+                else:
+                    children = getattr(module, 'db_portSpecs_id_index', {})
+                if obj_id in children:
+                    return module_id
+        return None
+
     def compute_signatures(self):
         """compute_signatures(): compute all module and subpipeline signatures
         for this pipeline."""
-        for i in self.modules.iterkeys():
-            self.subpipeline_signature(i)
+        self._compute_subpipeline_signatures(self.modules.keys())
         for c in self.connections.iterkeys():
             self.connection_signature(c)
 
@@ -848,60 +1133,62 @@ class Pipeline(DBWorkflow):
         # want to check entire pipeline and reconcile it with the
         # registry - if anything fails, generate invalid pipeline with
         # the errors
-        exceptions = set()
-        try:
-            self.ensure_modules_are_on_registry()
-        except InvalidPipeline, e:
-            exceptions.update(e.get_exception_set())
+        # If this pipeline was validated before against the same registry,
+        # only the modules and connections changed since are checked again
+        registry = get_module_registry()
+        state = self._validation
+        self._validation = None
+        if state is None or not state.is_current(registry):
+            state = _ValidationState(registry)
+            module_ids = set(self.modules.iterkeys())
+            connection_ids = set(self.connections.iterkeys())
+            check_cycles = True
+        else:
+            module_ids, connection_ids = self._take_modified(state)
+            # a single search, whatever the number of new connections
+            check_cycles = bool(state.cycle_errors or connection_ids)
+            # the connections of a module depend on its port specs
+            for module_id in module_ids:
+                connection_ids.update(
+                        conn_id
+                        for (_, conn_id) in chain(
+                                self.graph.edges_from(module_id),
+                                self.graph.edges_to(module_id)))
 
         # check for cycles
-        try:
-            self.graph.dfs(raise_if_cyclic=True)
-        except GraphContainsCycles, e:
-            exceptions.add(e)
+        if check_cycles:
+            state.cycle_errors = set()
+            try:
+                self.graph.dfs(raise_if_cyclic=True)
+            except GraphContainsCycles, e:
+                state.cycle_errors.add(e)
+
+        # modules first, it is possible that a subpipeline invalidates the
+        # module, meaning we shouldn't check the connection specs
+        for module_id in module_ids:
+            errors = self._validate_module(module_id)
+            if errors:
+                state.module_errors[module_id] = errors
+            else:
+                state.module_errors.pop(module_id, None)
+        for conn_id in connection_ids:
+            try:
+                self.ensure_connection_specs([conn_id])
+            except InvalidPipeline, e:
+                state.connection_errors[conn_id] = e.get_exception_set()
+            else:
+                state.connection_errors.pop(conn_id, None)
 
-        # do this before we check connection specs because it is
-        # possible that a subpipeline invalidates the module, meaning
-        # we shouldn't check the connection specs
-        for module in self.modules.itervalues():
-            if module.is_valid and (module.is_group() or 
-                                    module.is_abstraction()):
-                try:
-                    subpipeline = module.pipeline
-                    if subpipeline is not None:
-                        subpipeline.validate()
-                except InvalidPipeline, e:
-                    module.is_valid = False
-                    e._module_id = module.id
-                    exceptions.add(e)
-                if module.is_abstraction():
-                    try:
-                        desc = module.module_descriptor
-                        if long(module.internal_version) != long(desc.version):
-                            exceptions.add(MissingModuleVersion(
-                                desc.package, desc.name, desc.namespace,
-                                desc.version, desc.package_version, module.id))
-                    except Exception:
-                        pass
-        try:
-            self.ensure_port_specs()
-        except InvalidPipeline, e:
-            exceptions.update(e.get_exception_set())
-        try:
-            self.ensure_connection_specs()
-        except InvalidPipeline, e:
-            exceptions.update(e.get_exception_set())
-        try:
-            self.ensure_functions()
-        except InvalidPipeline, e:
-            exceptions.update(e.get_exception_set())
+        exceptions = state.errors()
         try:
             self.ensure_vistrail_variables(vistrail_vars)
         except InvalidPipeline, e:
             exceptions.update(e.get_exception_set())
-        
-        self.check_subworkflow_versions()
-        
+
+        if state.list_depth_modules is not None:
+            state.list_depth_modules.update(module_ids)
+        self._validation = state
+
         if len(exceptions) > 0:
             if raise_exception:
                 raise InvalidPipeline(exceptions, self)
@@ -909,11 +1196,51 @@ class Pipeline(DBWorkflow):
                 self.is_valid = False
                 return False
 
-        self.mark_list_depth()
+        self.mark_list_depth(state.list_depth_modules)
+        state.list_depth_modules = set()
 
         self.is_valid = True
         return True
 
+    def _take_modified(self, state):
+        """Returns the modules and connections changed since the last
+        validation that are still in the pipeline, and forgets about the
+        others.
+
+        """
+        module_ids = set()
+        for module_id in state.modules:
+            if module_id in self.modules:
+                module_ids.add(module_id)
+            else:
+                state.module_errors.pop(module_id, None)
+        connection_ids = set()
+        for conn_id in state.connections:
+            if conn_id in self.connections:
+                connection_ids.add(conn_id)
+            else:
+                state.connection_errors.pop(conn_id, None)
+        state.modules = set()
+        state.connections = set()
+        return module_ids, connection_ids
+
+    def _validate_module(self, module_id):
+        """Runs the checks that only concern a single module, returns the
+        set of exceptions found.
+
+        """
+        exceptions = set()
+        for check in (self.ensure_modules_are_on_registry,
+                      self.ensure_subpipelines,
+                      self.ensure_port_specs,
+                      self.ensure_functions):
+            try:
+                check([module_id])
+            except InvalidPipeline, e:
+                exceptions.update(e.get_exception_set())
+        self.check_subworkflow_versions([module_id])
+        return exceptions
+
     def ensure_old_modules_have_package_names(self):
         """ensure_old_modules_have_package_names()
 
@@ -989,7 +1316,6 @@ class Pipeline(DBWorkflow):
         """
         def find_descriptors(pipeline, module_ids=None):
             registry = get_module_registry()
-            conf = get_vistrails_configuration()
             if module_ids is None:
                 module_ids = pipeline.modules.iterkeys()
             exceptions = set()
@@ -1014,10 +1340,13 @@ class Pipeline(DBWorkflow):
         if len(exceptions) > 0:
             raise InvalidPipeline(exceptions, self)
 
-    def ensure_functions(self):
+    def ensure_functions(self, module_ids=None):
         exceptions = set()
         reg = get_module_registry()
-        for module in self.modules.itervalues():
+        if module_ids is None:
+            module_ids = self.modules.iterkeys()
+        for module_id in module_ids:
+            module = self.modules[module_id]
             for function in module.functions:
                 is_valid = True
                 if module.is_valid and not module.has_port_spec(function.name, 
@@ -1080,9 +1409,46 @@ class Pipeline(DBWorkflow):
         if len(exceptions) > 0:
             raise InvalidPipeline(exceptions, self)
 
-    def ensure_port_specs(self):
+    def ensure_subpipelines(self, module_ids=None):
+        """ensure_subpipelines(module_ids: optional list of module ids) -> None
+
+        Validates the pipelines of the groups and abstractions, and checks
+        that the abstractions are at the version of their descriptor.
+
+        """
         exceptions = set()
-        for module in self.modules.itervalues():
+        if module_ids is None:
+            module_ids = self.modules.iterkeys()
+        for module_id in module_ids:
+            module = self.modules[module_id]
+            if module.is_valid and (module.is_group() or 
+                                    module.is_abstraction()):
+                try:
+                    subpipeline = module.pipeline
+                    if subpipeline is not None:
+                        subpipeline.validate()
+                except InvalidPipeline, e:
+                    module.is_valid = False
+                    e._module_id = module.id
+                    exceptions.add(e)
+                if module.is_abstraction():
+                    try:
+                        desc = module.module_descriptor
+                        if long(module.internal_version) != long(desc.version):
+                            exceptions.add(MissingModuleVersion(
+                                desc.package, desc.name, desc.namespace,
+                                desc.version, desc.package_version, module.id))
+                    except Exception:
+                        pass
+        if len(exceptions) > 0:
+            raise InvalidPipeline(exceptions, self)
+
+    def ensure_port_specs(self, module_ids=None):
+        exceptions = set()
+        if module_ids is None:
+            module_ids = self.modules.iterkeys()
+        for module_id in module_ids:
+            module = self.modules[module_id]
             # if module.is_valid:
             try:
                 for port_spec in module.port_specs.itervalues():
@@ -1106,9 +1472,11 @@ class Pipeline(DBWorkflow):
         if len(exceptions) > 0:
             raise InvalidPipeline(exceptions, self)
 
-    def check_subworkflow_versions(self):
-        reg = get_module_registry()
-        for module in self.modules.itervalues():
+    def check_subworkflow_versions(self, module_ids=None):
+        if module_ids is None:
+            module_ids = self.modules.iterkeys()
+        for module_id in module_ids:
+            module = self.modules[module_id]
             if module.is_valid and module.is_abstraction():
                 module.check_latest_version()
 
@@ -1127,10 +1495,14 @@ class Pipeline(DBWorkflow):
         """
         from vistrails.core.modules.basic_modules import List, Variant
 
-        # TODO: module_ids is currently ignored, this is potentially suboptimal
         result = []
+        if module_ids is not None:
+            # the sort visits everything downstream of module_ids
+            module_ids = [m for m in module_ids if m in self.graph.vertices]
+            if not module_ids:
+                return result
         # Might raise GraphContainsCycles
-        for module_id in self.graph.vertices_topological_sort():
+        for module_id in self.graph.vertices_topological_sort(module_ids):
             module = self.get_module_by_id(module_id)
             module.list_depth = 0
             ports = []
@@ -1595,6 +1967,301 @@ class TestPipeline(unittest.TestCase):
         self.assertNotEquals(p1.module_signature(3),
                              p2.module_signature(3))
 
+    def test_refresh_signatures(self):
+        """Only the downstream of a change gets new signatures."""
+        basic_pkg = get_vistrails_basic_pkg_id()
+        p = Pipeline()
+        for i in xrange(3):
+            p.add_module(Module(
+                    id=i, name='Float', package=basic_pkg,
+                    functions=[ModuleFunction(name='value', parameters=[
+                            ModuleParam(type='Float', val='%d.0' % i)])]))
+        for i, (src, dst) in enumerate([(0, 1), (1, 2)]):
+            sig = '(%s:Float)' % basic_pkg
+            p.add_connection(Connection(id=i, ports=[
+                    Port(id=2*i, type='source', moduleId=src,
+                         moduleName='Float', name='value', signature=sig),
+                    Port(id=2*i+1, type='destination', moduleId=dst,
+                         moduleName='Float', name='value', signature=sig)]))
+        p.refresh_signatures()
+        before = dict(p._subpipeline_signatures)
+        before_conns = dict(p._connection_signatures)
+
+        # Nothing changed
+        p.refresh_signatures()
+        self.assertEqual(before, dict(p._subpipeline_signatures))
+        self.assertEqual(before_conns, dict(p._connection_signatures))
+
+        # Parameter of the middle module changed
+        p.modules[1].functions[0].params[0].strValue = '42.0'
+        p.refresh_signatures()
+        self.assertEqual(before[0], p.subpipeline_signature(0))
+        self.assertNotEqual(before[1], p.subpipeline_signature(1))
+        self.assertNotEqual(before[2], p.subpipeline_signature(2))
+        self.assertNotEqual(before_conns[0], p.connection_signature(0))
+        self.assertNotEqual(before_conns[1], p.connection_signature(1))
+
+        # Compare with a fresh computation
+        expected = dict(p._subpipeline_signatures)
+        p2 = copy.copy(p)
+        p2._subpipeline_signatures = Bidict()
+        p2._connection_signatures = Bidict()
+        p2._module_signatures = Bidict()
+        p2.compute_signatures()
+        self.assertEqual(expected, dict(p2._subpipeline_signatures))
+
+        # Removing a connection changes the downstream signature
+        p.delete_connection(1)
+        p.refresh_signatures()
+        self.assertEqual(expected[1], p.subpipeline_signature(1))
+        self.assertNotEqual(expected[2], p.subpipeline_signature(2))
+        self.assertTrue(p.has_subpipeline_signature(
+                p.subpipeline_signature(2)))
+
+    def create_chain_pipeline(self, length):
+        basic_pkg = get_vistrails_basic_pkg_id()
+        sig = '(%s:Float)' % basic_pkg
+        modules = []
+        connections = []
+        for i in xrange(length):
+            modules.append(Module(
+                    id=i, name='Float', package=basic_pkg,
+                    functions=[ModuleFunction(id=i, name='value', parameters=[
+                            ModuleParam(id=i, type='Float',
+                                        val='%d.0' % i)])]))
+            if i > 0:
+                connections.append(Connection(id=i - 1, ports=[
+                        Port(id=2*i, type='source', moduleId=i - 1,
+                             moduleName='Float', name='value',
+                             signature=sig),
+                        Port(id=2*i+1, type='destination', moduleId=i,
+                             moduleName='Float', name='value',
+                             signature=sig)]))
+        p = Pipeline(modules=modules, connections=connections)
+        # so that actions can find the functions
+        p.build_index()
+        return p
+
+    def test_long_chain_signatures(self):
+        """Signatures don't recurse, even on very deep pipelines."""
+        import sys
+        length = sys.getrecursionlimit() + 100
+        p = self.create_chain_pipeline(length)
+        sig = p.subpipeline_signature(length - 1)
+        self.assertEqual(len(p._subpipeline_signatures), length)
+        p.compute_signatures()
+        self.assertEqual(len(p._connection_signatures), length - 1)
+        self.assertEqual(sig, p.subpipeline_signature(length - 1))
+        self.assertEqual(len(set(p._subpipeline_signatures.itervalues())),
+                         length)
+
+    def test_signature_cycle(self):
+        basic_pkg = get_vistrails_basic_pkg_id()
+        sig = '(%s:Float)' % basic_pkg
+        p = self.create_chain_pipeline(3)
+        p.add_connection(Connection(id=5, ports=[
+                Port(id=20, type='source', moduleId=2, moduleName='Float',
+                     name='value', signature=sig),
+                Port(id=21, type='destination', moduleId=1,
+                     moduleName='Float', name='value', signature=sig)]))
+        self.assertEqual(len(p._subpipeline_signatures), 0)
+        p.subpipeline_signature(0)
+        self.assertRaises(CycleInPipeline, p.subpipeline_signature, 2)
+        self.assertRaises(CycleInPipeline, p.compute_signatures)
+
+    def test_perform_action_signatures(self):
+        """Actions only drop the signatures downstream of their changes."""
+        import vistrails.core.db.action
+        p = self.create_chain_pipeline(5)
+        p.compute_signatures()
+        before = dict(p._subpipeline_signatures)
+
+        # Moving a module changes nothing
+        module = p.modules[2]
+        action = vistrails.core.db.action.create_action([
+                ('add', Location(id=1, x=1.0, y=2.0),
+                 module.vtType, module.id)])
+        p.perform_action(action)
+        self.assertEqual(before, dict(p._subpipeline_signatures))
+
+        # Changing a parameter drops the downstream signatures
+        function = p.modules[2].functions[0]
+        old_param = function.params[0]
+        new_param = ModuleParam(id=5, pos=old_param.pos,
+                                name=old_param.name, val='42.0',
+                                type=old_param.type)
+        action = vistrails.core.db.action.create_action([
+                ('change', old_param, new_param,
+                 function.vtType, function.real_id)])
+        p.perform_action(action)
+        self.assertEqual(sorted(p._subpipeline_signatures.iterkeys()),
+                         [0, 1])
+        self.assertEqual(sorted(p._connection_signatures.iterkeys()),
+                         [0])
+        p.compute_signatures()
+        self.assertEqual(before[1], p.subpipeline_signature(1))
+        self.assertNotEqual(before[2], p.subpipeline_signature(2))
+        self.assertNotEqual(before[4], p.subpipeline_signature(4))
+
+        # The remaining signatures match a fresh computation
+        p2 = self.create_chain_pipeline(5)
+        p2.modules[2].functions[0].params[0].strValue = '42.0'
+        p2.compute_signatures()
+        self.assertEqual(dict(p2._subpipeline_signatures),
+                         dict(p._subpipeline_signatures))
+        self.assertEqual(dict(p2._connection_signatures),
+                         dict(p._connection_signatures))
+
+        # Deleting a connection splits the chain
+        action = vistrails.core.db.action.create_action([
+                ('delete', p.connections[2])])
+        p.perform_action(action)
+        self.assertEqual(sorted(p._subpipeline_signatures.iterkeys()),
+                         [0, 1, 2])
+        p.compute_signatures()
+        self.assertEqual(p2.subpipeline_signature(2),
+                         p.subpipeline_signature(2))
+        self.assertNotEqual(p2.subpipeline_signature(3),
+                            p.subpipeline_signature(3))
+
+    def assert_same_validation(self, p1, p2):
+        self.assertEqual(p1.is_valid, p2.is_valid)
+        self.assertEqual(sorted(p1.modules), sorted(p2.modules))
+        for module_id, m1 in p1.modules.iteritems():
+            m2 = p2.modules[module_id]
+            self.assertEqual((m1.is_valid, [f.is_valid for f in m1.functions]),
+                             (m2.is_valid, [f.is_valid for f in m2.functions]))
+            # list depths are only computed for valid pipelines
+            if p1.is_valid:
+                self.assertEqual((m1.list_depth, m1.iterated_ports),
+                                 (m2.list_depth, m2.iterated_ports))
+        self.assertEqual(sorted(p1.connections), sorted(p2.connections))
+        for conn_id, c1 in p1.connections.iteritems():
+            c2 = p2.connections[conn_id]
+            for (port1, port2) in [(c1.source, c2.source),
+                                   (c1.destination, c2.destination)]:
+                self.assertEqual(port1.is_valid, port2.is_valid)
+                self.assertEqual(port1.spec.sigstring, port2.spec.sigstring)
+        self.assertEqual(sorted(str(e) for e in p1._validation.errors()),
+                         sorted(str(e) for e in p2._validation.errors()))
+
+    def test_incremental_validation(self):
+        """Validating after each action agrees with a full validation."""
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        basic_pkg = get_vistrails_basic_pkg_id()
+        controller = VistrailController(Vistrail(), auto_save=False)
+        controller.change_selected_version(0)
+
+        def check():
+            p1 = controller.current_pipeline
+            p2 = controller.vistrail.getPipeline(controller.current_version)
+            p2.reset_validation()
+            p2.validate(False)
+            self.assert_same_validation(p1, p2)
+
+        s1 = controller.add_module(basic_pkg, 'String')
+        lst = controller.add_module(basic_pkg, 'List')
+        s2 = controller.add_module(basic_pkg, 'String')
+        i1 = controller.add_module(basic_pkg, 'Integer')
+        controller.add_connection(s1.id, 'value', lst.id, 'head')
+        conn = controller.add_connection(lst.id, 'value', s2.id, 'value')
+        controller.update_function(s1, 'value', ['a'])
+        self.assertIsNotNone(controller.current_pipeline._validation)
+        check()
+        self.assertEqual(controller.current_pipeline.modules[s2.id].list_depth,
+                         1)
+
+        # Only the modified module gets checked
+        checked = []
+        pipeline = controller.current_pipeline
+        validate_module = pipeline._validate_module
+        def count(module_id):
+            checked.append(module_id)
+            return validate_module(module_id)
+        pipeline._validate_module = count
+        controller.update_function(pipeline.modules[i1.id], 'value', ['4'])
+        self.assertEqual(checked, [i1.id])
+        del pipeline._validate_module
+        check()
+
+        # An invalid function
+        function = ModuleFunction(
+                id=controller.id_scope.getNewId(ModuleFunction.vtType),
+                name='bogus')
+        controller.add_function_action(i1, function)
+        self.assertFalse(controller.current_pipeline.is_valid)
+        check()
+        controller.delete_function(function.real_id, i1.id)
+        self.assertTrue(controller.current_pipeline.is_valid)
+        check()
+
+        # Removing the list changes the list depth downstream
+        controller.delete_connection(conn.id)
+        self.assertEqual(controller.current_pipeline.modules[s2.id].list_depth,
+                         0)
+        check()
+        controller.delete_module_list([lst.id])
+        check()
+
+        # A change to the registry triggers a full validation
+        get_module_registry().generation += 1
+        controller.update_function(
+                controller.current_pipeline.modules[s2.id], 'value', ['b'])
+        check()
+
+    def test_bulk_edits(self):
+        """Owners of functions are indexed, cycles found in one search."""
+        import vistrails.core.db.action
+        basic_pkg = get_vistrails_basic_pkg_id()
+        p = self.create_chain_pipeline(3)
+        for module in p.modules.itervalues():
+            module.version = get_module_registry().get_package_by_name(
+                    basic_pkg).version
+        p.validate()
+        p.compute_signatures()
+        function = p.modules[1].functions[0]
+        self.assertEqual(p._owner_module('function', function.real_id), 1)
+        self.assertIsNone(p._owner_module('function', 42))
+
+        # A new function is indexed when it is added
+        new_function = ModuleFunction(id=42, pos=1, name='value',
+                                      parameters=[ModuleParam(
+                                              id=42, type='Float',
+                                              val='1.0')])
+        action = vistrails.core.db.action.create_action([
+                ('add', new_function, Module.vtType, 2)])
+        p.perform_action(action)
+        self.assertEqual(p._owners[('function', 42)], 2)
+        p.compute_signatures()
+        action = vistrails.core.db.action.create_action([
+                ('change', p.modules[2].functions[1].params[0],
+                 ModuleParam(id=43, type='Float', val='2.0'),
+                 ModuleFunction.vtType, 42)])
+        p.perform_action(action)
+        self.assertEqual(sorted(p._subpipeline_signatures.iterkeys()),
+                         [0, 1])
+
+        # Stale entries are not trusted
+        p._owners[('function', function.real_id)] = 0
+        self.assertEqual(p._owner_module('function', function.real_id), 1)
+
+        # Closing a cycle is found by the next validation
+        p.validate()
+        sig = '(%s:Float)' % basic_pkg
+        action = vistrails.core.db.action.create_action([
+                ('add', Connection(id=5, ports=[
+                        Port(id=20, type='source', moduleId=2,
+                             moduleName='Float', name='value',
+                             signature=sig),
+                        Port(id=21, type='destination', moduleId=0,
+                             moduleName='Float', name='value',
+                             signature=sig)]))])
+        p.perform_action(action)
+        self.assertFalse(p.validate(False))
+        self.assertTrue(p._validation.cycle_errors)
+
     def test_find_method(self):
         p1 = Pipeline()
         p1_functions = [ModuleFunction(name='i1',
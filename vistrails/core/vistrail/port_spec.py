@@ -38,6 +38,7 @@ from __future__ import division
 from itertools import izip
 import operator
 
+from vistrails.core.cache.hasher import Hasher
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core.modules.utils import create_port_spec_string, parse_port_spec_string
 from vistrails.core.system import get_vistrails_basic_pkg_id, \
@@ -64,6 +65,10 @@ class PortSpec(DBPortSpec):
                             ('destination', PortEndPoint.Destination),
                             ('invalid', PortEndPoint.Invalid)])
 
+    # set by Hasher, dropped by the setters below and by the items' setters
+    _cached_signature = None
+    _signature_owner = None
+
     ##########################################################################
     # Constructors and copy
 
@@ -214,15 +219,33 @@ class PortSpec(DBPortSpec):
     # Properties
 
     id = DBPortSpec.db_id
-    name = DBPortSpec.db_name
-    type = DBPortSpec.db_type
     optional = DBPortSpec.db_optional
     sort_key = DBPortSpec.db_sort_key
     min_conns = DBPortSpec.db_min_conns
     max_conns = DBPortSpec.db_max_conns
     _depth = DBPortSpec.db_depth
-    port_spec_items = DBPortSpec.db_portSpecItems
-    items = DBPortSpec.db_portSpecItems
+
+    def _get_name(self):
+        return self.db_name
+    def _set_name(self, name):
+        self.db_name = name
+        Hasher.clear_signature(self)
+    name = property(_get_name, _set_name)
+
+    def _get_type(self):
+        return self.db_type
+    def _set_type(self, type):
+        self.db_type = type
+        Hasher.clear_signature(self)
+    type = property(_get_type, _set_type)
+
+    def _get_port_spec_items(self):
+        return self.db_portSpecItems
+    def _set_port_spec_items(self, items):
+        self.db_portSpecItems = items
+        Hasher.clear_signature(self)
+    port_spec_items = property(_get_port_spec_items, _set_port_spec_items)
+    items = port_spec_items
 
     def _get_sigstring(self):
         return create_port_spec_string([i.spec_tuple 
@@ -257,6 +280,7 @@ class PortSpec(DBPortSpec):
         return self._depth or 0
     def _set_depth(self, depth):
         self._depth = depth
+        Hasher.clear_signature(self)
     depth = property(_get_depth, _set_depth)
 
     def toolTip(self):
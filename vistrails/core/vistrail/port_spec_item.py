@@ -40,6 +40,7 @@ from ast import literal_eval
 import copy
 import unittest
 
+from vistrails.core.cache.hasher import Hasher
 from vistrails.core.modules.utils import parse_port_spec_item_string, \
     create_port_spec_item_string
 from vistrails.core.system import get_module_registry
@@ -56,6 +57,9 @@ def get_MissingPackage():
 
 class PortSpecItem(DBPortSpecItem):
 
+    # the port spec whose cached signature depends on this item, set by Hasher
+    _signature_owner = None
+
     ##########################################################################
     # Constructors and copy
 
@@ -143,6 +147,7 @@ class PortSpecItem(DBPortSpecItem):
             self._sigstring = None
             self._descriptor = None
             self.db_module = module
+            Hasher.clear_signature(self)
     module = property(_get_module, _set_module)
 
     def _get_package(self):
@@ -152,6 +157,7 @@ class PortSpecItem(DBPortSpecItem):
             self._sigstring = None
             self._descriptor = None
             self.db_package = package
+            Hasher.clear_signature(self)
     package = property(_get_package, _set_package)
     
     def _get_namespace(self):
@@ -161,6 +167,7 @@ class PortSpecItem(DBPortSpecItem):
             self._sigstring = None
             self._descriptor = None
             self.db_namespace = ns
+            Hasher.clear_signature(self)
     namespace = property(_get_namespace, _set_namespace)
 
     def _get_sigstring(self):
@@ -37,6 +37,7 @@ from __future__ import division
 
 from vistrails.core.paramexplore.paramexplore import ParameterExploration
 
+from collections import OrderedDict
 import copy
 import datetime
 import getpass
@@ -67,6 +68,7 @@ import random
 
 """ This file contains the definition of the class Vistrail """
 
+_missing = object()
 
 ################################################################################
 
@@ -121,6 +123,9 @@ class Vistrail(DBVistrail):
             self.is_abstraction = other.is_abstraction
             self.locator = other.locator
 
+        # recently materialized pipelines, see getPipelineVersionNumber()
+        self.clear_pipeline_cache()
+
         # object to keep explicit expanded 
         # version tree always updated
         self.tree = ExplicitExpandedVersionTree(self)
@@ -152,6 +157,8 @@ class Vistrail(DBVistrail):
     ##########################################################################
     # Constants
 
+    PIPELINE_CACHE_SIZE = 32
+
     TAG_ANNOTATION = '__tag__'
     NOTES_ANNOTATION = '__notes__'
     PARAMEXP_ANNOTATION = '__paramexp__'
@@ -322,10 +329,46 @@ class Vistrail(DBVistrail):
         """getPipelineVersionNumber(version:int) -> Pipeline
         Returns a pipeline given a version number.
 
+        Pipelines that are requested more than once are kept in a small LRU
+        cache, and copies are returned.
+
         """
+        if self.db_has_action_with_id(version):
+            action = self.db_get_action_by_id(version)
+        else:
+            action = None
+        try:
+            cached_action, workflow = self._pipeline_cache.pop(version)
+        except KeyError:
+            pass
+        else:
+            # if the action was replaced, the pipeline is not valid anymore
+            if cached_action is action:
+                self._pipeline_cache[version] = (action, workflow)
+                return copy.copy(workflow)
+
         workflow = vistrails.core.db.io.get_workflow(self, version)
+        if self._pipeline_requests.pop(version, _missing) is action:
+            self._pipeline_cache[version] = (action, workflow)
+            while len(self._pipeline_cache) > self.PIPELINE_CACHE_SIZE:
+                self._pipeline_cache.popitem(last=False)
+            return copy.copy(workflow)
+        self._pipeline_requests[version] = action
+        while len(self._pipeline_requests) > 4 * self.PIPELINE_CACHE_SIZE:
+            self._pipeline_requests.popitem(last=False)
         return workflow
 
+    def is_pipeline_cached(self, version):
+        """is_pipeline_cached(version: int) -> bool
+        Returns whether getPipeline() has this version in its cache.
+
+        """
+        return version in self._pipeline_cache
+
+    def clear_pipeline_cache(self):
+        self._pipeline_cache = OrderedDict()
+        self._pipeline_requests = OrderedDict()
+
     def get_pipeline_diff_with_connections(self, v1, v2):
         """like get_pipeline_diff but returns connection info
         Keyword arguments:
@@ -796,6 +839,10 @@ class Vistrail(DBVistrail):
             if action.description is not None:
                 return action.description
             ops = action.operations
+            if not getattr(ops, 'loaded', True) and \
+                    ops.description is not None:
+                # stored in compact bundles, no need to read the operations
+                return ops.description
             added_modules = 0
             added_functions = 0
             added_parameters = 0
@@ -1036,7 +1083,21 @@ class Vistrail(DBVistrail):
             log = open_vt_log_from_db(connection, self.db_id)
         Log.convert(log)
         return log
-    
+
+    def iter_persisted_workflow_execs(self):
+        """
+        Yields the workflow executions of the persisted log one at a time,
+        without reading the whole log of a .vt file
+        """
+        if isinstance(self.locator, vistrails.core.db.locator.ZIPFileLocator):
+            if self.db_log_filename is not None:
+                for wf_exec in vistrails.core.db.io.iter_log(
+                        self.db_log_filename, True):
+                    yield wf_exec
+        else:
+            for wf_exec in self.get_persisted_log().workflow_execs:
+                yield wf_exec
+
     def get_used_packages(self):
         package_list = {}
         for action in self.actions:
@@ -1283,6 +1344,22 @@ class TestVistrail(unittest.TestCase):
                            '/tests/resources/dummy.xml').load()
         assert v.actionChain(17, 17) == []
 
+    def test_pipeline_cache(self):
+        v = self.create_vistrail()
+        version = v.get_tag_str('first action').action_id
+        p1 = v.getPipeline(version)
+        self.assertFalse(v.is_pipeline_cached(version))
+        p2 = v.getPipeline(version)
+        self.assertTrue(v.is_pipeline_cached(version))
+        p3 = v.getPipeline(version)
+        self.assertIsNot(p2, p3)
+        self.assertEqual(p1, p3)
+        # changing the pipeline doesn't change the cached version
+        p3.delete_module(p3.modules.keys()[0])
+        self.assertEqual(v.getPipeline(version), p1)
+        v.clear_pipeline_cache()
+        self.assertFalse(v.is_pipeline_cached(version))
+
     def test_get_version_negative_one(self):
         """Tests getting the 'no version' vistrail. This should raise
         VistrailsDBException.
@@ -36,6 +36,8 @@
 
 from __future__ import division
 
+from collections import OrderedDict
+
 def getActionChain(obj, version, start=0):
     result = []
     currentId = version
@@ -129,3 +131,171 @@ def getCurrentOperations(actions):
     sortedOperations.sort(key=lambda x: x.db_id)
     return sortedOperations
 
+
+class ActionChainCache(object):
+    """Snapshots of the current operations at some versions of a vistrail.
+
+    Materializing a version replays every action from the root. This keeps
+    the result of getCurrentOperationDict() at selected versions, so that
+    only the actions after the closest snapshot need to be replayed.
+    Snapshots are taken while replaying, when the number of operations
+    replayed since the last snapshot reaches 'interval' (or a quarter of it
+    on versions that have several children, since they are shared by more
+    versions). The least recently used snapshots are dropped beyond
+    'max_snapshots'.
+    """
+    def __init__(self, interval=200, max_snapshots=512):
+        self.interval = interval
+        self.max_snapshots = max_snapshots
+        # version -> (action, {(what, id): operation})
+        self._snapshots = OrderedDict()
+        # snapshots read from a file, as version -> [operation ids]
+        self._stored = {}
+        self._children = None
+        self._nb_actions = None
+
+    def clear(self):
+        self._snapshots.clear()
+        self._stored = {}
+        self._children = None
+
+    def __len__(self):
+        return len(self._snapshots) + len(self._stored)
+
+    def _child_count(self, vistrail, version):
+        # recompute when actions get added
+        nb_actions = len(vistrail.db_actions)
+        if self._children is None or self._nb_actions != nb_actions:
+            children = {}
+            for action in vistrail.db_actions:
+                children[action.db_prevId] = \
+                    children.get(action.db_prevId, 0) + 1
+            self._children = children
+            self._nb_actions = nb_actions
+        return self._children.get(version, 0)
+
+    def _get_snapshot(self, vistrail, version):
+        try:
+            action, operations = self._snapshots[version]
+        except KeyError:
+            if version in self._stored:
+                self._load_stored(vistrail)
+                return self._get_snapshot(vistrail, version)
+            return None
+        if (not vistrail.db_has_action_with_id(version) or
+                vistrail.db_get_action_by_id(version) is not action):
+            # the action was replaced, this snapshot is not valid anymore
+            del self._snapshots[version]
+            return None
+        # mark as recently used
+        del self._snapshots[version]
+        self._snapshots[version] = action, operations
+        return operations
+
+    def _add_snapshot(self, vistrail, version, operations):
+        self._snapshots[version] = (vistrail.db_get_action_by_id(version),
+                                    dict(operations))
+        while len(self._snapshots) > self.max_snapshots:
+            self._snapshots.popitem(last=False)
+
+    def get_operation_dict(self, vistrail, version):
+        """get_operation_dict(vistrail, version: int) -> dict
+        Returns a new dict, same as getCurrentOperationDict() for the chain
+        of actions leading to version.
+
+        """
+        chain = []
+        current = version
+        snapshot = None
+        while current > 0:
+            snapshot = self._get_snapshot(vistrail, current)
+            if snapshot is not None:
+                break
+            action = vistrail.db_get_action_by_id(current)
+            chain.append(action)
+            current = action.db_prevId
+        chain.reverse()
+
+        operations = dict(snapshot) if snapshot is not None else {}
+        cost = 0
+        for action in chain:
+            getCurrentOperationDict([action], operations)
+            cost += len(action.db_operations)
+            if (cost >= self.interval or
+                    (cost * 4 >= self.interval and
+                     self._child_count(vistrail, action.db_id) > 1)):
+                self._add_snapshot(vistrail, action.db_id, operations)
+                cost = 0
+        return operations
+
+    def get_operations(self, vistrail, version):
+        """get_operations(vistrail, version: int) -> list
+        Same as getCurrentOperations() for the chain of actions leading to
+        version.
+
+        """
+        operations = self.get_operation_dict(vistrail, version).values()
+        operations.sort(key=lambda x: x.db_id)
+        return operations
+
+    def to_dict(self):
+        """to_dict() -> dict
+        Returns the snapshots as lists of operation ids, to be saved.
+
+        """
+        result = dict((str(version), operations)
+                      for version, operations in self._stored.iteritems())
+        for version, (_, operations) in self._snapshots.iteritems():
+            result[str(version)] = sorted(op.db_id
+                                          for op in operations.itervalues())
+        return result
+
+    def update(self, snapshots):
+        """update(snapshots: dict) -> None
+        Adds snapshots returned by to_dict(). They are only checked and
+        loaded when needed.
+
+        """
+        for version, operations in snapshots.iteritems():
+            self._stored[int(version)] = operations
+
+    def _load_stored(self, vistrail):
+        stored, self._stored = self._stored, {}
+        index = {}
+        for action in vistrail.db_actions:
+            for operation in action.db_operations:
+                index[operation.db_id] = operation
+        for version, op_ids in stored.iteritems():
+            if not vistrail.db_has_action_with_id(version):
+                continue
+            operations = {}
+            for op_id in op_ids:
+                try:
+                    operation = index[op_id]
+                except KeyError:
+                    operations = None
+                    break
+                if operation.vtType == 'change':
+                    key = (operation.db_what, operation.db_newObjId)
+                elif operation.vtType == 'add':
+                    key = (operation.db_what, operation.db_objectId)
+                else:
+                    operations = None
+                    break
+                operations[key] = operation
+            if operations is not None:
+                self._snapshots[version] = (
+                        vistrail.db_get_action_by_id(version), operations)
+        while len(self._snapshots) > self.max_snapshots:
+            self._snapshots.popitem(last=False)
+
+def get_action_chain_cache(vistrail):
+    """get_action_chain_cache(vistrail) -> ActionChainCache
+    Returns the cache associated with this vistrail, creating it if needed.
+
+    """
+    try:
+        return vistrail._action_chain_cache
+    except AttributeError:
+        cache = vistrail._action_chain_cache = ActionChainCache()
+        return cache
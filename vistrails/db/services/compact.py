@@ -0,0 +1,648 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Compact vistrail storage, where actions are read when they are needed.
+
+Instead of a single 'vistrail' XML file, the bundle contains:
+  * 'vistrail_header': the vistrail XML without its actions (tags,
+    annotations, variables, parameter explorations...)
+  * 'actions/index': a JSON table with the id, parent, date, session, user
+    and annotations of every action, the description of the version, the
+    state of the id scope and the chunks whose actions add abstractions
+  * 'actions/<n>': the operations of the actions with ids from
+    n * chunk_size to (n + 1) * chunk_size - 1, as XML
+
+The version tree can be built from the header and the index; the operations
+of a chunk are only parsed when one of its actions is first accessed.
+
+"""
+
+from __future__ import division
+
+from datetime import datetime
+import json
+import os
+import shutil
+
+from vistrails.core.system import get_elementtree_library
+from vistrails.db import VistrailsDBException
+from vistrails.db.domain import DBVistrail, DBAction, DBAnnotation, \
+    DBAbstraction
+from vistrails.db.versions import getVersionDAO, currentVersion
+
+import unittest
+
+ElementTree = get_elementtree_library()
+
+HEADER_NAME = 'vistrail_header'
+ACTIONS_DIR = 'actions'
+INDEX_NAME = 'index'
+CHUNK_SIZE = 256
+
+
+def _to_str(value):
+    # json returns unicode strings, the XML reader returns str where it can
+    if isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            pass
+    return value
+
+def _to_long(value):
+    if value is None:
+        return None
+    return long(value)
+
+def _format_date(date):
+    if date is None:
+        return None
+    return '%04d-%02d-%02d %02d:%02d:%02d' % (date.year, date.month, date.day,
+                                              date.hour, date.minute,
+                                              date.second)
+
+def _parse_date(date):
+    if date is None:
+        return None
+    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                    int(date[11:13]), int(date[14:16]), int(date[17:19]))
+
+
+class LazyOperations(list):
+    """The operations of an action, read from their chunk on first use.
+
+    Any list method triggers the loading; 'converters' are called on each
+    operation once it is read, so that the core classes can be set on them.
+
+    """
+    def __init__(self, store, action, description=None):
+        list.__init__(self)
+        self.store = store
+        self.action = action
+        self.description = description
+        self.loaded = False
+        self.converters = []
+
+    def load(self):
+        if not self.loaded:
+            self.store.load_chunk(self.store.chunk_of(self.action.db_id))
+        if not self.loaded:
+            raise VistrailsDBException("Operations of action %s are missing "
+                                       "from the vistrail file" %
+                                       self.action.db_id)
+
+    def set_operations(self, operations):
+        self.loaded = True
+        list.extend(self, operations)
+        index = self.action.db_operations_id_index
+        for operation in operations:
+            index[operation.db_id] = operation
+        for convert in self.converters:
+            for operation in operations:
+                convert(operation)
+        self.converters = []
+
+    def __copy__(self):
+        self.load()
+        return list(self)
+
+    def __reduce_ex__(self, protocol):
+        self.load()
+        return (list, (list(self),))
+
+def _loading(name):
+    method = getattr(list, name)
+    def wrapper(self, *args):
+        if not self.loaded:
+            self.load()
+        for arg in args:
+            if isinstance(arg, LazyOperations) and not arg.loaded:
+                arg.load()
+        return method(self, *args)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ['__add__', '__contains__', '__delitem__', '__delslice__',
+              '__eq__', '__ge__', '__getitem__', '__getslice__', '__gt__',
+              '__iadd__', '__imul__', '__iter__', '__le__', '__len__',
+              '__lt__', '__mul__', '__ne__', '__repr__', '__reversed__',
+              '__rmul__', '__setitem__', '__setslice__', 'append', 'count',
+              'extend', 'index', 'insert', 'pop', 'remove', 'reverse',
+              'sort']:
+    setattr(LazyOperations, _name, _loading(_name))
+del _name
+
+
+def is_loaded(action):
+    """is_loaded(action: DBAction) -> bool
+    Whether the operations of this action are in memory.
+
+    """
+    return getattr(action._db_operations, 'loaded', True)
+
+def _adds_abstraction(action):
+    for op in action.db_operations:
+        if (op.vtType == 'add' or op.vtType == 'change') and \
+                op.db_data is not None and \
+                op.db_data.vtType == DBAbstraction.vtType:
+            return True
+    return False
+
+
+class CompactActionStore(object):
+    """Reads the chunks of operations of a compact vistrail.
+
+    """
+    def __init__(self, vistrail, directory, chunk_size=CHUNK_SIZE,
+                 chunks=None, abstraction_chunks=None):
+        self.vistrail = vistrail
+        self.directory = directory
+        self.chunk_size = chunk_size
+        # chunk number -> sorted action ids, as found in the directory
+        if chunks is None:
+            chunks = {}
+        self.chunks = chunks
+        # chunks in the directory with actions adding abstractions, None if
+        # unknown
+        self.abstraction_chunks = abstraction_chunks
+
+    def chunk_of(self, action_id):
+        return action_id // self.chunk_size
+
+    def get_filename(self, chunk):
+        return os.path.join(self.directory, ACTIONS_DIR, str(chunk))
+
+    def load_chunk(self, chunk):
+        """load_chunk(chunk: int) -> None
+        Reads the operations of all the actions in a chunk that were not
+        loaded yet.
+
+        """
+        filename = self.get_filename(chunk)
+        try:
+            tree = ElementTree.parse(filename)
+        except (IOError, SyntaxError), e:
+            raise VistrailsDBException("Could not read actions from %s: %s" %
+                                       (filename, e))
+        dao_list = getVersionDAO(currentVersion)
+        vistrail = self.vistrail
+        for node in tree.getroot():
+            action_id = long(node.get('id'))
+            if not vistrail.db_has_action_with_id(action_id):
+                continue
+            operations = vistrail.db_get_action_by_id(action_id)._db_operations
+            if getattr(operations, 'loaded', True):
+                continue
+            ops = [dao_list.read_xml_object(child.tag, child)
+                   for child in node]
+            for op in ops:
+                if op.vtType == 'add' or op.vtType == 'change':
+                    if op.db_data is None:
+                        if op.vtType == 'change':
+                            op.db_objectId = op.db_oldObjId
+                    else:
+                        vistrail.db_add_object(op.db_data)
+            operations.set_operations(ops)
+
+    def load_all(self):
+        """load_all() -> None
+        Reads every remaining chunk.
+
+        """
+        chunks = set(self.chunk_of(action.db_id)
+                     for action in self.vistrail.db_actions
+                     if not is_loaded(action))
+        for chunk in sorted(chunks):
+            self.load_chunk(chunk)
+
+    def get_abstraction_actions(self):
+        """get_abstraction_actions() -> list(DBAction)
+        Returns the actions that can add abstractions: those in memory and
+        those in the chunks that the index lists as adding some. Getting
+        their operations doesn't read the other chunks.
+
+        """
+        abstraction_chunks = self.abstraction_chunks
+        if abstraction_chunks is None:
+            return list(self.vistrail.db_actions)
+        return [action for action in self.vistrail.db_actions
+                if is_loaded(action) or
+                    self.chunk_of(action.db_id) in abstraction_chunks]
+
+
+def get_action_store(vistrail):
+    """get_action_store(vistrail) -> CompactActionStore
+    Returns the store the actions of this vistrail are read from, or None if
+    it was not opened from or saved to a compact bundle.
+
+    """
+    return getattr(vistrail, '_compact_store', None)
+
+def is_compact_bundle(save_dir):
+    return (os.path.isfile(os.path.join(save_dir, HEADER_NAME)) and
+            os.path.isfile(os.path.join(save_dir, ACTIONS_DIR, INDEX_NAME)))
+
+def remove_compact_files(vistrail, save_dir):
+    """remove_compact_files(vistrail, save_dir: str) -> None
+    Deletes the files of the compact format from a bundle directory, after
+    reading the operations of vistrail that are still stored there.
+
+    """
+    store = get_action_store(vistrail)
+    if store is not None and store.directory == save_dir:
+        store.load_all()
+        store.chunks = {}
+        store.abstraction_chunks = None
+    header = os.path.join(save_dir, HEADER_NAME)
+    if os.path.exists(header):
+        os.unlink(header)
+    actions_dir = os.path.join(save_dir, ACTIONS_DIR)
+    if os.path.isdir(actions_dir):
+        shutil.rmtree(actions_dir)
+
+def save_compact_vistrail(vistrail, save_dir, chunk_size=None):
+    """save_compact_vistrail(vistrail, save_dir: str, chunk_size: int) -> None
+    Writes vistrail in the compact format in a bundle directory.
+
+    Chunks whose actions have not changed and were not loaded are kept (or
+    copied from the directory they were read from) instead of being written
+    again.
+
+    """
+    store = get_action_store(vistrail)
+    if store is None:
+        store = CompactActionStore(vistrail, save_dir,
+                                   chunk_size or CHUNK_SIZE)
+    elif chunk_size is not None and chunk_size != store.chunk_size:
+        store.load_all()
+        store.chunks = {}
+        store.abstraction_chunks = None
+        store.chunk_size = chunk_size
+    dao_list = getVersionDAO(currentVersion)
+
+    actions_dir = os.path.join(save_dir, ACTIONS_DIR)
+    if not os.path.isdir(actions_dir):
+        os.makedirs(actions_dir)
+
+    chunks = {}
+    for action in vistrail.db_actions:
+        chunks.setdefault(store.chunk_of(action.db_id), []).append(action)
+
+    describe = getattr(vistrail, 'get_description', None)
+    rows = []
+    saved_chunks = {}
+    abstraction_chunks = set()
+    for chunk, actions in sorted(chunks.iteritems()):
+        actions.sort(key=lambda a: a.db_id)
+        action_ids = [action.db_id for action in actions]
+        saved_chunks[chunk] = action_ids
+        filename = os.path.join(actions_dir, str(chunk))
+        if (store.chunks.get(chunk) == action_ids and
+                not any(is_loaded(action) for action in actions)):
+            source = store.get_filename(chunk)
+            if source != filename:
+                shutil.copyfile(source, filename)
+            if store.abstraction_chunks is None or \
+                    chunk in store.abstraction_chunks:
+                abstraction_chunks.add(chunk)
+        else:
+            if any(_adds_abstraction(action) for action in actions):
+                abstraction_chunks.add(chunk)
+            root = ElementTree.Element('actions')
+            for action in actions:
+                node = ElementTree.SubElement(root, 'action')
+                node.set('id', str(action.db_id))
+                for op in action.db_operations:
+                    dao_list.write_xml_object(
+                            op, ElementTree.SubElement(node, op.vtType))
+            ElementTree.ElementTree(root).write(filename)
+        for action in actions:
+            if describe is not None:
+                description = describe(action.db_id)
+            else:
+                description = None
+            annotations = [[annotation.db_id, annotation.db_key,
+                            annotation.db_value]
+                           for annotation in action.db_annotations]
+            rows.append([action.db_id, action.db_prevId,
+                         _format_date(action.db_date), action.db_session,
+                         action.db_user, description, annotations])
+
+    index = {'version': currentVersion,
+             'chunk_size': store.chunk_size,
+             'ids': vistrail.idScope.ids,
+             'actions': rows,
+             'abstraction_chunks': sorted(abstraction_chunks)}
+    with open(os.path.join(actions_dir, INDEX_NAME), 'wb') as f:
+        json.dump(index, f, separators=(',', ':'))
+
+    header = DBVistrail(id=vistrail.db_id,
+                        entity_type=vistrail.db_entity_type,
+                        version=currentVersion,
+                        name=vistrail.db_name,
+                        last_modified=vistrail.db_last_modified,
+                        tags=vistrail.db_tags,
+                        annotations=vistrail.db_annotations,
+                        controlParameters=vistrail.db_controlParameters,
+                        vistrailVariables=vistrail.db_vistrailVariables,
+                        parameter_explorations=\
+                            vistrail.db_parameter_explorations,
+                        actionAnnotations=vistrail.db_actionAnnotations)
+    tags = {'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+            'xsi:schemaLocation': 'http://www.vistrails.org/vistrail.xsd'
+            }
+    dao_list.save_to_xml(header, os.path.join(save_dir, HEADER_NAME), tags,
+                         currentVersion)
+
+    # remove the chunks of actions that are gone
+    names = set(str(chunk) for chunk in saved_chunks)
+    names.add(INDEX_NAME)
+    for fname in os.listdir(actions_dir):
+        if fname not in names:
+            os.unlink(os.path.join(actions_dir, fname))
+
+    store.vistrail = vistrail
+    store.directory = save_dir
+    store.chunks = saved_chunks
+    store.abstraction_chunks = abstraction_chunks
+    vistrail._compact_store = store
+
+def open_compact_vistrail(save_dir):
+    """open_compact_vistrail(save_dir: str) -> DBVistrail
+    Reads a vistrail from the compact files in a bundle directory. The
+    operations of its actions are read when they are first accessed.
+
+    """
+    header_fname = os.path.join(save_dir, HEADER_NAME)
+    index_fname = os.path.join(save_dir, ACTIONS_DIR, INDEX_NAME)
+    try:
+        tree = ElementTree.parse(header_fname)
+        with open(index_fname, 'rb') as f:
+            index = json.load(f)
+    except (IOError, SyntaxError, ValueError), e:
+        raise VistrailsDBException("Could not read compact vistrail: %s" % e)
+    version = tree.getroot().get('version')
+    if version != currentVersion or index.get('version') != currentVersion:
+        raise VistrailsDBException(
+            "This vistrail was saved in the compact format of another "
+            "version of VisTrails (schema %s) and cannot be opened." %
+            version)
+
+    dao_list = getVersionDAO(currentVersion)
+    vistrail = dao_list.open_from_xml(header_fname, DBVistrail.vtType, tree)
+    if vistrail is None:
+        raise VistrailsDBException("Couldn't read vistrail from XML")
+    vistrail.update_id_scope()
+
+    store = CompactActionStore(vistrail, save_dir, index['chunk_size'])
+    chunks = {}
+    for (action_id, prev_id, date, session, user, description,
+            annotations) in index['actions']:
+        action_id = long(action_id)
+        annotations = [DBAnnotation(id=long(annotation_id),
+                                    key=_to_str(key),
+                                    value=_to_str(value))
+                       for annotation_id, key, value in annotations]
+        for annotation in annotations:
+            annotation.is_dirty = False
+        action = DBAction(id=action_id,
+                          prevId=_to_long(prev_id),
+                          date=_parse_date(date),
+                          session=_to_long(session),
+                          user=_to_str(user),
+                          annotations=annotations)
+        action._db_operations = LazyOperations(store, action, description)
+        action.is_dirty = False
+        vistrail.db_add_action(action)
+        chunks.setdefault(store.chunk_of(action_id), []).append(action_id)
+    for action_ids in chunks.itervalues():
+        action_ids.sort()
+    store.chunks = chunks
+    if index.get('abstraction_chunks') is not None:
+        store.abstraction_chunks = set(index['abstraction_chunks'])
+    for obj_type, begin_id in index['ids'].iteritems():
+        vistrail.idScope.updateBeginId(str(obj_type), long(begin_id))
+    vistrail.is_dirty = False
+    vistrail._compact_store = store
+    return vistrail
+
+
+##############################################################################
+# Testing
+
+class TestCompact(unittest.TestCase):
+    def open_dummy(self):
+        from vistrails.db.services.io import open_vistrail_from_xml
+        import vistrails.core.system
+
+        return open_vistrail_from_xml(
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/dummy.xml'))
+
+    def setUp(self):
+        import tempfile
+        self.dirs = [tempfile.mkdtemp(prefix='vt_compact'),
+                     tempfile.mkdtemp(prefix='vt_compact')]
+
+    def tearDown(self):
+        for d in self.dirs:
+            shutil.rmtree(d)
+
+    def assertSameVistrail(self, vistrail, other):
+        from vistrails.db.services.io import serialize
+        self.assertEqual(serialize(vistrail), serialize(other))
+        self.assertEqual(vistrail.idScope.ids, other.idScope.ids)
+
+    def test_save_open(self):
+        vistrail = self.open_dummy()
+        save_compact_vistrail(vistrail, self.dirs[0], chunk_size=4)
+        loaded = open_compact_vistrail(self.dirs[0])
+        self.assertFalse(any(is_loaded(a) for a in loaded.db_actions))
+        self.assertEqual(sorted(a.db_id for a in loaded.db_actions),
+                         sorted(a.db_id for a in vistrail.db_actions))
+        self.assertEqual(len(loaded.db_actionAnnotations),
+                         len(vistrail.db_actionAnnotations))
+        self.assertSameVistrail(vistrail, loaded)
+        self.assertTrue(all(is_loaded(a) for a in loaded.db_actions))
+
+    def test_lazy(self):
+        from vistrails.db.services.io import serialize
+        from vistrails.db.services.vistrail import materializeWorkflow
+
+        vistrail = self.open_dummy()
+        save_compact_vistrail(vistrail, self.dirs[0], chunk_size=4)
+        loaded = open_compact_vistrail(self.dirs[0])
+        version = max(a.db_id for a in vistrail.db_actions)
+        workflow = materializeWorkflow(loaded, version)
+        self.assertEqual(serialize(workflow),
+                         serialize(materializeWorkflow(vistrail, version)))
+        # only the chunks of that version's ancestors were read
+        chunks = set()
+        action_id = version
+        while action_id > 0:
+            chunks.add(action_id // 4)
+            action_id = loaded.db_get_action_by_id(action_id).db_prevId
+        for action in loaded.db_actions:
+            self.assertEqual(is_loaded(action), action.db_id // 4 in chunks)
+
+    def test_save_again(self):
+        import copy
+
+        vistrail = self.open_dummy()
+        save_compact_vistrail(vistrail, self.dirs[0], chunk_size=4)
+        loaded = open_compact_vistrail(self.dirs[0])
+        version = max(a.db_id for a in loaded.db_actions)
+        loaded.db_get_action_by_id(version).db_operations
+        action = DBAction(id=loaded.idScope.getNewId(DBAction.vtType),
+                          prevId=version)
+        loaded.db_add_action(action)
+        vistrail.db_add_action(copy.copy(action))
+        vistrail.idScope.getNewId(DBAction.vtType)
+
+        save_compact_vistrail(loaded, self.dirs[1])
+        # the store now reads from the new directory
+        self.assertEqual(get_action_store(loaded).directory, self.dirs[1])
+        self.assertTrue(any(not is_loaded(a) for a in loaded.db_actions))
+        self.assertSameVistrail(vistrail, open_compact_vistrail(self.dirs[1]))
+
+        # saving in place keeps the chunks that were not loaded
+        chunk = os.path.join(self.dirs[1], ACTIONS_DIR, '0')
+        os.utime(chunk, (0, 0))
+        save_compact_vistrail(loaded, self.dirs[1])
+        self.assertEqual(os.path.getmtime(chunk), 0)
+        self.assertSameVistrail(vistrail, open_compact_vistrail(self.dirs[1]))
+
+        remove_compact_files(loaded, self.dirs[1])
+        self.assertFalse(is_compact_bundle(self.dirs[1]))
+        self.assertSameVistrail(vistrail, loaded)
+
+    def test_bundle(self):
+        from vistrails.core.configuration import get_vistrails_configuration
+        from vistrails.db.services.io import open_vistrail_bundle_from_zip_xml, \
+            save_vistrail_bundle_to_zip_xml, SaveBundle
+        import vistrails.core.system
+
+        filename = os.path.join(self.dirs[1], 'compact.vt')
+        bundle, save_dir = open_vistrail_bundle_from_zip_xml(
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/dummy_new.vt'))
+        self.dirs.append(save_dir)
+        configuration = get_vistrails_configuration()
+        old_value = configuration.saveCompactVistrails
+        configuration.saveCompactVistrails = True
+        try:
+            save_vistrail_bundle_to_zip_xml(bundle, filename, self.dirs[0])
+        finally:
+            configuration.saveCompactVistrails = old_value
+        self.assertTrue(is_compact_bundle(self.dirs[0]))
+        self.assertFalse(os.path.exists(os.path.join(self.dirs[0],
+                                                     'vistrail')))
+        loaded, save_dir = open_vistrail_bundle_from_zip_xml(filename)
+        self.dirs.append(save_dir)
+        self.assertIsNotNone(get_action_store(loaded.vistrail))
+        self.assertSameVistrail(bundle.vistrail, loaded.vistrail)
+
+        # saving as XML again removes the compact files
+        save_vistrail_bundle_to_zip_xml(SaveBundle(DBVistrail.vtType,
+                                                   loaded.vistrail),
+                                        filename, save_dir)
+        self.assertFalse(is_compact_bundle(save_dir))
+        loaded, save_dir = open_vistrail_bundle_from_zip_xml(filename)
+        self.dirs.append(save_dir)
+        self.assertSameVistrail(bundle.vistrail, loaded.vistrail)
+
+    def test_abstraction_chunks(self):
+        from vistrails.db.domain import DBAdd
+
+        vistrail = self.open_dummy()
+        version = max(a.db_id for a in vistrail.db_actions)
+        abstraction = DBAbstraction(
+                id=vistrail.idScope.getNewId(DBAbstraction.vtType),
+                name='abs', package='local.abstractions', cache=1,
+                version='', internal_version='1')
+        add = DBAdd(id=vistrail.idScope.getNewId('operation'),
+                    what=DBAbstraction.vtType, objectId=abstraction.db_id,
+                    data=abstraction)
+        action = DBAction(id=vistrail.idScope.getNewId(DBAction.vtType),
+                          prevId=version, operations=[add])
+        vistrail.db_add_action(action)
+        save_compact_vistrail(vistrail, self.dirs[0], chunk_size=4)
+        loaded = open_compact_vistrail(self.dirs[0])
+        store = get_action_store(loaded)
+        self.assertEqual(store.abstraction_chunks,
+                         set([action.db_id // 4]))
+        for a in store.get_abstraction_actions():
+            a.db_operations[:]
+        for a in loaded.db_actions:
+            self.assertEqual(is_loaded(a), a.db_id // 4 == action.db_id // 4)
+
+        # the chunks that were kept keep their entry in the index
+        save_compact_vistrail(loaded, self.dirs[1])
+        loaded = open_compact_vistrail(self.dirs[1])
+        self.assertEqual(get_action_store(loaded).abstraction_chunks,
+                         set([action.db_id // 4]))
+
+    def test_controller(self):
+        """Opening a compact bundle in a controller doesn't read actions"""
+        from vistrails.core.configuration import get_vistrails_configuration
+        from vistrails.core.db.io import load_vistrail
+        from vistrails.core.db.locator import ZIPFileLocator
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.db.services.io import open_vistrail_bundle_from_zip_xml, \
+            save_vistrail_bundle_to_zip_xml
+        import vistrails.core.system
+
+        filename = os.path.join(self.dirs[1], 'compact.vt')
+        bundle, save_dir = open_vistrail_bundle_from_zip_xml(
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/terminator.vt'))
+        self.dirs.append(save_dir)
+        save_compact_vistrail(bundle.vistrail, self.dirs[0], chunk_size=8)
+        configuration = get_vistrails_configuration()
+        old_value = configuration.saveCompactVistrails
+        configuration.saveCompactVistrails = True
+        try:
+            save_vistrail_bundle_to_zip_xml(bundle, filename, self.dirs[0])
+        finally:
+            configuration.saveCompactVistrails = old_value
+
+        locator = ZIPFileLocator(filename)
+        (vistrail, abstractions, thumbnails, mashups) = load_vistrail(locator)
+        controller = VistrailController(vistrail, locator,
+                                        abstractions=abstractions,
+                                        thumbnails=thumbnails,
+                                        mashups=mashups)
+        self.assertFalse(any(is_loaded(a) for a in vistrail.db_actions))
+        controller.close_vistrail(locator)
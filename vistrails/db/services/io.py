@@ -46,6 +46,9 @@ from vistrails.core.modules.sub_module import get_cur_abs_namespace,\
 
 import vistrails.core.requirements
 
+import filecmp
+import hashlib
+import json
 import os.path
 import shutil
 import tempfile
@@ -57,7 +60,11 @@ from vistrails.db.domain import DBVistrail, DBWorkflow, DBLog, DBAbstraction, DB
     DBRegistry, DBWorkflowExec, DBOpmGraph, DBProvDocument, DBAnnotation, \
     DBMashuptrail, DBStartup
 import vistrails.db.services.abstraction
+import vistrails.db.services.action_chain
+import vistrails.db.services.compact
+import vistrails.db.services.journal
 import vistrails.db.services.log
+import vistrails.db.services.log_index
 import vistrails.db.services.opm
 import vistrails.db.services.prov
 import vistrails.db.services.registry
@@ -704,10 +711,14 @@ def open_vistrail_from_xml(filename):
 def open_vistrail_bundle_from_zip_xml(filename):
     """open_vistrail_bundle_from_zip_xml(filename) -> SaveBundle
     Open a vistrail from a zip compressed format.
-    It expects that the vistrail file inside archive has name 'vistrail',
+    It expects that the vistrail file inside archive has name 'vistrail'
+    (or that the archive has the 'vistrail_header' and 'actions' of the
+    compact format, see vistrails.db.services.compact),
     the log inside archive has name 'log',
     abstractions inside archive have prefix 'abstraction_',
-    and thumbnails inside archive are '.png' files in 'thumbs' dir
+    and thumbnails inside archive are '.png' files in 'thumbs' dir.
+    Entries in the 'journal' dir, written by incremental saves, are applied
+    to the vistrail and appended to the log.
 
     """
     vt_save_dir = tempfile.mkdtemp(prefix='vt_save')
@@ -725,11 +736,27 @@ def open_vistrail_bundle_from_zip_xml(filename):
     unknown_files = []
     thumbnail_files = []
     mashups = []
+    snapshots_fname = None
+    vistrail_fname = None
+    actions_dir = os.path.join(vt_save_dir,
+                               vistrails.db.services.compact.ACTIONS_DIR)
+    journal_dir = os.path.join(vt_save_dir,
+                               vistrails.db.services.journal.JOURNAL_DIR)
     try:
         for root, dirs, files in os.walk(vt_save_dir):
             for fname in files:
                 if fname == 'vistrail' and root == vt_save_dir:
-                    vistrail = open_vistrail_from_xml(os.path.join(root, fname))
+                    vistrail_fname = os.path.join(root, fname)
+                elif (fname == vistrails.db.services.compact.HEADER_NAME and
+                      root == vt_save_dir) or root in (actions_dir,
+                                                       journal_dir):
+                    # read below
+                    pass
+                elif fname == vistrails.db.services.log_index.get_index_name(
+                        'log') and root == vt_save_dir:
+                    # only written when indexExecutionLogs is set,
+                    # opened on demand by open_log_index()
+                    pass
                 elif fname == 'log' and root == vt_save_dir:
                     # FIXME read log to get execution info
                     # right now, just ignore the file
@@ -744,6 +771,8 @@ def open_vistrail_bundle_from_zip_xml(filename):
                       root == os.path.join(vt_save_dir,'thumbs')):
                     thumbnail_file = os.path.join(root, fname)
                     thumbnail_files.append(thumbnail_file)
+                elif fname == 'snapshots' and root == vt_save_dir:
+                    snapshots_fname = os.path.join(root, fname)
                 elif root == os.path.join(vt_save_dir,'mashups'):
                     mashup_file = os.path.join(root, fname)
                     mashup = open_mashuptrail_from_xml(mashup_file)
@@ -763,9 +792,40 @@ def open_vistrail_bundle_from_zip_xml(filename):
     if len(unknown_files) > 0:
         raise VistrailsDBException("Unknown files in vt file: %s" % \
                                        unknown_files)
+    if vistrails.db.services.compact.is_compact_bundle(vt_save_dir):
+        vistrail = vistrails.db.services.compact.open_compact_vistrail(
+                vt_save_dir)
+    elif vistrail_fname is not None:
+        vistrail = open_vistrail_from_xml(vistrail_fname)
     if vistrail is None:
         raise VistrailsDBException("vt file does not contain vistrail")
+    journal_bytes = 0
+    entries = vistrails.db.services.journal.get_entries(vt_save_dir)
+    for entry in entries:
+        entry_fname = vistrails.db.services.journal.get_entry_filename(
+                vt_save_dir, entry)
+        if os.path.exists(entry_fname):
+            vistrails.db.services.journal.read_entry(vistrail, entry_fname)
+            journal_bytes += os.path.getsize(entry_fname)
+        entry_fname = vistrails.db.services.journal.get_log_filename(
+                vt_save_dir, entry)
+        if os.path.exists(entry_fname):
+            log_fname = os.path.join(vt_save_dir, 'log')
+            with open(log_fname, 'ab') as log_file:
+                with open(entry_fname, 'rb') as entry_file:
+                    shutil.copyfileobj(entry_file, log_file)
+            journal_bytes += os.path.getsize(entry_fname)
     vistrail.db_log_filename = log_fname
+    if snapshots_fname is not None:
+        try:
+            with open(snapshots_fname, 'rb') as f:
+                snapshots = json.load(f)
+        except (IOError, ValueError), e:
+            debug.warning("Could not read version snapshots", str(e))
+        else:
+            cache = vistrails.db.services.action_chain.get_action_chain_cache(
+                vistrail)
+            cache.update(snapshots)
 
     # call package hooks
     from vistrails.core.packagemanager import get_package_manager
@@ -773,6 +833,15 @@ def open_vistrail_bundle_from_zip_xml(filename):
     for package in pm.enabled_package_list():
         package.loadVistrailFileHook(vistrail, vt_save_dir)
 
+    if save_incrementally():
+        vistrails.db.services.journal.mark_saved(vistrail)
+        vistrails.db.services.journal.set_bundle_state(
+                vistrail,
+                vistrails.db.services.journal.BundleState(
+                        filename, vt_save_dir,
+                        get_bundle_hook_files(vt_save_dir),
+                        len(entries), journal_bytes))
+
     save_bundle = SaveBundle(DBVistrail.vtType, vistrail, log, 
                              abstractions=abstraction_files, 
                              thumbnails=thumbnail_files, mashups=mashups)
@@ -858,6 +927,48 @@ def save_vistrail_to_xml(vistrail, filename, version=None):
     vistrail.db_currentVersion = current_action
     return vistrail
 
+def check_configuration(option):
+    """check_configuration(option: str) -> bool
+    Returns the value of a boolean configuration option, or False when no
+    application configuration is available.
+
+    """
+    from vistrails.core.configuration import get_vistrails_configuration
+    configuration = get_vistrails_configuration()
+    if configuration is None:
+        return False
+    return bool(configuration.check(option))
+
+def save_version_snapshots():
+    """save_version_snapshots() -> bool
+    Whether snapshots of the version tree should be written to .vt files.
+
+    """
+    return check_configuration('saveVersionSnapshots')
+
+def save_incrementally():
+    """save_incrementally() -> bool
+    Whether saving a .vt file should only append the changes to its
+    journal, when possible.
+
+    """
+    return check_configuration('saveIncrementally')
+
+def save_compact_vistrails():
+    """save_compact_vistrails() -> bool
+    Whether .vt files should store actions in the compact format, where they
+    are read on demand.
+
+    """
+    return check_configuration('saveCompactVistrails')
+
+def index_execution_logs():
+    """index_execution_logs() -> bool
+    Whether .vt files should store an index of their execution log.
+
+    """
+    return check_configuration('indexExecutionLogs')
+
 def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, version=None):
     """save_vistrail_bundle_to_zip_xml(save_bundle: SaveBundle, filename: str,
                                 vt_save_dir: str, version: str)
@@ -875,6 +986,13 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
     if save_bundle.vistrail is None:
         raise VistrailsDBException('save_vistrail_bundle_to_zip_xml failed, '
                                    'bundle does not contain a vistrail')
+    if (vt_save_dir and save_incrementally() and
+            version in (None, currentVersion)):
+        saved_bundle = append_vistrail_bundle_to_zip_xml(save_bundle,
+                                                         filename,
+                                                         vt_save_dir)
+        if saved_bundle is not None:
+            return (saved_bundle, vt_save_dir)
     if not vt_save_dir:
         vt_save_dir = tempfile.mkdtemp(prefix='vt_save')
     # abstractions are saved in the root of the zip file
@@ -885,7 +1003,22 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
     
     # Save Vistrail
     xml_fname = os.path.join(vt_save_dir, 'vistrail')
-    save_vistrail_to_xml(save_bundle.vistrail, xml_fname, version)
+    if save_compact_vistrails() and version in (None, currentVersion):
+        if not save_bundle.vistrail.db_version:
+            save_bundle.vistrail.db_version = currentVersion
+        vistrails.db.services.compact.save_compact_vistrail(
+                save_bundle.vistrail, vt_save_dir)
+        if os.path.exists(xml_fname):
+            os.unlink(xml_fname)
+    else:
+        save_vistrail_to_xml(save_bundle.vistrail, xml_fname, version)
+        vistrails.db.services.compact.remove_compact_files(
+                save_bundle.vistrail, vt_save_dir)
+    # the journal is included in the files written above
+    journal_dir = os.path.join(vt_save_dir,
+                               vistrails.db.services.journal.JOURNAL_DIR)
+    if os.path.isdir(journal_dir):
+        shutil.rmtree(journal_dir)
 
     # Save Log
     if save_bundle.vistrail.db_log_filename is not None:
@@ -899,6 +1032,25 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
         save_log_to_xml(save_bundle.log, xml_fname, version, True)
         save_bundle.vistrail.db_log_filename = xml_fname
 
+    # Save log index
+    index_fname = vistrails.db.services.log_index.get_index_name(
+            os.path.join(vt_save_dir, 'log'))
+    if (index_execution_logs() and
+            save_bundle.vistrail.db_log_filename is not None):
+        open_log_index(save_bundle.vistrail.db_log_filename).close()
+    elif os.path.exists(index_fname):
+        os.unlink(index_fname)
+
+    # Save version snapshots
+    snapshots_fname = os.path.join(vt_save_dir, 'snapshots')
+    if save_version_snapshots():
+        cache = vistrails.db.services.action_chain.get_action_chain_cache(
+            save_bundle.vistrail)
+        with open(snapshots_fname, 'wb') as f:
+            json.dump(cache.to_dict(), f)
+    elif os.path.exists(snapshots_fname):
+        os.unlink(snapshots_fname)
+
     # Save Abstractions
     saved_abstractions = []
     for obj in save_bundle.abstractions:
@@ -973,27 +1125,210 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
             package.saveVistrailFileHook(save_bundle.vistrail, vt_save_dir)
     except Exception, e:
         debug.warning("Could not call package hooks", str(e))
-    tmp_zip_dir = tempfile.mkdtemp(prefix='vt_zip')
-    tmp_zip_file = os.path.join(tmp_zip_dir, "vt.zip")
-
-    z = zipfile.ZipFile(tmp_zip_file, 'w')
+    # write the zip next to the file, then move it over the file so that
+    # the previous version is kept if anything fails
+    fd, tmp_zip_file = tempfile.mkstemp(
+            prefix='.vt_zip', dir=os.path.dirname(os.path.abspath(filename)))
+    os.close(fd)
     try:
-        with Chdir(vt_save_dir):
-            # zip current directory
-            for root, dirs, files in os.walk('.'):
-                for f in files:
-                    z.write(os.path.join(root, f))
-        z.close()
-        shutil.copyfile(tmp_zip_file, filename)
+        z = zipfile.ZipFile(tmp_zip_file, 'w')
+        try:
+            with Chdir(vt_save_dir):
+                # zip current directory
+                for root, dirs, files in os.walk('.'):
+                    for f in files:
+                        z.write(os.path.join(root, f))
+        finally:
+            z.close()
+        replace_file(tmp_zip_file, filename)
     finally:
-        os.unlink(tmp_zip_file)
-        os.rmdir(tmp_zip_dir)
+        if os.path.exists(tmp_zip_file):
+            os.unlink(tmp_zip_file)
+    if save_incrementally():
+        vistrails.db.services.journal.mark_saved(save_bundle.vistrail)
+        vistrails.db.services.journal.set_bundle_state(
+                save_bundle.vistrail,
+                vistrails.db.services.journal.BundleState(
+                        filename, vt_save_dir,
+                        get_bundle_hook_files(vt_save_dir)))
     save_bundle = SaveBundle(save_bundle.bundle_type, save_bundle.vistrail,
                              save_bundle.log, thumbnails=saved_thumbnails,
                              abstractions=saved_abstractions,
                              mashups=saved_mashups)
     return (save_bundle, vt_save_dir)
 
+def append_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir):
+    """append_vistrail_bundle_to_zip_xml(save_bundle: SaveBundle,
+                                         filename: str, vt_save_dir: str)
+         -> SaveBundle
+
+    Saves the changes made to the vistrail since filename was last read or
+    written as a new journal entry at the end of the zip, along with the
+    new log entries, thumbnails, abstractions and mashups. The zip is
+    updated in a copy that then replaces filename.
+
+    Returns None if the bundle has to be written entirely instead, because
+    the file changed, the journal is getting too long or a file that is
+    already in the bundle was modified.
+
+    """
+    journal = vistrails.db.services.journal
+    vistrail = save_bundle.vistrail
+    state = journal.get_bundle_state(vistrail)
+    if (state is None or not state.is_current(filename, vt_save_dir) or
+            state.needs_compaction()):
+        return None
+    log_fname = os.path.join(vt_save_dir, 'log')
+    if vistrail.db_log_filename not in (None, log_fname):
+        return None
+
+    # files to add, as (source, path in vt_save_dir)
+    new_files = []
+    saved_thumbnails = []
+    for obj in save_bundle.thumbnails:
+        if not isinstance(obj, basestring):
+            return None
+        png_fname = os.path.join(vt_save_dir, 'thumbs', os.path.basename(obj))
+        if not os.path.exists(png_fname):
+            new_files.append((obj, png_fname))
+        saved_thumbnails.append(png_fname)
+    saved_abstractions = []
+    for obj in save_bundle.abstractions:
+        if not isinstance(obj, basestring):
+            return None
+        obj_fname = os.path.basename(obj)
+        if not obj_fname.startswith('abstraction_'):
+            obj_fname = 'abstraction_' + obj_fname
+        xml_fname = os.path.join(vt_save_dir, obj_fname)
+        if not os.path.exists(xml_fname):
+            new_files.append((obj, xml_fname))
+        saved_abstractions.append(xml_fname)
+
+    tmp_dir = tempfile.mkdtemp(prefix='vt_journal')
+    try:
+        for obj in save_bundle.mashups:
+            xml_fname = os.path.join(vt_save_dir, 'mashups', str(obj.id))
+            tmp_fname = os.path.join(tmp_dir, str(obj.id))
+            save_mashuptrail_to_xml(obj, tmp_fname)
+            if not os.path.exists(xml_fname):
+                new_files.append((tmp_fname, xml_fname))
+            elif not filecmp.cmp(tmp_fname, xml_fname, shallow=False):
+                return None
+
+        # package hooks may only add or change their files on a full save
+        try:
+            from vistrails.core.packagemanager import get_package_manager
+            pm = get_package_manager()
+            for package in pm.enabled_package_list():
+                package.saveVistrailFileHook(vistrail, vt_save_dir)
+        except Exception, e:
+            debug.warning("Could not call package hooks", str(e))
+        if get_bundle_hook_files(vt_save_dir) != state.files:
+            return None
+
+        entry = state.entries
+        entry_fname = journal.get_entry_filename(tmp_dir, entry)
+        entry_log_fname = journal.get_log_filename(tmp_dir, entry)
+        os.mkdir(os.path.join(tmp_dir, journal.JOURNAL_DIR))
+        if journal.has_changes(vistrail):
+            journal.write_entry(vistrail, entry_fname)
+            new_files.append((entry_fname,
+                              journal.get_entry_filename(vt_save_dir, entry)))
+        if save_bundle.log is not None:
+            save_log_to_xml(save_bundle.log, entry_log_fname, None, True)
+            new_files.append((entry_log_fname,
+                              journal.get_log_filename(vt_save_dir, entry)))
+
+        if new_files:
+            fd, tmp_zip_file = tempfile.mkstemp(
+                    prefix='.vt_zip',
+                    dir=os.path.dirname(os.path.abspath(filename)))
+            os.close(fd)
+            try:
+                shutil.copyfile(filename, tmp_zip_file)
+                z = zipfile.ZipFile(tmp_zip_file, 'a')
+                try:
+                    for src, dst in new_files:
+                        arcname = os.path.relpath(dst, vt_save_dir)
+                        z.write(src, arcname.replace(os.sep, '/'))
+                finally:
+                    z.close()
+                replace_file(tmp_zip_file, filename)
+            finally:
+                if os.path.exists(tmp_zip_file):
+                    os.unlink(tmp_zip_file)
+
+        # the file was written, update vt_save_dir to match it
+        journal_bytes = 0
+        for src, dst in new_files:
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            shutil.copyfile(src, dst)
+        if os.path.exists(entry_fname):
+            journal_bytes += os.path.getsize(entry_fname)
+        if os.path.exists(entry_log_fname):
+            journal_bytes += os.path.getsize(entry_log_fname)
+            with open(log_fname, 'ab') as log_file:
+                with open(entry_log_fname, 'rb') as entry_file:
+                    shutil.copyfileobj(entry_file, log_file)
+            vistrail.db_log_filename = log_fname
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    journal.mark_saved(vistrail)
+    if new_files:
+        state.appended(filename, journal_bytes,
+                       get_bundle_hook_files(vt_save_dir))
+    return SaveBundle(save_bundle.bundle_type, vistrail, save_bundle.log,
+                      thumbnails=saved_thumbnails,
+                      abstractions=saved_abstractions,
+                      mashups=list(save_bundle.mashups))
+
+def get_bundle_hook_files(vt_save_dir):
+    """get_bundle_hook_files(vt_save_dir: str) -> dict
+    Returns a digest of each file of a bundle directory that is not written
+    by save_vistrail_bundle_to_zip_xml() itself (i.e. by package hooks).
+
+    """
+    own_dirs = set(['thumbs', 'mashups',
+                    vistrails.db.services.compact.ACTIONS_DIR,
+                    vistrails.db.services.journal.JOURNAL_DIR])
+    own_files = set(['vistrail', 'log', 'snapshots',
+                     vistrails.db.services.compact.HEADER_NAME,
+                     vistrails.db.services.log_index.get_index_name('log')])
+    files = {}
+    for root, dirs, fnames in os.walk(vt_save_dir):
+        if root == vt_save_dir:
+            dirs[:] = [d for d in dirs if d not in own_dirs]
+            fnames = [f for f in fnames
+                      if f not in own_files and
+                      not f.startswith('abstraction_')]
+        for fname in fnames:
+            path = os.path.join(root, fname)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, vt_save_dir)] = \
+                    hashlib.md5(f.read()).hexdigest()
+    return files
+
+def replace_file(src, dst):
+    """replace_file(src: str, dst: str) -> None
+    Moves src over dst, atomically where the platform allows it. The file
+    gets the permissions of dst, or the default ones if it doesn't exist.
+
+    """
+    with open(src, 'ab') as f:
+        os.fsync(f.fileno())
+    if os.path.exists(dst):
+        shutil.copymode(dst, src)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(src, 0666 & ~umask)
+    if os.name == 'nt' and os.path.exists(dst):
+        # os.rename() doesn't replace on Windows
+        os.unlink(dst)
+    os.rename(src, dst)
+
 def save_vistrail_bundle_to_db(save_bundle, db_connection, do_copy=False, version=None):
     if save_bundle.vistrail is None:
         raise VistrailsDBException('save_vistrail_bundle_to_db failed, '
@@ -1189,28 +1524,7 @@ def get_saved_workflows(vistrail, db_connection):
 def open_log_from_xml(filename, was_appended=False):
     """open_log_from_xml(filename) -> DBLog"""
     if was_appended:
-        parser = ElementTree.XMLTreeBuilder()
-        parser.feed("<log>\n")
-        f = open(filename, "rb")
-        parser.feed(f.read())
-        parser.feed("</log>\n")
-        root = parser.close()
-        workflow_execs = []
-        for node in root:
-            version = get_version_for_xml(node)
-            daoList = getVersionDAO(version)
-            workflow_exec = \
-                daoList.read_xml_object(DBWorkflowExec.vtType, node)
-            if version != currentVersion:
-                # if version is wrong, dump this into a dummy log object, 
-                # then translate, then get workflow_exec back
-                log = DBLog()
-                translate_log(log, currentVersion, version)
-                log.db_add_workflow_exec(workflow_exec)
-                log = translate_log(log, version)
-                workflow_exec = log.db_workflow_execs[0]
-            workflow_execs.append(workflow_exec)
-        log = DBLog(workflow_execs=workflow_execs)
+        log = DBLog(workflow_execs=list(iter_log_from_xml(filename, True)))
         vistrails.db.services.log.update_ids(log)
     else:
         tree = ElementTree.parse(filename)
@@ -1221,6 +1535,34 @@ def open_log_from_xml(filename, was_appended=False):
         vistrails.db.services.log.update_id_scope(log)
     return log
 
+def iter_log_from_xml(filename, was_appended=False):
+    """iter_log_from_xml(filename) -> iterator over DBWorkflowExec
+    Reads the workflow executions of a log one at a time instead of
+    building the whole DBLog. Executions of appended logs are numbered as
+    open_log_from_xml() does.
+
+    """
+    workflow_execs = vistrails.db.services.log.read_workflow_execs(
+            filename, was_appended)
+    for i, (_, workflow_exec) in enumerate(workflow_execs):
+        if was_appended:
+            workflow_exec.db_id = i + 1
+        yield workflow_exec
+
+def open_log_index(filename, create=True):
+    """open_log_index(filename, create: bool) -> LogIndex
+    Opens the index of an appended log, creating or updating it next to
+    the log file. If create is False, returns None when the log has no
+    index yet.
+
+    """
+    if not create and not os.path.exists(
+            vistrails.db.services.log_index.get_index_name(filename)):
+        return None
+    index = vistrails.db.services.log_index.LogIndex(filename)
+    index.update()
+    return index
+
 def open_log_from_db(db_connection, id, lock=False, version=None):
     """open_log_from_db(db_connection, id : long: lock: bool, version: str) 
          -> DBLog 
@@ -1872,3 +2214,17 @@ class TestDBIO(unittest.TestCase):
                 self.fail(str(e))
         finally:
             os.rmdir(testdir)
+
+    def test_check_configuration(self):
+        """ test reading a saving option """
+        from vistrails.core.configuration import get_vistrails_configuration
+
+        configuration = get_vistrails_configuration()
+        old_value = configuration.saveIncrementally
+        try:
+            configuration.saveIncrementally = True
+            self.assertTrue(save_incrementally())
+            configuration.saveIncrementally = False
+            self.assertFalse(save_incrementally())
+        finally:
+            configuration.saveIncrementally = old_value
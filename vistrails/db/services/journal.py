@@ -0,0 +1,402 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Journal of the changes made to a vistrail since it was last written.
+
+An entry records the actions and vistrail-level objects (annotations, tags,
+variables, parameter explorations...) that are new or modified, the ones
+that were deleted and the state of the id scope, relying on the is_new and
+is_dirty flags of the DB objects and on their db_deleted_* lists. Entries
+are written in the 'journal' directory of .vt bundles by the incremental
+save (see vistrails.db.services.io) and replayed in order when the bundle
+is opened.
+
+"""
+
+from __future__ import division
+
+import os
+
+from vistrails.core.system import get_elementtree_library
+from vistrails.db import VistrailsDBException
+from vistrails.db.domain import DBVistrail, DBAction, DBAnnotation
+from vistrails.db.versions import getVersionDAO, currentVersion
+
+import unittest
+
+ElementTree = get_elementtree_library()
+
+JOURNAL_DIR = 'journal'
+LOG_SUFFIX = '.log'
+
+# the bundle is rewritten entirely when the journal gets that long, or
+# bigger than a quarter of the rest of the file
+MAX_JOURNAL_ENTRIES = 64
+
+# (vtType, collection name, index attribute, key attribute) of the objects
+# of a vistrail that are journaled
+COLLECTIONS = [
+    (DBAction.vtType, 'actions', 'db_actions_id_index', 'db_id'),
+    ('tag', 'tags', 'db_tags_id_index', 'db_id'),
+    (DBAnnotation.vtType, 'annotations', 'db_annotations_id_index', 'db_id'),
+    ('controlParameter', 'controlParameters',
+     'db_controlParameters_id_index', 'db_id'),
+    ('vistrailVariable', 'vistrailVariables',
+     'db_vistrailVariables_uuid_index', 'db_uuid'),
+    ('parameter_exploration', 'parameter_explorations',
+     'db_parameter_explorations_id_index', 'db_id'),
+    ('actionAnnotation', 'actionAnnotations',
+     'db_actionAnnotations_id_index', 'db_id'),
+    ]
+
+
+def _children(obj):
+    if obj.vtType == DBAction.vtType:
+        # don't read the operations, they don't change once the action has
+        # been added
+        return [obj] + obj.db_annotations
+    return [child for child, _, _ in obj.db_children()]
+
+def _is_changed(obj):
+    for child in _children(obj):
+        if child.is_new or child.is_dirty:
+            return True
+    return False
+
+def mark_saved(vistrail):
+    """mark_saved(vistrail) -> None
+    Clears the flags that the next journal entry is computed from.
+
+    """
+    for _, name, _, _ in COLLECTIONS:
+        for obj in getattr(vistrail, 'db_' + name):
+            for child in _children(obj):
+                child.is_new = False
+                child.is_dirty = False
+        setattr(vistrail, 'db_deleted_' + name, [])
+    vistrail.is_new = False
+    vistrail.is_dirty = False
+
+def has_changes(vistrail):
+    """has_changes(vistrail) -> bool
+    Whether the vistrail changed since mark_saved() was called.
+
+    """
+    for _, name, _, _ in COLLECTIONS:
+        if getattr(vistrail, 'db_deleted_' + name):
+            return True
+        for obj in getattr(vistrail, 'db_' + name):
+            if _is_changed(obj):
+                return True
+    return False
+
+def write_entry(vistrail, filename):
+    """write_entry(vistrail, filename: str) -> None
+    Writes the changes since mark_saved() was called to a journal entry.
+
+    """
+    changes = {}
+    for _, name, _, _ in COLLECTIONS:
+        changes[name] = [obj for obj in getattr(vistrail, 'db_' + name)
+                         if _is_changed(obj)]
+    delta = DBVistrail(id=vistrail.db_id,
+                       entity_type=vistrail.db_entity_type,
+                       version=currentVersion,
+                       name=vistrail.db_name,
+                       last_modified=vistrail.db_last_modified,
+                       **changes)
+
+    dao_list = getVersionDAO(currentVersion)
+    root = ElementTree.Element('journal')
+    root.set('version', currentVersion)
+    root.append(dao_list.write_xml_object(delta))
+    for vt_type, name, _, key in COLLECTIONS:
+        for obj in getattr(vistrail, 'db_deleted_' + name):
+            node = ElementTree.SubElement(root, 'deleted')
+            node.set('type', vt_type)
+            node.set('key', str(getattr(obj, key)))
+    for obj_type, begin_id in sorted(vistrail.idScope.ids.iteritems()):
+        node = ElementTree.SubElement(root, 'idScope')
+        node.set('type', obj_type)
+        node.set('beginId', str(begin_id))
+    ElementTree.ElementTree(root).write(filename)
+
+def read_entry(vistrail, filename):
+    """read_entry(vistrail, filename: str) -> None
+    Applies the changes of a journal entry to vistrail.
+
+    """
+    try:
+        root = ElementTree.parse(filename).getroot()
+    except (IOError, SyntaxError), e:
+        raise VistrailsDBException("Could not read journal entry %s: %s" %
+                                   (filename, e))
+    if root.get('version') != currentVersion:
+        raise VistrailsDBException(
+            "This vistrail was saved by another version of VisTrails "
+            "(schema %s) and cannot be opened." % root.get('version'))
+    dao_list = getVersionDAO(currentVersion)
+    collections = dict((vt_type, (name, index, key))
+                       for vt_type, name, index, key in COLLECTIONS)
+    delta = None
+    for node in root:
+        if node.tag == DBVistrail.vtType:
+            delta = dao_list.read_xml_object(DBVistrail.vtType, node)
+        elif node.tag == 'deleted':
+            vt_type = node.get('type')
+            name, index, key = collections[vt_type]
+            key_value = node.get('key')
+            if key == 'db_id':
+                key_value = long(key_value)
+            obj = getattr(vistrail, index).get(key_value)
+            if obj is not None:
+                getattr(vistrail, 'db_delete_' + vt_type)(obj)
+        elif node.tag == 'idScope':
+            vistrail.idScope.updateBeginId(node.get('type'),
+                                           long(node.get('beginId')))
+    if delta is None:
+        return
+
+    vistrail.db_name = delta.db_name
+    vistrail.db_last_modified = delta.db_last_modified
+    for vt_type, name, index, key in COLLECTIONS:
+        for obj in getattr(delta, 'db_' + name):
+            old_obj = getattr(vistrail, index).get(getattr(obj, key))
+            if old_obj is not None:
+                getattr(vistrail, 'db_delete_' + vt_type)(old_obj)
+            getattr(vistrail, 'db_add_' + vt_type)(obj)
+    for action in delta.db_actions:
+        for op in action.db_operations:
+            if op.vtType == 'add' or op.vtType == 'change':
+                if op.db_data is None:
+                    if op.vtType == 'change':
+                        op.db_objectId = op.db_oldObjId
+                else:
+                    vistrail.db_add_object(op.db_data)
+
+def get_entries(save_dir):
+    """get_entries(save_dir: str) -> list
+    Returns the numbers of the journal entries in a bundle directory, in the
+    order they are to be applied. An entry has a vistrail part, a log part
+    (the workflow executions to append to the log) or both.
+
+    """
+    journal_dir = os.path.join(save_dir, JOURNAL_DIR)
+    if not os.path.isdir(journal_dir):
+        return []
+    entries = set()
+    for fname in os.listdir(journal_dir):
+        if fname.endswith(LOG_SUFFIX):
+            fname = fname[:-len(LOG_SUFFIX)]
+        if fname.isdigit():
+            entries.add(int(fname))
+    return sorted(entries)
+
+def get_entry_filename(save_dir, entry):
+    return os.path.join(save_dir, JOURNAL_DIR, str(entry))
+
+def get_log_filename(save_dir, entry):
+    return os.path.join(save_dir, JOURNAL_DIR, str(entry) + LOG_SUFFIX)
+
+
+class BundleState(object):
+    """What a .vt file contained when it was last read or written, to know
+    whether the next save can be appended to its journal.
+
+    'files' maps the other files of the bundle directory (written by
+    package hooks) to a digest of their content.
+
+    """
+    def __init__(self, filename, save_dir, files, entries=0,
+                 journal_bytes=0):
+        self.filename = os.path.abspath(filename)
+        self.save_dir = save_dir
+        self.files = files
+        self.entries = entries
+        self.journal_bytes = journal_bytes
+        self.stat = self.get_stat(filename)
+        self.base_bytes = self.stat[0] - journal_bytes
+
+    @staticmethod
+    def get_stat(filename):
+        st = os.stat(filename)
+        return (st.st_size, st.st_mtime)
+
+    def is_current(self, filename, save_dir):
+        """is_current(filename: str, save_dir: str) -> bool
+        Whether filename is still the file this state was recorded for.
+
+        """
+        if (os.path.abspath(filename) != self.filename or
+                save_dir != self.save_dir):
+            return False
+        try:
+            return self.get_stat(filename) == self.stat
+        except OSError:
+            return False
+
+    def needs_compaction(self):
+        return (self.entries >= MAX_JOURNAL_ENTRIES or
+                self.journal_bytes * 4 > self.base_bytes)
+
+    def appended(self, filename, nb_bytes, files):
+        self.entries += 1
+        self.journal_bytes += nb_bytes
+        self.files = files
+        self.stat = self.get_stat(filename)
+
+def get_bundle_state(vistrail):
+    """get_bundle_state(vistrail) -> BundleState
+    Returns the state recorded when this vistrail was last read from or
+    written to a .vt file, or None.
+
+    """
+    return getattr(vistrail, '_bundle_state', None)
+
+def set_bundle_state(vistrail, state):
+    vistrail._bundle_state = state
+
+
+##############################################################################
+# Testing
+
+class TestJournal(unittest.TestCase):
+    def open_dummy(self):
+        from vistrails.db.services.io import open_vistrail_from_xml
+        import vistrails.core.system
+
+        return open_vistrail_from_xml(
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/dummy.xml'))
+
+    def make_changes(self, vistrail):
+        from vistrails.db.domain import DBActionAnnotation
+
+        # a new action, and a new tag on it
+        action = vistrail.db_get_action_by_id(
+            max(vistrail.db_actions_id_index))
+        action = action.do_copy(True, vistrail.idScope, {})
+        vistrail.db_add_action(action)
+        vistrail.db_add_actionAnnotation(DBActionAnnotation(
+            id=vistrail.idScope.getNewId(DBAnnotation.vtType),
+            key='__tag__', value='new version', action_id=action.db_id))
+        # a deleted and a modified annotation
+        annotations = vistrail.db_actionAnnotations
+        vistrail.db_delete_actionAnnotation(annotations[0])
+        annotations[0].db_value = 'changed'
+        return annotations[0].db_id
+
+    def assertSameObjects(self, vistrail, other):
+        from vistrails.db.services.io import serialize
+
+        for _, plural, _, _ in COLLECTIONS:
+            self.assertEqual(
+                sorted(serialize(o) for o in getattr(vistrail, 'db_' + plural)),
+                sorted(serialize(o) for o in getattr(other, 'db_' + plural)))
+        self.assertEqual(vistrail.idScope.ids, other.idScope.ids)
+
+    def test_entry(self):
+        import shutil
+        import tempfile
+
+        vistrail = self.open_dummy()
+        mark_saved(vistrail)
+        self.assertFalse(has_changes(vistrail))
+        changed_id = self.make_changes(vistrail)
+        self.assertTrue(has_changes(vistrail))
+
+        tmp_dir = tempfile.mkdtemp(prefix='vt_journal')
+        try:
+            filename = os.path.join(tmp_dir, '0')
+            write_entry(vistrail, filename)
+            loaded = self.open_dummy()
+            read_entry(loaded, filename)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(
+            loaded.db_get_actionAnnotation_by_id(changed_id).db_value,
+            'changed')
+        self.assertSameObjects(loaded, vistrail)
+        mark_saved(vistrail)
+        self.assertFalse(has_changes(vistrail))
+
+    def test_bundle(self):
+        import shutil
+        import tempfile
+        import zipfile
+        from vistrails.core.configuration import get_vistrails_configuration
+        import vistrails.core.system
+        from vistrails.db.services.io import \
+            open_vistrail_bundle_from_zip_xml, save_vistrail_bundle_to_zip_xml
+
+        tmp_dir = tempfile.mkdtemp(prefix='vt_journal')
+        dirs = []
+        configuration = get_vistrails_configuration()
+        old_value = configuration.saveIncrementally
+        configuration.saveIncrementally = True
+        try:
+            filename = os.path.join(tmp_dir, 'journal.vt')
+            save_bundle, save_dir = open_vistrail_bundle_from_zip_xml(
+                os.path.join(vistrails.core.system.vistrails_root_directory(),
+                             'tests/resources/dummy_new.vt'))
+            dirs.append(save_dir)
+            save_bundle, save_dir = save_vistrail_bundle_to_zip_xml(
+                save_bundle, filename, save_dir)
+            vistrail = save_bundle.vistrail
+            self.make_changes(vistrail)
+            save_bundle, save_dir = save_vistrail_bundle_to_zip_xml(
+                save_bundle, filename, save_dir)
+            self.assertIn('%s/0' % JOURNAL_DIR,
+                          zipfile.ZipFile(filename).namelist())
+
+            loaded, loaded_dir = open_vistrail_bundle_from_zip_xml(filename)
+            dirs.append(loaded_dir)
+            self.assertSameObjects(loaded.vistrail, vistrail)
+
+            # the journal is merged when the file is written again
+            self.make_changes(loaded.vistrail)
+            get_bundle_state(loaded.vistrail).entries = MAX_JOURNAL_ENTRIES
+            save_vistrail_bundle_to_zip_xml(loaded, filename, loaded_dir)
+            names = zipfile.ZipFile(filename).namelist()
+            self.assertFalse(any(n.startswith(JOURNAL_DIR) for n in names))
+            reloaded, reloaded_dir = open_vistrail_bundle_from_zip_xml(
+                filename)
+            dirs.append(reloaded_dir)
+            self.assertSameObjects(reloaded.vistrail, loaded.vistrail)
+        finally:
+            configuration.saveIncrementally = old_value
+            shutil.rmtree(tmp_dir)
+            for d in dirs:
+                shutil.rmtree(d)
@@ -35,7 +35,16 @@
 ###############################################################################
 from __future__ import division
 
-from vistrails.db.domain import DBWorkflowExec
+import collections
+
+from vistrails.core.system import get_elementtree_library
+from vistrails.db import VistrailsDBException
+from vistrails.db.domain import DBLog, DBWorkflowExec
+from vistrails.db.versions import getVersionDAO, currentVersion, translate_log
+
+ElementTree = get_elementtree_library()
+
+WORKFLOW_EXEC_TAG = 'workflowExec'
 
 def update_id_scope(log):
     if hasattr(log, 'update_id_scope'):
@@ -46,3 +55,105 @@ def update_id_scope(log):
 def update_ids(log):
     for workflow_exec in log.db_workflow_execs:
         workflow_exec.db_id = log.id_scope.getNewId(DBWorkflowExec.vtType)
+
+def read_workflow_exec(node, version):
+    """read_workflow_exec(node: Element, version: str) -> DBWorkflowExec
+    Reads a workflowExec element written in the given schema version and
+    translates it to the current one.
+
+    """
+    dao_list = getVersionDAO(version)
+    workflow_exec = dao_list.read_xml_object(DBWorkflowExec.vtType, node)
+    if version != currentVersion:
+        # if version is wrong, dump this into a dummy log object,
+        # then translate, then get workflow_exec back
+        log = DBLog()
+        translate_log(log, currentVersion, version)
+        log.db_add_workflow_exec(workflow_exec)
+        log = translate_log(log, version)
+        workflow_exec = log.db_workflow_execs[0]
+    return workflow_exec
+
+class LogFile(object):
+    """File-like object reading a log file from a given offset.
+
+    Appended logs are a sequence of workflowExec elements without a root,
+    so a <log> element is wrapped around them. The offset of each
+    workflowExec start tag read so far is queued in starts.
+
+    """
+    START_TAG = '<%s' % WORKFLOW_EXEC_TAG
+
+    def __init__(self, f, was_appended=False, offset=0, size=None):
+        if size is None:
+            f.seek(0, 2)
+            size = f.tell()
+        f.seek(offset)
+        self.file = f
+        self.pos = offset
+        self.remaining = size - offset
+        if was_appended:
+            self.head, self.tail = '<log>\n', '</log>\n'
+        else:
+            self.head, self.tail = '', ''
+        self.carry = ''
+        self.starts = collections.deque()
+
+    def read(self, size=16384):
+        if self.head:
+            data, self.head = self.head, ''
+            return data
+        if self.remaining > 0:
+            data = self.file.read(min(size, self.remaining))
+            if data:
+                self.remaining -= len(data)
+                self.scan(data)
+                return data
+            self.remaining = 0
+        data, self.tail = self.tail, ''
+        return data
+
+    def scan(self, data):
+        buf = self.carry + data
+        base = self.pos - len(self.carry)
+        i = buf.find(self.START_TAG)
+        while i >= 0:
+            self.starts.append(base + i)
+            i = buf.find(self.START_TAG, i + 1)
+        self.carry = buf[-(len(self.START_TAG) - 1):]
+        self.pos += len(data)
+
+def read_workflow_execs(filename, was_appended=False, offset=0, size=None):
+    """read_workflow_execs(filename: str, was_appended: bool, offset: int,
+                           size: int) -> iterator over (int, DBWorkflowExec)
+    Parses a log file incrementally, yielding each workflow execution
+    with the offset of its start tag as soon as it has been read. Only
+    one execution is kept in memory at a time.
+
+    For appended logs, offset must be 0 or the end of a previous read;
+    parsing stops at size (the current size of the file by default).
+
+    """
+    with open(filename, 'rb') as f:
+        log_file = LogFile(f, was_appended, offset, size)
+        depth = 0
+        root = None
+        log_version = None
+        for event, node in ElementTree.iterparse(log_file, ('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = node
+                    log_version = node.get('version', None)
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+            if node.tag == WORKFLOW_EXEC_TAG:
+                start = log_file.starts.popleft()
+                version = node.get('version', log_version)
+                if version is None:
+                    msg = "Cannot find version information"
+                    raise VistrailsDBException(msg)
+                yield start, read_workflow_exec(node, version)
+            root.clear()
@@ -0,0 +1,416 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""SQLite index of the workflow executions in an appended log.
+
+The index is a sidecar file next to the log (log.index inside .vt
+bundles, only saved when the indexExecutionLogs option is set). It
+records, for each execution, the offset of its element in the log along
+with the version, user, dates and executed modules, so executions can be
+queried without parsing the log and loaded one by one.
+
+Logs are only ever appended to, so the index keeps the size of the log it
+has seen and only reads what was appended since; a log that does not
+start with the indexed content is indexed again from scratch.
+
+"""
+from __future__ import division
+
+from collections import namedtuple
+import hashlib
+import os
+import sqlite3
+import unittest
+
+from vistrails.db import VistrailsDBException
+from vistrails.db.domain import DBModuleExec
+from vistrails.db.services.log import read_workflow_execs
+
+INDEX_SUFFIX = '.index'
+INDEX_VERSION = '1'
+FINGERPRINT_SIZE = 4096
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS workflow_exec ("
+    "id INTEGER PRIMARY KEY, offset INTEGER, parent_version INTEGER, "
+    "user TEXT, ts_start TEXT, ts_end TEXT, completed INTEGER, "
+    "session INTEGER, name TEXT)",
+    "CREATE TABLE IF NOT EXISTS module_exec ("
+    "workflow_exec_id INTEGER, module_id INTEGER, module_name TEXT, "
+    "completed INTEGER)",
+    "CREATE INDEX IF NOT EXISTS workflow_exec_version "
+    "ON workflow_exec (parent_version)",
+    "CREATE INDEX IF NOT EXISTS workflow_exec_user ON workflow_exec (user)",
+    "CREATE INDEX IF NOT EXISTS workflow_exec_start "
+    "ON workflow_exec (ts_start)",
+    "CREATE INDEX IF NOT EXISTS module_exec_name "
+    "ON module_exec (module_name)",
+    "CREATE INDEX IF NOT EXISTS module_exec_id ON module_exec (module_id)",
+    ]
+
+IndexedWorkflowExec = namedtuple('IndexedWorkflowExec',
+                                 ['id', 'parent_version', 'user', 'ts_start',
+                                  'ts_end', 'completed', 'session', 'name'])
+
+def get_index_name(log_filename):
+    return log_filename + INDEX_SUFFIX
+
+def _format_date(date):
+    if date is None or isinstance(date, basestring):
+        return date
+    return date.strftime(DATE_FORMAT)
+
+def _fingerprint(filename, size):
+    """Digest of the bytes of the log just before size."""
+    with open(filename, 'rb') as f:
+        f.seek(max(0, size - FINGERPRINT_SIZE))
+        return hashlib.md5(f.read(min(size, FINGERPRINT_SIZE))).hexdigest()
+
+def _iter_module_execs(item_execs):
+    for item_exec in item_execs:
+        if item_exec.vtType == DBModuleExec.vtType:
+            yield item_exec
+        # group executions, loops and their iterations
+        for attr in ('db_item_execs', 'db_loop_execs', 'db_loop_iterations'):
+            children = getattr(item_exec, attr, None)
+            if children:
+                for module_exec in _iter_module_execs(children):
+                    yield module_exec
+
+class LogIndex(object):
+    """Index of an appended log file, see module docstring.
+
+    Workflow executions are numbered in the order of the log, as
+    open_log_from_xml() does.
+
+    """
+    def __init__(self, filename, index_filename=None):
+        if index_filename is None:
+            index_filename = get_index_name(filename)
+        self.filename = filename
+        self.index_filename = index_filename
+        try:
+            self.connection = sqlite3.connect(index_filename)
+            with self.connection:
+                for statement in SCHEMA:
+                    self.connection.execute(statement)
+        except sqlite3.Error, e:
+            raise VistrailsDBException("Cannot open log index '%s': %s" %
+                                       (index_filename, e))
+
+    def close(self):
+        self.connection.close()
+
+    def get_info(self, key):
+        row = self.connection.execute("SELECT value FROM info WHERE key=?",
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def update(self):
+        """update() -> int
+        Indexes the executions appended to the log since the last update,
+        returns how many were added.
+
+        """
+        size = os.path.getsize(self.filename)
+        indexed_size = 0
+        if self.get_info('version') == INDEX_VERSION:
+            indexed_size = int(self.get_info('size') or 0)
+            if indexed_size > size or (
+                    indexed_size > 0 and
+                    _fingerprint(self.filename, indexed_size) !=
+                    self.get_info('fingerprint')):
+                indexed_size = 0
+        if indexed_size == size:
+            return 0
+
+        count = 0
+        with self.connection:
+            c = self.connection.cursor()
+            if indexed_size == 0:
+                c.execute("DELETE FROM workflow_exec")
+                c.execute("DELETE FROM module_exec")
+            next_id = c.execute("SELECT count(*) FROM workflow_exec"
+                                ).fetchone()[0] + 1
+            for offset, workflow_exec in read_workflow_execs(
+                    self.filename, True, indexed_size, size):
+                wf_exec_id = next_id + count
+                c.execute("INSERT INTO workflow_exec VALUES "
+                          "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (wf_exec_id, offset,
+                           workflow_exec.db_parent_version,
+                           workflow_exec.db_user,
+                           _format_date(workflow_exec.db_ts_start),
+                           _format_date(workflow_exec.db_ts_end),
+                           workflow_exec.db_completed,
+                           workflow_exec.db_session,
+                           workflow_exec.db_name))
+                c.executemany("INSERT INTO module_exec VALUES (?, ?, ?, ?)",
+                              [(wf_exec_id, module_exec.db_module_id,
+                                module_exec.db_module_name,
+                                module_exec.db_completed)
+                               for module_exec in _iter_module_execs(
+                                   workflow_exec.db_item_execs)])
+                count += 1
+            c.executemany("INSERT OR REPLACE INTO info VALUES (?, ?)",
+                          [('version', INDEX_VERSION),
+                           ('size', str(size)),
+                           ('fingerprint', _fingerprint(self.filename,
+                                                        size))])
+        return count
+
+    def __len__(self):
+        return self.connection.execute("SELECT count(*) FROM workflow_exec"
+                                       ).fetchone()[0]
+
+    def find_workflow_execs(self, parent_version=None, user=None,
+                            module_name=None, module_id=None, start=None,
+                            end=None, completed=None):
+        """find_workflow_execs(...) -> list of IndexedWorkflowExec
+        Returns the executions matching all the given criteria, in the
+        order of the log. start and end (datetime or string) bound the
+        start date of the executions, inclusively. module_name and
+        module_id can also be collections, matching executions of any of
+        these modules.
+
+        """
+        conditions = []
+        args = []
+        for column, value in [('parent_version', parent_version),
+                              ('user', user),
+                              ('completed', completed)]:
+            if value is not None:
+                conditions.append('%s=?' % column)
+                args.append(value)
+        if start is not None:
+            conditions.append('ts_start>=?')
+            args.append(_format_date(start))
+        if end is not None:
+            conditions.append('ts_start<=?')
+            args.append(_format_date(end))
+        for column, value in [('module_name', module_name),
+                              ('module_id', module_id)]:
+            if value is None:
+                continue
+            if isinstance(value, (basestring, int, long)):
+                value = [value]
+            else:
+                value = list(value)
+            conditions.append('id IN (SELECT workflow_exec_id FROM '
+                              'module_exec WHERE %s IN (%s))' %
+                              (column, ', '.join('?' * len(value))))
+            args.extend(value)
+        query = ("SELECT %s FROM workflow_exec" %
+                 ', '.join(IndexedWorkflowExec._fields))
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id"
+        return [IndexedWorkflowExec(*row)
+                for row in self.connection.execute(query, args)]
+
+    def load_workflow_exec(self, wf_exec_id):
+        """load_workflow_exec(wf_exec_id: int) -> DBWorkflowExec
+        Reads a single execution from the log.
+
+        """
+        row = self.connection.execute(
+                "SELECT offset FROM workflow_exec WHERE id=?",
+                (wf_exec_id,)).fetchone()
+        if row is None:
+            raise KeyError(wf_exec_id)
+        for _, workflow_exec in read_workflow_execs(self.filename, True,
+                                                    row[0]):
+            workflow_exec.db_id = wf_exec_id
+            return workflow_exec
+        raise VistrailsDBException("Log index '%s' is out of date" %
+                                   self.index_filename)
+
+    def iter_workflow_execs(self, wf_exec_ids):
+        for wf_exec_id in wf_exec_ids:
+            yield self.load_workflow_exec(wf_exec_id)
+
+##############################################################################
+# Testing
+
+class TestLogIndex(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        import zipfile
+        import vistrails.core.system
+
+        self.tmp_dir = tempfile.mkdtemp(prefix='vt_log_index')
+        self.log_fname = os.path.join(self.tmp_dir, 'log')
+        z = zipfile.ZipFile(os.path.join(
+                vistrails.core.system.vistrails_root_directory(),
+                'tests/resources/spx_loop.vt'))
+        with open(self.log_fname, 'wb') as f:
+            f.write(z.read('log'))
+        z.close()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index(self):
+        from vistrails.db.services.io import open_log_from_xml, \
+            open_log_index, serialize
+
+        log = open_log_from_xml(self.log_fname, True)
+        index = open_log_index(self.log_fname)
+        try:
+            self.assertEqual(len(index), len(log.db_workflow_execs))
+            execs = index.find_workflow_execs()
+            self.assertEqual([e.id for e in execs],
+                             [e.db_id for e in log.db_workflow_execs])
+            last = log.db_workflow_execs[-1]
+            self.assertEqual(serialize(index.load_workflow_exec(last.db_id)),
+                             serialize(last))
+
+            version = last.db_parent_version
+            self.assertEqual(
+                [e.id for e in index.find_workflow_execs(
+                        parent_version=version)],
+                [e.db_id for e in log.db_workflow_execs
+                 if e.db_parent_version == version])
+            module_name = last.db_item_execs[0].db_module_name
+            self.assertEqual(
+                [e.id for e in index.find_workflow_execs(
+                        module_name=module_name, start=last.db_ts_start)],
+                [e.db_id for e in log.db_workflow_execs
+                 if e.db_ts_start >= last.db_ts_start and
+                 any(m.db_module_name == module_name
+                     for m in _iter_module_execs(e.db_item_execs))])
+            module_ids = set(m.db_module_id
+                             for e in log.db_workflow_execs
+                             for m in _iter_module_execs(e.db_item_execs))
+            first, second = sorted(module_ids)[:2]
+            self.assertEqual(
+                [e.id for e in index.find_workflow_execs(
+                        module_id=set([first, second]))],
+                sorted(set(e.id for e in
+                           index.find_workflow_execs(module_id=first) +
+                           index.find_workflow_execs(module_id=second))))
+            self.assertEqual(index.find_workflow_execs(module_id=[]), [])
+            self.assertEqual(index.find_workflow_execs(user='nobody'), [])
+            self.assertEqual(index.update(), 0)
+        finally:
+            index.close()
+
+    def test_append(self):
+        from vistrails.db.services.io import open_log_from_xml, \
+            open_log_index, save_log_to_xml
+
+        index = open_log_index(self.log_fname)
+        try:
+            count = len(index)
+            log = open_log_from_xml(self.log_fname, True)
+            new_log = log.__class__(
+                workflow_execs=[log.db_workflow_execs[0].do_copy()])
+            save_log_to_xml(new_log, self.log_fname, None, True)
+            self.assertEqual(index.update(), 1)
+            self.assertEqual(len(index), count + 1)
+            workflow_exec = index.load_workflow_exec(count + 1)
+            self.assertEqual(workflow_exec.db_ts_start,
+                             log.db_workflow_execs[0].db_ts_start)
+
+            # a different log is indexed again
+            open(self.log_fname, 'wb').close()
+            save_log_to_xml(new_log, self.log_fname, None, True)
+            self.assertEqual(index.update(), 1)
+            self.assertEqual(len(index), 1)
+        finally:
+            index.close()
+
+    def test_bundle(self):
+        import shutil
+        import zipfile
+        import vistrails.core.system
+        from vistrails.core.configuration import get_vistrails_configuration
+        from vistrails.db.services.io import open_log_index, \
+            open_vistrail_bundle_from_zip_xml, save_vistrail_bundle_to_zip_xml
+
+        index_name = get_index_name('log')
+        configuration = get_vistrails_configuration()
+        old_value = configuration.indexExecutionLogs
+        try:
+            # the index is only saved in the bundle with indexExecutionLogs
+            filename = os.path.join(self.tmp_dir, 'indexed.vt')
+            save_bundle, save_dir = open_vistrail_bundle_from_zip_xml(
+                os.path.join(vistrails.core.system.vistrails_root_directory(),
+                             'tests/resources/spx_loop.vt'))
+            try:
+                configuration.indexExecutionLogs = False
+                save_vistrail_bundle_to_zip_xml(save_bundle, filename,
+                                                save_dir)
+                z = zipfile.ZipFile(filename)
+                self.assertNotIn(index_name, z.namelist())
+                z.close()
+                self.assertIsNone(open_log_index(
+                        save_bundle.vistrail.db_log_filename, False))
+
+                configuration.indexExecutionLogs = True
+                save_vistrail_bundle_to_zip_xml(save_bundle, filename,
+                                                save_dir)
+            finally:
+                shutil.rmtree(save_dir)
+
+            # the index still matches the log, and is dropped when the
+            # option is unset
+            save_bundle, save_dir = open_vistrail_bundle_from_zip_xml(
+                filename)
+            try:
+                log_fname = save_bundle.vistrail.db_log_filename
+                index = open_log_index(log_fname, False)
+                self.assertIsNotNone(index)
+                try:
+                    self.assertEqual(index.update(), 0)
+                    self.assertEqual(len(index), 109)
+                finally:
+                    index.close()
+
+                configuration.indexExecutionLogs = False
+                save_vistrail_bundle_to_zip_xml(save_bundle, filename,
+                                                save_dir)
+                z = zipfile.ZipFile(filename)
+                self.assertNotIn(index_name, z.namelist())
+                z.close()
+            finally:
+                shutil.rmtree(save_dir)
+        finally:
+            configuration.indexExecutionLogs = old_value
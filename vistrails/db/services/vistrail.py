@@ -37,8 +37,8 @@ from __future__ import division
 
 from vistrails.db.domain import DBWorkflow, DBAdd, DBDelete, DBAction, DBAbstraction, \
     DBModule, DBConnection, DBPort, DBFunction, DBParameter, DBGroup
-from vistrails.db.services.action_chain import getActionChain, getCurrentOperationDict, \
-    getCurrentOperations, simplify_ops
+from vistrails.db.services.action_chain import getActionChain, \
+    getCurrentOperations, simplify_ops, get_action_chain_cache
 from vistrails.db import VistrailsDBException
 
 import copy
@@ -74,10 +74,10 @@ def materializeWorkflow(vistrail, version):
     # construct path up through tree and perform each action
     if vistrail.db_has_action_with_id(version):
         workflow = DBWorkflow()
-        #for action in getActionChain(vistrail, version):
-        #    oldPerformAction(action, workflow)
-        performActions(getActionChain(vistrail, version), 
-                            workflow)
+        # replay the actions from the closest snapshot
+        performAdds(get_action_chain_cache(vistrail).get_operations(vistrail,
+                                                                    version),
+                    workflow)
         workflow.db_id = version
         workflow.db_vistrailId = vistrail.db_id
         return workflow
@@ -642,8 +642,8 @@ def normalOperations(adds, deletes, do_copy=False):
 
 def getPathAsAction(vistrail, v1, v2, do_copy=False):
     sharedRoot = getSharedRoot(vistrail, [v1, v2])
-    sharedActionChain = getActionChain(vistrail, sharedRoot)
-    sharedOperationDict = getCurrentOperationDict(sharedActionChain)
+    sharedOperationDict = get_action_chain_cache(vistrail).get_operation_dict(
+            vistrail, sharedRoot)
     v1Actions = getActionChain(vistrail, v1, sharedRoot)
     v2Actions = getActionChain(vistrail, v2, sharedRoot)
     (v1AddDict, v1DeleteDict) = getOperationDiff(v1Actions, 
@@ -706,8 +706,8 @@ def addAndFixActions(startDict, actions):
     return curDict
 
 def fixActions(vistrail, v, actions):
-    startingChain = getActionChain(vistrail, v)
-    startingDict = getCurrentOperationDict(startingChain)
+    startingDict = get_action_chain_cache(vistrail).get_operation_dict(
+            vistrail, v)
     addAndFixActions(startingDict, actions)
     
 ################################################################################
@@ -797,8 +797,8 @@ def getObjects(actions):
 
 def getVersionDifferences(vistrail, versions):
     sharedRoot = getSharedRoot(vistrail, versions)
-    sharedActionChain = getActionChain(vistrail, sharedRoot)
-    sharedOperationDict = getCurrentOperationDict(sharedActionChain)
+    sharedOperationDict = get_action_chain_cache(vistrail).get_operation_dict(
+            vistrail, sharedRoot)
 
     vOnlySorted = []
     for v in versions:
@@ -1634,5 +1634,31 @@ class TestDBVistrailService(unittest.TestCase):
         # test parameter change inequality
         assert heuristicModuleMatch(module1, module5) == 0
 
+    def test_action_chain_cache(self):
+        from vistrails.db.services.action_chain import ActionChainCache
+        from vistrails.db.services.io import open_vistrail_from_xml
+        import vistrails.core.system
+        import os
+
+        vistrail = open_vistrail_from_xml(
+            os.path.join(vistrails.core.system.vistrails_root_directory(),
+                         'tests/resources/dummy.xml'))
+        versions = sorted(vistrail.db_actions_id_index)
+        cache = ActionChainCache(interval=4)
+        for version in versions + versions[::-1]:
+            expected = getCurrentOperations(getActionChain(vistrail,
+                                                           version))
+            self.assertEqual(cache.get_operations(vistrail, version),
+                             expected)
+        self.assertTrue(len(cache) > 0)
+
+        # snapshots can be saved and loaded back
+        loaded = ActionChainCache(interval=4)
+        loaded.update(cache.to_dict())
+        self.assertEqual(len(loaded), len(cache))
+        for version in versions:
+            self.assertEqual(loaded.get_operations(vistrail, version),
+                             cache.get_operations(vistrail, version))
+
 if __name__ == '__main__':
     unittest.main()
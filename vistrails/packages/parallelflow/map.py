@@ -40,8 +40,11 @@ import vistrails.core.db.action
 from vistrails.core.db.locator import XMLFileLocator
 from vistrails.core.db.io import serialize, unserialize
 from vistrails.core import debug
+from vistrails.core.interpreter.cached import CachedInterpreter
 from vistrails.core.interpreter.default import get_default_interpreter
+from vistrails.core.log.controller import DummyLogController, LogController
 from vistrails.core.log.group_exec import GroupExec
+from vistrails.core.log.log import Log
 from vistrails.core.log.machine import Machine
 from vistrails.core.log.module_exec import ModuleExec
 from vistrails.core.modules.basic_modules import Constant
@@ -62,12 +65,12 @@ import vistrails.db.versions
 import copy
 import inspect
 from itertools import izip
+import multiprocessing
 import os
 import re
 import sys
 import tempfile
-
-from IPython.parallel.error import CompositeError
+import traceback
 
 from .api import get_client
 
@@ -171,6 +174,116 @@ def execute_wf(wf, output_port):
     finally:
         os.unlink(temp_wf)
 
+###############################################################################
+# Local backend
+#
+# The module is serialized once and handed to the worker processes when they
+# start; then only the values of the elements are sent. Each worker keeps the
+# pipeline and its CachedInterpreter across the elements it computes.
+#
+
+def add_element_functions(pipeline_module, element, input_ports):
+    """Sets the values of an element of the input list as functions of the
+    module that is mapped.
+    """
+    # getting highest id between functions to guarantee unique ids
+    # TODO: can get current IdScope here?
+    if pipeline_module.functions:
+        high_id = max(function.db_id
+                      for function in pipeline_module.functions)
+    else:
+        high_id = 0
+
+    # adding function and parameter to module in pipeline
+    # TODO: 'pos' should not be always 0 here
+    id_scope = IdScope(beginId=long(high_id+1))
+    for elementValue, inputPort in izip(element, input_ports):
+
+        p_spec = pipeline_module.get_port_spec(inputPort, 'input')
+        descrs = p_spec.descriptors()
+        if len(descrs) != 1:
+            raise ValueError("Tuple input ports are not supported")
+        if not issubclass(descrs[0].module, Constant):
+            raise ValueError("Module inputs should be Constant types")
+        type = p_spec.sigstring[1:-1]
+        if not isinstance(elementValue, basestring):
+            elementValue = descrs[0].module.translate_to_string(elementValue)
+
+        mod_function = ModuleFunction(id=id_scope.getNewId(ModuleFunction.vtType),
+                                      pos=0,
+                                      name=inputPort)
+        mod_param = ModuleParam(id=0L,
+                                pos=0,
+                                type=type,
+                                val=elementValue)
+
+        mod_function.add_parameter(mod_param)
+        pipeline_module.add_function(mod_function)
+
+
+class LocalWorker(object):
+    """Executes the mapped module for elements of the input list.
+    """
+    def __init__(self, wf, input_ports, output_port):
+        self.pipeline = unserialize(wf, Pipeline)
+        self.module_id, = self.pipeline.modules.keys()
+        self.input_ports = input_ports
+        self.output_port = output_port
+        self.interpreter = CachedInterpreter()
+
+    def execute(self, element):
+        """Returns the same dictionary as execute_wf().
+        """
+        try:
+            pipeline = self.pipeline.do_copy()
+            add_element_functions(pipeline.modules[self.module_id],
+                                  element, self.input_ports)
+            log = Log()
+            result = self.interpreter.execute(
+                    pipeline,
+                    logger=LogController(log),
+                    reason='Parallel Map Execution')
+
+            errors = ['%s: %s' % (pipeline.modules[key].name, error)
+                      for key, error in result.errors.iteritems()]
+
+            try:
+                module_log = log.workflow_execs[0].item_execs[0]
+            except IndexError:
+                errors.append("Module log not found")
+                return dict(errors=errors)
+            machine = log.workflow_execs[0].machines[module_log.machine_id]
+
+            output = None
+            if not result.errors:
+                executed_module = result.objects[self.module_id]
+                try:
+                    output = executed_module.get_output(self.output_port)
+                except ModuleError:
+                    errors.append("Output port not found: %s" %
+                                  self.output_port)
+                    return dict(errors=errors)
+                if isinstance(output, Module):
+                    raise TypeError("Output value is a Module instance")
+
+            return dict(errors=errors,
+                        output=output,
+                        xml_log=serialize(module_log),
+                        machine_log=serialize(machine))
+        except Exception, e:
+            return dict(errors=["%s\n%s" % (debug.format_exception(e),
+                                            traceback.format_exc())])
+
+
+_local_worker = None
+
+def _init_local_worker(wf, input_ports, output_port):
+    global _local_worker
+    _local_worker = LocalWorker(wf, input_ports, output_port)
+
+def _execute_local(element):
+    return _local_worker.execute(element)
+
 ###############################################################################
 
 _ansi_code = re.compile(r'%s(?:(?:\[[^A-Za-z]*[A-Za-z])|[^\[])' % '\x1B')
@@ -182,11 +295,15 @@ def strip_ansi_codes(s):
 # Map Operator
 #
 class Map(Module):
-    """The Map Module executes a map operator in parallel on IPython engines.
+    """The Map Module executes a map operator in parallel on IPython engines,
+    or in processes on the local machine.
 
     The FunctionPort should be connected to the 'self' output of the module you
     want to execute.
     The InputList is the list of values to be scattered on the engines.
+    Backend is either 'ipython' or 'local'; it defaults to 'ipython' if IPython
+    is available. Processes sets the number of local processes (default: one
+    per CPU).
     """
     def __init__(self):
         Module.__init__(self)
@@ -236,6 +353,7 @@ class Map(Module):
         nameInput = self.get_input('InputPort')
         nameOutput = self.get_input('OutputPort')
         rawInputList = self.get_input('InputList')
+        backend = self.get_backend()
 
         # Create inputList to always have iterable elements
         # to simplify code
@@ -261,6 +379,16 @@ class Map(Module):
             module_id = connector.obj.moduleInfo['moduleId']
             vtType = original_pipeline.modules[module_id].vtType
 
+            # checking type
+            self.typeChecking(connector.obj, nameInput, inputList)
+
+            if backend == 'local':
+                # the module is serialized once, without the elements
+                workflows.append(self.serialize_module(
+                        self.get_pipeline_module(original_pipeline,
+                                                 module_id)))
+                break
+
             # serialize the module for each value in the list
             for i, element in enumerate(inputList):
                 if element_is_iter:
@@ -268,66 +396,16 @@ class Map(Module):
                 else:
                     self.element = element[0]
 
-                # checking type and setting input in the module
-                self.typeChecking(connector.obj, nameInput, inputList)
+                # setting input in the module
                 self.setInputValues(connector.obj, nameInput, element, i)
 
-                pipeline_db_module = original_pipeline.modules[module_id].do_copy()
-
-                # transforming a subworkflow in a group
-                # TODO: should we also transform inner subworkflows?
-                if pipeline_db_module.is_abstraction():
-                    group = Group(id=pipeline_db_module.id,
-                                  cache=pipeline_db_module.cache,
-                                  location=pipeline_db_module.location,
-                                  functions=pipeline_db_module.functions,
-                                  annotations=pipeline_db_module.annotations)
-
-                    source_port_specs = pipeline_db_module.sourcePorts()
-                    dest_port_specs = pipeline_db_module.destinationPorts()
-                    for source_port_spec in source_port_specs:
-                        group.add_port_spec(source_port_spec)
-                    for dest_port_spec in dest_port_specs:
-                        group.add_port_spec(dest_port_spec)
-
-                    group.pipeline = pipeline_db_module.pipeline
-                    pipeline_db_module = group
-
-                # getting highest id between functions to guarantee unique ids
-                # TODO: can get current IdScope here?
-                if pipeline_db_module.functions:
-                    high_id = max(function.db_id
-                                  for function in pipeline_db_module.functions)
-                else:
-                    high_id = 0
-
-                # adding function and parameter to module in pipeline
-                # TODO: 'pos' should not be always 0 here
-                id_scope = IdScope(beginId=long(high_id+1))
-                for elementValue, inputPort in izip(element, nameInput):
-
-                    p_spec = pipeline_db_module.get_port_spec(inputPort, 'input')
-                    descrs = p_spec.descriptors()
-                    if len(descrs) != 1:
-                        raise ModuleError(
-                                self,
-                                "Tuple input ports are not supported")
-                    if not issubclass(descrs[0].module, Constant):
-                        raise ModuleError(
-                                self,
-                                "Module inputs should be Constant types")
-                    type = p_spec.sigstring[1:-1]
-
-                    mod_function = ModuleFunction(id=id_scope.getNewId(ModuleFunction.vtType),
-                                                  pos=0,
-                                                  name=inputPort)
-                    mod_param = ModuleParam(id=0L,
-                                            pos=0,
-                                            type=type,
-                                            val=elementValue)
-
-                    mod_function.add_parameter(mod_param)
-                    pipeline_db_module.add_function(mod_function)
+                pipeline_db_module = self.get_pipeline_module(
+                        original_pipeline, module_id)
+                try:
+                    add_element_functions(pipeline_db_module, element,
+                                          nameInput)
+                except ValueError, e:
+                    raise ModuleError(self, str(e))
 
                 # serializing module
                 wf = self.serialize_module(pipeline_db_module)
@@ -336,6 +414,158 @@ class Map(Module):
             # getting first connector, ignoring the rest
             break
 
+        if backend == 'local':
+            map_result = self.map_local(module, workflows[0], inputList,
+                                        nameInput, nameOutput)
+        else:
+            map_result = self.map_ipython(module, workflows, nameOutput)
+
+        # verifying errors
+        errors = []
+        for engine in range(len(map_result)):
+            if map_result[engine]['errors']:
+                msg = "ModuleError in engine %d: '%s'" % (
+                        engine,
+                        ', '.join(map_result[engine]['errors']))
+                errors.append(msg)
+
+        if errors:
+            raise ModuleError(self, '\n'.join(errors))
+
+        # setting success color
+        module.logging.signalSuccess(module)
+
+        reg = vistrails.core.modules.module_registry.get_module_registry()
+        self.result = []
+        for map_execution in map_result:
+            output = map_execution['output']
+            self.result.append(output)
+
+        # including execution logs
+        if getattr(self.logging, 'log', None) in (None, DummyLogController):
+            # execution log is disabled
+            return
+        for engine in range(len(map_result)):
+            log = map_result[engine]['xml_log']
+            exec_ = None
+            if (vtType == 'abstraction') or (vtType == 'group'):
+                exec_ = unserialize(log, GroupExec)
+            elif (vtType == 'module'):
+                exec_ = unserialize(log, ModuleExec)
+            else:
+                # something is wrong...
+                continue
+
+            # assigning new ids to existing annotations
+            exec_annotations = exec_.annotations
+            for i in range(len(exec_annotations)):
+                exec_annotations[i].id = self.logging.log.log.id_scope.getNewId(Annotation.vtType)
+
+            parallel_annotation = Annotation(key='parallel_execution', value=True)
+            parallel_annotation.id = self.logging.log.log.id_scope.getNewId(Annotation.vtType)
+            annotations = [parallel_annotation] + exec_annotations
+            exec_.annotations = annotations
+
+            # before adding the execution log, we need to get the machine information
+            machine = unserialize(map_result[engine]['machine_log'], Machine)
+            machine_id = self.logging.add_machine(machine)
+
+            # recursively add machine information to execution items
+            def add_machine_recursive(exec_):
+                for item in exec_.item_execs:
+                    if hasattr(item, 'machine_id'):
+                        item.machine_id = machine_id
+                        if item.vtType in ('abstraction', 'group'):
+                            add_machine_recursive(item)
+
+            exec_.machine_id = machine_id
+            if (vtType == 'abstraction') or (vtType == 'group'):
+                add_machine_recursive(exec_)
+
+            self.logging.add_exec(exec_)
+
+    def get_backend(self):
+        """Returns the backend to use, 'ipython' or 'local'.
+        """
+        if self.has_input('Backend'):
+            backend = self.get_input('Backend')
+            if backend not in ('ipython', 'local'):
+                raise ModuleError(self, "Unknown backend %r" % backend)
+            return backend
+        try:
+            import IPython.parallel.error
+        except ImportError:
+            return 'local'
+        else:
+            return 'ipython'
+
+    def get_pipeline_module(self, original_pipeline, module_id):
+        """Returns a copy of the module to execute from the pipeline.
+        """
+        pipeline_db_module = original_pipeline.modules[module_id].do_copy()
+
+        # transforming a subworkflow in a group
+        # TODO: should we also transform inner subworkflows?
+        if pipeline_db_module.is_abstraction():
+            group = Group(id=pipeline_db_module.id,
+                          cache=pipeline_db_module.cache,
+                          location=pipeline_db_module.location,
+                          functions=pipeline_db_module.functions,
+                          annotations=pipeline_db_module.annotations)
+
+            source_port_specs = pipeline_db_module.sourcePorts()
+            dest_port_specs = pipeline_db_module.destinationPorts()
+            for source_port_spec in source_port_specs:
+                group.add_port_spec(source_port_spec)
+            for dest_port_spec in dest_port_specs:
+                group.add_port_spec(dest_port_spec)
+
+            group.pipeline = pipeline_db_module.pipeline
+            pipeline_db_module = group
+
+        return pipeline_db_module
+
+    def map_local(self, module, wf, inputList, nameInput, nameOutput):
+        """Executes the module for each element in local processes.
+
+        Returns a list of dictionaries, as returned by execute_wf().
+        """
+        if self.has_input('Processes'):
+            processes = self.get_input('Processes')
+            if processes <= 0:
+                raise ModuleError(self, "Processes should be positive")
+        else:
+            processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, len(inputList)))
+
+        # setting computing color
+        module.logging.set_computing(module)
+
+        if processes == 1 or not hasattr(os, 'fork'):
+            # run in this process, still reusing the same interpreter
+            worker = LocalWorker(wf, nameInput, nameOutput)
+            return [worker.execute(element) for element in inputList]
+
+        pool = multiprocessing.Pool(processes,
+                                    initializer=_init_local_worker,
+                                    initargs=(wf, nameInput, nameOutput))
+        try:
+            chunksize = max(1, len(inputList) // (processes * 4))
+            return list(pool.imap(_execute_local, inputList, chunksize))
+        except Exception, e:
+            raise ModuleError(self, "Error running map in local processes: "
+                                    "%s" % debug.format_exception(e))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def map_ipython(self, module, workflows, nameOutput):
+        """Executes the workflows on the IPython engines.
+
+        Returns a list of dictionaries, as returned by execute_wf().
+        """
+        from IPython.parallel.error import CompositeError
+
         # IPython stuff
         try:
             rc = get_client()
@@ -401,73 +631,13 @@ class Map(Module):
         # each map returns a dictionary
         try:
             ldview = rc.load_balanced_view()
-            map_result = ldview.map_sync(execute_wf, workflows, [nameOutput]*len(workflows))
+            return ldview.map_sync(execute_wf, workflows,
+                                   [nameOutput]*len(workflows))
         except CompositeError, e:
             self.print_compositeerror(e)
             raise ModuleError(self, "Error from IPython engines:\n"
                               "%s" % self.list_exceptions(e))
 
-        # verifying errors
-        errors = []
-        for engine in range(len(map_result)):
-            if map_result[engine]['errors']:
-                msg = "ModuleError in engine %d: '%s'" % (
-                        engine,
-                        ', '.join(map_result[engine]['errors']))
-                errors.append(msg)
-
-        if errors:
-            raise ModuleError(self, '\n'.join(errors))
-
-        # setting success color
-        module.logging.signalSuccess(module)
-
-        reg = vistrails.core.modules.module_registry.get_module_registry()
-        self.result = []
-        for map_execution in map_result:
-            output = map_execution['output']
-            self.result.append(output)
-
-        # including execution logs
-        for engine in range(len(map_result)):
-            log = map_result[engine]['xml_log']
-            exec_ = None
-            if (vtType == 'abstraction') or (vtType == 'group'):
-                exec_ = unserialize(log, GroupExec)
-            elif (vtType == 'module'):
-                exec_ = unserialize(log, ModuleExec)
-            else:
-                # something is wrong...
-                continue
-
-            # assigning new ids to existing annotations
-            exec_annotations = exec_.annotations
-            for i in range(len(exec_annotations)):
-                exec_annotations[i].id = self.logging.log.log.id_scope.getNewId(Annotation.vtType)
-
-            parallel_annotation = Annotation(key='parallel_execution', value=True)
-            parallel_annotation.id = self.logging.log.log.id_scope.getNewId(Annotation.vtType)
-            annotations = [parallel_annotation] + exec_annotations
-            exec_.annotations = annotations
-
-            # before adding the execution log, we need to get the machine information
-            machine = unserialize(map_result[engine]['machine_log'], Machine)
-            machine_id = self.logging.add_machine(machine)
-
-            # recursively add machine information to execution items
-            def add_machine_recursive(exec_):
-                for item in exec_.item_execs:
-                    if hasattr(item, 'machine_id'):
-                        item.machine_id = machine_id
-                        if item.vtType in ('abstraction', 'group'):
-                            add_machine_recursive(item)
-
-            exec_.machine_id = machine_id
-            if (vtType == 'abstraction') or (vtType == 'group'):
-                add_machine_recursive(exec_)
-
-            self.logging.add_exec(exec_)
-
 
     def serialize_module(self, module):
         """
@@ -545,3 +715,53 @@ def get_module(value, signature):
         debug.warning("Could not identify the type of the list element.")
         debug.warning("Type checking is not going to be done inside Map module.")
         return None
+
+
+###############################################################################
+
+import unittest
+
+from vistrails.tests.utils import execute, intercept_result
+
+
+class TestLocalMap(unittest.TestCase):
+    def run_map(self, processes, input_list='[1, 2, 3, 4, 5]', op='*'):
+        with intercept_result(Map, 'Result') as results:
+            errors = execute([
+                    ('PythonCalc', 'org.vistrails.vistrails.pythoncalc', [
+                        ('value2', [('Float', '2.0')]),
+                        ('op', [('String', op)]),
+                    ]),
+                    ('Map', 'edu.poly.vistrails.parallel_flow', [
+                        ('InputPort', [('List', "['value1']")]),
+                        ('OutputPort', [('String', 'value')]),
+                        ('InputList', [('List', input_list)]),
+                        ('Backend', [('String', 'local')]),
+                        ('Processes', [('Integer', str(processes))]),
+                    ]),
+                ],
+                [
+                    (0, 'self', 1, 'FunctionPort'),
+                ])
+        return errors, results
+
+    def test_serial(self):
+        """Runs the map in this process"""
+        errors, results = self.run_map(1)
+        self.assertFalse(errors)
+        self.assertEqual(results, [[2.0, 4.0, 6.0, 8.0, 10.0]])
+
+    def test_processes(self):
+        """Runs the map in worker processes, results come back in order"""
+        if not hasattr(os, 'fork'):
+            self.skipTest("worker processes need fork()")
+        errors, results = self.run_map(2, '[%s]' % ', '.join(
+                str(i) for i in xrange(20)))
+        self.assertFalse(errors)
+        self.assertEqual(results, [[i * 2.0 for i in xrange(20)]])
+
+    def test_error(self):
+        """Errors from the mapped module are reported on Map"""
+        # PythonCalc doesn't have a '%' operation
+        errors, results = self.run_map(1, '[1, 2]', op='%')
+        self.assertEqual(list(errors), [1])
@@ -44,41 +44,106 @@ except ImportError:
     import sha
     sha_hash = sha.new
 
+from vistrails.core.cache.file_hash import get_file_hasher, stat_fingerprint
+
+def list_files(persistent_path):
+    """Returns the relative names of the files under a directory, in the
+    order they are hashed.
+    """
+    fnames = []
+    dir_stack = ['.']
+    while dir_stack:
+        dir = dir_stack.pop()
+        for base in sorted(os.listdir(os.path.join(persistent_path, dir))):
+            name = os.path.join(dir, base)
+            if os.path.isdir(os.path.join(persistent_path, name)):
+                dir_stack.append(name)
+            else:
+                fnames.append(name)
+    return fnames
+
 def compute_hash(persistent_path, is_dir=None):
     def hash_file(filename, hasher):
-        f = open(filename, 'rb')
-        while True:
-            block = f.read(8192)
-            if not block:
-                break
-            hasher.update(block)
-
-    sha_hasher = sha_hash()
+        with open(filename, 'rb') as f:
+            while True:
+                block = f.read(1 << 20)
+                if not block:
+                    break
+                hasher.update(block)
+
     if is_dir is None:
         is_dir = os.path.isdir(persistent_path)
+    file_hasher = get_file_hasher()
     if is_dir:
         # get all of the files we need to hash
-        fnames = []
-        base_dir = persistent_path
-        dir_stack = ['.']
-        while dir_stack:
-            dir = dir_stack.pop()
-            for base in sorted(os.listdir(os.path.join(base_dir, dir))):
-                name = os.path.join(dir, base)
-                if os.path.isdir(os.path.join(base_dir, name)):
-                    dir_stack.append(name)
-                else:
-                    fnames.append(name)
-
-        # hash filenames and files to ensure directory structure
-        # is accounted for
+        fnames = list_files(persistent_path)
+
+        # The file names and contents are fed to a single digest, so it
+        # can't be composed from the files' own hashes; instead the result
+        # is recorded against the stat of every file in the tree
+        fingerprint = sha_hash()
+        mtime = 0
         for fname in fnames:
-            # print fname
-            sha_hasher.update(fname)
-            hash_file(os.path.join(base_dir, fname), sha_hasher)
+            st = os.stat(os.path.join(persistent_path, fname))
+            fingerprint.update('%s\0%s\n' % (fname, stat_fingerprint(st)))
+            mtime = max(mtime, st.st_mtime)
+
+        def compute():
+            sha_hasher = sha_hash()
+            # hash filenames and files to ensure directory structure
+            # is accounted for
+            for fname in fnames:
+                sha_hasher.update(fname)
+                hash_file(os.path.join(persistent_path, fname), sha_hasher)
+            return sha_hasher.hexdigest()
+        return file_hasher.get_digest(persistent_path, 'persistence-dir',
+                                      fingerprint.hexdigest(), mtime,
+                                      compute)
     else:
-        hash_file(persistent_path, sha_hasher)
-    return sha_hasher.hexdigest()
+        return file_hasher.hash_file(persistent_path, 'sha1')
+
+##############################################################################
+
+import unittest
+
+class TestComputeHash(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix='vt_compute_hash_')
+        self.make_file('a', 'hello')
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        self.make_file(os.path.join('sub', 'b'), 'world')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def make_file(self, name, contents, mtime=None):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as fp:
+            fp.write(contents)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_file(self):
+        self.assertEqual(compute_hash(os.path.join(self.directory, 'a')),
+                         sha_hash('hello').hexdigest())
+
+    def test_directory(self):
+        self.assertEqual(compute_hash(self.directory),
+                         sha_hash('./ahello./sub/bworld').hexdigest())
+
+    def test_directory_changed(self):
+        """A same-size change in the same mtime tick is not missed."""
+        import time
+        mtime = int(time.time())
+        self.make_file('a', 'hello', mtime)
+        digest = compute_hash(self.directory)
+        self.make_file('a', 'HELLO', mtime)
+        self.assertNotEqual(compute_hash(self.directory), digest)
+        self.assertEqual(compute_hash(self.directory),
+                         sha_hash('./aHELLO./sub/bworld').hexdigest())
 
 if __name__ == '__main__':
     import sys
@@ -59,7 +59,6 @@ def find_files(filename, version=None):
     vistrail = save_bundle.vistrail
     # FIXME hack for now, should change in the future
     log_fname = vistrail.db_log_filename
-    log = vistrails.db.services.io.open_log_from_xml(log_fname, True)
 
     if version:
         if isinstance(version, basestring):
@@ -75,10 +74,20 @@ def find_files(filename, version=None):
                 module = op.db_data
                 if module.db_package in persistence_pkg_ids:
                     persistent_module_ids.add(module.db_id)
+
+    log_index = vistrails.db.services.io.open_log_index(log_fname, False)
+    if log_index is not None:
+        # only read the executions of persistent modules
+        wf_exec_ids = [wf_exec.id for wf_exec in log_index.find_workflow_execs(
+                parent_version=version, module_id=persistent_module_ids)]
+        workflow_execs = log_index.iter_workflow_execs(wf_exec_ids)
+    else:
+        workflow_execs = vistrails.db.services.io.iter_log_from_xml(log_fname,
+                                                                    True)
                 
     filenames = {}
     tags = {}
-    for workflow_exec in log.db_workflow_execs:
+    for workflow_exec in workflow_execs:
         cur_version = workflow_exec.db_parent_version
         if version is not None and cur_version != version:
             continue
@@ -94,6 +103,8 @@ def find_files(filename, version=None):
                         val = annotation.db_value.upper()
                         filenames[cur_version].add(os.path.join(val[:2], 
                                                                 val[2:]))
+    if log_index is not None:
+        log_index.close()
     shutil.rmtree(save_dir)
     return filenames, tags
                         
@@ -73,7 +73,6 @@ def find_workflows(path_name, vistrail_dir):
             vistrails.db.services.io.open_vistrail_bundle_from_zip_xml(filename)
         vistrail = save_bundle.vistrail
         log_fname = vistrail.db_log_filename
-        log = vistrails.db.services.io.open_log_from_xml(log_fname, True)
         
         persistent_module_ids = set()
         for action in vistrail.db_actions:
@@ -84,9 +83,20 @@ def find_workflows(path_name, vistrail_dir):
                     if module.db_package in persistence_pkg_ids:
                         persistent_module_ids.add(module.db_id)
 
+        log_index = vistrails.db.services.io.open_log_index(log_fname, False)
+        if log_index is not None:
+            # only read the executions of persistent modules
+            wf_exec_ids = [wf_exec.id
+                           for wf_exec in log_index.find_workflow_execs(
+                               module_id=persistent_module_ids)]
+            workflow_execs = log_index.iter_workflow_execs(wf_exec_ids)
+        else:
+            workflow_execs = \
+                vistrails.db.services.io.iter_log_from_xml(log_fname, True)
+
         execs = {}
         tags = {}
-        for workflow_exec in log.db_workflow_execs:
+        for workflow_exec in workflow_execs:
             cur_version = workflow_exec.db_parent_version
             if cur_version in vistrail.db_tags_id_index:
                 tags[cur_version] = \
@@ -113,6 +123,8 @@ def find_workflows(path_name, vistrail_dir):
         if len(execs) > 0:
             vt_finds[filename] = (execs, tags)
 
+        if log_index is not None:
+            log_index.close()
         shutil.rmtree(save_dir)
 
     return vt_finds
@@ -43,6 +43,7 @@ py_import('dulwich', {
         'linux-ubuntu': 'python-dulwich',
         'linux-fedora': 'python-dulwich'})
 from vistrails.core import debug
+from vistrails.core.cache.file_hash import get_file_hasher
 
 from dulwich.errors import NotCommitError, NotGitRepository
 from dulwich.repo import Repo
@@ -165,25 +166,46 @@ class GitRepo(object):
 
     @staticmethod
     def compute_tree_hash(dirname):
-        tree = Tree()
-        for entry in sorted(os.listdir(dirname)):
-            fname = os.path.join(dirname, entry)
-            if os.path.isdir(fname):
-                thash = GitRepo.compute_tree_hash(fname)
-                mode = stat.S_IFDIR # os.stat(fname)[stat.ST_MODE]
-                tree.add(entry, mode, thash)
-            elif os.path.isfile(fname):
-                bhash = GitRepo.compute_blob_hash(fname)
-                mode = os.stat(fname)[stat.ST_MODE]
-                tree.add(entry, mode, bhash)
-        return tree.id
+        # List the whole tree first, so that the blobs can be hashed as a
+        # single batch (in parallel, skipping the files that didn't change)
+        listings = []
+        fnames = []
+        dir_stack = [dirname]
+        while dir_stack:
+            dname = dir_stack.pop()
+            entries = []
+            for entry in sorted(os.listdir(dname)):
+                fname = os.path.join(dname, entry)
+                if os.path.isdir(fname):
+                    entries.append((entry, fname, True))
+                    dir_stack.append(fname)
+                elif os.path.isfile(fname):
+                    entries.append((entry, fname, False))
+                    fnames.append(fname)
+            listings.append((dname, entries))
+        blob_hashes = get_file_hasher().hash_files(fnames, 'git-blob')
+
+        # Build the trees bottom-up; subdirectories are always listed after
+        # their parent
+        tree_hashes = {}
+        for dname, entries in reversed(listings):
+            tree = Tree()
+            for entry, fname, is_dir in entries:
+                if is_dir:
+                    mode = stat.S_IFDIR # os.stat(fname)[stat.ST_MODE]
+                    tree.add(entry, mode, tree_hashes[fname])
+                else:
+                    mode = os.stat(fname)[stat.ST_MODE]
+                    tree.add(entry, mode, blob_hashes[fname])
+            tree_hashes[dname] = tree.id
+        return tree_hashes[dirname]
 
     @staticmethod
     def compute_hash(path):
         if os.path.isdir(path):
             return GitRepo.compute_tree_hash(path)
         elif os.path.isfile(path):
-            return GitRepo.compute_blob_hash(path)
+            return get_file_hasher().hash_file(path, 'git-blob')
         raise TypeError("Do not support this type of path")
 
     def get_latest_version(self, path):
@@ -270,5 +292,46 @@ def run_init_add_test():
                 "/Users/dakoop/.vistrails/git_test")
     print r.add_commit("README.md")
 
+##############################################################################
+
+import unittest
+
+class TestGitRepo(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_repo_')
+        self.make_file('a', 'hello')
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        self.make_file(os.path.join('sub', 'b'), 'world')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_file(self, name, contents, mtime=None):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as fp:
+            fp.write(contents)
+        os.chmod(filename, 0644)
+        if mtime is not None:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_tree_hash(self):
+        # same as 'git write-tree' on these files
+        self.assertEqual(GitRepo.compute_tree_hash(self.directory),
+                         'b8fd0ad12a2a2d9b682b360729b9e2b9de230c77')
+        self.assertEqual(GitRepo.compute_hash(
+                                 os.path.join(self.directory, 'a')),
+                         Blob.from_string('hello').id)
+
+    def test_tree_hash_changed(self):
+        """A same-size change in the same mtime tick is not missed."""
+        import time
+        mtime = int(time.time())
+        self.make_file('a', 'hello', mtime)
+        digest = GitRepo.compute_tree_hash(self.directory)
+        self.make_file('a', 'HELLO', mtime)
+        self.assertNotEqual(GitRepo.compute_tree_hash(self.directory),
+                            digest)
+
 if __name__ == '__main__':
     run_init_add_test()
@@ -36,9 +36,13 @@
 from __future__ import division
 
 from datetime import datetime
-from file_archive import hash_file, hash_directory
+from file_archive import relativize_link, UsageWarning
+import hashlib
 import os
+import unittest
+import warnings
 
+from vistrails.core.cache.file_hash import get_file_hasher
 import vistrails.core.debug as debug
 from vistrails.core.modules.basic_modules import Directory, File, Path, \
     PathObject
@@ -50,12 +54,70 @@ from .common import KEY_TYPE, TYPE_INPUT, KEY_TIME, \
 from .queries import Metadata
 
 
+def _list_directory(path, root, visited, files):
+    """Lists a directory tree the way file_archive.hash_directory() reads it.
+
+    Returns a list of (kind, name, value) entries, where value is the link
+    target, the subdirectory's own listing or the file's path; the files are
+    appended to `files` so that they can be hashed as a batch.
+    """
+    if os.path.realpath(path) in visited:
+        raise ValueError("Can't hash directory structure: loop detected at "
+                         "%s" % path)
+    visited.add(os.path.realpath(path))
+    entries = []
+    for f in sorted(os.listdir(path)):
+        pf = os.path.join(path, f)
+        if os.path.islink(pf):
+            link = relativize_link(pf, root)
+            if link is not None:
+                entries.append(('link', f, link))
+                continue
+        if os.path.isdir(pf):
+            if os.path.islink(pf):
+                warnings.warn("%s is a symbolic link, recursing on target "
+                              "directory" % pf,
+                              UsageWarning)
+            entries.append(('dir', f,
+                            _list_directory(pf, root, visited, files)))
+        else:
+            if os.path.islink(pf):
+                warnings.warn("%s is a symbolic link, using target file "
+                              "instead" % pf,
+                              UsageWarning)
+            entries.append(('file', f, pf))
+            files.append(pf)
+    return entries
+
+
+def _hash_listing(entries, file_hashes):
+    h = hashlib.sha1()
+    h.update(b'dir\n')
+    for kind, f, value in entries:
+        if kind == 'link':
+            value = hashlib.sha1(value).hexdigest()
+        elif kind == 'dir':
+            value = _hash_listing(value, file_hashes)
+        else:
+            value = file_hashes[value]
+        h.update('%s %s %s\n' % (kind, f, value))
+    return h.hexdigest()
+
+
 def hash_path(path):
+    """Hashes a file or directory, giving the same digest as file_archive.
+
+    The files are hashed through the shared FileHasher, so a directory's
+    files are read in parallel and the unchanged ones are not read at all.
+    """
+    file_hasher = get_file_hasher()
     if os.path.isdir(path):
-        return hash_directory(path)
+        files = []
+        entries = _list_directory(path, os.path.realpath(path), set(), files)
+        file_hashes = file_hasher.hash_files(files, 'file_archive')
+        return _hash_listing(entries, file_hashes)
     else:
-        with open(path, 'rb') as fp:
-            return hash_file(fp)
+        return file_hasher.hash_file(path, 'file_archive')
 
 
 class PersistedInputPath(Module):
@@ -181,3 +243,52 @@ class PersistedInputDir(PersistedInputPath):
     def check_path_type(self, path):
         if not os.path.isdir(path):
             raise ModuleError(self, "Path is not a directory")
+
+
+class TestHashPath(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp_dir = tempfile.mkdtemp(prefix='vt_hash_path')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, contents):
+        with open(os.path.join(self.tmp_dir, name), 'wb') as f:
+            f.write(contents)
+
+    def test_file(self):
+        """ hash_path() gives file_archive's digest for a file """
+        from file_archive import hash_file
+
+        self.write('data.txt', b'some data\n')
+        fname = os.path.join(self.tmp_dir, 'data.txt')
+        with open(fname, 'rb') as f:
+            self.assertEqual(hash_path(fname), hash_file(f))
+
+    def test_directory(self):
+        """ hash_path() gives file_archive's digest for a directory tree """
+        from file_archive import hash_directory
+
+        os.makedirs(os.path.join(self.tmp_dir, 'root', 'sub', 'deeper'))
+        os.mkdir(os.path.join(self.tmp_dir, 'root', 'empty'))
+        self.write('root/a.txt', b'first file')
+        self.write('root/sub/b.txt', b'second file\n')
+        self.write('root/sub/deeper/c.bin', b'\x00\x01\x02' * 1000)
+        self.write('outside.txt', b'not in the tree')
+        root = os.path.join(self.tmp_dir, 'root')
+        if hasattr(os, 'symlink'):
+            # a link inside the tree is hashed as a link, one to the
+            # outside as its target
+            os.symlink(os.path.join('sub', 'b.txt'),
+                       os.path.join(root, 'link.txt'))
+            os.symlink(os.path.join(self.tmp_dir, 'outside.txt'),
+                       os.path.join(root, 'sub', 'outside.txt'))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UsageWarning)
+            self.assertEqual(hash_path(root), hash_directory(root))
+
+            # changes in nested files are seen
+            self.write('root/sub/deeper/c.bin', b'changed')
+            self.assertEqual(hash_path(root), hash_directory(root))
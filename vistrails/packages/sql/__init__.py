@@ -41,10 +41,14 @@ Uses SQLAlchemy to access a variety of database software.
 
 from __future__ import division
 
+from vistrails.core.configuration import ConfigurationObject
+
 identifier = 'org.vistrails.vistrails.sql'
 name = 'SQL'
 version = '0.1.0'
 old_identifiers = ['edu.utah.sci.vistrails.sql']
+configuration = ConfigurationObject(pool_size=5,
+                                    pool_idle_timeout=300)
 
 def package_dependencies():
     return ['org.vistrails.vistrails.tabledata']
@@ -36,9 +36,14 @@
 
 from __future__ import division
 
+import sqlalchemy
+from sqlalchemy import event
 from sqlalchemy.engine import create_engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import NullPool, QueuePool
+import threading
+import time
 import urllib
 
 from vistrails.core.db.action import create_action
@@ -53,11 +58,105 @@ from vistrails.core.utils import versions_increasing
 from vistrails.packages.tabledata.common import TableObject
 
 
+class EnginePool(object):
+    """Keeps SQLAlchemy engines around so that their connections get reused.
+
+    Engines are keyed on their normalized URL, including the credentials.
+    Each engine keeps up to pool_size idle connections, recycled after
+    idle_timeout seconds; engines that are not used for that long are
+    disposed of. A pool_size of 0 disables pooling entirely.
+
+    Connections held by cached DBConnection modules stay checked out for as
+    long as they are cached, so the pool never limits how many connections
+    are open at once (checking out never blocks), and connections are
+    tested before being handed out, where SQLAlchemy supports it.
+    """
+    def __init__(self):
+        self._engines = {} # key -> [engine, last_used]
+        self._lock = threading.Lock()
+        self.connects = {} # key -> number of database connections opened
+
+    @staticmethod
+    def make_key(url):
+        return (url.drivername, url.username, url.password, url.host,
+                url.port, url.database, tuple(sorted(url.query.iteritems())))
+
+    def get_engine(self, url, pool_size=5, idle_timeout=300, now=None):
+        if now is None:
+            now = time.time()
+        key = self.make_key(url)
+        with self._lock:
+            if idle_timeout > 0:
+                self.expire(now - idle_timeout)
+            entry = self._engines.get(key)
+            if entry is None:
+                engine = self.create_engine(key, url, pool_size, idle_timeout)
+                if pool_size <= 0:
+                    return engine
+                entry = self._engines[key] = [engine, now]
+            entry[1] = now
+            return entry[0]
+
+    def create_engine(self, key, url, pool_size, idle_timeout):
+        kwargs = {}
+        in_memory = url.drivername.startswith('sqlite') and \
+                url.database in (None, '', ':memory:')
+        if pool_size <= 0:
+            kwargs['poolclass'] = NullPool
+        elif not in_memory:
+            # Each connection to an in-memory database is a different
+            # database, keep SQLAlchemy's default pool for these
+            kwargs['poolclass'] = QueuePool
+            kwargs['pool_size'] = pool_size
+            kwargs['max_overflow'] = -1
+            if not versions_increasing(sqlalchemy.__version__, '1.2'):
+                kwargs['pool_pre_ping'] = True
+            if idle_timeout > 0:
+                kwargs['pool_recycle'] = idle_timeout
+            if url.drivername.startswith('sqlite'):
+                # Pooled connections can be checked out from other threads
+                kwargs['connect_args'] = {'check_same_thread': False}
+        engine = create_engine(url, **kwargs)
+
+        def on_connect(dbapi_connection, connection_record):
+            self.connects[key] = self.connects.get(key, 0) + 1
+        event.listen(engine, 'connect', on_connect)
+        return engine
+
+    def expire(self, before):
+        """Disposes of the engines that were last used before a given time.
+        """
+        for key, (engine, last_used) in self._engines.items():
+            if last_used < before:
+                engine.dispose()
+                del self._engines[key]
+
+    def clear(self):
+        with self._lock:
+            for engine, last_used in self._engines.itervalues():
+                engine.dispose()
+            self._engines.clear()
+            self.connects.clear()
+
+
+_engine_pool = EnginePool()
+
+
+def get_engine(url):
+    return _engine_pool.get_engine(url,
+                                   configuration.pool_size,
+                                   configuration.pool_idle_timeout)
+
+
 class DBConnection(Module):
     """Connects to a database.
 
     If the URI you enter uses a driver which is not currently installed,
     VisTrails will try to set it up.
+
+    Engines are kept between executions, so that the connections to the
+    database get reused (see the package's pool_size and pool_idle_timeout
+    configuration options).
     """
     _input_ports = [('protocol', '(basic:String)'),
                     ('user', '(basic:String)',
@@ -80,7 +179,7 @@ class DBConnection(Module):
                   database=self.get_input('db_name'))
 
         try:
-            engine = create_engine(url)
+            engine = get_engine(url)
         except ImportError, e:
             driver = url.drivername
             installed = False
@@ -122,7 +221,7 @@ class DBConnection(Module):
                 raise ModuleError(self,
                                   "Failed to install required driver")
             try:
-                engine = create_engine(url)
+                engine = get_engine(url)
             except Exception, e:
                 raise ModuleError(self,
                                   "Couldn't connect to the database: %s" %
@@ -138,14 +237,93 @@ class DBConnection(Module):
         self.set_output('connection', engine.connect())
 
 
+class QueryResultCache(object):
+    """Keeps the results of queries in memory for a limited time.
+
+    Entries are keyed on the connection URL, the query and its bound inputs,
+    so that identical queries from different pipelines share results. At
+    most max_entries results are kept; the least recently used ones are
+    dropped first.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = {} # key -> [expiration, last_used, keys, rows]
+
+    @staticmethod
+    def make_key(url, query, inputs):
+        return (str(url), query, repr(sorted(inputs.iteritems())))
+
+    def get(self, key, now=None):
+        """Returns (keys, rows) for a query, or None if it is not cached.
+        """
+        if now is None:
+            now = time.time()
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            return None
+        entry[1] = now
+        return entry[2], entry[3]
+
+    def put(self, key, keys, rows, ttl, now=None):
+        if now is None:
+            now = time.time()
+        self._entries[key] = [now + ttl, now, keys, rows]
+        while len(self._entries) > self.max_entries:
+            lru = min(self._entries, key=lambda k: self._entries[k][1])
+            del self._entries[lru]
+
+    def clear(self):
+        self._entries.clear()
+
+
+_result_cache = QueryResultCache()
+
+
+def table_from_rows(rows, keys):
+    """Builds a table from result rows, one column at a time.
+    """
+    if rows:
+        columns = [list(column) for column in zip(*rows)]
+    else:
+        columns = [[] for key in keys]
+    return TableObject(columns, len(rows), list(keys))
+
+
 class SQLSource(Module):
+    """Runs a query on a database.
+
+    The query is given in 'source', and can reference the module's other
+    input ports as bound parameters (e.g. ':name').
+
+    Setting 'cacheTTL' keeps the results in memory for this many seconds;
+    running the same query with the same inputs on the same database during
+    that time reuses them instead of querying the database again.
+
+    Setting 'batchSize' switches to streaming mode: the rows are fetched in
+    batches of that size, using a server-side cursor if the database
+    supports it, and each batch is streamed as a table on 'resultStream'.
+    'result' and 'resultSet' are not set in that mode.
+    """
     _settings = ModuleSettings(configure_widget=
             'vistrails.packages.sql.widgets:SQLSourceConfigurationWidget')
     _input_ports = [('connection', '(DBConnection)'),
                     ('cacheResults', '(basic:Boolean)'),
+                    ('cacheTTL', '(basic:Float)',
+                     {'optional': True}),
+                    ('batchSize', '(basic:Integer)',
+                     {'optional': True}),
                     ('source', '(basic:String)')]
     _output_ports = [('result', '(org.vistrails.vistrails.tabledata:Table)'),
-                     ('resultSet', '(basic:List)')]
+                     ('resultSet', '(basic:List)'),
+                     ('resultStream',
+                      '(org.vistrails.vistrails.tabledata:Table)',
+                      {'depth': 1})]
+
+    _control_ports = ('source', 'connection', 'cacheResults', 'cacheTTL',
+                      'batchSize')
 
     def is_cacheable(self):
         return False
@@ -157,9 +335,33 @@ class SQLSource(Module):
             self.is_cacheable = lambda: cached
         connection = self.get_input('connection')
         inputs = dict((k, self.get_input(k)) for k in self.inputPorts.iterkeys()
-                  if k not in ('source', 'connection', 'cacheResults'))
+                  if k not in self._control_ports)
         s = urllib.unquote(str(self.get_input('source')))
 
+        if self.has_input('batchSize'):
+            batch_size = self.get_input('batchSize')
+            if batch_size <= 0:
+                raise ModuleError(self, "batchSize should be positive")
+            connection, close = self.check_out(connection)
+            self.set_streaming_output('resultStream',
+                                      self.stream_results(connection, s,
+                                                          inputs, batch_size,
+                                                          close))
+            return
+
+        ttl = self.force_get_input('cacheTTL', 0)
+        cache_key = None
+        if ttl > 0:
+            cache_key = QueryResultCache.make_key(connection.engine.url,
+                                                  s, inputs)
+            entry = _result_cache.get(cache_key)
+            if entry is not None:
+                keys, rows = entry
+                self.set_output('result', table_from_rows(rows, keys))
+                self.set_output('resultSet', list(rows))
+                return
+
+        connection, close = self.check_out(connection)
         try:
             transaction = connection.begin()
             results = connection.execute(s, inputs)
@@ -172,12 +374,64 @@ class SQLSource(Module):
                 # results.returns_rows is True
                 # We don't use 'if return_rows' because this attribute didn't
                 # use to exist
-                table = TableObject.from_dicts(rows, results.keys())
-                self.set_output('result', table)
+                keys = results.keys()
+                self.set_output('result', table_from_rows(rows, keys))
                 self.set_output('resultSet', rows)
+                if cache_key is not None:
+                    # downstream modules might change the output list
+                    _result_cache.put(cache_key, keys, list(rows), ttl)
             transaction.commit()
         except SQLAlchemyError, e:
             raise ModuleError(self, debug.format_exception(e))
+        finally:
+            if close:
+                connection.close()
+
+    @staticmethod
+    def check_out(connection):
+        """Returns a usable connection, and whether it should be closed.
+
+        The query runs on a connection checked out of the engine's pool
+        rather than on the one held by the DBConnection module, which might
+        have been closed by another module or dropped by the server since
+        it was cached. It is given back to the pool by closing it after
+        use. In-memory SQLite databases only exist on their one connection,
+        which is used directly.
+        """
+        url = connection.engine.url
+        if connection.closed or not (
+                url.drivername.startswith('sqlite') and
+                url.database in (None, '', ':memory:')):
+            return connection.engine.connect(), True
+        else:
+            return connection, False
+
+    def stream_results(self, connection, query, inputs, batch_size,
+                       close=False):
+        """Runs a query and yields its result as tables of batch_size rows.
+        """
+        try:
+            transaction = connection.begin()
+            try:
+                results = connection.execution_options(
+                        stream_results=True).execute(query, inputs)
+                keys = results.keys()
+                while True:
+                    rows = results.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield table_from_rows(rows, keys)
+                results.close()
+            except Exception:
+                transaction.rollback()
+                raise
+            else:
+                transaction.commit()
+        except SQLAlchemyError, e:
+            raise ModuleError(self, debug.format_exception(e))
+        finally:
+            if close:
+                connection.close()
 
 
 _modules = [DBConnection, SQLSource]
@@ -333,3 +587,184 @@ class TestSQL(unittest.TestCase):
                 os.remove(test_db)
             except OSError:
                 pass # Oops, we are leaking the file here...
+
+    def test_result_cache(self):
+        """Tests expiration and eviction in QueryResultCache.
+        """
+        cache = QueryResultCache(max_entries=2)
+        key1 = QueryResultCache.make_key('sqlite:///a', 'SELECT 1',
+                                         {'b': 2, 'a': 1})
+        self.assertEqual(key1,
+                         QueryResultCache.make_key('sqlite:///a', 'SELECT 1',
+                                                   {'a': 1, 'b': 2}))
+        cache.put(key1, ['a'], [(1,)], 10, now=100)
+        self.assertEqual(cache.get(key1, now=105), (['a'], [(1,)]))
+        self.assertIsNone(cache.get(key1, now=110))
+
+        cache.put(1, ['a'], [], 10, now=100)
+        cache.put(2, ['a'], [], 10, now=101)
+        cache.get(1, now=102)
+        cache.put(3, ['a'], [], 10, now=103)
+        self.assertIsNotNone(cache.get(1, now=104))
+        self.assertIsNone(cache.get(2, now=104))
+        self.assertIsNotNone(cache.get(3, now=104))
+
+    def test_cache_and_stream(self):
+        """Caches query results and streams them in batches.
+        """
+        import os
+        import sqlite3
+        import tempfile
+        import urllib2
+        from sqlalchemy.engine import create_engine
+        from vistrails.tests.utils import execute, intercept_results
+        identifier = 'org.vistrails.vistrails.sql'
+
+        test_db_fd, test_db = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(test_db_fd)
+        try:
+            conn = sqlite3.connect(test_db)
+            cur = conn.cursor()
+            cur.execute('CREATE TABLE test(name VARCHAR(24), age INTEGER)')
+            cur.executemany('INSERT INTO test(name, age) VALUES(?, ?)',
+                            [('John', 25), ('Lara', 21), ('Bob', 40)])
+            conn.commit()
+
+            source = "SELECT name FROM test WHERE age > :age ORDER BY name"
+
+            def run():
+                with intercept_results(DBConnection, 'connection',
+                                       SQLSource, 'result', 'resultSet') as (
+                                               connection, table, rows):
+                    self.assertFalse(execute([
+                            ('DBConnection', identifier, [
+                                ('protocol', [('String', 'sqlite')]),
+                                ('db_name', [('String', test_db)]),
+                            ]),
+                            ('SQLSource', identifier, [
+                                ('source', [('String',
+                                             urllib2.quote(source))]),
+                                ('age', [('Integer', '22')]),
+                                ('cacheTTL', [('Float', '3600')]),
+                            ]),
+                        ],
+                        [
+                            (0, 'connection', 1, 'connection'),
+                        ],
+                        add_port_specs=[
+                            (1, 'input', 'age',
+                             'org.vistrails.vistrails.basic:Integer'),
+                        ]))
+                connection[0].close()
+                # changing the output doesn't change the cached results
+                rows[0].append(('Zoe',))
+                return table[0].get_column(0)
+
+            _result_cache.clear()
+            self.assertEqual(run(), ['Bob', 'John'])
+            cur.execute("INSERT INTO test(name, age) VALUES('Ann', 30)")
+            conn.commit()
+            # Served from the cache
+            self.assertEqual(run(), ['Bob', 'John'])
+            _result_cache.clear()
+            self.assertEqual(run(), ['Ann', 'Bob', 'John'])
+            conn.close()
+
+            connection = create_engine('sqlite:///%s' % test_db).connect()
+            try:
+                batches = list(SQLSource().stream_results(
+                        connection, source, {'age': 22}, 2))
+            finally:
+                connection.close()
+            self.assertEqual([t.get_column(0) for t in batches],
+                             [['Ann', 'Bob'], ['John']])
+        finally:
+            _result_cache.clear()
+            try:
+                os.remove(test_db)
+            except OSError:
+                pass # Oops, we are leaking the file here...
+
+    def test_engine_pool(self):
+        """Reuses database connections between executions.
+        """
+        import os
+        import sqlite3
+        import tempfile
+        import urllib2
+        from vistrails.tests.utils import execute, intercept_result
+        identifier = 'org.vistrails.vistrails.sql'
+
+        test_db_fd, test_db = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(test_db_fd)
+        try:
+            conn = sqlite3.connect(test_db)
+            conn.execute('CREATE TABLE test(name VARCHAR(24))')
+            conn.execute("INSERT INTO test(name) VALUES('John')")
+            conn.commit()
+            conn.close()
+
+            source = "SELECT name FROM test"
+            _engine_pool.clear()
+            nb_runs = 5
+            for i in xrange(nb_runs):
+                with intercept_result(DBConnection, 'connection') as conns:
+                    self.assertFalse(execute([
+                            ('DBConnection', identifier, [
+                                ('protocol', [('String', 'sqlite')]),
+                                ('db_name', [('String', test_db)]),
+                            ]),
+                            ('SQLSource', identifier, [
+                                ('source', [('String',
+                                             urllib2.quote(source))]),
+                            ]),
+                        ],
+                        [
+                            (0, 'connection', 1, 'connection'),
+                        ]))
+                conns[0].close()
+            key = EnginePool.make_key(URL(drivername='sqlite',
+                                          database=test_db))
+            # The same connections (one for DBConnection, one for the
+            # query) were used for all the runs
+            self.assertEqual(_engine_pool.connects, {key: 2})
+
+            # Connections held by cached modules don't exhaust the pool
+            url = URL(drivername='sqlite', database=test_db)
+            held = [get_engine(url).connect() for i in xrange(20)]
+            try:
+                with intercept_result(SQLSource, 'resultSet') as results:
+                    self.assertFalse(execute([
+                            ('DBConnection', identifier, [
+                                ('protocol', [('String', 'sqlite')]),
+                                ('db_name', [('String', test_db)]),
+                            ]),
+                            ('SQLSource', identifier, [
+                                ('source', [('String',
+                                             urllib2.quote(source))]),
+                            ]),
+                        ],
+                        [
+                            (0, 'connection', 1, 'connection'),
+                        ]))
+                self.assertEqual([tuple(r) for r in results[0]],
+                                 [('John',)])
+            finally:
+                for conn in held:
+                    conn.close()
+
+            # Engines are dropped when idle
+            url = URL(drivername='sqlite', database=test_db)
+            engine = _engine_pool.get_engine(url, 5, 300, now=0)
+            self.assertIs(_engine_pool.get_engine(url, 5, 300, now=200),
+                          engine)
+            self.assertIsNot(_engine_pool.get_engine(url, 5, 300, now=600),
+                             engine)
+            self.assertIsNot(_engine_pool.get_engine(url, 0, 300),
+                             _engine_pool.get_engine(url, 0, 300))
+        finally:
+            _engine_pool.clear()
+            try:
+                os.remove(test_db)
+            except OSError:
+                pass # Oops, we are leaking the file here...
@@ -79,6 +79,40 @@ class InternalModuleError(Exception):
         raise ModuleError(module_obj, self.message)
 
 
+def column_array(values):
+    """Makes a numpy array from a column, inferring its dtype.
+
+    Columns holding only ints, only floats or only booleans get the matching
+    numpy dtype; anything else (strings, mixed types, big integers) is stored
+    in an object array, so that the values are kept as-is.
+    """
+    numpy = get_numpy()
+    if isinstance(values, numpy.ndarray):
+        return values
+    types = set(type(v) for v in values)
+    if types == set([bool]):
+        dtype = numpy.bool_
+    elif types and types <= set([int, long]):
+        dtype = numpy.int64
+    elif types == set([float]):
+        dtype = numpy.float64
+    else:
+        dtype = object
+    if dtype is not object:
+        try:
+            return numpy.array(values, dtype=dtype)
+        except OverflowError:
+            pass
+    array = numpy.empty(len(values), dtype=object)
+    try:
+        array[:] = values
+    except ValueError:
+        # Elements are sequences, which numpy tries to broadcast
+        for i, value in enumerate(values):
+            array[i] = value
+    return array
+
+
 class TableObject(object):
     columns = None # the number of columns in the table
     rows = None # the number of rows in the table
@@ -91,6 +125,7 @@ class TableObject(object):
         self.names = names
 
         self._columns = columns
+        self.column_cache = {}
 
     def get_column(self, i, numeric=False): # pragma: no cover
         """Gets a column from the table as a list or numpy array.
@@ -103,10 +138,24 @@ class TableObject(object):
         """
         numpy = get_numpy(False)
         if numeric and numpy is not None:
-            return numpy.array(self._columns[i], dtype=numpy.float32)
+            if (i, numeric) not in self.column_cache:
+                self.column_cache[(i, numeric)] = numpy.array(
+                        self._columns[i], dtype=numpy.float32)
+            return self.column_cache[(i, numeric)]
         else:
             return self._columns[i]
 
+    def get_array(self, i):
+        """Gets a column from the table as a numpy array.
+
+        The dtype is inferred from the values, see column_array(). Unlike
+        get_column(numeric=True), the values are not converted to float.
+
+        This default implementation builds a new array from get_column();
+        tables that store arrays should override it to return them directly.
+        """
+        return column_array(self.get_column(i))
+
     def get_column_by_name(self, name, numeric=False):
         """Gets a column from its name.
 
@@ -148,12 +197,43 @@ class TableObject(object):
         return cls(columns, count, keys)
 
 
+class ArrayTableObject(TableObject):
+    """A table whose columns are stored as numpy arrays.
+
+    Each column keeps the dtype inferred by column_array(), and get_array()
+    returns it without copying. get_column() converts it once to a list or
+    to a float32 array, and caches the result.
+
+    Subclasses can build their columns lazily by overriding get_array().
+    """
+    def __init__(self, columns, nb_rows, names):
+        TableObject.__init__(self, [column_array(c) for c in columns],
+                             nb_rows, names)
+
+    def get_array(self, i):
+        return self._columns[i]
+
+    def get_column(self, i, numeric=False):
+        if (i, numeric) in self.column_cache:
+            return self.column_cache[(i, numeric)]
+
+        array = self.get_array(i)
+        if numeric:
+            numpy = get_numpy()
+            result = array.astype(numpy.float32, copy=False)
+        else:
+            result = array.tolist()
+        self.column_cache[(i, numeric)] = result
+        return result
+
+
 class Table(Module):
     _input_ports = [('name', '(org.vistrails.vistrails.basic:String)')]
     _output_ports = [('value', 'Table')]
 
     def set_output(self, port_name, value):
-        if self.list_depth == 0 and value is not None and port_name == 'value':
+        if (self.list_depth == 0 and isinstance(value, TableObject) and
+                port_name == 'value'):
             if value.name is None:
                 value.name = self.force_get_input('name', None)
         Module.set_output(self, port_name, value)
@@ -35,11 +35,12 @@
 
 from __future__ import division
 
+import operator
 import re
 
 from vistrails.core.modules.vistrails_module import ModuleError
 
-from .common import get_numpy, TableObject, Table, \
+from .common import get_numpy, TableObject, ArrayTableObject, Table, \
     choose_column, choose_columns
 
 # FIXME use pandas?
@@ -54,7 +55,7 @@ def utf8(obj):
         return bytes(obj)
 
 
-class JoinedTables(TableObject):
+class JoinedTables(ArrayTableObject):
     def __init__(self, left_t, right_t, left_key_col, right_key_col,
                  case_sensitive=False, always_prefix=False):
         self.left_t = left_t
@@ -66,8 +67,9 @@ class JoinedTables(TableObject):
 
         self.build_column_names()
         self.compute_row_map()
+        self._columns = {}
         self.column_cache = {}
-        self.rows = len(self.row_map)
+        self.rows = len(self.left_rows)
 
     def build_column_names(self):
         left_name = self.left_t.name
@@ -97,29 +99,17 @@ class JoinedTables(TableObject):
                       get_col_names(self.right_t, self.left_t, right_name))
         self.columns = len(self.names)
 
-    def get_column(self, index, numeric=False):
-        if (index, numeric) in self.column_cache:
-            return self.column_cache[(index, numeric)]
+    def get_array(self, index):
+        if index in self._columns:
+            return self._columns[index]
 
-        result = []
         if index < self.left_t.columns:
-            column = self.left_t.get_column(index, numeric)
-            for i in xrange(self.left_t.rows):
-                if i in self.row_map:
-                    result.append(column[i])
+            array = self.left_t.get_array(index)[self.left_rows]
         else:
-            column = self.right_t.get_column(index - self.left_t.columns,
-                                             numeric)
-            for i in xrange(self.left_t.rows):
-                if i in self.row_map:
-                    j = self.row_map[i]
-                    result.append(column[j])
-
-        numpy = get_numpy(False)
-        if numeric and numpy is not None:
-            result = numpy.array(result, dtype=numpy.float32)
-        self.column_cache[(index, numeric)] = result
-        return result
+            array = self.right_t.get_array(
+                    index - self.left_t.columns)[self.right_rows]
+        self._columns[index] = array
+        return array
 
     def compute_row_map(self):
         def build_key_dict(table, key_col):
@@ -134,14 +124,20 @@ class JoinedTables(TableObject):
 
         right_keys = build_key_dict(self.right_t, self.right_key_col)
 
-        self.row_map = {}
+        # Matching rows, as arrays of indices in both tables
+        left_rows = []
+        right_rows = []
         for left_row_idx, key in enumerate(
                 self.left_t.get_column(self.left_key_col)):
             key = utf8(key).strip()
             if not self.case_sensitive:
                 key = key.upper()
             if key in right_keys:
-                self.row_map[left_row_idx] = right_keys[key]
+                left_rows.append(left_row_idx)
+                right_rows.append(right_keys[key])
+        numpy = get_numpy()
+        self.left_rows = numpy.array(left_rows, dtype=numpy.intp)
+        self.right_rows = numpy.array(right_rows, dtype=numpy.intp)
 
 
 class JoinTables(Table):
@@ -204,6 +200,9 @@ class ProjectedTable(TableObject):
         mapped_idx = self.col_map[index]
         return self.table.get_column(mapped_idx, numeric)
 
+    def get_array(self, index):
+        return self.table.get_array(self.col_map[index])
+
     @property
     def rows(self):
         return self.table.rows
@@ -270,29 +269,38 @@ class SelectFromTable(Table):
                       'values': "[[], ['==', '!=', '<', '>', '<=', '>='], []]"})]
     _output_ports = [('value', Table)]
 
-    @staticmethod
-    def make_condition(comparand, comparer):
+    _comparers = {'==': operator.eq,
+                  '!=': operator.ne,
+                  '<': operator.lt,
+                  '>': operator.gt,
+                  '<=': operator.le,
+                  '>=': operator.ge}
+
+    @classmethod
+    def make_mask(cls, table, idx, comparand, comparer):
+        """Evaluates the condition on a column, as a boolean array.
+        """
+        numpy = get_numpy()
+        if comparer == '=~':
+            search = re.compile(comparand).search
+            column = table.get_array(idx)
+            return numpy.fromiter((search(v) is not None for v in column),
+                                  dtype=numpy.bool_, count=len(column))
+        try:
+            op = cls._comparers[comparer]
+        except KeyError:
+            raise ValueError("Invalid comparison operator %r" % comparer)
         if isinstance(comparand, float):
-            with_cast = lambda f: lambda v: f(float(v))
-        else:
-            with_cast = lambda f: f
-        if comparer == '==':
-            return with_cast(lambda v: v == comparand)
-        elif comparer == '!=':
-            return with_cast(lambda v: v != comparand)
-        elif comparer == '<':
-            return with_cast(lambda v: v < comparand)
-        elif comparer == '>':
-            return with_cast(lambda v: v > comparand)
-        elif comparer == '<=':
-            return with_cast(lambda v: v <= comparand)
-        elif comparer == '>=':
-            return with_cast(lambda v: v >= comparand)
-        elif comparer == '=~':
-            regex = re.compile(comparand)
-            return regex.search
+            column = numpy.asarray(table.get_column(idx, True),
+                                   dtype=numpy.float64)
         else:
-            raise ValueError("Invalid comparison operator %r" % comparer)
+            column = table.get_array(idx).astype(object, copy=False)
+        mask = numpy.asarray(op(column, comparand), dtype=numpy.bool_)
+        if mask.shape != column.shape:
+            # The comparison wasn't done element-wise
+            mask = numpy.array([op(v, comparand) for v in column],
+                               dtype=numpy.bool_)
+        return mask
 
     def compute(self):
         table = self.get_input('table')
@@ -317,21 +325,48 @@ class SelectFromTable(Table):
                                   "No column %d, table only has %d columns" % (
                                   idx, table.columns))
 
-        condition = self.make_condition(comparand, comparer)
-        numeric = isinstance(comparand, float)
-        column = table.get_column(idx, numeric)
-        matched_rows = [i
-                        for i, col_val in enumerate(column)
-                        if condition(col_val)]
-        columns = []
-        for col in xrange(table.columns):
-            column = table.get_column(col)
-            columns.append([column[row] for row in matched_rows])
-        selected_table = TableObject(columns, len(matched_rows), table.names)
+        try:
+            mask = self.make_mask(table, idx, comparand, comparer)
+        except ValueError, e:
+            raise ModuleError(self, e.message)
+        columns = [table.get_array(col)[mask]
+                   for col in xrange(table.columns)]
+        selected_table = ArrayTableObject(columns, int(mask.sum()),
+                                          table.names)
         self.set_output('value', selected_table)
 
 
-class AggregatedTable(TableObject):
+def group_rows(keys):
+    """Groups the rows that have equal keys.
+
+    Returns the index of the first row of each group, and the group of each
+    row. Groups are numbered in order of first appearance.
+    """
+    numpy = get_numpy()
+    try:
+        _, first, inverse = numpy.unique(keys,
+                                         return_index=True,
+                                         return_inverse=True)
+    except TypeError:
+        # Keys can't be sorted, use a dict
+        groups = {}
+        first = []
+        inverse = numpy.empty(len(keys), dtype=numpy.intp)
+        for i, key in enumerate(keys):
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = len(first)
+                first.append(i)
+            inverse[i] = group
+        return numpy.array(first, dtype=numpy.intp), inverse
+    # numpy.unique() numbers the groups in sorted order
+    order = numpy.argsort(first)
+    rank = numpy.empty_like(order)
+    rank[order] = numpy.arange(len(order))
+    return first[order], rank[inverse]
+
+
+class AggregatedTable(ArrayTableObject):
     def __init__(self, table, op, col, group_col):
         self.table = table
         self.op = op
@@ -341,44 +376,50 @@ class AggregatedTable(TableObject):
         self.build_map()
 
     def build_map(self):
-        agg_map = {}
-        for i, val in enumerate(self.table.get_column(self.group_col)):
-            if val in agg_map:
-                agg_map[val].append(i)
-            else:
-                agg_map[val] = [i]
-        self.agg_rows = [(min(rows), rows) for rows in agg_map.itervalues()]
-        self.agg_rows.sort()
-        self.rows = len(self.agg_rows)
+        numpy = get_numpy()
+        first_rows, groups = group_rows(self.table.get_array(self.group_col))
+        self.rows = len(first_rows)
         self.columns = 2
         if self.table.names is not None:
             self.names = [self.table.names[self.group_col],
                           self.table.names[self.col]]
 
-    def get_column(self, index, numeric=False):
-        def average(value_iter):
-            # value_iter can only be used once
-            sum = 0
-            count = 0
-            for count, v in enumerate(value_iter):
-                sum += v
-            return sum / (count+1)
-        op_map = {'sum': sum,
-                  'average': average,
-                  'min': min,
-                  'max': max}
-        if index == 0:
-            col = self.table.get_column(self.group_col, numeric)
-            return [col[x[0]] for x in self.agg_rows]
-        else:
-            if self.op == 'count':
-                return [len(x[1]) for x in self.agg_rows]
-            elif self.op in op_map:
-                col = self.table.get_column(self.col, True)
-                return [op_map[self.op](col[idx] for idx in x[1])
-                        for x in self.agg_rows]
+        counts = numpy.bincount(groups, minlength=self.rows)
+        if self.op == 'count':
+            values = counts
+        elif self.op in ('sum', 'average', 'min', 'max'):
+            column = numpy.asarray(self.table.get_column(self.col, True),
+                                   dtype=numpy.float64)
+            if self.op in ('sum', 'average'):
+                values = numpy.bincount(groups, weights=column,
+                                        minlength=self.rows)
+                if self.op == 'average':
+                    values /= counts
+            elif self.rows == 0:
+                values = column
             else:
-                raise ValueError('Unknown operation: "%s"' % self.op)
+                # Sort the values by group, and reduce each slice
+                order = numpy.argsort(groups, kind='mergesort')
+                starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+                reduce_f = {'min': numpy.minimum,
+                            'max': numpy.maximum}[self.op]
+                values = reduce_f.reduceat(column[order], starts)
+        else:
+            raise ValueError('Unknown operation: "%s"' % self.op)
+
+        self._columns = [self.table.get_array(self.group_col)[first_rows],
+                         values]
+        self.column_cache = {}
+
+    def get_column(self, index, numeric=False):
+        # This table has always returned lists, even for numeric=True
+        if (index, numeric) not in self.column_cache:
+            array = self.get_array(index)
+            if numeric:
+                numpy = get_numpy()
+                array = array.astype(numpy.float64, copy=False)
+            self.column_cache[(index, numeric)] = array.tolist()
+        return self.column_cache[(index, numeric)]
 
 
 class AggregateColumn(Table):
@@ -408,7 +449,10 @@ class AggregateColumn(Table):
                                name=group_by_name,
                                index=group_by_index)
 
-        res_table = AggregatedTable(table, op, col_idx, gb_idx)
+        try:
+            res_table = AggregatedTable(table, op, col_idx, gb_idx)
+        except ValueError, e:
+            raise ModuleError(self, e.message)
         self.set_output('value', res_table)
 
 _modules = [JoinTables, ProjectTable, SelectFromTable, AggregateColumn]
@@ -734,3 +778,55 @@ class TestAggregate(unittest.TestCase):
                                    ('group_by_index', [('Integer', '2')])])
         self.assertEqual(table.get_column(0, False), ['T', 'F'])
         self.assertEqual(table.get_column(1, True), [-7, 21])
+
+    def test_aggregate_max(self):
+        table = self.do_aggregate([('op', [('String', 'max')]),
+                                   ('column_index', [('Integer', '3')]),
+                                   ('group_by_index', [('Integer', '1')])])
+        self.assertEqual(table.get_column(0, False), ['a', 'b', 'd', 'e'])
+        self.assertEqual(table.get_column(1, True), [100, 23, 41, 21])
+
+    def test_aggregate_count(self):
+        table = self.do_aggregate([('op', [('String', 'count')]),
+                                   ('column_index', [('Integer', '0')]),
+                                   ('group_by_index', [('Integer', '2')])])
+        self.assertEqual(table.get_column(0, False), ['T', 'F'])
+        self.assertEqual(table.get_column(1, False), [3, 4])
+
+
+class TestArrayTable(unittest.TestCase):
+    def test_dtypes(self):
+        """Tests that column types are inferred and values kept as-is.
+        """
+        import numpy
+
+        table = ArrayTableObject([[1, 2, 3],
+                                  [1.5, 2.5, 3.5],
+                                  ['a', 'b', 'c'],
+                                  [1, 'b', 3.5]],
+                                 3, ['ints', 'floats', 'strs', 'mixed'])
+        self.assertEqual(table.get_array(0).dtype, numpy.int64)
+        self.assertEqual(table.get_array(1).dtype, numpy.float64)
+        self.assertEqual(table.get_array(2).dtype, object)
+        self.assertEqual(table.get_array(3).dtype, object)
+        self.assertEqual(table.get_column(3), [1, 'b', 3.5])
+        self.assertIs(table.get_array(1), table.get_array(1))
+        self.assertIs(table.get_column(0, True), table.get_column(0, True))
+        self.assertEqual(list(table.get_column(0, True)), [1.0, 2.0, 3.0])
+
+    def test_select_join(self):
+        """Selects and joins array tables.
+        """
+        left = ArrayTableObject([[1, 2, 3, 4], ['a', 'b', 'c', 'd']],
+                                4, ['id', 'letter'])
+        right = ArrayTableObject([['4', '2', '7'], [40.0, 20.0, 70.0]],
+                                 3, ['id', 'value'])
+        mask = SelectFromTable.make_mask(left, 0, 2.0, '>=')
+        self.assertEqual(list(mask), [False, True, True, True])
+        mask = SelectFromTable.make_mask(left, 1, 'c', '!=')
+        self.assertEqual(list(mask), [True, True, False, True])
+
+        joined = JoinedTables(left, right, 0, 0)
+        self.assertEqual(joined.rows, 2)
+        self.assertEqual(joined.get_column(1), ['b', 'd'])
+        self.assertEqual(joined.get_column(3), [20.0, 40.0])
@@ -36,23 +36,50 @@
 from __future__ import division
 
 import csv
-import operator
+from itertools import islice, izip
 
-from ..common import get_numpy, TableObject, Table, InternalModuleError
+from vistrails.core.modules.vistrails_module import ModuleError
 
+from ..common import get_numpy, TableObject, ArrayTableObject, Table, \
+    InternalModuleError
 
-def count_lines(fp):
+
+def count_lines(fp, chunk_size=1 << 20):
     lines = 0
-    for line in fp:
+    last = None
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        lines += chunk.count('\n')
+        last = chunk[-1]
+    if last is not None and last != '\n':
         lines += 1
     return lines
 
 
-# FIXME : test coverage for CSVTable
+_column_types = {'str': None,
+                 'int': int,
+                 'float': float}
+
+
 class CSVTable(TableObject):
+    """A table read from a CSV file.
+
+    The file is parsed in a single pass the first time a column is needed,
+    filling all the columns at once. iter_chunks() can also be used to read
+    it as a sequence of smaller tables, without loading the whole file.
+
+    column_types is an optional list of types ('str', 'int' or 'float', or
+    None to keep the strings) that are used to convert the columns while
+    reading them.
+    """
     def __init__(self, csv_file, header_present, delimiter,
-                 skip_lines=0, dialect=None, use_sniffer=True):
+                 skip_lines=0, dialect=None, use_sniffer=True,
+                 column_types=None):
         self._rows = None
+        self._data = None
+        self._short_rows = {} # column index -> (line, fields) of a short row
 
         self.header_present = header_present
         self.delimiter = delimiter
@@ -67,6 +94,17 @@ class CSVTable(TableObject):
         if self.header_present:
             self.skip_lines += 1
 
+        self.converters = [None] * self.columns
+        for i, type_name in enumerate(column_types or []):
+            if i >= self.columns:
+                break
+            if type_name:
+                try:
+                    self.converters[i] = _column_types[type_name]
+                except KeyError:
+                    raise InternalModuleError("Unknown column type %r" %
+                                              type_name)
+
         self.column_cache = {}
 
     @staticmethod
@@ -121,41 +159,86 @@ class CSVTable(TableObject):
 
         return column_count, column_names, delimiter, header_present, dialect
 
+    def iter_row_chunks(self, chunk_size):
+        """Parses the file, yielding lists of columns of up to chunk_size rows.
+        """
+        with open(self.filename, 'rb') as fp:
+            for i in xrange(self.skip_lines):
+                line = fp.readline()
+                if not line:
+                    raise ValueError("skip_lines greater than the number "
+                                     "of lines in the file")
+            if self.dialect is not None:
+                reader = csv.reader(fp, dialect=self.dialect)
+            else:
+                reader = csv.reader(fp, delimiter=self.delimiter)
+
+            nb_columns = self.columns
+            rownb = 0
+            while True:
+                rows = list(islice(reader, chunk_size))
+                if not rows:
+                    break
+                for row in rows:
+                    rownb += 1
+                    if len(row) < nb_columns:
+                        for i in xrange(len(row), nb_columns):
+                            self._short_rows.setdefault(i, (rownb, len(row)))
+                        row.extend([None] * (nb_columns - len(row)))
+                columns = zip(*rows)[:nb_columns]
+                yield [list(column) if converter is None
+                       else self.convert(column, converter)
+                       for column, converter in izip(columns,
+                                                     self.converters)]
+
+    @staticmethod
+    def convert(column, converter):
+        try:
+            return [None if v is None else converter(v) for v in column]
+        except ValueError, e:
+            raise ValueError("Invalid CSV file: %s" % e)
+
+    def iter_chunks(self, chunk_size):
+        """Reads the file as a sequence of tables of up to chunk_size rows.
+        """
+        self._short_rows = {}
+        for columns in self.iter_row_chunks(chunk_size):
+            for i in xrange(self.columns):
+                if i in self._short_rows:
+                    self._raise_short_row(i)
+            yield ArrayTableObject(columns, len(columns[0]), self.names)
+
+    def read_all(self, chunk_size=65536):
+        """Parses the whole file into all the columns.
+        """
+        self._short_rows = {}
+        data = [[] for i in xrange(self.columns)]
+        for columns in self.iter_row_chunks(chunk_size):
+            for column, values in izip(data, columns):
+                column.extend(values)
+        self._data = data
+        self._rows = len(data[0]) if data else 0
+
+    def _raise_short_row(self, index):
+        rownb, nb_fields = self._short_rows[index]
+        raise ValueError("Invalid CSV file: only %d fields on line %d "
+                         "(column %d requested)" % (nb_fields, rownb, index))
+
     def get_column(self, index, numeric=False):
         if (index, numeric) in self.column_cache:
             return self.column_cache[(index, numeric)]
 
-        numpy = get_numpy(False)
-
-        if numeric and numpy is not None:
-            result = numpy.loadtxt(
-                    self.filename,
-                    dtype=numpy.float32,
-                    delimiter=self.delimiter,
-                    skiprows=self.skip_lines,
-                    usecols=[index])
-        else:
-            with open(self.filename, 'rb') as fp:
-                for i in xrange(self.skip_lines):
-                    line = fp.readline()
-                    if not line:
-                        raise ValueError("skip_lines greater than the number "
-                                         "of lines in the file")
-                if self.dialect is not None:
-                    reader = csv.reader(fp, dialect=self.dialect)
-                else:
-                    reader = csv.reader(fp, delimiter=self.delimiter)
-
-                getter = operator.itemgetter(index)
-                try:
-                    result = []
-                    for rownb, row in enumerate(reader, 1):
-                        result.append(getter(row))
-                except IndexError:
-                    raise ValueError("Invalid CSV file: only %d fields on "
-                                     "line %d (column %d requested)" % (
-                                         len(row), rownb, index))
-            if numeric:
+        if self._data is None:
+            self.read_all()
+        if index in self._short_rows:
+            self._raise_short_row(index)
+        result = self._data[index]
+
+        if numeric:
+            numpy = get_numpy(False)
+            if numpy is not None:
+                result = numpy.array(result, dtype=numpy.float32)
+            else:
                 result = [float(e) for e in result]
 
         self.column_cache[(index, numeric)] = result
@@ -178,6 +261,9 @@ class CSVFile(Table):
     able to guess the actual format of the file in most cases, or you can use
     the 'delimiter', 'header_present' and 'skip_lines' ports to force how the
     file will be read.
+
+    'column_types' can be set to a list of types ('str', 'int' or 'float')
+    to convert the columns while the file is read.
     """
     _input_ports = [
             ('file', '(org.vistrails.vistrails.basic:File)'),
@@ -190,32 +276,68 @@ class CSVFile(Table):
             ('skip_lines', '(org.vistrails.vistrails.basic:Integer)',
              {'optional': True, 'defaults': "['0']"}),
             ('dialect', '(org.vistrails.vistrails.basic:String)',
+             {'optional': True}),
+            ('column_types', '(org.vistrails.vistrails.basic:List)',
              {'optional': True})]
     _output_ports = [
             ('column_count', '(org.vistrails.vistrails.basic:Integer)'),
             ('column_names', '(org.vistrails.vistrails.basic:List)'),
             ('value', Table)]
 
-    def compute(self):
+    def open_table(self):
         csv_file = self.get_input('file').name
         header_present = self.force_get_input('header_present', None)
         delimiter = self.force_get_input('delimiter', None)
         skip_lines = self.get_input('skip_lines')
         dialect = self.force_get_input('dialect', None)
         sniff_header = self.get_input('sniff_header')
+        column_types = self.force_get_input('column_types', None)
 
         try:
-            table = CSVTable(csv_file, header_present, delimiter, skip_lines,
-                             dialect, sniff_header)
+            return CSVTable(csv_file, header_present, delimiter, skip_lines,
+                            dialect, sniff_header, column_types)
         except InternalModuleError, e:
             e.raise_module_error(self)
 
+    def compute(self):
+        table = self.open_table()
+
         self.set_output('column_count', table.columns)
         self.set_output('column_names', table.names)
         self.set_output('value', table)
 
 
-_modules = [CSVFile]
+class CSVFileChunks(CSVFile):
+    """Reads a CSV file as a stream of tables.
+
+    This reads the file like CSVFile, but streams it as consecutive tables
+    of 'chunk_size' rows, so that downstream modules can process it without
+    loading it whole in memory.
+    """
+    _input_ports = [
+            ('chunk_size', '(org.vistrails.vistrails.basic:Integer)',
+             {'optional': True, 'defaults': "['10000']"})]
+    _output_ports = [
+            ('value', Table, {'depth': 1})]
+
+    def compute(self):
+        table = self.open_table()
+        chunk_size = self.get_input('chunk_size')
+        if chunk_size <= 0:
+            raise ModuleError(self, "chunk_size should be positive")
+
+        self.set_output('column_count', table.columns)
+        self.set_output('column_names', table.names)
+        name = self.force_get_input('name', None)
+
+        def chunks():
+            for chunk in table.iter_chunks(chunk_size):
+                chunk.name = name
+                yield chunk
+        self.set_streaming_output('value', chunks())
+
+
+_modules = [CSVFile, CSVFileChunks]
 
 
 ###############################################################################
@@ -321,6 +443,65 @@ class CSVTestCase(unittest.TestCase):
                          ['col moutarde', '4', 'not a number', '7'])
 
 
+    def test_csv_types(self):
+        """Reads a CSV file with column types.
+        """
+        table = CSVTable(self._test_dir + '/test.csv', True, ';',
+                         column_types=['int', 'float'])
+        self.assertEqual(table.rows, 3)
+        self.assertEqual(table.get_column(0), [-1, 2, 6])
+        self.assertEqual(table.get_column(1), [2.0, 3.0, 14.5])
+        self.assertEqual(table.get_column(2), ['4', 'not a number', '7'])
+        self.assertRaises(InternalModuleError, CSVTable,
+                          self._test_dir + '/test.csv', True, ';',
+                          column_types=['complex'])
+
+    def test_csv_short_rows(self):
+        """Reads a CSV file with missing fields.
+        """
+        import os
+        import tempfile
+        fd, filename = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        try:
+            with open(filename, 'wb') as fp:
+                fp.write('a;b;c\n1;2;3\n4;5\n6;7;8\n')
+            table = CSVTable(filename, True, ';')
+            self.assertEqual(table.get_column(1), ['2', '5', '7'])
+            with self.assertRaises(ValueError) as cm:
+                table.get_column(2)
+            self.assertIn("only 2 fields on line 2", cm.exception.message)
+        finally:
+            os.remove(filename)
+
+    def test_csv_chunks(self):
+        """Reads a CSV file in chunks.
+        """
+        table = CSVTable(self._test_dir + '/test.csv', True, ';',
+                         column_types=[None, 'float'])
+        chunks = list(table.iter_chunks(2))
+        self.assertEqual([chunk.rows for chunk in chunks], [2, 1])
+        self.assertEqual(chunks[0].names, ['col 1', 'col 2', 'col moutarde'])
+        self.assertEqual(chunks[0].get_column(0), ['-1', '2'])
+        self.assertEqual(list(chunks[1].get_column(1, True)), [14.5])
+
+        with intercept_result(CSVFileChunks, 'column_count') as columns:
+            self.assertFalse(execute([
+                    ('read|CSVFileChunks', identifier, [
+                        ('file', [('File', self._test_dir + '/test.csv')]),
+                        ('chunk_size', [('Integer', '2')]),
+                    ]),
+                    ('ExtractColumn', identifier, [
+                        ('column_index', [('Integer', '1')]),
+                        ('numeric', [('Boolean', 'True')]),
+                    ]),
+                ],
+                [
+                    (0, 'value', 1, 'table'),
+                ]))
+        self.assertEqual(columns, [3])
+
+
 class TestCountlines(unittest.TestCase):
     def test_countlines(self):
         # Simple
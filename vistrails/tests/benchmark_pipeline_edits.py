@@ -0,0 +1,159 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Times bulk edits on a pipeline that keeps its signatures and validation
+up to date.
+
+A chain of Float modules, each with a parameter, is added in a single action
+and validated; then a batch of parameter changes is applied in a single
+action and the pipeline validated again. Run it with:
+
+    python -m vistrails.tests.benchmark_pipeline_edits [size [changes]]
+"""
+
+from __future__ import division
+
+import random
+import sys
+import time
+
+
+def chain_action(size):
+    """Returns an action adding a chain of `size` Float modules.
+    """
+    from vistrails.core.db.action import create_action
+    from vistrails.core.modules.module_registry import get_module_registry
+    from vistrails.core.system import get_vistrails_basic_pkg_id
+    from vistrails.core.vistrail.connection import Connection
+    from vistrails.core.vistrail.module import Module
+    from vistrails.core.vistrail.module_function import ModuleFunction
+    from vistrails.core.vistrail.module_param import ModuleParam
+    from vistrails.core.vistrail.port import Port
+
+    basic_pkg = get_vistrails_basic_pkg_id()
+    version = get_module_registry().get_package_by_name(basic_pkg).version
+    sig = '(%s:Float)' % basic_pkg
+    ops = []
+    for i in xrange(size):
+        function = ModuleFunction(id=i, pos=0, name='value', parameters=[
+                ModuleParam(id=i, pos=0, type='Float', val='%d.0' % i)])
+        ops.append(('add', Module(id=i, name='Float', package=basic_pkg,
+                                  version=version, functions=[function])))
+    for i in xrange(size - 1):
+        ops.append(('add', Connection(id=i, ports=[
+                Port(id=2*i, type='source', moduleId=i, moduleName='Float',
+                     name='value', signature=sig),
+                Port(id=2*i+1, type='destination', moduleId=i+1,
+                     moduleName='Float', name='value', signature=sig)])))
+    return create_action(ops)
+
+
+def changes_action(pipeline, changes, seed=0):
+    """Returns an action changing the parameters of `changes` random
+    modules.
+    """
+    from vistrails.core.db.action import create_action
+    from vistrails.core.vistrail.module_param import ModuleParam
+
+    rng = random.Random(seed)
+    next_id = max(p.real_id
+                  for m in pipeline.modules.itervalues()
+                  for f in m.functions
+                  for p in f.params) + 1
+    ops = []
+    for i, module_id in enumerate(rng.sample(sorted(pipeline.modules),
+                                             changes)):
+        function = pipeline.modules[module_id].functions[0]
+        old_param = function.params[0]
+        new_param = ModuleParam(id=next_id + i, pos=old_param.pos,
+                                name=old_param.name, type=old_param.type,
+                                val='%d.5' % module_id)
+        ops.append(('change', old_param, new_param,
+                    function.vtType, function.real_id))
+    return create_action(ops)
+
+
+def benchmark(size, changes):
+    """Returns (time to build and validate, time to change and validate).
+    """
+    from vistrails.core.vistrail.pipeline import Pipeline
+
+    pipeline = Pipeline()
+    pipeline.validate()
+    pipeline.compute_signatures()
+    action = chain_action(size)
+    start = time.time()
+    pipeline.perform_action(action)
+    pipeline.validate()
+    build_time = time.time() - start
+    pipeline.compute_signatures()
+
+    action = changes_action(pipeline, changes)
+    start = time.time()
+    pipeline.perform_action(action)
+    pipeline.validate()
+    change_time = time.time() - start
+    return build_time, change_time
+
+
+def main(args):
+    import vistrails.core.api
+
+    sizes = [int(args[0])] if args else [1000, 2000]
+    changes = int(args[1]) if len(args) > 1 else 500
+    vistrails.core.api.initialize()
+    print "%8s %8s %14s %14s" % ("modules", "changes", "build+validate",
+                                 "edit+validate")
+    for size in sizes:
+        build_time, change_time = benchmark(size, changes)
+        print "%8d %8d %13.3fs %13.3fs" % (size, changes, build_time,
+                                           change_time)
+
+
+###############################################################################
+
+import unittest
+
+
+class TestPipelineEditsBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        build_time, change_time = benchmark(50, 20)
+        self.assertGreater(build_time, 0)
+        self.assertGreater(change_time, 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,162 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Compares the throughput of a stream produced one element at a time with
+the same stream produced in batches, consumed either one element at a time
+or by a BatchStreaming module.
+
+The modules are driven directly, the way the interpreter runs the streams,
+so that the timings measure the streaming machinery rather than the
+pipeline setup. Run it with:
+
+    python -m vistrails.tests.benchmark_streaming [size [batch_size ...]]
+"""
+
+from __future__ import division
+
+import sys
+import time
+
+from vistrails.core.modules.basic_modules import Generator
+from vistrails.core.modules.vistrails_module import BatchStreaming, Module
+
+
+class Double(Module):
+    def compute(self):
+        self.set_output('value', self.get_input('value') * 2)
+
+
+class BatchDouble(BatchStreaming, Module):
+    def compute(self):
+        self.set_output('value', [v * 2 for v in self.get_input('value')])
+
+
+def source(size, batch_size=None):
+    if batch_size:
+        return ([float(j) for j in xrange(i, min(i + batch_size, size))]
+                for i in xrange(0, size, batch_size))
+    else:
+        return (float(i) for i in xrange(size))
+
+
+def run_stream(size, batch_size=None, batch_consumer=False):
+    """Streams `size` floats through a module doubling them.
+
+    Returns the time it took and the results.
+    """
+    generators, Generator.generators = Generator.generators, []
+    try:
+        producer = Module()
+        producer.set_streaming_output('value', source(size, batch_size),
+                                      size, batched=bool(batch_size))
+        stream = producer.get_output('value')
+
+        if batch_consumer:
+            consumer = BatchDouble()
+            consumer.streamed_ports = {'value': stream}
+        else:
+            consumer = Double()
+            consumer.list_depth = 1
+            consumer.iterated_ports = [('value', 1, stream)]
+        consumer.signature = '0' * 40
+        consumer.set_output('value', None)
+        consumer.build_stream()
+        output = consumer.get_output('value')
+
+        results = []
+        start = time.time()
+        while True:
+            for m in Generator.generators:
+                m.generator.next()
+            values = output.next_batch()
+            if values is None:
+                break
+            results.extend(values)
+        return time.time() - start, results
+    finally:
+        Generator.generators = generators
+
+
+def benchmark(size, batch_sizes):
+    """Returns a list of (batch_size, batch_consumer, elements per second).
+    """
+    timings = []
+    runs = [(None, False)]
+    for batch_size in batch_sizes:
+        runs.append((batch_size, False))
+        runs.append((batch_size, True))
+    for batch_size, batch_consumer in runs:
+        elapsed, results = run_stream(size, batch_size, batch_consumer)
+        assert len(results) == size
+        timings.append((batch_size, batch_consumer, size / elapsed))
+    return timings
+
+
+def main(args):
+    import vistrails.core.api
+
+    size = int(args[0]) if args else 100000
+    batch_sizes = [int(a) for a in args[1:]] or [100, 1000, 10000]
+    vistrails.core.api.initialize()
+    print "%-10s %-10s %16s" % ("producer", "consumer", "elements/s")
+    for batch_size, batch_consumer, rate in benchmark(size, batch_sizes):
+        print "%-10s %-10s %16.0f" % (batch_size or "elements",
+                                      "batches" if batch_consumer
+                                      else "elements",
+                                      rate)
+
+
+###############################################################################
+
+import unittest
+
+
+class TestStreamingBenchmark(unittest.TestCase):
+    def test_same_results(self):
+        """Element and batched streams give the same results.
+        """
+        expected = [i * 2.0 for i in xrange(25)]
+        self.assertEqual(run_stream(25)[1], expected)
+        self.assertEqual(run_stream(25, 10)[1], expected)
+        self.assertEqual(run_stream(25, 10, True)[1], expected)
+
+    def test_benchmark(self):
+        for batch_size, batch_consumer, rate in benchmark(100, [10]):
+            self.assertGreater(rate, 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,239 @@
+###############################################################################
+##
+## Copyright (C) 2014-2016, New York University.
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah.
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice,
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright
+##    notice, this list of conditions and the following disclaimer in the
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the New York University nor the names of its
+##    contributors may be used to endorse or promote products derived from
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+
+"""Measures visual queries over synthetic vistrails of increasing size.
+
+Each vistrail grows a tree of String modules, one module and one connection
+per version, branching from random earlier versions. The query is a chain of
+String modules. For every size, this reports the time the former heuristic
+matching and SubgraphMatcher spend on the pipelines of all versions, and the
+time of a complete VisualQuery.run(). Run it with:
+
+    python -m vistrails.tests.benchmark_visual_query [size ...]
+"""
+
+from __future__ import division
+
+import random
+import sys
+import time
+
+from vistrails.core.utils import append_to_dict_of_lists
+
+
+def build_vistrail(size, seed=0):
+    """Returns a controller on a vistrail with about 'size' versions.
+    """
+    from vistrails.core.modules.basic_modules import identifier as basic_pkg
+    from vistrails.core.vistrail.controller import VistrailController
+    from vistrails.core.vistrail.vistrail import Vistrail
+
+    rng = random.Random(seed)
+    controller = VistrailController(Vistrail(), auto_save=False)
+    controller.change_selected_version(0)
+    module = controller.add_module(basic_pkg, 'String')
+    heads = [(controller.current_version, [module.id])]
+    while len(controller.vistrail.actionMap) < size:
+        version, module_ids = rng.choice(heads[-3:])
+        controller.change_selected_version(version)
+        module = controller.add_module(basic_pkg, 'String')
+        controller.add_connection(rng.choice(module_ids), 'value',
+                                  module.id, 'value')
+        heads.append((controller.current_version, module_ids + [module.id]))
+    return controller
+
+
+def build_query(length):
+    from vistrails.core.modules.basic_modules import identifier as basic_pkg
+    from vistrails.core.vistrail.controller import VistrailController
+    from vistrails.core.vistrail.vistrail import Vistrail
+
+    controller = VistrailController(Vistrail(), auto_save=False)
+    controller.change_selected_version(0)
+    previous = None
+    for i in xrange(length):
+        module = controller.add_module(basic_pkg, 'String')
+        if previous is not None:
+            controller.add_connection(previous.id, 'value',
+                                      module.id, 'value')
+        previous = module
+    return controller.current_pipeline
+
+
+def heuristic_dag_isomorphism(query, target, template, target_ids,
+                              template_ids):
+    """Walks down template and target from the given modules, one level at
+    a time, collecting the target modules with matching names.
+
+    """
+    resultIds = set()
+    while 1:
+        templateNames = set((i, template.modules[i].name)
+                            for i in template_ids)
+        targetNames = {}
+        for i in target_ids:
+            append_to_dict_of_lists(targetNames, target.modules[i].name, i)
+
+        nextTargetIds = set()
+        nextTemplateIds = set()
+
+        for (i, templateName) in templateNames:
+            if templateName not in targetNames:
+                return (False, resultIds)
+            else:
+                templateModule = template.modules[i]
+                matched = [tId
+                           for tId in targetNames[templateName]
+                           if query.matchQueryModule(target.modules[tId],
+                                                     templateModule)]
+                resultIds.update(matched)
+                for matchedTargetId in matched:
+                    nextTargetIds.update([moduleId for
+                                          (moduleId, edgeId) in
+                                          target.graph.edges_from(
+                                              matchedTargetId)])
+                nextTemplateIds.update([moduleId for
+                                        (moduleId, edgeId) in
+                                        template.graph.edges_from(i)])
+
+        if not len(nextTemplateIds):
+            return (True, resultIds)
+
+        target_ids = nextTargetIds
+        template_ids = nextTemplateIds
+
+
+def heuristic_match(query, p):
+    """heuristic_match(query: VisualQuery, p: Pipeline) -> set
+    Returns the modules of p matched by heuristic_dag_isomorphism(), from
+    every source of the query. This is how VisualQuery matched pipelines
+    before SubgraphMatcher; it is only kept here for comparison.
+
+    """
+    matches = set()
+    queryModuleNameIndex = {}
+    for moduleId, module in p.modules.iteritems():
+        append_to_dict_of_lists(queryModuleNameIndex, module.name, moduleId)
+    for querySourceId in query.queryPipeline.graph.sources():
+        querySourceName = query.queryPipeline.modules[querySourceId].name
+        if not queryModuleNameIndex.has_key(querySourceName):
+            # need to reset matches here!
+            matches = set()
+            continue
+        candidates = queryModuleNameIndex[querySourceName]
+        atLeastOneMatch = False
+        for candidateSourceId in candidates:
+            querySource = query.queryPipeline.modules[querySourceId]
+            candidateSource = p.modules[candidateSourceId]
+            if not query.matchQueryModule(candidateSource, querySource):
+                continue
+            (match, targetIds) = heuristic_dag_isomorphism(
+                    query, target=p, template=query.queryPipeline,
+                    target_ids=[candidateSourceId],
+                    template_ids=[querySourceId])
+            if match:
+                atLeastOneMatch = True
+                matches.update(targetIds)
+
+        # We always perform AND operation
+        if not atLeastOneMatch:
+            matches = set()
+            break
+
+    return matches
+
+
+def benchmark(size, query_length=3):
+    """Returns (versions, modules, heuristic time, matcher time, run time,
+    number of matched versions).
+
+    """
+    from vistrails.core.query.subgraph import PipelineGraphIndex, \
+        SubgraphMatcher
+    from vistrails.core.query.visual import VisualQuery
+
+    controller = build_vistrail(size)
+    versions = set(controller.vistrail.actionMap) - set([0])
+    pipelines = [controller.vistrail.getPipeline(version)
+                 for version in versions]
+    modules = sum(len(p.modules) for p in pipelines) / len(pipelines)
+    query = VisualQuery(build_query(query_length), versions)
+
+    start = time.time()
+    for pipeline in pipelines:
+        heuristic_match(query, pipeline)
+    heuristic_time = time.time() - start
+
+    start = time.time()
+    matcher = SubgraphMatcher(query.queryPipeline, query.matchQueryModule)
+    for pipeline in pipelines:
+        matcher.matched_modules(PipelineGraphIndex(pipeline))
+    matcher_time = time.time() - start
+
+    start = time.time()
+    result = query.run(controller, '')
+    run_time = time.time() - start
+    matched = len(set(version for version, module_id in result))
+    return (len(versions), modules, heuristic_time, matcher_time, run_time,
+            matched)
+
+
+def main(args):
+    import vistrails.core.api
+
+    sizes = [int(a) for a in args] or [50, 100, 200, 400]
+    vistrails.core.api.initialize()
+    print "%8s %8s %12s %12s %12s %8s" % ("versions", "modules", "heuristic",
+                                          "subgraph", "query run",
+                                          "matched")
+    for size in sizes:
+        print "%8d %8.1f %11.3fs %11.3fs %11.3fs %8d" % benchmark(size)
+
+
+###############################################################################
+
+import unittest
+
+
+class TestVisualQueryBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        versions, modules, heuristic, matcher, run, matched = benchmark(20)
+        self.assertGreaterEqual(versions, 20)
+        self.assertGreater(matched, 0)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])